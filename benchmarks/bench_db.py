@@ -0,0 +1,129 @@
+"""
+Benchmarks the hot database queries of Nephos with a fresh connection per call, as
+DBHandler.connect used to do, against the persistent per-thread connections.
+
+Run from the repository root:
+    python -m benchmarks.bench_db
+"""
+import os
+import sqlite3
+import tempfile
+import time
+from contextlib import contextmanager
+from unittest import mock
+
+from nephos.manage_db import DBHandler
+
+
+CHANNELS = 200
+ROUNDS = 2000
+HOT_QUERIES = {
+    # recorder, _is_up before every recording
+    "is_up": ("SELECT * FROM channels WHERE ip=?", lambda i: ("{}:1234".format(i), )),
+    # preprocessor, _assemble_tags for every processed file
+    "task_info": ("SELECT * FROM tasks WHERE orig_path = ?", lambda i: (str(i), )),
+    "channel_info": ("SELECT * FROM channels WHERE name = ?", lambda i: ("ch" + str(i), )),
+    # maintenance, _check_ip for every channel
+    "channel_status": ('UPDATE channels SET status = "up" WHERE ip = ?',
+                       lambda i: ("{}:1234".format(i), )),
+}
+
+
+def per_call_connect(db_path):
+    """
+    Returns
+    -------
+    type: callable
+    context manager behaving like the former DBHandler.connect
+
+    """
+    @contextmanager
+    def connect():
+        conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        yield conn.cursor()
+        conn.commit()
+        conn.close()
+    return connect
+
+
+def populate(db_path):
+    """
+    Creates the tables in a new database and fills channels and tasks.
+
+    Parameters
+    ----------
+    db_path
+        type: str
+        path to the database to be created
+
+    Returns
+    -------
+
+    """
+    with mock.patch('nephos.manage_db.DB_PATH', new=db_path):
+        DBHandler().first_time()
+        with DBHandler.connect() as db_cur:
+            for index in range(CHANNELS):
+                db_cur.execute("INSERT INTO channels (name, ip, timezone) VALUES (?, ?, ?)",
+                               ("ch" + str(index), "{}:1234".format(index), "utc"))
+                db_cur.execute("INSERT INTO tasks (orig_path, ch_name) VALUES (?, ?)",
+                               (str(index), "ch" + str(index)))
+        DBHandler.close()
+
+
+def run(connect):
+    """
+    Runs every hot query ROUNDS times through the given connect.
+
+    Parameters
+    ----------
+    connect
+        type: callable
+        context manager providing a database cursor
+
+    Returns
+    -------
+    type: dict
+    operations per second of each query
+
+    """
+    results = {}
+    for name, (query, params) in HOT_QUERIES.items():
+        start = time.perf_counter()
+        for index in range(ROUNDS):
+            with connect() as db_cur:
+                db_cur.execute(query, params(index % CHANNELS))
+                db_cur.fetchall()
+        results[name] = ROUNDS / (time.perf_counter() - start)
+    return results
+
+
+def main():
+    """
+    Runs the benchmark and prints a table of the results.
+
+    Returns
+    -------
+
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        before_path = os.path.join(temp_dir, "before.db")
+        after_path = os.path.join(temp_dir, "after.db")
+        populate(before_path)
+        populate(after_path)
+        # the former connection used the default rollback journal
+        sqlite3.connect(before_path).execute("PRAGMA journal_mode=DELETE").close()
+
+        before = run(per_call_connect(before_path))
+        with mock.patch('nephos.manage_db.DB_PATH', new=after_path):
+            after = run(DBHandler.connect)
+            DBHandler.close()
+
+    print("{:<16}{:>14}{:>14}{:>10}".format("query", "before ops/s", "after ops/s", "speedup"))
+    for name in HOT_QUERIES:
+        print("{:<16}{:>14.0f}{:>14.0f}{:>9.1f}x".format(name, before[name], after[name],
+                                                         after[name] / before[name]))
+
+
+if __name__ == '__main__':
+    main()
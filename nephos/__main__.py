@@ -9,6 +9,8 @@ import click
 
 from . import __nephos_dir__
 from .nephos import Nephos
+from .recorder.timeshift import cut_clip
+from .uploader.throttle import display_throughput
 from .ver_info import VER_INFO
 
 
@@ -65,6 +67,8 @@ def runtime_help():
     "add share", "adsh"\t\t\tadd a new share entity with tags
     "list share", "lssh"\t\tlists present share entities in database
     "list tasks", "lstk"\t\tlists the recordings queue for processing and uploading
+    "upload rate", "uprt"\t\tshows the current upload rate and limit of every destination
+    "cut clip", "clip"\t\t\tsaves the last minutes of a channel from its time-shift buffer
     "remove task", "rmtk"\t\tremove a task from queue using it's ID from 'lstk' 
 
     For more details, see the docs present in $HOME/Nephos
@@ -132,7 +136,9 @@ def start():
         ("list channels", "lsch"): client.channel_handler.display_channel,
         ("add share", "adsh"): client.share_handler.add_share_entity,
         ("list share", "lssh"): client.share_handler.display_shr_entities,
-        ("list tasks", "lstk"): client.preprocessor.display_tasks
+        ("list tasks", "lstk"): client.preprocessor.display_tasks,
+        ("upload rate", "uprt"): display_throughput,
+        ("cut clip", "clip"): cut_clip
         # ("remove task", "rmtk"): client.preprocessor.rm_task
         # ("adtk", "add task"): client.preprocessor.add_task
     }
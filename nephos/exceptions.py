@@ -10,10 +10,10 @@ from .mail_notifier import add_to_report
 
 LOG = getLogger(__name__)
 UNSET_PROCESSING_COMMAND = """UPDATE tasks
-                            SET status = "not processed"
+                            SET status = "not processed", worker_id = NULL, lease_expiry = NULL
                             WHERE orig_path = ?"""
 UNSET_UPLOADING_COMMAND = """UPDATE tasks
-                            SET status = "processed"
+                            SET status = "processed", worker_id = NULL, lease_expiry = NULL
                             WHERE store_path = ?"""
 REMOVE_ENTRY = """DELETE
             FROM tasks
@@ -108,7 +108,6 @@ class UploadingFailed(Exception):
     Handles failure of uploading and reverts the status back to processed.
     """
     def __init__(self, store_path, db_cur):
-        # TODO: this is not working
         db_cur.execute(UNSET_UPLOADING_COMMAND, (store_path, ))
         super(UploadingFailed, self).__init__()
 
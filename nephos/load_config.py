@@ -3,6 +3,8 @@ Contains class which facilitates loading configurations files and implements the
 """
 
 import os
+import threading
+from copy import deepcopy
 import logging
 from logging import getLogger
 import logging.config
@@ -11,11 +13,15 @@ import yaml.error
 import pydash
 
 from . import __nephos_dir__, __config_dir__, __default_config_dir__
+from .manage_db import set_db_config
 from .recorder import set_recorder_config
 from .uploader import set_uploader_config
 
 
 LOG = getLogger(__name__)
+# parsed YAML files, keyed by path, with the stat signature they were parsed at
+_CACHE = {}
+_CACHE_LOCK = threading.Lock()
 
 
 class Config:
@@ -26,19 +32,25 @@ class Config:
     maintenance_config = None
     modules_config = None
 
-    def load_config(self):
+    def load_config(self, reload=False):
         """
         Loads configurations from /config/ (Path relative to __nephos_dir__)
 
+        Parameters
+        ----------
+        reload
+            type: bool
+            True to parse the files again even if they are unchanged since last loaded
+
         Returns
         -------
 
         """
 
         # loading configuration
-        self.logging_config = self.load_data("logging.yaml", True)
-        self.maintenance_config = self.load_data("maintenance.yaml", True)
-        self.modules_config = self.load_data("modules.yaml", True)
+        self.logging_config = self.load_data("logging.yaml", True, reload)
+        self.maintenance_config = self.load_data("maintenance.yaml", True, reload)
+        self.modules_config = self.load_data("modules.yaml", True, reload)
 
         # updating configuration as needed with manual data / environment variables
         config_update = list(self._config_update())
@@ -64,18 +76,20 @@ class Config:
         -------
 
         """
+        set_db_config(self.modules_config.get('database'))
         set_recorder_config(self.modules_config['recording'])
         # set_preprocessor_config(self.modules_config['preprocess'])
         set_uploader_config(self.modules_config['upload'])
         LOG.info('Modules configured')
 
     @staticmethod
-    def load_data(file_name, is_config):
+    def load_data(file_name, is_config, reload=False):
         """
         Loads data from YAML configuration
 
         Using PyYAML's safe_load method, read more at
         https://security.openstack.org/guidelines/dg_avoid-dangerous-input-parsing-libraries.html
+        Parsed files are cached until their mtime, inode or size changes.
 
         Parameters
         ----------
@@ -85,6 +99,9 @@ class Config:
         is_config
             type: bool
             if file is config, default loads.
+        reload
+            type: bool
+            True to parse the file again even if it is unchanged since last loaded
 
         Returns
         -------
@@ -102,9 +119,7 @@ class Config:
 
         try:
             try:
-                with open(path, 'r') as config_file:
-                    yaml_data = config_file.read()
-                    return yaml.safe_load(yaml_data)
+                return _load_yaml(path, reload)
             except IOError as err:
                 print("Failed to open", path)
                 LOG.debug(err)
@@ -115,12 +130,36 @@ class Config:
             print(exception)
             if is_config:
                 print("using default configuration for {file}".format(file=path))
-                with open(default_path) as config_file:
-                    yaml_data = config_file.read()
-                    return yaml.safe_load(yaml_data)
+                return _load_yaml(default_path, reload)
             else:
                 return False
 
+    @staticmethod
+    def invalidate_cache(file_name=None, is_config=True):
+        """
+        Drops parsed files from the cache, so that they are read again on the next load.
+
+        Parameters
+        ----------
+        file_name
+            type: str
+            name of the config file, else full path for data files; None for all files
+        is_config
+            type: bool
+            if file is config
+
+        Returns
+        -------
+
+        """
+        with _CACHE_LOCK:
+            if file_name is None:
+                _CACHE.clear()
+                return
+            path = os.path.join(__config_dir__, file_name) if is_config else file_name
+            for cached_path in (path, os.path.join(__default_config_dir__, file_name)):
+                _CACHE.pop(cached_path, None)
+
     def _correct_log_file_path(self, handler_name):
         """
         Appends relative file path specified for the handler's file in filename to __nephos_dir__
@@ -184,6 +223,45 @@ class Config:
         return config_list
 
 
+def _load_yaml(path, reload=False):
+    """
+    Parses a YAML file, reusing the previous result while the file is unchanged.
+
+    Parameters
+    ----------
+    path
+        type: str
+        path of the YAML file
+    reload
+        type: bool
+        True to parse the file even if it is cached
+
+    Returns
+    -------
+    type: dict
+    copy of the parsed data, safe to be modified by the caller
+
+    Raises
+    ------
+    IOError
+        when the file cannot be read
+    yaml.error.YAMLError
+        when the file is not valid YAML
+
+    """
+    stat = os.stat(path)
+    signature = (stat.st_mtime_ns, stat.st_ino, stat.st_size)
+    with _CACHE_LOCK:
+        cached = _CACHE.get(path)
+    if reload or cached is None or cached[0] != signature:
+        with open(path, 'r') as config_file:
+            data = yaml.safe_load(config_file.read())
+        cached = (signature, data)
+        with _CACHE_LOCK:
+            _CACHE[path] = cached
+    return deepcopy(cached[1])
+
+
 def get_env_var(name):
     """
     Gets environment variable from the OS
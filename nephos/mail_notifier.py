@@ -46,26 +46,26 @@ def send_mail(msg, msg_type):
         "update_success": "[NEPHOS] Updating Config Successful"
     }
 
-    cmd = 'echo "{msg}" | mail -s "{subject}" {emails}'.format(
-        msg=msg,
-        subject=subject[msg_type],
-        emails=emails
-    )
+    cmd = ["mail", "-s", subject[msg_type]] + list(emails)
 
     try:
-        LOG.debug("running '%s' command", cmd)
+        LOG.debug("running '%s' command", " ".join(cmd))
         record_process = subprocess.Popen(cmd,
-                                          shell=True,
+                                          stdin=subprocess.PIPE,
                                           stdout=subprocess.PIPE,
                                           stderr=subprocess.STDOUT)
-        process_output, _ = record_process.communicate()
+        process_output, _ = record_process.communicate(input=msg.encode())
         LOG.debug(process_output)
-        return True
-    except subprocess.CalledProcessError as err:
+    except OSError as err:  # mail is not installed
         LOG.warning("Sending notification mail failed!")
         LOG.debug(err)
         return False
 
+    if record_process.returncode:
+        LOG.warning("Sending notification mail failed!")
+        return False
+    return True
+
 
 def add_to_report(msg):
     """
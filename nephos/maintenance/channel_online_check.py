@@ -4,15 +4,21 @@ Contains class for the checking of channel, whether online or not
 import os
 from tempfile import TemporaryDirectory
 from logging import getLogger
+from functools import partial
+from multiprocessing.pool import ThreadPool
 
 from .checker import Checker
 from ..manage_db import DBHandler, CH_IP_INDEX, CH_NAME_INDEX, CH_STAT_INDEX
+from ..recorder import get_recorder_config, receiver, registry
 from ..recorder.channels import ChannelHandler
 from ..exceptions import DBException
 
 
 LOG = getLogger(__name__)
 MIN_BYTES = 1024  # 1 KB, recording created in 5 seconds should be larger than this
+PROBE_SECS = 5  # duration of the test recording
+DEFAULT_PARALLELISM = 10
+DEFAULT_PROBE_TIMEOUT = 15  # seconds
 CH_DOWN_COMMAND = """UPDATE channels
                     SET status = "down"
                     WHERE ip = ?"""
@@ -59,8 +65,24 @@ class ChannelOnlineCheck(Checker):
             # create a list of IPs and pass it to recording
             ips = self._extract_ips()
             if ips:  # when ip is not empty
-                for ip_to_check in ips:
-                    self._check_ip(ip_to_check, tmpdir)
+                parallelism = int(self._get_data("channel_online_check", "parallelism") or
+                                  DEFAULT_PARALLELISM)
+                timeout = int(self._get_data("channel_online_check", "probe_timeout") or
+                              DEFAULT_PROBE_TIMEOUT)
+                if self._get_data("channel_online_check", "probe") == "native":
+                    check = partial(self._probe_ip, ifaddr=get_recorder_config()['ifaddr'])
+                else:
+                    check = partial(self._check_ip, path=tmpdir, timeout=timeout)
+                LOG.debug("Probing %d channels, %d at a time", len(ips), parallelism)
+
+                # probes spend their time waiting on the stream, hence threads suffice
+                pool = ThreadPool(max(1, min(parallelism, len(ips))))
+                try:
+                    results = pool.map(check, ips)
+                finally:
+                    pool.close()
+                    pool.join()
+                self._update_status(results)
 
                 self.channel_list = ChannelHandler.grab_ch_list()
                 new_stats = self._channel_stats()
@@ -74,11 +96,10 @@ class ChannelOnlineCheck(Checker):
         LOG.debug("tmp directory removed")
 
     @staticmethod
-    def _check_ip(ip_addr, path):
+    def _check_ip(ip_addr, path, timeout=None):
         """
-        Evaluates whether an IP address is online or offline and updates it's status accordingly
-        in the database; status set to 'down' for unreachable channels and 'up' for healthy
-        channels.
+        Evaluates whether an IP address is online or offline; unreachable channels are
+        to be marked 'down' and healthy channels 'up'.
 
         Parameters
         -------
@@ -88,14 +109,19 @@ class ChannelOnlineCheck(Checker):
         path
             type: dir
             temporary directory to be used for channel checking
+        timeout
+            type: int
+            seconds after which the probe is abandoned and the channel considered down
 
         Returns
         -------
+        type: tuple
+        ip address and True if the channel is down, False otherwise
 
         """
         path = os.path.join(path, "test_{ip}.ts".format(ip=ip_addr))
         is_down = False
-        if ChannelHandler.record_stream(ip_addr, path, 5, test=True):
+        if ChannelHandler.record_stream(ip_addr, path, PROBE_SECS, test=True, timeout=timeout):
             try:
                 if os.stat(path).st_size < MIN_BYTES:
                     is_down = True
@@ -107,17 +133,74 @@ class ChannelOnlineCheck(Checker):
             is_down = True
             LOG.debug("IP:%s check failed", ip_addr)
 
+        return ip_addr, is_down
+
+    @staticmethod
+    def _probe_ip(ip_addr, ifaddr=""):
+        """
+        Evaluates whether an IP address is online by listening to the stream in process,
+        without forking multicat or writing the stream to disk; a recording in progress
+        through the shared receiver lends its traffic to the probe.
+
+        Parameters
+        -------
+        ip_addr
+            type: str
+            ip address of the channel to be checked
+        ifaddr
+            type: str
+            address of the interface to join the multicast group on
+
+        Returns
+        -------
+        type: tuple
+        ip address and True if the channel is down, False otherwise
+
+        """
+        try:
+            result = receiver.probe(ip_addr, PROBE_SECS, ifaddr, enough_bytes=MIN_BYTES)
+        except (OSError, ValueError) as err:
+            LOG.debug("Failed to join the stream of IP:%s; wrong channel address", ip_addr)
+            LOG.debug(err)
+            return ip_addr, True
+
+        if not result.is_receiving:
+            LOG.debug("Channel with ip: %s down, no packets received", ip_addr)
+        elif not result.is_valid:
+            LOG.debug("Channel with ip: %s down, packets received are not MPEG-TS", ip_addr)
+        elif result.valid_bytes < MIN_BYTES:
+            LOG.debug("Channel with ip: %s down, too few packets received", ip_addr)
+        else:
+            return ip_addr, False
+        return ip_addr, True
+
+    @staticmethod
+    def _update_status(results):
+        """
+        Writes the status of all the probed channels in a single transaction.
+
+        Parameters
+        ----------
+        results
+            type: list
+            tuples of ip address and whether the channel is down
+
+        Returns
+        -------
+
+        """
+        down_ips = [(ip_addr, ) for ip_addr, is_down in results if is_down]
+        up_ips = [(ip_addr, ) for ip_addr, is_down in results if not is_down]
         try:
             with DBHandler.connect() as db_cur:
-                if is_down:
-                    db_cur.execute(CH_DOWN_COMMAND, (ip_addr,))
-                    LOG.debug("IP:%s is down", ip_addr)
-                else:
-                    db_cur.execute(CH_UP_COMMAND, (ip_addr,))
-                    LOG.debug("IP:%s is up", ip_addr)
+                db_cur.executemany(CH_DOWN_COMMAND, down_ips)
+                db_cur.executemany(CH_UP_COMMAND, up_ips)
+            LOG.debug("%d channel(s) up, %d channel(s) down", len(up_ips), len(down_ips))
         except DBException as err:
             LOG.warning("Couldn't update channel status")
             LOG.debug(err)
+        finally:
+            registry.refresh()
 
     def _channel_stats(self):
         """
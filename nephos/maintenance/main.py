@@ -143,6 +143,6 @@ Initiate the Maintenance object with it's configuration.
 
     """
     config = Config()
-    config.load_config()
+    config.load_config(reload=True)
     config = config.maintenance_config
     return config
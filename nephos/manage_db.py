@@ -2,6 +2,9 @@
 Manages all the database operations
 """
 import os
+import time
+import threading
+from collections import OrderedDict
 from contextlib import contextmanager
 from logging import getLogger
 import sqlite3
@@ -14,6 +17,11 @@ from . import __nephos_dir__
 LOG = getLogger(__name__)
 DB_PATH = os.path.join(__nephos_dir__, "databases/storage.db")
 DB_JOBS_PATH = os.path.join(__nephos_dir__, "databases/jobs.db")
+CONFIG = None
+DEFAULT_BUSY_TIMEOUT = 30  # seconds to wait for a lock before failing
+CACHED_STATEMENTS = 256  # prepared statements kept per connection
+# every thread keeps its connections open, mapped by database path
+_THREAD_DATA = threading.local()
 
 
 # indexes for channel, tasks and share list
@@ -32,9 +40,104 @@ TSK_SUBLANG_INDEX = 5
 TSK_STAT_INDEX = 6
 TSK_FAIL_INDEX = 7
 TSK_SHR_INDEX = 8
+TSK_WORKER_INDEX = 9
+TSK_LEASE_INDEX = 10
+TSK_PARENT_INDEX = 11
+TSK_SEG_INDEX = 12
+TSK_GAPS_INDEX = 13
+SL_ID_INDEX = 0
 SL_MAIL_INDEX = 1
 SL_TAG_INDEX = 2
 
+# columns added to the tasks table after its first release, in order of addition
+TASK_NEW_COLUMNS = (
+    ("worker_id", "text"),
+    ("lease_expiry", "real"),
+    ("parent_id", "integer"),
+    ("seg_index", "integer"),
+    ("gaps", "text"),
+)
+
+# state machine of a task:
+#   "not processed" -> "processing" -> "processed" -> "uploading" -> (removed)
+# a recording split in segments has a parent task, and a child task per segment:
+#   parent: "recording" -> "segmented" -> "stitching" -> "processed" -> ...
+#   child:  "not processed" -> "processing" -> "segment processed" -> (removed once stitched)
+# a recording transcoded live has nothing to encode, and is in no queue until processed:
+#   "encoded" -> "processed" -> ...
+# each queue maps to the state a task is claimed from and the state it is claimed into
+TASK_QUEUES = {
+    "preprocess": ("not processed", "processing"),
+    "upload": ("processed", "uploading"),
+}
+# statuses of the upload of a task to a sink (destination), see TaskSinks
+SINK_UPLOADED = "uploaded"
+SINK_FAILED = "failed"
+DEFAULT_LEASE_SECS = 600  # 10 minutes, kept alive by heartbeats while the task is worked upon
+CMD_GET_CLAIMABLE = """SELECT *
+                    FROM tasks
+                    WHERE (status = ? OR (status = ? AND lease_expiry < ?)){after}
+                    ORDER BY task_id
+                    LIMIT 1"""
+CMD_CLAIM = """UPDATE tasks
+            SET status = ?, worker_id = ?, lease_expiry = ?
+            WHERE task_id = ? AND (status = ? OR (status = ? AND lease_expiry < ?))"""
+CMD_GET_TASK = """SELECT *
+                FROM tasks
+                WHERE task_id = ?"""
+CMD_HEARTBEAT = """UPDATE tasks
+                SET lease_expiry = ?
+                WHERE task_id = ? AND status = ? AND worker_id = ?"""
+CMD_RELEASE = """UPDATE tasks
+                SET status = ?, worker_id = NULL, lease_expiry = NULL
+                WHERE task_id = ? AND status = ? AND worker_id = ?"""
+CMD_RECOVER = """UPDATE tasks
+                SET status = ?, worker_id = NULL, lease_expiry = NULL
+                WHERE status = ? AND (? OR lease_expiry IS NULL OR lease_expiry < ?)"""
+CMD_GET_SESSION = """SELECT session
+                    FROM upload_sessions
+                    WHERE path = ? AND sink = ?"""
+CMD_SAVE_SESSION = """INSERT OR REPLACE INTO upload_sessions (path, sink, session, updated)
+                    VALUES (?, ?, ?, ?)"""
+CMD_RM_SESSION = """DELETE
+                    FROM upload_sessions
+                    WHERE path = ? AND sink = ?"""
+CMD_SET_SINK_STATUS = """INSERT OR REPLACE INTO task_sinks (task_id, sink, status, updated)
+                    VALUES (?, ?, ?, ?)"""
+CMD_GET_SINKS = """SELECT sink
+                FROM task_sinks
+                WHERE task_id = ? AND status = ?"""
+
+
+def set_db_config(db_config):
+    """
+    sets CONFIG for the module
+
+    Parameters
+    ----------
+    db_config
+        type: dict
+        configuration for the database connections
+
+    Returns
+    -------
+
+    """
+    global CONFIG
+    CONFIG = db_config
+
+
+def get_db_config():
+    """
+    Returns
+    -------
+    type: dict
+    configuration for the database connections
+
+    """
+    global CONFIG
+    return CONFIG
+
 
 class DBHandler:
     """
@@ -80,6 +183,11 @@ class DBHandler:
                                     status text DEFAULT "not processed",
                                     fail_count integer DEFAULT "0",
                                     share_with test,
+                                    worker_id text,
+                                    lease_expiry real,
+                                    parent_id integer,
+                                    seg_index integer,
+                                    gaps text,
                                     FOREIGN KEY (ch_name) REFERENCES channels(name)
                                     );
                         """)
@@ -107,6 +215,46 @@ class DBHandler:
                                     );   
             """)
 
+        self.upgrade()
+
+    def upgrade(self):
+        """
+        Adds the columns introduced in newer versions of Nephos to an existing database,
+        so databases created by an older version keep working.
+
+        Returns
+        -------
+
+        """
+        with self.connect() as db_cur:
+            # resumable upload sessions, kept so an interrupted upload continues where it stopped
+            db_cur.execute("""CREATE TABLE IF NOT EXISTS upload_sessions (
+                                    path text NOT NULL,
+                                    sink text NOT NULL,
+                                    session text NOT NULL,
+                                    updated real,
+                                    PRIMARY KEY (path, sink)
+                                    );
+            """)
+            # outcome of the upload of each task to each sink, the folder of a task is
+            # removed once every sink has it
+            db_cur.execute("""CREATE TABLE IF NOT EXISTS task_sinks (
+                                    task_id integer NOT NULL,
+                                    sink text NOT NULL,
+                                    status text NOT NULL,
+                                    updated real,
+                                    PRIMARY KEY (task_id, sink)
+                                    );
+            """)
+
+            db_cur.execute("PRAGMA table_info(tasks)")
+            present_columns = [column[1] for column in db_cur.fetchall()]
+            for name, col_type in TASK_NEW_COLUMNS:
+                if name not in present_columns:
+                    LOG.info("Adding column %s to tasks table", name)
+                    db_cur.execute("ALTER TABLE tasks ADD COLUMN {name} {col_type}".format(
+                        name=name, col_type=col_type))
+
     @staticmethod
     def insert_data(db_cur, table_name, row_data):
         """
@@ -130,19 +278,119 @@ class DBHandler:
             the channel_id/share_id of the new data
 
         """
-        cols = ', '.join('{}'.format(col) for col in row_data.keys())
-        vals = ', '.join("'{}'".format(col) for col in row_data.values())
         try:
-            command = """INSERT INTO "{table_name}"
-                            ({keys}) 
-                            VALUES ({values})""".format(table_name=table_name, keys=cols,
-                                                        values=vals)
-            db_cur.execute(command)
+            db_cur.execute(DBHandler._insert_command(table_name, row_data.keys()),
+                           tuple(row_data.values()))
             return db_cur.lastrowid
         except Error as err:
             LOG.warning("Insertion failed: %s into %s", row_data, table_name)
             LOG.debug(err)
 
+    @staticmethod
+    def insert_many(db_cur, table_name, rows):
+        """
+        Inserts multiple rows into a table using bound parameters, in the transaction of
+        the cursor.
+
+        Rows with the same columns are inserted together through one executemany. A row
+        which fails, e.g. a duplicate channel, is skipped and the rest of its batch is
+        inserted by another executemany.
+
+        Parameters
+        ----------
+        db_cur
+            cursor to database
+        table_name
+            type: str
+            name of the table to which the data is to be inserted
+        rows
+            type: list
+            list of dicts containing the key-value paired row data to be appended
+
+        Returns
+        -------
+        type: list
+        rows which were inserted
+
+        """
+        batches = OrderedDict()
+        for row in rows:
+            batches.setdefault(tuple(row.keys()), []).append(row)
+
+        inserted = []
+        for columns, batch in batches.items():
+            command = DBHandler._insert_command(table_name, columns)
+            while batch:
+                read = []
+                try:
+                    db_cur.executemany(command, DBHandler._read_rows(batch, columns, read))
+                    inserted.extend(batch)
+                    break
+                except Error as err:
+                    LOG.debug(err)
+                    if not read:  # the statement itself is invalid
+                        LOG.warning("Insertion failed: %s into %s", batch, table_name)
+                        break
+                    # executemany reads one row at a time, so the last row read failed
+                    LOG.warning("Insertion failed: %s into %s", read[-1], table_name)
+                    inserted.extend(read[:-1])
+                    batch = batch[len(read):]
+
+        return inserted
+
+    @staticmethod
+    def _read_rows(batch, columns, read):
+        """
+        Yields the values of the rows of a batch, keeping track of the rows read.
+
+        Parameters
+        ----------
+        batch
+            type: list
+            dicts containing the key-value paired row data
+        columns
+            type: tuple
+            columns of the rows, in the order of the insert command
+        read
+            type: list
+            rows read so far, appended to as they are yielded
+
+        Returns
+        -------
+        type: generator
+        tuples of the values of the rows
+
+        """
+        for row in batch:
+            read.append(row)
+            yield tuple(row[col] for col in columns)
+
+    @staticmethod
+    def _insert_command(table_name, columns):
+        """
+        Parameters
+        ----------
+        table_name
+            type: str
+            name of the table to which the data is to be inserted
+        columns
+            type: iterable
+            names of the columns to be filled
+
+        Returns
+        -------
+        type: str
+        INSERT statement with a bound parameter for every column
+
+        """
+        columns = list(columns)
+        return """INSERT INTO "{table_name}"
+                    ({keys})
+                    VALUES ({values})""".format(
+                        table_name=table_name,
+                        keys=', '.join('"{}"'.format(col) for col in columns),
+                        values=', '.join('?' for _ in columns))
+
     @staticmethod
     def init_jobs_db():
         """
@@ -165,18 +413,425 @@ class DBHandler:
     @contextmanager
     def connect():
         """
-        Instantiates the class with a connection to the main database which stores
-        channels and share lists.
-        Provides cursor to the database connection.
+        Provides cursor to the main database which stores channels, tasks and share lists.
+
+        Every thread keeps a persistent connection which is reused across calls. Changes
+        are committed when the outermost block exits cleanly and rolled back otherwise,
+        while nested blocks share the transaction of the outermost one.
 
         """
         try:
-            conn = sqlite3.connect(DB_PATH, check_same_thread=False, timeout=30)
-            yield conn.cursor()
-            conn.commit()
-            conn.close()
+            conn = DBHandler._get_connection()
         except Error as error:
             LOG.warning("Unable to connect to database!\nPlease look into debugging details.")
             LOG.debug(error)
             # catch this exception only if the error can be ignored.
             raise DBException("Database Operation failed!")
+
+        depth = getattr(_THREAD_DATA, "depth", 0)
+        _THREAD_DATA.depth = depth + 1
+        db_cur = conn.cursor()
+        try:
+            yield db_cur
+            if not depth:
+                conn.commit()
+        except Error as error:
+            if not depth:
+                conn.rollback()
+            LOG.warning("Database operation failed!\nPlease look into debugging details.")
+            LOG.debug(error)
+            raise DBException("Database Operation failed!")
+        except BaseException:
+            if not depth:
+                conn.rollback()
+            raise
+        finally:
+            db_cur.close()
+            _THREAD_DATA.depth = depth
+
+    @staticmethod
+    def _get_connection():
+        """
+        Returns the calling thread's connection to the main database, opening it if needed.
+
+        New connections use write-ahead logging, so readers and the writer don't block each
+        other, with "NORMAL" synchronisation, which is durable enough with WAL and saves
+        an fsync on every commit.
+
+        Returns
+        -------
+        type: sqlite3.Connection
+        persistent connection of the thread
+
+        """
+        connections = getattr(_THREAD_DATA, "connections", None)
+        if connections is None:
+            connections = _THREAD_DATA.connections = {}
+
+        conn = connections.get(DB_PATH)
+        if conn is None:
+            busy_timeout = (get_db_config() or {}).get("busy_timeout", DEFAULT_BUSY_TIMEOUT)
+            conn = sqlite3.connect(DB_PATH, timeout=busy_timeout,
+                                   cached_statements=CACHED_STATEMENTS)
+            try:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+            except Error:
+                conn.close()
+                raise
+            connections[DB_PATH] = conn
+        return conn
+
+    @staticmethod
+    def close():
+        """
+        Closes the connections opened by the calling thread.
+
+        Returns
+        -------
+
+        """
+        connections = getattr(_THREAD_DATA, "connections", {})
+        for conn in connections.values():
+            conn.close()
+        connections.clear()
+
+
+class TaskQueue:
+    """
+    Queue layer over the tasks table.
+
+    Workers claim tasks from a queue ("preprocess" or "upload") which atomically moves the
+    task into its working state along with the worker's id and a lease. The lease is
+    extended by heartbeats while the task is being worked upon; a task whose lease has
+    expired, e.g. due to a crash, can be claimed again by any worker.
+    """
+
+    @staticmethod
+    def worker_id():
+        """
+        Returns
+        -------
+        type: str
+        id unique to the calling thread of this process
+
+        """
+        return "{pid}:{thread}".format(pid=os.getpid(), thread=threading.get_ident())
+
+    @staticmethod
+    def claim_next(kind, worker_id, lease_secs=DEFAULT_LEASE_SECS, after=None):
+        """
+        Claims the oldest available task of the queue for the worker.
+
+        The update only succeeds if the task is still claimable, so when two workers race
+        for the same task, exactly one of them gets it and the other one moves on to the
+        next task.
+
+        Parameters
+        ----------
+        kind
+            type: str
+            queue to claim from, key of TASK_QUEUES
+        worker_id
+            type: str
+            id of the claiming worker
+        lease_secs
+            type: int
+            seconds after which the claim expires unless renewed
+        after
+            type: int
+            id of the task claimed last, only tasks after it are claimed, None for any task
+
+        Returns
+        -------
+        type: tuple
+        row of the claimed task, None if the queue is empty
+
+        """
+        pending, working = TASK_QUEUES[kind]
+        # a bound on the id, unlike a list of ids to skip, stays a single query parameter
+        command = CMD_GET_CLAIMABLE.format(after="" if after is None else " AND task_id > ?")
+        after = () if after is None else (after, )
+        while True:
+            now = time.time()
+            with DBHandler.connect() as db_cur:
+                db_cur.execute(command, (pending, working, now) + after)
+                task = db_cur.fetchone()
+                if task is None:
+                    return None
+                db_cur.execute(CMD_CLAIM, (working, worker_id, now + lease_secs,
+                                           task[TSK_ID_INDEX], pending, working, now))
+                if db_cur.rowcount == 1:
+                    db_cur.execute(CMD_GET_TASK, (task[TSK_ID_INDEX], ))
+                    return db_cur.fetchone()
+            LOG.debug("Task (id = %s) claimed by another worker, retrying", task[TSK_ID_INDEX])
+
+    @staticmethod
+    def heartbeat(kind, task_id, worker_id, lease_secs=DEFAULT_LEASE_SECS):
+        """
+        Extends the lease of a task held by the worker.
+
+        Parameters
+        ----------
+        kind
+            type: str
+            queue the task was claimed from
+        task_id
+            type: int
+            id of the claimed task
+        worker_id
+            type: str
+            id of the worker holding the task
+        lease_secs
+            type: int
+            seconds from now after which the claim expires
+
+        Returns
+        -------
+        type: bool
+        True if the lease was extended, False if the worker no longer holds the task
+
+        """
+        working = TASK_QUEUES[kind][1]
+        with DBHandler.connect() as db_cur:
+            db_cur.execute(CMD_HEARTBEAT, (time.time() + lease_secs, task_id, working,
+                                           worker_id))
+            return db_cur.rowcount == 1
+
+    @staticmethod
+    def release(kind, task_id, worker_id):
+        """
+        Returns a task still held by the worker back to the queue.
+
+        Parameters
+        ----------
+        kind
+            type: str
+            queue the task was claimed from
+        task_id
+            type: int
+            id of the claimed task
+        worker_id
+            type: str
+            id of the worker holding the task
+
+        Returns
+        -------
+        type: bool
+        True if the task was released, False if the worker no longer held it
+
+        """
+        pending, working = TASK_QUEUES[kind]
+        with DBHandler.connect() as db_cur:
+            db_cur.execute(CMD_RELEASE, (pending, task_id, working, worker_id))
+            return db_cur.rowcount == 1
+
+    @staticmethod
+    def recover_stale_tasks(expired_only=True):
+        """
+        Returns tasks stranded in a working state back to their queues.
+
+        Parameters
+        ----------
+        expired_only
+            type: bool
+            if False, every task in a working state is recovered; to be used on startup
+            when no worker of a previous run can still be alive
+
+        Returns
+        -------
+        type: int
+        number of tasks recovered
+
+        """
+        recovered = 0
+        try:
+            with DBHandler.connect() as db_cur:
+                for pending, working in TASK_QUEUES.values():
+                    db_cur.execute(CMD_RECOVER, (pending, working, not expired_only,
+                                                 time.time()))
+                    recovered += db_cur.rowcount
+        except DBException as err:
+            LOG.warning("Failed to recover stale tasks!")
+            LOG.debug(err)
+            return 0
+
+        if recovered:
+            LOG.info("%d stale task(s) returned to their queues", recovered)
+        return recovered
+
+
+class TaskLease:
+    """
+    Context manager keeping the leases of claimed tasks alive through periodic heartbeats.
+    """
+
+    def __init__(self, kind, task_ids, worker_id, lease_secs=DEFAULT_LEASE_SECS):
+        """
+
+        Parameters
+        ----------
+        kind
+            type: str
+            queue the tasks were claimed from
+        task_ids
+            type: list
+            ids of the claimed tasks
+        worker_id
+            type: str
+            id of the worker holding the tasks
+        lease_secs
+            type: int
+            length of each renewed lease, heartbeats are sent thrice per lease
+        """
+        self.kind = kind
+        self.task_ids = list(task_ids)
+        self.worker_id = worker_id
+        self.lease_secs = lease_secs
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._beat, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *_):
+        self._stop.set()
+        self._thread.join()
+
+    def _beat(self):
+        """
+        Sends heartbeats for all the held tasks until stopped.
+
+        Returns
+        -------
+
+        """
+        while not self._stop.wait(self.lease_secs / 3):
+            for task_id in self.task_ids:
+                try:
+                    TaskQueue.heartbeat(self.kind, task_id, self.worker_id, self.lease_secs)
+                except DBException as err:
+                    LOG.debug(err)
+
+
+class UploadSessions:
+    """
+    Resumable upload sessions of the files being uploaded, per sink (destination).
+    """
+
+    @staticmethod
+    def get(path, sink):
+        """
+        Parameters
+        ----------
+        path
+            type: str
+            absolute path of the file being uploaded
+        sink
+            type: str
+            destination the file is uploaded to, eg. "gdrive"
+
+        Returns
+        -------
+        type: str
+        session of the interrupted upload, None if there is none
+
+        """
+        with DBHandler.connect() as db_cur:
+            db_cur.execute(CMD_GET_SESSION, (path, sink))
+            row = db_cur.fetchone()
+        return None if row is None else row[0]
+
+    @staticmethod
+    def save(path, sink, session):
+        """
+        Stores the session of an upload, replacing the previous one of the file.
+
+        Parameters
+        ----------
+        path
+            type: str
+            absolute path of the file being uploaded
+        sink
+            type: str
+            destination the file is uploaded to
+        session
+            type: str
+            session to resume the upload with, eg. a resumable upload URI
+
+        Returns
+        -------
+
+        """
+        with DBHandler.connect() as db_cur:
+            db_cur.execute(CMD_SAVE_SESSION, (path, sink, session, time.time()))
+
+    @staticmethod
+    def remove(path, sink):
+        """
+        Forgets the session of a finished or abandoned upload.
+
+        Parameters
+        ----------
+        path
+            type: str
+            absolute path of the uploaded file
+        sink
+            type: str
+            destination the file was uploaded to
+
+        Returns
+        -------
+
+        """
+        with DBHandler.connect() as db_cur:
+            db_cur.execute(CMD_RM_SESSION, (path, sink))
+
+
+class TaskSinks:
+    """
+    Status of the upload of every task to every sink (destination), so that a task
+    uploaded to only some of the sinks is only uploaded to the others when retried.
+    """
+
+    @staticmethod
+    def set_status(task_id, sink, status):
+        """
+        Parameters
+        ----------
+        task_id
+            type: int
+            id of the uploaded task
+        sink
+            type: str
+            destination the task is uploaded to, eg. "ftp"
+        status
+            type: str
+            SINK_UPLOADED or SINK_FAILED
+
+        Returns
+        -------
+
+        """
+        with DBHandler.connect() as db_cur:
+            db_cur.execute(CMD_SET_SINK_STATUS, (task_id, sink, status, time.time()))
+
+    @staticmethod
+    def uploaded(task_id):
+        """
+        Parameters
+        ----------
+        task_id
+            type: int
+            id of the task
+
+        Returns
+        -------
+        type: set
+        sinks the task has been uploaded to
+
+        """
+        with DBHandler.connect() as db_cur:
+            db_cur.execute(CMD_GET_SINKS, (task_id, SINK_UPLOADED))
+            return {row[0] for row in db_cur.fetchall()}
@@ -6,13 +6,15 @@ from logging import getLogger
 
 from . import first_time, __nephos_dir__
 from .load_config import Config
-from .manage_db import DBHandler
+from .manage_db import DBHandler, TaskQueue
 from .scheduler import Scheduler
 from .recorder.channels import ChannelHandler
 from .recorder.jobs import JobHandler
+from .recorder import timeshift
 from .maintenance.main import Maintenance
 from .maintenance.single_instance import SingleInstance
 from .exceptions import SingleInstanceException
+from .preprocessor import segments
 from .preprocessor.preprocess import PreprocessHandler
 from .preprocessor.share_handler import ShareHandler
 from .uploader.gdrive import GDrive
@@ -52,7 +54,8 @@ class Nephos:
 
         LOG.info("Loading database, scheduler, maintenance modules...")
         self.db_handler = DBHandler()
-        self.scheduler = Scheduler(True)
+        self.db_handler.upgrade()
+        self.scheduler = Scheduler(True, self.config_handler.modules_config.get('scheduler'))
         self.channel_handler = ChannelHandler()
         self.share_handler = ShareHandler()
         self.job_handler = JobHandler(self.scheduler)
@@ -72,10 +75,15 @@ class Nephos:
 
         """
 
+        # no worker of a previous run can be alive, hence all claimed tasks are stale
+        TaskQueue.recover_stale_tasks(expired_only=False)
+        segments.recover()
+        PreprocessHandler.recover_encoded()
         self.scheduler.start()
         self.maintenance_handler.add_maintenance_to_scheduler(self.scheduler)
         self.preprocessor.add_to_scheduler()
         self.uploader.add_to_scheduler()
+        timeshift.add_to_scheduler(self.scheduler)
 
     def load_channels_sharelist(self):
         """
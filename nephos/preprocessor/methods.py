@@ -2,37 +2,36 @@
 Contains all the methods applied in preprocessing
 """
 import os
+import re
 import subprocess
 import json
 from logging import getLogger
 
-from . import get_preprocessor_config
+from . import get_preprocessor_config, pipeline
 from .share_handler import ShareHandler
-from .. import __config_dir__
-from ..manage_db import DBHandler, SL_MAIL_INDEX, SL_TAG_INDEX, \
-    TSK_CHNAME_INDEX, TSK_LANG_INDEX, TSK_SUBLANG_INDEX, CH_COUN_INDEX, \
-    CH_LANG_INDEX, CH_TMZ_INDEX
+from ..manage_db import DBHandler
 from ..exceptions import DBException, ProcessFailedException
 
 
 LOG = getLogger(__name__)
-SET_PROCESSING_COMMAND = """UPDATE tasks
-                    SET status = "processing"
-                    WHERE orig_path = ?"""
 SET_PROCESSED_COMMAND = """UPDATE tasks
-                    SET status = "processed"
+                    SET status = "processed", worker_id = NULL, lease_expiry = NULL
+                    WHERE orig_path = ?"""
+SET_SEGMENT_PROCESSED_COMMAND = """UPDATE tasks
+                    SET status = "segment processed", worker_id = NULL, lease_expiry = NULL
                     WHERE orig_path = ?"""
 SET_SHARE_COMMAND = """UPDATE tasks
                     SET share_with = ?
                     WHERE orig_path = ?"""
-GET_TASK_INFO = """SELECT *
+# tags of a file: its channel name and languages, and the country, timezone and language
+# of its channel
+GET_TAGS = """SELECT tasks.ch_name, tasks.lang, tasks.sub_lang,
+                    channels.country_code, channels.timezone, channels.lang
                 FROM tasks
-                WHERE orig_path = ?"""
-GET_CH_INFO = """SELECT *
-                FROM channels
-                WHERE name = ?"""
-PATH_TO_PROCESSING_SCRIPT = os.path.join(__config_dir__, "processing.sh")
+                LEFT JOIN channels ON channels.name = tasks.ch_name
+                WHERE tasks.orig_path = ?"""
 MIN_BYTES = 1024  # 1KB
+RECORDING_TIME_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2}_\d{4}$")  # appended by the recorder
 
 
 class ApplyProcessMethods:
@@ -41,10 +40,10 @@ class ApplyProcessMethods:
     eventually updating the database.
     """
 
-    def __init__(self, path_to_file, store_path):
+    def __init__(self, path_to_file, store_path, encoded=False, segment=False):
         """
-        Loads the file to be processed, modifies status to "processing" and calls
-        apply_methods on it.
+        Loads the file to be processed and calls apply_methods on it.
+        The task must already have been claimed, i.e. its status set to "processing".
 
         Parameters
         ----------
@@ -54,18 +53,21 @@ class ApplyProcessMethods:
         store_path
             type: str
             path to directory to store the files, post-processing
+        encoded
+            type: bool
+            True if the recording was transcoded live into store_path, skipping encoding
+        segment
+            type: bool
+            True if the file is a segment of a recording, which is shared and uploaded
+            only once all its segments are stitched together
 
         """
         self.addr = path_to_file
         self.name = self._get_name()
         self.store_dir = store_path
-        try:
-            with DBHandler.connect() as db_cur:
-                db_cur.execute(SET_PROCESSING_COMMAND, (self.addr, ))
-            self._apply_methods()
-        except DBException as error:
-            LOG.warning("Couldn't connect to database for %s", path_to_file)
-            LOG.debug(error)
+        self.encoded = encoded
+        self.segment = segment
+        self._apply_methods()
 
     def _apply_methods(self):
         """
@@ -77,15 +79,18 @@ class ApplyProcessMethods:
         """
         try:
             os.makedirs(self.store_dir, exist_ok=True)
-            self._execute_processing()
-            self._add_share_entities()
+            if not self.encoded:
+                self._execute_processing()
+            if not self.segment:
+                self._add_share_entities()
             try:
                 os.remove(self.addr)
             except FileNotFoundError as err:
                 LOG.debug(err)
             try:
                 with DBHandler.connect() as db_cur:
-                    db_cur.execute(SET_PROCESSED_COMMAND, (self.addr, ))
+                    db_cur.execute(SET_SEGMENT_PROCESSED_COMMAND if self.segment
+                                   else SET_PROCESSED_COMMAND, (self.addr, ))
             except DBException as err:
                 LOG.debug(err)
 
@@ -94,64 +99,57 @@ class ApplyProcessMethods:
 
     def _execute_processing(self):
         """
-        Executes the script for processing of the recording
+        Applies the encode profile selected for the recording
 
         Raises
         -------
         ProcessFailedException
-            In case of exit code not 0 from command or output file not appropriate
+            In case of a failed step or output file not appropriate
         """
-        failed = False
+        error = None
         out_file_mp4 = os.path.join(self.store_dir, self.name + ".mp4")
-        cmd = '{path_script} "{INPUT}" "{OUT_FILE_WITHOUT_EXTENSION}" "{OUT_FOLDER}"'.format(
-            path_script=PATH_TO_PROCESSING_SCRIPT,
-            INPUT=self.addr,
-            OUT_FILE_WITHOUT_EXTENSION=self.name,
-            OUT_FOLDER=self.store_dir
-        )
+        config = get_preprocessor_config()
         try:
-            LOG.debug("running command: %s", cmd)
-            conversion_process = subprocess.Popen(cmd,
-                                                  shell=True,
-                                                  stdout=subprocess.PIPE,
-                                                  stderr=subprocess.STDOUT)
-            output, _ = conversion_process.communicate()
-            LOG.debug(output)
-        except subprocess.CalledProcessError as err:
-            LOG.debug(err)
+            profile = pipeline.select_profile(config, self._get_channel_name(),
+                                              self._get_job_name())
+            results = pipeline.run_profile(profile, self.addr, self.name, self.store_dir, config)
+            failed_steps = [result for result in results
+                            if result.failed and result.name != "ccextractor"]
+            if failed_steps:
+                error = "step(s) failed: {steps}".format(steps=failed_steps)
+        except ValueError as err:
+            LOG.warning("Invalid encode profile configuration")
             error = err
-            failed = True
 
-        try:
-            if os.stat(out_file_mp4).st_size < MIN_BYTES:
-                failed = True
-        except FileNotFoundError as err:
-            LOG.debug(err)
-            error = err
-            failed = True
+        if error is None:
+            try:
+                if os.stat(out_file_mp4).st_size < MIN_BYTES:
+                    error = "output {file} is smaller than {min_bytes} bytes".format(
+                        file=out_file_mp4, min_bytes=MIN_BYTES)
+            except FileNotFoundError as err:
+                error = err
 
-        if failed:
+        if error is not None:
+            LOG.debug(error)
             try:
+                # the exception reverts the task, raised after the block so that it commits
                 with DBHandler.connect() as db_cur:
-                    raise ProcessFailedException(self.addr, self.store_dir, db_cur, error)
+                    failure = ProcessFailedException(self.addr, self.store_dir, db_cur, error)
             except DBException as err:
                 LOG.debug(err)
+            else:
+                raise failure
 
     def _add_share_entities(self):
         """
-        Appends share entities to the file querying share_list database.
+        Appends share entities to the file, matching its tags against the index of
+        the share list.
 
         Returns
         -------
 
         """
-        valid_entities = []
-        all_entities = ShareHandler.grab_shr_list()
-        tags_for_file = self._assemble_tags()
-
-        for entity in all_entities:
-            if self._tag_match(entity[SL_TAG_INDEX].split(), tags_for_file.split()):
-                valid_entities.append(entity[SL_MAIL_INDEX])
+        valid_entities = ShareHandler.match_emails(self._assemble_tags().split())
         try:
             with DBHandler.connect() as db_cur:
                 db_cur.execute(SET_SHARE_COMMAND, (" ".join(valid_entities), self.addr, ))
@@ -167,57 +165,37 @@ class ApplyProcessMethods:
         str containing multiple tags separated by space
 
         """
-        tags = []
-
-        # getting data from tasks tables
         try:
             with DBHandler.connect() as db_cur:
-                db_cur.execute(GET_TASK_INFO, (self.addr, ))
-                task_info = db_cur.fetchall()[0]
-            tags.append(task_info[TSK_CHNAME_INDEX])
-            tags.append(task_info[TSK_LANG_INDEX])
-            tags.append(task_info[TSK_SUBLANG_INDEX])
+                db_cur.execute(GET_TAGS, (self.addr, ))
+                row = db_cur.fetchone()
         except DBException as err:
             LOG.debug(err)
+            return ""
 
-        # getting data from channels table
-        try:
-            with DBHandler.connect() as db_cur:
-                db_cur.execute(GET_CH_INFO, (task_info[TSK_CHNAME_INDEX], ))
-                ch_info = db_cur.fetchall()[0]
-            tags.append(ch_info[CH_COUN_INDEX])
-            tags.append(ch_info[CH_TMZ_INDEX])
-            tags.append(ch_info[CH_LANG_INDEX])
-
-        except DBException as err:
-            LOG.debug(err)
+        if row is None:
+            return ""
+        return " ".join(tag for tag in row if tag)
 
-        return " ".join(tags)
-
-    @staticmethod
-    def _tag_match(list_a, list_b):
+    def _get_channel_name(self):
         """
-        Takes in two lists and evaluates if they have any element common.
+        Returns
+        -------
+        type: str
+        name of the channel, the recordings being stored in a folder per channel
 
-        Parameters
-        ----------
-        list_a
-            type: list
-            first list to compare
-        list_b
-            type: list
-            second list to compare
+        """
+        return os.path.basename(os.path.dirname(self.addr))
 
+    def _get_job_name(self):
+        """
         Returns
         -------
-        type: bool
-        true if list matches, false otherwise
+        type: str
+        name of the job, the recordings being named after it followed by their start time
 
         """
-        for item in list_a:
-            if item in list_b:
-                return True
-        return False
+        return RECORDING_TIME_PATTERN.sub("", self.name)
 
     def _get_name(self):
         """
@@ -255,24 +233,24 @@ class ApplyProcessMethods:
         aud_lang = []
         sub_lang = []
         path_ffprobe = get_preprocessor_config()['path_to_ffprobe']
-        cmd = "{path_ffprobe} -v quiet -print_format json -show_streams '{path_to_file}'".format(
-            path_ffprobe=path_ffprobe,
-            path_to_file=path_to_file
-        )
+        cmd = [path_ffprobe, "-v", "quiet", "-print_format", "json", "-show_streams",
+               path_to_file]
         try:
-            LOG.debug("running %s command", cmd)
-            raw_json = subprocess.check_output(cmd, shell=True).decode('utf-8')
+            LOG.debug("running %s command", " ".join(cmd))
+            raw_json = subprocess.check_output(cmd).decode('utf-8')
             lang_data = json.loads(raw_json)
-            for data in lang_data["streams"]:
-                if data["codec_type"] == "audio":
-                    lang = data["tags"]["language"].lower()
+            for data in lang_data.get("streams", []):
+                lang = data.get("tags", {}).get("language")
+                if lang is None:  # untagged stream
+                    continue
+                lang = lang.lower()
+                if data.get("codec_type") == "audio":
                     if lang not in aud_lang:
                         aud_lang.append(lang)
-                elif data["codec_type"] == "subtitle":
-                    lang = data["tags"]["language"].lower()
+                elif data.get("codec_type") == "subtitle":
                     if lang not in sub_lang:
                         sub_lang.append(lang)
-        except subprocess.CalledProcessError as error:
+        except (OSError, ValueError, subprocess.CalledProcessError) as error:
             LOG.warning("ffprobe failed for %s", path_to_file)
             LOG.debug(error)
 
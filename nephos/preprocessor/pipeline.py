@@ -0,0 +1,471 @@
+"""
+Encode profiles of the preprocessor and the runner timing each of their steps
+"""
+import os
+import shlex
+import subprocess
+import tempfile
+import threading
+import time
+from functools import partial
+from logging import getLogger
+
+from .. import __config_dir__
+
+
+LOG = getLogger(__name__)
+SINGLE_PASS = "single_pass"
+TWO_PASS = "two_pass"
+SCRIPT = "script"
+PROFILE_TYPES = (SINGLE_PASS, TWO_PASS, SCRIPT)
+LEGACY_PROFILE = "script"
+LEGACY_SCRIPT = "processing.sh"
+FFMPEG_LOG = "ffmpeg.log"
+CCEX_LOG = "ccex.log"
+FFMPEG_STDIN = "pipe:0"
+CCEX_STDIN = "-"
+READ_CHUNK = 1024 * 1024  # bytes of the recording read at once when shared between steps
+
+
+class StepResult:
+    """
+    Exit status and resources consumed by a step of an encode profile.
+    """
+
+    def __init__(self, name, returncode, wall_secs, cpu_secs):
+        """
+        Parameters
+        ----------
+        name
+            type: str
+            name of the step
+        returncode
+            type: int
+            exit code of the step's process, negative for a signal
+        wall_secs
+            type: float
+            elapsed time of the step
+        cpu_secs
+            type: float
+            user and system time of the step's process
+        """
+        self.name = name
+        self.returncode = returncode
+        self.wall_secs = wall_secs
+        self.cpu_secs = cpu_secs
+
+    @property
+    def failed(self):
+        """
+        Returns
+        -------
+        type: bool
+        True if the step exited with an error, False otherwise
+
+        """
+        return self.returncode != 0
+
+    def __repr__(self):
+        return "<StepResult {name}: exit {code}, {wall:.1f}s wall, {cpu:.1f}s CPU>".format(
+            name=self.name, code=self.returncode, wall=self.wall_secs, cpu=self.cpu_secs)
+
+
+class Profile:
+    """
+    An encode profile from modules.yaml, building the commands applied to a recording.
+    """
+
+    def __init__(self, name, profile_config):
+        """
+        Parameters
+        ----------
+        name
+            type: str
+            name of the profile
+        profile_config
+            type: dict
+            profile's entry in "preprocess.profiles" of modules.yaml
+
+        Raises
+        ------
+        ValueError
+            when the type of the profile is unknown
+        """
+        self.name = name
+        self.kind = profile_config.get('type', SINGLE_PASS)
+        if self.kind not in PROFILE_TYPES:
+            raise ValueError("Unknown type {kind} of profile {name}".format(kind=self.kind,
+                                                                           name=name))
+        self.input_args = shlex.split(profile_config.get('input_args') or '')
+        self.args = shlex.split(profile_config.get('args') or '')
+        self.script = os.path.join(__config_dir__, profile_config.get('path') or LEGACY_SCRIPT)
+        # scripts extract the subtitles on their own
+        self.subtitles = profile_config.get('subtitles', self.kind != SCRIPT)
+        self.shared_read = profile_config.get('shared_read', False)
+
+    def stages(self, input_file, out_name, out_dir,  # pylint: disable=too-many-arguments
+               config, live=False, pass_dir=None):
+        """
+        Builds the commands of the profile, grouped in stages. The steps of a stage run
+        concurrently; subtitle extraction overlaps the first encoding pass.
+
+        Parameters
+        ----------
+        input_file
+            type: str
+            path to the recording
+        out_name
+            type: str
+            name of the output files, without extension
+        out_dir
+            type: str
+            directory in which the output files are written
+        config
+            type: dict
+            configuration of the preprocessing module
+        live
+            type: bool
+            True if the stream is fed to the steps while it is recorded
+        pass_dir
+            type: str
+            directory for the pass log of a two-pass profile, kept out of out_dir since
+            that is uploaded; None for the temporary directory of the system
+
+        Returns
+        -------
+        type: list
+        lists of tuples of the step name and its arguments, stages to be run in order
+
+        """
+        ffmpeg = config.get('path_to_ffmpeg') or 'ffmpeg'
+        out_file = os.path.join(out_dir, out_name + ".mp4")
+
+        def encode(shared):
+            return [ffmpeg, "-y"] + self.input_args + \
+                   ["-i", FFMPEG_STDIN if shared else input_file] + self.args
+
+        def subtitles(shared):
+            return ("ccextractor", [config.get('path_to_ccextractor') or 'ccextractor',
+                                    CCEX_STDIN if shared else input_file, "-autoprogram",
+                                    "-o", os.path.join(out_dir, out_name + ".srt")])
+
+        shared = live or self.shares_read
+        if self.kind == SINGLE_PASS:
+            stages = [[("encode", encode(shared) + [out_file])]]
+        elif self.kind == TWO_PASS:
+            pass_log = ["-passlogfile", os.path.join(pass_dir or tempfile.gettempdir(),
+                                                     out_name)]
+            stages = [[("pass 1", encode(shared) + ["-pass", "1"] + pass_log +
+                        ["-f", "mp4", os.devnull])],
+                      [("pass 2", encode(False) + ["-pass", "2"] + pass_log + [out_file])]]
+        else:
+            stages = [[("script", [self.script, input_file, out_name, out_dir])]]
+
+        if self.subtitles:
+            stages[0].insert(0, subtitles(shared))
+        return stages
+
+    @property
+    def streamable(self):
+        """
+        Returns
+        -------
+        type: bool
+        True if the profile can encode a stream while it is recorded, False otherwise
+
+        """
+        return self.kind == SINGLE_PASS
+
+    @property
+    def shares_read(self):
+        """
+        Returns
+        -------
+        type: bool
+        True if the steps of the first stage read the recording once, through their stdin
+
+        """
+        return self.shared_read and self.subtitles and self.kind != SCRIPT
+
+
+def select_profile(config, channel_name=None, job_name=None):
+    """
+    Picks the encode profile of a recording; the job's profile takes precedence over the
+    channel's, which takes precedence over the default one.
+
+    Parameters
+    ----------
+    config
+        type: dict
+        configuration of the preprocessing module
+    channel_name
+        type: str
+        name of the channel of the recording
+    job_name
+        type: str
+        name of the job which recorded it
+
+    Returns
+    -------
+    type: Profile
+    profile to be applied
+
+    Raises
+    ------
+    ValueError
+        when the selected profile is not defined or not valid
+
+    """
+    profiles = config.get('profiles')
+    if not profiles:
+        # configurations predating profiles keep running processing.sh
+        return Profile(LEGACY_PROFILE, {'type': SCRIPT})
+
+    name = ((config.get('job_profiles') or {}).get(job_name) or
+            (config.get('channel_profiles') or {}).get(channel_name) or
+            config.get('profile'))
+    if name not in profiles:
+        raise ValueError("Profile {name} is not defined".format(name=name))
+    return Profile(name, profiles[name] or {})
+
+
+class RunningStep:
+    """
+    A started step of an encode profile, to be reaped by finish().
+    """
+
+    def __init__(self, name, args, cwd, log_path, stdin=None):
+        """
+        Parameters
+        ----------
+        name
+            type: str
+            name of the step
+        args
+            type: list
+            command to be run
+        cwd
+            type: str
+            working directory of the command
+        log_path
+            type: str
+            file to which the output of the command is appended
+        stdin
+            type: int
+            subprocess.PIPE to feed the command, subprocess.DEVNULL for a command reading
+            its input from a file, None to inherit the stdin of nephos as run_step does
+
+        Raises
+        ------
+        OSError
+            when the command cannot be started
+        """
+        LOG.debug("running step %s: %s", name, " ".join(shlex.quote(arg) for arg in args))
+        self.name = name
+        self.start = time.monotonic()
+        with open(log_path, "ab") as log_file:
+            self.process = subprocess.Popen(args, cwd=cwd, stdin=stdin, stdout=log_file,
+                                            stderr=subprocess.STDOUT)
+
+    def finish(self):
+        """
+        Waits for the step to exit.
+
+        Returns
+        -------
+        type: StepResult
+
+        """
+        # wait4 gives the resources of this very child, unlike RUSAGE_CHILDREN which
+        # would include the steps of the other preprocessing workers
+        _, status, usage = os.wait4(self.process.pid, 0)
+        self.process.returncode = _exit_code(status)
+        result = StepResult(self.name, self.process.returncode, time.monotonic() - self.start,
+                            usage.ru_utime + usage.ru_stime)
+        LOG.debug(result)
+        return result
+
+
+def _exit_code(status):
+    """
+    Parameters
+    ----------
+    status
+        type: int
+        status of a child as given by os.wait4
+
+    Returns
+    -------
+    type: int
+    exit code of the child, negative of the signal if it was killed by one, as Popen sets
+
+    """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def run_step(name, args, cwd, log_path):
+    """
+    Runs a command, reporting its exit status along with its wall and CPU time.
+
+    Parameters
+    ----------
+    name
+        type: str
+        name of the step
+    args
+        type: list
+        command to be run
+    cwd
+        type: str
+        working directory of the command
+    log_path
+        type: str
+        file to which the output of the command is appended
+
+    Returns
+    -------
+    type: StepResult
+
+    Raises
+    ------
+    OSError
+        when the command cannot be started
+
+    """
+    return RunningStep(name, args, cwd, log_path).finish()
+
+
+def fan_out_file(input_file, pipes):
+    """
+    Reads the recording once, writing every chunk to all the pipes; a step which exits
+    early is dropped while the others keep being fed.
+
+    Parameters
+    ----------
+    input_file
+        type: str
+        path to the recording
+    pipes
+        type: list
+        stdin of the steps sharing the read
+
+    Returns
+    -------
+
+    """
+    pipes = list(pipes)
+    try:
+        with open(input_file, "rb") as recording:
+            while pipes:
+                chunk = recording.read(READ_CHUNK)
+                if not chunk:
+                    break
+                for pipe in list(pipes):
+                    try:
+                        pipe.write(chunk)
+                    except (BrokenPipeError, ValueError):
+                        pipes.remove(pipe)
+    except OSError as err:
+        LOG.warning("Failed to read %s", input_file)
+        LOG.debug(err)
+    finally:
+        for pipe in pipes:
+            try:
+                pipe.close()
+            except BrokenPipeError:
+                pass
+
+
+def run_stage(stage, out_dir, feed=None):
+    """
+    Runs the steps of a stage concurrently.
+
+    Parameters
+    ----------
+    stage
+        type: list
+        tuples of the step name and its arguments
+    out_dir
+        type: str
+        directory in which the output files are written, and the logs
+    feed
+        type: callable
+        called in a thread with the stdin of every step, to write the recording into
+        and close; None for steps reading the recording on their own
+
+    Returns
+    -------
+    type: list
+    StepResult of every step, in the order of the stage
+
+    """
+    started = []
+    for name, args in stage:
+        log_file = CCEX_LOG if name == "ccextractor" else FFMPEG_LOG
+        try:
+            started.append(RunningStep(name, args, out_dir, os.path.join(out_dir, log_file),
+                                       subprocess.DEVNULL if feed is None else subprocess.PIPE))
+        except OSError as err:
+            LOG.warning("Step %s could not be started", name)
+            LOG.debug(err)
+            started.append(StepResult(name, -1, 0.0, 0.0))
+
+    running = [step for step in started if isinstance(step, RunningStep)]
+    feeder = None
+    if feed is not None and running:
+        feeder = threading.Thread(target=feed, name="fan-out",
+                                  args=([step.process.stdin for step in running], ))
+        feeder.start()
+    results = [step.finish() if isinstance(step, RunningStep) else step for step in started]
+    if feeder is not None:
+        feeder.join()
+    return results
+
+
+def run_profile(profile, input_file, out_name, out_dir, config):
+    """
+    Applies the profile to a recording, stopping after the stage of a failed encoding step.
+
+    Parameters
+    ----------
+    profile
+        type: Profile
+        profile to be applied
+    input_file
+        type: str
+        path to the recording
+    out_name
+        type: str
+        name of the output files, without extension
+    out_dir
+        type: str
+        directory in which the output files are written
+    config
+        type: dict
+        configuration of the preprocessing module
+
+    Returns
+    -------
+    type: list
+    StepResult of every step which was run
+
+    """
+    start = time.monotonic()
+    results = []
+    # the pass log of a two-pass profile is removed along with the directory after pass 2
+    with tempfile.TemporaryDirectory(prefix="nephos-pass-") as pass_dir:
+        for index, stage in enumerate(profile.stages(input_file, out_name, out_dir, config,
+                                                     pass_dir=pass_dir)):
+            feed = partial(fan_out_file, input_file) \
+                if profile.shares_read and index == 0 else None
+            stage_results = run_stage(stage, out_dir, feed)
+            results.extend(stage_results)
+            # missing subtitles do not spoil the recording
+            if any(result.failed and result.name != "ccextractor" for result in stage_results):
+                break
+
+    LOG.info("Profile %s applied to %s in %.1fs wall, %.1fs CPU", profile.name, input_file,
+             time.monotonic() - start, sum(result.cpu_secs for result in results))
+    return results
@@ -2,18 +2,74 @@
 Contains the main preprocess class
 """
 import os
+import json
+import threading
 from logging import getLogger
 from sqlite3 import Error
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait
 
-from . import get_preprocessor_config
+from . import get_preprocessor_config, segments
 from .methods import ApplyProcessMethods
 from .. import __upload_dir__
-from ..manage_db import DBHandler, DBException, TSK_ID_INDEX, \
-    TSK_PATH_INDEX, TSK_STORE_INDEX, TSK_STAT_INDEX, TSK_FAIL_INDEX
+from ..recorder import registry
+from ..manage_db import DBHandler, DBException, TaskQueue, TaskLease, CH_NAME_INDEX, \
+    TSK_ID_INDEX, TSK_PATH_INDEX, TSK_STORE_INDEX, TSK_STAT_INDEX, TSK_FAIL_INDEX, TSK_PARENT_INDEX
 
 
 LOG = getLogger(__name__)
+DEFAULT_WORKERS = 1
+EXECUTOR = "process"  # scheduler executor of the preprocessing runs
+CMD_GET_ENCODED = """SELECT *
+                  FROM tasks
+                  WHERE status = "encoded"
+                  ORDER BY task_id"""
+# workers of the preprocessing runs and of the segments processed as soon as recorded, so
+# that no more than "workers" recordings are encoded at once
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+class ClaimCursor:
+    """
+    Id of the last task claimed in a run of the preprocessor, shared by the workers of the
+    run. Tasks are claimed in the order of their ids, so claiming only after it attempts
+    every task at most once per run.
+    """
+
+    def __init__(self):
+        self._last_id = None
+        self._lock = threading.Lock()
+
+    @property
+    def last_id(self):
+        """
+        Returns
+        -------
+        type: int
+        id of the last task claimed in the run, None if none was claimed yet
+
+        """
+        with self._lock:
+            return self._last_id
+
+    def advance(self, task_id):
+        """
+        Moves the cursor past a claimed task.
+
+        Parameters
+        ----------
+        task_id
+            type: int
+            id of the claimed task
+
+        Returns
+        -------
+
+        """
+        with self._lock:
+            if self._last_id is None or task_id > self._last_id:
+                self._last_id = task_id
 
 
 class PreprocessHandler:
@@ -38,15 +94,99 @@ class PreprocessHandler:
     @staticmethod
     def init_preprocess_pipe():
         """
-        Loads data from the database and passes it into the preprocessing pipe
+        Processes all the "not processed" tasks using a bounded pool of workers.
+
+        The number of workers is read from "preprocess.workers" in modules.yaml. Each
+        worker claims one task at a time, so several recordings are encoded at once
+        while no two workers (or overlapping runs) ever pick up the same recording.
+        Recordings whose segments are all processed are stitched afterwards.
 
         Returns
         -------
 
         """
-        sql_command = 'SELECT * FROM tasks where status = "not processed"'
-        for task in PreprocessHandler._query_tasks(sql_command):
-            ApplyProcessMethods(task[TSK_PATH_INDEX], task[TSK_STORE_INDEX])
+        pool, workers = _get_pool()
+        LOG.debug("Starting preprocessing with %d worker(s)", workers)
+
+        # shared by the workers, a task failing in this run is retried in the next one
+        cursor = ClaimCursor()
+        wait([pool.submit(PreprocessHandler._run_worker, cursor) for _ in range(workers)])
+        segments.stitch_segments()
+
+    @staticmethod
+    def start_worker():
+        """
+        Queues a worker in the shared pool, to process a newly inserted task without
+        waiting for the next run of the preprocessor.
+
+        Returns
+        -------
+
+        """
+        _get_pool()[0].submit(PreprocessHandler._run_standalone_worker)
+
+    @staticmethod
+    def _run_standalone_worker():
+        """
+        Runs a worker of its own, then stitches the recordings whose last segment it may
+        have processed, so that they are not left waiting for the next run.
+
+        Returns
+        -------
+
+        """
+        PreprocessHandler._run_worker()
+        segments.stitch_segments()
+
+    @staticmethod
+    def _run_worker(cursor=None):
+        """
+        Keeps claiming and processing tasks until none are left.
+        Encoding happens in child processes, hence threads are enough to run
+        multiple encodes in parallel.
+
+        The lease over the claimed task is renewed while it is processed, and the
+        task is returned to the queue if processing ends without moving it ahead.
+        A task is attempted once per run, so that the retries of a failing task are
+        spaced by the preprocessing interval.
+
+        Parameters
+        ----------
+        cursor
+            type: ClaimCursor
+            cursor of the run the worker belongs to, None for a run of its own
+
+        Returns
+        -------
+
+        """
+        cursor = ClaimCursor() if cursor is None else cursor
+        worker_id = TaskQueue.worker_id()
+        while True:
+            try:
+                task = TaskQueue.claim_next("preprocess", worker_id, after=cursor.last_id)
+            except DBException as err:
+                LOG.warning("Failed to claim task for preprocessing!")
+                LOG.debug(err)
+                return
+            if task is None:
+                return
+
+            cursor.advance(task[TSK_ID_INDEX])
+            LOG.debug("Task (id = %s) claimed for preprocessing", task[TSK_ID_INDEX])
+            try:
+                with TaskLease("preprocess", [task[TSK_ID_INDEX]], worker_id):
+                    ApplyProcessMethods(task[TSK_PATH_INDEX], task[TSK_STORE_INDEX],
+                                        segment=task[TSK_PARENT_INDEX] is not None)
+            except Exception as err:  # pylint: disable=broad-except
+                # an unexpected error should not kill the worker and stall the queue
+                LOG.warning("Preprocessing failed for %s", task[TSK_PATH_INDEX])
+                LOG.debug(err)
+
+            try:
+                TaskQueue.release("preprocess", task[TSK_ID_INDEX], worker_id)
+            except DBException as err:
+                LOG.debug(err)
 
     # # TODO: remove this
     # @staticmethod
@@ -63,7 +203,8 @@ class PreprocessHandler:
     #     PreprocessHandler.insert_task(orig_path, ip_addr)
 
     @staticmethod
-    def insert_task(orig_path, ip_addr):
+    def insert_task(orig_path, ip_addr, store_path=None,  # pylint: disable=too-many-arguments
+                    encoded=False, parent_id=None, seg_index=None, gaps=None):
         """
         Insert a new task into the "tasks" table
 
@@ -75,18 +216,41 @@ class PreprocessHandler:
         ip_addr
             type: str
             ip address of the channel of the recorded video
+        store_path
+            type: str
+            directory for the processed files, None to create a name for it
+        encoded
+            type: bool
+            True if the recording was transcoded live into store_path, and hence
+            has no file at orig_path; the task is then inserted as "encoded", out of
+            the preprocessing queue
+        parent_id
+            type: int
+            task of the whole recording, if the file is a segment of it
+        seg_index
+            type: int
+            position of the segment in the recording
+        gaps
+            type: list
+            seconds the stream stopped at and was missing for, for every gap in the
+            recording; stored in the task as JSON
 
         Returns
         -------
+        type: int
+        id of the inserted task, None on failure
 
         """
         try:
-            with DBHandler.connect() as db_cur:
-                ch_name = PreprocessHandler._get_channel_name(ip_addr, db_cur)
-
-            store_path = os.path.join(__upload_dir__, ch_name + "_" +
-                                      str(datetime.now().strftime("%Y-%m-%d-%H-%M")))
-            lang, sub_lang = ApplyProcessMethods.get_lang(orig_path)
+            ch_name = PreprocessHandler._get_channel_name(ip_addr)
+            if store_path is None:
+                store_path = PreprocessHandler.get_store_path(ch_name)
+            if encoded:
+                name = os.path.splitext(os.path.basename(orig_path))[0]
+                lang, sub_lang = ApplyProcessMethods.get_lang(
+                    os.path.join(store_path, name + ".mp4"))
+            else:
+                lang, sub_lang = ApplyProcessMethods.get_lang(orig_path)
 
             data = {
                 "orig_path": orig_path,
@@ -95,6 +259,13 @@ class PreprocessHandler:
                 "lang": lang,
                 "sub_lang": sub_lang
             }
+            if encoded:
+                data["status"] = "encoded"
+            if parent_id is not None:
+                data["parent_id"] = parent_id
+                data["seg_index"] = seg_index
+            if gaps:
+                data["gaps"] = json.dumps(gaps)
             with DBHandler.connect() as db_cur:
                 task_id = DBHandler.insert_data(db_cur, "tasks", data)
 
@@ -102,13 +273,96 @@ class PreprocessHandler:
                 LOG.debug("Task (id = %s) added with following data:\n%s", task_id, data)
             else:
                 raise DBException
+            return task_id
 
         except (DBException, KeyError) as err:
             LOG.warning("Failed to insert task for recording: %s", orig_path)
             if err == KeyError:
                 LOG.debug("%s is a corrupted recording!", orig_path)
-            os.remove(orig_path)
+            if not encoded:
+                os.remove(orig_path)
+            LOG.debug(err)
+            return None
+
+    @staticmethod
+    def insert_parent_task(orig_path, ip_addr):
+        """
+        Inserts the task of a recording made of segments, while it is being recorded.
+        The segments are inserted as tasks of their own, with this task as their parent.
+
+        Parameters
+        -------
+        orig_path
+            type: str
+            path the whole recording would have been saved at
+        ip_addr
+            type: str
+            ip address of the channel of the recorded video
+
+        Returns
+        -------
+        type: tuple
+        id and store path of the inserted task, None on failure
+
+        """
+        try:
+            ch_name = PreprocessHandler._get_channel_name(ip_addr)
+            store_path = PreprocessHandler.get_store_path(ch_name)
+            with DBHandler.connect() as db_cur:
+                data = {
+                    "orig_path": orig_path,
+                    "store_path": store_path,
+                    "ch_name": ch_name,
+                    "status": "recording",
+                    "seg_index": 0
+                }
+                task_id = DBHandler.insert_data(db_cur, "tasks", data)
+            if task_id is None:
+                raise DBException
+            LOG.debug("Task (id = %s) added for segmented recording %s", task_id, orig_path)
+            return task_id, store_path
+
+        except (DBException, KeyError, IndexError) as err:
+            LOG.warning("Failed to insert task for recording: %s", orig_path)
             LOG.debug(err)
+            return None
+
+    @staticmethod
+    def recover_encoded():
+        """
+        Finishes the recordings transcoded live whose processing was cut short by a stop
+        of nephos, to be used on startup.
+
+        Returns
+        -------
+        type: int
+        number of recordings finished
+
+        """
+        tasks = PreprocessHandler._query_tasks(CMD_GET_ENCODED) or []
+        for task in tasks:
+            ApplyProcessMethods(task[TSK_PATH_INDEX], task[TSK_STORE_INDEX], encoded=True)
+        if tasks:
+            LOG.info("%d recording(s) transcoded live finished", len(tasks))
+        return len(tasks)
+
+    @staticmethod
+    def get_store_path(ch_name):
+        """
+        Parameters
+        ----------
+        ch_name
+            type: str
+            name of the channel of the recording
+
+        Returns
+        -------
+        type: str
+        new directory in which the processed files of the recording are stored
+
+        """
+        return os.path.join(__upload_dir__, ch_name + "_" +
+                            str(datetime.now().strftime("%Y-%m-%d-%H-%M")))
 
     @staticmethod
     def display_tasks():
@@ -168,7 +422,7 @@ class PreprocessHandler:
         for job in jobs:
             LOG.debug("Adding %s default job to scheduler...", job)
             self.scheduler.add_necessary_job(job_funcs[job], job,
-                                             self.config['interval'])
+                                             self.config['interval'], executor=EXECUTOR)
 
     @staticmethod
     def _query_tasks(sql_cmd):
@@ -195,7 +449,7 @@ class PreprocessHandler:
             LOG.debug(err)
 
     @staticmethod
-    def _get_channel_name(ip_addr, db_cur):
+    def _get_channel_name(ip_addr):
         """
 
         Parameters
@@ -203,16 +457,37 @@ class PreprocessHandler:
         ip_addr
             type: str
             ip address of a channel
-        db_cur
-            type: sqlite database cursor
-            cursor to the database of channels
 
         Returns
         -------
             type: str
             name of the channel to which the ip address belongs
 
+        Raises
+        ------
+        KeyError
+            if no channel has the ip address
+
         """
-        sql_command = "SELECT name FROM channels WHERE ip=?"
-        db_cur.execute(sql_command, (ip_addr,))
-        return db_cur.fetchall()[0][0]
+        channel = registry.get_by_ip(ip_addr)
+        if channel is None:
+            raise KeyError(ip_addr)
+        return channel[CH_NAME_INDEX]
+
+
+def _get_pool():
+    """
+    Returns
+    -------
+    type: tuple
+    pool of the preprocessing workers, started on first use, and its number of workers
+    read from "preprocess.workers"
+
+    """
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            workers = get_preprocessor_config().get('workers', DEFAULT_WORKERS)
+            workers = max(1, int(workers or DEFAULT_WORKERS))
+            _POOL = ThreadPoolExecutor(max_workers=workers), workers
+        return _POOL
@@ -0,0 +1,324 @@
+"""
+Stitches the processed segments of a recording together once all of them are processed
+"""
+import os
+import re
+import shutil
+import subprocess
+from logging import getLogger
+
+from . import get_preprocessor_config, pipeline
+from .methods import ApplyProcessMethods, MIN_BYTES
+from ..manage_db import DBHandler, TSK_ID_INDEX, TSK_PATH_INDEX, TSK_STORE_INDEX, \
+    TSK_LANG_INDEX, TSK_SUBLANG_INDEX
+from ..exceptions import DBException
+from ..mail_notifier import add_to_report
+
+
+LOG = getLogger(__name__)
+CONCAT_LIST = "segments.txt"
+SEGMENTS_SUFFIX = ".segments"
+SRT_TIME_PATTERN = re.compile(r"(\d{2}):(\d{2}):(\d{2}),(\d{3})")
+# parents whose segments are all through preprocessing, whether successfully or not
+CMD_GET_STITCHABLE = """SELECT *
+                     FROM tasks AS parent
+                     WHERE status = "segmented" AND NOT EXISTS (
+                         SELECT 1 FROM tasks
+                         WHERE parent_id = parent.task_id
+                         AND status IN ("not processed", "processing"))
+                     ORDER BY task_id"""
+CMD_GET_SEGMENTS = """SELECT *
+                   FROM tasks
+                   WHERE parent_id = ? AND status = "segment processed"
+                   ORDER BY seg_index"""
+CMD_SET_STITCHING = """UPDATE tasks
+                    SET status = "stitching"
+                    WHERE task_id = ? AND status = "segmented\""""
+CMD_UNSET_STITCHING = """UPDATE tasks
+                      SET status = "segmented"
+                      WHERE task_id = ? AND status = "stitching\""""
+CMD_SET_LANG = """UPDATE tasks
+               SET lang = ?, sub_lang = ?
+               WHERE task_id = ?"""
+CMD_REMOVE_SEGMENTS = "DELETE FROM tasks WHERE parent_id = ?"
+CMD_REMOVE_TASK = "DELETE FROM tasks WHERE task_id = ?"
+# recordings and stitches cut short by a stop of nephos are stitched from what was saved
+CMD_RECOVER = """UPDATE tasks
+              SET status = "segmented"
+              WHERE status IN ("recording", "stitching")"""
+
+
+def stitch_segments():
+    """
+    Concatenates the processed segments of every recording whose segments are all
+    through preprocessing; the stitched recording is then shared and uploaded like any
+    other processed recording.
+
+    Returns
+    -------
+    type: int
+    number of recordings stitched
+
+    """
+    try:
+        with DBHandler.connect() as db_cur:
+            db_cur.execute(CMD_GET_STITCHABLE)
+            parents = db_cur.fetchall()
+    except DBException as err:
+        LOG.warning("Failed to query segmented recordings!")
+        LOG.debug(err)
+        return 0
+
+    stitched = 0
+    for parent in parents:
+        try:
+            with DBHandler.connect() as db_cur:
+                # claiming the parent keeps overlapping runs from stitching it twice
+                db_cur.execute(CMD_SET_STITCHING, (parent[TSK_ID_INDEX], ))
+                if db_cur.rowcount != 1:
+                    continue
+                db_cur.execute(CMD_GET_SEGMENTS, (parent[TSK_ID_INDEX], ))
+                children = db_cur.fetchall()
+        except DBException as err:
+            LOG.debug(err)
+            continue
+
+        if _stitch(parent, children):
+            stitched += 1
+    return stitched
+
+
+def recover():
+    """
+    Returns recordings left in the middle of being recorded or stitched by a previous run
+    to be stitched again.
+
+    Returns
+    -------
+    type: int
+    number of recordings recovered
+
+    """
+    try:
+        with DBHandler.connect() as db_cur:
+            db_cur.execute(CMD_RECOVER)
+            recovered = db_cur.rowcount
+    except DBException as err:
+        LOG.warning("Failed to recover segmented recordings!")
+        LOG.debug(err)
+        return 0
+
+    if recovered:
+        LOG.info("%d segmented recording(s) returned to be stitched", recovered)
+    return recovered
+
+
+def _stitch(parent, children):
+    """
+    Concatenates the encoded segments and their subtitles into the store path of the
+    parent task, and processes the result as a recording transcoded live.
+
+    Parameters
+    ----------
+    parent
+        type: tuple
+        row of the task of the whole recording
+    children
+        type: list
+        rows of the processed segments, in order
+
+    Returns
+    -------
+    type: bool
+    True if stitched, False otherwise
+
+    """
+    parent_id = parent[TSK_ID_INDEX]
+    addr = parent[TSK_PATH_INDEX]
+    store_path = parent[TSK_STORE_INDEX]
+    name = os.path.splitext(os.path.basename(addr))[0]
+    if not children:
+        LOG.warning("No segment of %s was processed, discarding it", addr)
+        add_to_report("{file} discarded since none of its segments could be processed\n".format(
+            file=addr))
+        _remove(parent_id, store_path, remove_parent=True)
+        return False
+
+    segments = [(_segment_file(child, ".mp4"), _segment_file(child, ".srt"))
+                for child in children]
+    config = get_preprocessor_config()
+    out_file = os.path.join(store_path, name + ".mp4")
+    list_path = os.path.join(store_path, CONCAT_LIST)
+    try:
+        os.makedirs(store_path, exist_ok=True)
+        with open(list_path, "w") as list_file:
+            for video, _ in segments:
+                list_file.write("file '{path}'\n".format(path=video.replace("'", r"'\''")))
+        failed = pipeline.run_step("concat", [config.get('path_to_ffmpeg') or 'ffmpeg', "-y",
+                                              "-f", "concat", "-safe", "0", "-i", list_path,
+                                              "-c", "copy", out_file],
+                                   store_path, os.path.join(store_path, pipeline.FFMPEG_LOG)).failed
+    except OSError as err:
+        # eg. ffmpeg missing, the parent is left to be stitched by the next run
+        LOG.debug(err)
+        failed = True
+    if os.path.exists(list_path):
+        os.remove(list_path)
+    if failed or not os.path.exists(out_file) or os.stat(out_file).st_size <= MIN_BYTES:
+        LOG.warning("Stitching the segments of %s failed", addr)
+        try:
+            with DBHandler.connect() as db_cur:
+                db_cur.execute(CMD_UNSET_STITCHING, (parent_id, ))
+        except DBException as err:
+            LOG.debug(err)
+        return False
+
+    _merge_subtitles(segments, os.path.join(store_path, name + ".srt"))
+    try:
+        with DBHandler.connect() as db_cur:
+            db_cur.execute(CMD_SET_LANG, (children[0][TSK_LANG_INDEX],
+                                          children[0][TSK_SUBLANG_INDEX], parent_id))
+    except DBException as err:
+        LOG.debug(err)
+    LOG.info("%d segment(s) of %s stitched", len(children), addr)
+    ApplyProcessMethods(addr, store_path, encoded=True)
+    _remove(parent_id, store_path)
+    return True
+
+
+def _segment_file(child, extension):
+    """
+    Parameters
+    ----------
+    child
+        type: tuple
+        row of the task of a segment
+    extension
+        type: str
+        extension of the processed file, with the dot
+
+    Returns
+    -------
+    type: str
+    path to the processed file of the segment
+
+    """
+    name = os.path.splitext(os.path.basename(child[TSK_PATH_INDEX]))[0]
+    return os.path.join(child[TSK_STORE_INDEX], name + extension)
+
+
+def _merge_subtitles(segments, out_path):
+    """
+    Appends the subtitles of the segments, shifting each by the duration of the
+    segments before it.
+
+    Parameters
+    ----------
+    segments
+        type: list
+        tuples of the paths to the video and the subtitles of every segment, in order
+    out_path
+        type: str
+        path to the merged subtitles
+
+    Returns
+    -------
+
+    """
+    offset_ms = 0
+    count = 0
+    with open(out_path, "w", encoding="utf-8") as out_file:
+        for video, subtitles in segments:
+            try:
+                with open(subtitles, encoding="utf-8", errors="replace") as srt_file:
+                    blocks = srt_file.read().strip().split("\n\n")
+            except FileNotFoundError:
+                blocks = []
+            for block in blocks:
+                lines = block.strip().splitlines()
+                if len(lines) < 2:
+                    continue
+                count += 1
+                timing = SRT_TIME_PATTERN.sub(lambda match: _shift(match, offset_ms), lines[1])
+                out_file.write("\n".join([str(count), timing] + lines[2:]) + "\n\n")
+            offset_ms += int(_get_duration(video) * 1000)
+
+
+def _shift(match, offset_ms):
+    """
+    Parameters
+    ----------
+    match
+        type: re.Match
+        SRT_TIME_PATTERN matching a timestamp
+    offset_ms
+        type: int
+        milliseconds to be added to the timestamp
+
+    Returns
+    -------
+    type: str
+    shifted timestamp
+
+    """
+    hours, minutes, secs, millis = (int(group) for group in match.groups())
+    total = ((hours * 60 + minutes) * 60 + secs) * 1000 + millis + offset_ms
+    return "{:02d}:{:02d}:{:02d},{:03d}".format(total // 3600000, total // 60000 % 60,
+                                                total // 1000 % 60, total % 1000)
+
+
+def _get_duration(path_to_file):
+    """
+    Uses ffprobe to find the duration of a processed segment.
+
+    Parameters
+    ----------
+    path_to_file
+        type: str
+        path to the video
+
+    Returns
+    -------
+    type: float
+    duration in seconds, 0 if it cannot be found
+
+    """
+    path_ffprobe = get_preprocessor_config()['path_to_ffprobe']
+    try:
+        output = subprocess.check_output([path_ffprobe, "-v", "quiet", "-show_entries",
+                                          "format=duration", "-of", "csv=p=0", path_to_file])
+        return float(output.decode('utf-8').strip())
+    except (OSError, ValueError, subprocess.CalledProcessError) as err:
+        LOG.warning("ffprobe failed for %s", path_to_file)
+        LOG.debug(err)
+        return 0.0
+
+
+def _remove(parent_id, store_path, remove_parent=False):
+    """
+    Removes the segments of a recording, from the database and the disk.
+
+    Parameters
+    ----------
+    parent_id
+        type: int
+        id of the task of the whole recording
+    store_path
+        type: str
+        store path of the whole recording
+    remove_parent
+        type: bool
+        True to remove the task of the whole recording as well
+
+    Returns
+    -------
+
+    """
+    try:
+        with DBHandler.connect() as db_cur:
+            db_cur.execute(CMD_REMOVE_SEGMENTS, (parent_id, ))
+            if remove_parent:
+                db_cur.execute(CMD_REMOVE_TASK, (parent_id, ))
+    except DBException as err:
+        LOG.debug(err)
+    shutil.rmtree(store_path + SEGMENTS_SUFFIX, ignore_errors=True)
@@ -1,16 +1,20 @@
 """
 Class and methods required to handle sharing
 """
+import threading
 from logging import getLogger
 from sqlite3 import Error
 
 from .. import validate_entries
-from ..manage_db import DBHandler, DBException
+from ..manage_db import DBHandler, DBException, SL_ID_INDEX, SL_MAIL_INDEX, SL_TAG_INDEX
 
 
 LOG = getLogger(__name__)
 CMD_GET_SHRS = "SELECT * FROM share_list"
 CMD_DEL_SHRS = "DELETE FROM share_list"
+# inverted index of the share list, built on first use and dropped whenever the table changes
+_INDEX = None  # tuple of the ids of the entities per tag, and the email per id
+_INDEX_LOCK = threading.Lock()
 
 
 class ShareHandler:
@@ -53,15 +57,18 @@ class ShareHandler:
 
         """
         shr_data = validate_entries(shr_data)
-        for key in shr_data.keys():
-            try:
-                with DBHandler.connect() as db_cur:
-                    shr_id = DBHandler.insert_data(db_cur, "share_list", shr_data[key])
-                LOG.info("Share entity (id = %s) added with following data:\n%s", shr_id,
-                         shr_data[key])
-            except DBException as err:
-                LOG.info("Failed to connect to database")
-                LOG.debug(err)
+        try:
+            with DBHandler.connect() as db_cur:
+                added = DBHandler.insert_many(db_cur, "share_list", list(shr_data.values()))
+        except DBException as err:
+            LOG.info("Failed to connect to database")
+            LOG.debug(err)
+            return
+        finally:
+            ShareHandler.invalidate_index()
+
+        for entity in added:
+            LOG.info("Share entity added with following data:\n%s", entity)
 
     def display_shr_entities(self):
         """
@@ -93,6 +100,8 @@ class ShareHandler:
             LOG.warning("Failed to remove share lists!")
             LOG.debug(err)
             raise IOError
+        finally:
+            ShareHandler.invalidate_index()
 
     @staticmethod
     def grab_shr_list():
@@ -113,3 +122,63 @@ class ShareHandler:
         except DBException as err:
             LOG.warning("Failed to get share_entities list!")
             LOG.debug(err)
+
+    @staticmethod
+    def match_emails(tags):
+        """
+        Resolves the share entities of a file from the inverted index of the share list.
+
+        Parameters
+        ----------
+        tags
+            type: list
+            tags of the file, eg. its channel name and languages
+
+        Returns
+        -------
+        type: list
+        emails of the entities having any of the tags, in the order they were added
+
+        """
+        ids_by_tag, emails = ShareHandler._get_index()
+        matched = set().union(*(ids_by_tag.get(tag, ()) for tag in tags))
+        return [emails[share_id] for share_id in sorted(matched)]
+
+    @staticmethod
+    def invalidate_index():
+        """
+        Drops the inverted index, to be rebuilt from the share list on next use.
+
+        Returns
+        -------
+
+        """
+        global _INDEX
+        with _INDEX_LOCK:
+            _INDEX = None
+
+    @staticmethod
+    def _get_index():
+        """
+        Returns
+        -------
+        type: tuple
+        dict of the set of ids of the entities per tag, and dict of the email per id;
+        both empty if the share list could not be read, which is then retried next time
+
+        """
+        global _INDEX
+        with _INDEX_LOCK:
+            if _INDEX is not None:
+                return _INDEX
+            entities = ShareHandler.grab_shr_list()
+            if entities is None:
+                return {}, {}
+            ids_by_tag, emails = {}, {}
+            for entity in entities:
+                emails[entity[SL_ID_INDEX]] = entity[SL_MAIL_INDEX]
+                for tag in (entity[SL_TAG_INDEX] or "").split():
+                    ids_by_tag.setdefault(tag, set()).add(entity[SL_ID_INDEX])
+            _INDEX = ids_by_tag, emails
+            LOG.debug("Share list indexed: %d entities, %d tags", len(emails), len(ids_by_tag))
+            return _INDEX
@@ -2,22 +2,32 @@
 Manages all operations related to channels, including adding, deleting and updating channel data
 """
 import os
+import json
+import shutil
 import subprocess
+import time
 from logging import getLogger
 from sqlite3 import Error
-from datetime import datetime
+from datetime import datetime, timedelta
 
-from . import get_recorder_config
+from . import get_recorder_config, receiver, registry, timeshift
 from .. import __recording_dir__, validate_entries
 from ..manage_db import DBHandler, CH_STAT_INDEX
 from ..exceptions import DBException
+from .live import record_live
+from .watchdog import Watchdog, supervise, STALLED, TIMED_OUT, SAMPLE_SECS
 from ..preprocessor.preprocess import PreprocessHandler
+from ..preprocessor.segments import SEGMENTS_SUFFIX
 from ..mail_notifier import add_to_report
 
 
 LOG = getLogger(__name__)
 CMD_GET_CHANNELS = "SELECT * FROM channels"
 MIN_BYTES = 1024  # 1 KB, recording created in 5 seconds should be larger than this
+RECEIVER_CAPTURE = "receiver"
+CMD_SET_SEGMENTED = """UPDATE tasks
+                    SET status = "segmented", seg_index = ?, gaps = ?
+                    WHERE task_id = ?"""
 
 
 class ChannelHandler:
@@ -86,14 +96,22 @@ class ChannelHandler:
             ch_data[key]["name"] = "_".join(
                 ch_data[key]["name"].lower().split()
             )  # replace whitespace with underscore
+        try:
             with DBHandler.connect() as db_cur:
-                ch_id = DBHandler.insert_data(db_cur, "channels", ch_data[key])
-            if ch_id is not None:
-                LOG.info("Channel (id = %s) added with following data:\n%s", ch_id, ch_data[key])
+                added = DBHandler.insert_many(db_cur, "channels", list(ch_data.values()))
+        except DBException as err:
+            LOG.warning("Failed to add channels!")
+            LOG.debug(err)
+            return
+        finally:
+            registry.refresh()
 
-                # create directory for channel recordings and putting processed files
-                ch_dir = os.path.join(__recording_dir__, ch_data[key]["name"])
-                os.makedirs(ch_dir, exist_ok=True)
+        for channel in added:
+            LOG.info("Channel added with following data:\n%s", channel)
+
+            # create directory for channel recordings and putting processed files
+            ch_dir = os.path.join(__recording_dir__, channel["name"])
+            os.makedirs(ch_dir, exist_ok=True)
 
     @staticmethod
     def delete_channel():
@@ -113,6 +131,8 @@ class ChannelHandler:
             LOG.warning("Failed to remove channels!")
             LOG.debug(err)
             raise IOError
+        finally:
+            registry.refresh()
 
     @staticmethod
     def grab_ch_list():
@@ -135,7 +155,9 @@ class ChannelHandler:
             LOG.debug(err)
 
     @staticmethod
-    def record_stream(ip_addr, addr, duration_secs, test=False):
+    def record_stream(ip_addr, addr,  # pylint: disable=too-many-arguments
+                      duration_secs, test=False, timeout=None, live=False, preroll=0,
+                      lookback=0):
         """
         Function to record stream from the ip address for the given duration,
         and in the given addr.
@@ -154,6 +176,20 @@ class ChannelHandler:
         test
             type: bool
             True if run by channel online check test, False otherwise
+        timeout
+            type: int
+            seconds after which the recording process is killed, None to wait for it
+        live
+            type: bool
+            True to transcode the stream while recording, without writing the ".ts"
+        preroll
+            type: int
+            seconds the job was launched ahead of the scheduled start; the recording begins
+            right away, is named after the scheduled start and ends duration_secs after it
+        lookback
+            type: int
+            seconds before the start the recording begins at, taken from the time-shift
+            buffer of the channel if it has one; not applied to live or segmented recordings
 
         Returns
         -------
@@ -162,7 +198,8 @@ class ChannelHandler:
 
         """
         if not test:
-            addr = addr + str(datetime.now().strftime("%Y-%m-%d_%H%M") + ".ts")
+            start = _scheduled_start(preroll)
+            addr = addr + str(start.strftime("%Y-%m-%d_%H%M") + ".ts")
             aux_addr = str.replace(addr, ".ts", ".aux")
             if not _is_up(ip_addr):
                 add_to_report("Recording IP:{ip_addr} skipped since the channel is down.".format(
@@ -171,33 +208,43 @@ class ChannelHandler:
                 return False
 
         config = get_recorder_config()
-
-        duration_27khz = int(duration_secs * 27000000)
-        timeout_str = '-d {:d}'.format(duration_27khz)
-        path_to_multicat = config['path_to_multicat']
-        ifaddr = config['ifaddr']
-        if ifaddr:
-            ifaddr = '/ifaddr=' + ifaddr
-
-        cmd = "{multicat_path} {duration} -u @{channel_ip}{ifaddr} '{out_file}'".format(
-            multicat_path=path_to_multicat, duration=timeout_str, channel_ip=ip_addr,
-            ifaddr=ifaddr, out_file=addr)
+        if preroll and not test:
+            # the time left until the start is recorded too, keeping the end on schedule
+            lead_secs = (start - datetime.now()).total_seconds()
+            duration_secs = int(round(duration_secs + lead_secs))
+            lookback = max(lookback - lead_secs, 0)
+            LOG.debug("Recording %s from %.1f seconds before its start", addr, lead_secs)
+        if live and not test:
+            recorded = record_live(ip_addr, addr, duration_secs, config['ifaddr'])
+            if recorded is not None:
+                return recorded
+
+        segment_secs = 60 * int(config.get('segment_minutes') or 0)
+        if not test and 0 < segment_secs < duration_secs:
+            return _record_segments(ip_addr, addr, duration_secs, segment_secs, config, timeout)
+
+        gaps = []
+        buffered = bool(lookback) and not test and timeshift.get_buffer(ip_addr) is not None
+        shared = config.get('capture') == RECEIVER_CAPTURE or buffered
         try:
-            LOG.debug("running '%s' command", cmd)
-            record_process = subprocess.Popen(cmd,
-                                              shell=True,
-                                              stdout=subprocess.PIPE,
-                                              stderr=subprocess.STDOUT)
-            process_output, _ = record_process.communicate()
-            LOG.debug(process_output)
+            if buffered:
+                LOG.debug("recording %s from %d seconds back in its time-shift buffer",
+                          ip_addr, lookback)
+                timeshift.record(ip_addr, addr, duration_secs, lookback, config['ifaddr'])
+            elif shared:
+                LOG.debug("recording %s through the shared receiver", ip_addr)
+                receiver.record(ip_addr, addr, duration_secs, config['ifaddr'])
+            elif not _record_multicat(ip_addr, addr, duration_secs, config, timeout, gaps):
+                return False
             if not test:
-                os.remove(aux_addr)
+                if not shared:
+                    os.remove(aux_addr)
                 if os.stat(addr).st_size <= MIN_BYTES:
                     os.remove(addr)
                 else:
-                    PreprocessHandler.insert_task(addr, ip_addr)
+                    PreprocessHandler.insert_task(addr, ip_addr, gaps=gaps)
             return True
-        except (OSError, subprocess.CalledProcessError) as err:
+        except (OSError, ValueError, subprocess.CalledProcessError) as err:
             LOG.warning("Recording for channel with ip %s, failed!", ip_addr)
             add_to_report("Recording IP:{ip_addr} failed due to following error:\n{error}\n".format(
                 ip_addr=ip_addr,
@@ -207,6 +254,293 @@ class ChannelHandler:
             return False
 
 
+def _record_segments(ip_addr, addr, duration_secs,  # pylint: disable=too-many-arguments
+                     segment_secs, config, timeout):
+    """
+    Records the stream in segments of segment_secs, each inserted as a task of its own
+    as soon as it is closed, so that it is processed while the rest is being recorded.
+    Through the shared receiver, every segment starts exactly where the previous one stops.
+
+    Parameters
+    ----------
+    ip_addr
+        type: str
+        IP address of the stream, format "host:port"
+    addr
+        type: str
+        absolute file path the whole recording would have been saved at, with ".ts"
+    duration_secs
+        type: int
+        duration to record the show in seconds
+    segment_secs
+        type: int
+        duration of a segment in seconds
+    config
+        type: dict
+        configuration for the recording module
+    timeout
+        type: int
+        seconds after which a multicat process is killed, None to wait for it
+
+    Returns
+    -------
+    type: bool
+    True if any segment was recorded, False otherwise
+
+    """
+    parent = PreprocessHandler.insert_parent_task(addr, ip_addr)
+    if parent is None:
+        return False
+    parent_id, store_path = parent
+    bounds = [(offset, min(segment_secs, duration_secs - offset))
+              for offset in range(0, duration_secs, segment_secs)]
+    paths = ["{base}_part{index:03d}.ts".format(base=addr[:-3], index=index)
+             for index in range(len(bounds))]
+    segments = 0
+    gaps = []
+
+    try:
+        if config.get('capture') == RECEIVER_CAPTURE:
+            start = time.monotonic()
+            consumers = []
+            for index, (offset, secs) in enumerate(bounds):
+                # the next segment is attached before the current one stops, leaving no gap
+                if index == 0:
+                    consumers.append(receiver.FileConsumer(paths[0], secs, start))
+                    receiver.attach(ip_addr, consumers[0], config['ifaddr'])
+                if index + 1 < len(bounds):
+                    consumers.append(receiver.FileConsumer(paths[index + 1],
+                                                           bounds[index + 1][1],
+                                                           start + bounds[index + 1][0]))
+                    receiver.attach(ip_addr, consumers[-1], config['ifaddr'])
+                receiver.wait(consumers[index])
+                segments += _insert_segment(paths[index], ip_addr, index, parent_id,
+                                            store_path)
+        else:
+            for index, (offset, secs) in enumerate(bounds):
+                seg_gaps = []
+                if not _record_multicat(ip_addr, paths[index], secs, config, timeout, seg_gaps):
+                    break
+                os.remove(str.replace(paths[index], ".ts", ".aux"))
+                segments += _insert_segment(paths[index], ip_addr, index, parent_id,
+                                            store_path, seg_gaps)
+                gaps.extend([offset + at, gap_secs] for at, gap_secs in seg_gaps)
+    except (OSError, ValueError, subprocess.CalledProcessError) as err:
+        LOG.warning("Recording for channel with ip %s, failed!", ip_addr)
+        add_to_report("Recording IP:{ip_addr} failed due to following error:\n{error}\n".format(
+            ip_addr=ip_addr,
+            error=err
+        ))
+        LOG.debug(err)
+    finally:
+        # the segments recorded so far are stitched even if the recording was cut short
+        try:
+            with DBHandler.connect() as db_cur:
+                db_cur.execute(CMD_SET_SEGMENTED, (segments, json.dumps(gaps) if gaps else None,
+                                                   parent_id))
+        except DBException as err:
+            LOG.debug(err)
+    return segments > 0
+
+
+def _insert_segment(path, ip_addr, index,  # pylint: disable=too-many-arguments
+                    parent_id, store_path, gaps=None):
+    """
+    Inserts the task of a recorded segment and starts processing it.
+
+    Parameters
+    ----------
+    path
+        type: str
+        absolute path of the segment
+    ip_addr
+        type: str
+        IP address of the stream, format "host:port"
+    index
+        type: int
+        position of the segment in the recording
+    parent_id
+        type: int
+        id of the task of the whole recording
+    store_path
+        type: str
+        store path of the whole recording
+    gaps
+        type: list
+        gap markers of the segment, see _record_multicat
+
+    Returns
+    -------
+    type: int
+    1 if the segment was inserted, 0 otherwise
+
+    """
+    if os.stat(path).st_size <= MIN_BYTES:
+        os.remove(path)
+        return 0
+    seg_store_path = os.path.join(store_path + SEGMENTS_SUFFIX, "{:03d}".format(index))
+    if PreprocessHandler.insert_task(path, ip_addr, store_path=seg_store_path,
+                                     parent_id=parent_id, seg_index=index, gaps=gaps) is None:
+        return 0
+    PreprocessHandler.start_worker()
+    return 1
+
+
+def _record_multicat(ip_addr, addr, duration_secs,  # pylint: disable=too-many-arguments
+                     config, timeout, gaps=None):
+    """
+    Records the stream with a multicat process of its own, sampled by a watchdog.
+    If nothing is written for "stall_secs", the capture is restarted into a new piece,
+    appended to the recording once closed, until the recording is due to end.
+
+    Parameters
+    ----------
+    ip_addr
+        type: str
+        IP address of the stream, format "host:port"
+    addr
+        type: str
+        absolute file path to save the recording
+    duration_secs
+        type: int
+        duration to record the show in seconds
+    config
+        type: dict
+        configuration for the recording module
+    timeout
+        type: int
+        seconds after which the recording process is killed, None to wait for it
+    gaps
+        type: list
+        list the gap markers of the recording are appended to, each a list of the second
+        of the recording the stream stopped at and the seconds it was missing for
+
+    Returns
+    -------
+    type: bool
+    True if multicat finished, False if it timed out
+
+    """
+    gaps = [] if gaps is None else gaps
+    stall_secs = int(config.get('stall_secs') or 0)
+    start = time.monotonic()
+    path = addr
+    piece = 0
+    stalled_at = None  # second of the recording the stream stopped at, while it is missing
+    while True:
+        remaining = start + duration_secs - time.monotonic()
+        # a capture too short to stall is left to run out
+        watchdog = Watchdog(path, stall_secs if remaining > stall_secs else 0)
+        cmd = _multicat_cmd(ip_addr, path, remaining, config)
+        LOG.debug("running '%s' command", " ".join(cmd))
+        record_process = subprocess.Popen(cmd,
+                                          stdout=subprocess.PIPE,
+                                          stderr=subprocess.STDOUT)
+        outcome = supervise(record_process, watchdog,
+                            None if timeout is None else start + timeout - time.monotonic())
+        if outcome == TIMED_OUT:
+            LOG.debug("Recording for channel with ip %s timed out", ip_addr)
+            return False
+        if piece and os.path.exists(path):
+            _append_piece(path, addr)
+
+        if stalled_at is not None and watchdog.first_growth is not None:
+            gaps.append([stalled_at, int(round(watchdog.first_growth - start)) - stalled_at])
+            LOG.info("Stream of %s resumed after %d seconds", ip_addr, gaps[-1][1])
+            stalled_at = None
+        if outcome != STALLED:
+            break
+        if stalled_at is None:
+            stalled_at = int(round(watchdog.last_growth - start))
+            LOG.warning("Stream of %s stalled, restarting its capture", ip_addr)
+            add_to_report("Recording IP:{ip_addr} stalled {secs} seconds into {file}\n".format(
+                ip_addr=ip_addr, secs=stalled_at, file=addr))
+        if start + duration_secs - time.monotonic() < SAMPLE_SECS:
+            break
+        piece += 1
+        path = "{base}_piece{index:02d}.ts".format(base=addr[:-3], index=piece)
+
+    if stalled_at is not None:
+        gaps.append([stalled_at, duration_secs - stalled_at])
+    return True
+
+
+def _multicat_cmd(ip_addr, path, duration_secs, config):
+    """
+    Parameters
+    ----------
+    ip_addr
+        type: str
+        IP address of the stream, format "host:port"
+    path
+        type: str
+        absolute file path to save the capture
+    duration_secs
+        type: float
+        duration of the capture in seconds
+    config
+        type: dict
+        configuration for the recording module
+
+    Returns
+    -------
+    type: list
+    arguments of the multicat process
+
+    """
+    source = "@" + ip_addr
+    if config['ifaddr']:
+        source += "/ifaddr=" + config['ifaddr']
+    return [config['path_to_multicat'], "-d", str(int(duration_secs * 27000000)),
+            "-u", source, path]
+
+
+def _append_piece(path, addr):
+    """
+    Appends a piece of a restarted capture to the recording, and removes it.
+
+    Parameters
+    ----------
+    path
+        type: str
+        absolute path of the piece
+    addr
+        type: str
+        absolute path of the recording
+
+    Returns
+    -------
+
+    """
+    with open(path, "rb") as piece_file, open(addr, "ab") as recording:
+        shutil.copyfileobj(piece_file, recording)
+    os.remove(path)
+    aux_path = str.replace(path, ".ts", ".aux")
+    if os.path.exists(aux_path):
+        os.remove(aux_path)
+
+
+def _scheduled_start(preroll):
+    """
+    Parameters
+    ----------
+    preroll
+        type: int
+        seconds the recording job is launched ahead of its start
+
+    Returns
+    -------
+    type: datetime.datetime
+    start of the recording as scheduled, ie. the minute nearest to preroll seconds from
+    now; the launch of a job is late by well under half a minute
+
+    """
+    start = datetime.now() + timedelta(seconds=preroll)
+    if preroll:
+        start = (start + timedelta(seconds=30)).replace(second=0, microsecond=0)
+    return start
+
+
 def _is_up(ip_addr):
     """
     Queries if the channel was up in the previous test.
@@ -223,10 +557,7 @@ def _is_up(ip_addr):
         True, if the channel was up, False otherwise.
 
     """
-    command = """SELECT * FROM channels WHERE ip=?"""
-    with DBHandler.connect() as db_cur:
-        db_cur.execute(command, (ip_addr, ))
-        ch_data = db_cur.fetchall()[0]
-    if ch_data[CH_STAT_INDEX] == "up":
+    channel = registry.get_by_ip(ip_addr)
+    if channel is not None and channel[CH_STAT_INDEX] == "up":
         return True
     return False
@@ -4,10 +4,11 @@ Stores all code related to recording jobs
 
 import os
 from logging import getLogger
-from sqlite3 import InterfaceError
+from pydash import get
 
+from . import get_recorder_config, registry
 from .. import __recording_dir__, validate_entries
-from ..manage_db import DBHandler
+from ..manage_db import CH_IP_INDEX
 from ..exceptions import DBException
 
 
@@ -55,8 +56,7 @@ class JobHandler:
             }
         }
         try:
-            with DBHandler.connect() as db_cur:
-                self.insert_jobs(db_cur, validate_entries(job_data))
+            self.insert_jobs(validate_entries(job_data))
         except DBException as err:
             LOG.warning("Data addition failed")
             LOG.debug(err)
@@ -80,23 +80,19 @@ class JobHandler:
 
         """
         try:
-            with DBHandler.connect() as db_cur:
-                self.insert_jobs(db_cur, data)
+            self.insert_jobs(data)
             return True
         except DBException as err:
             LOG.warning("Data addition failed")
             LOG.debug(err)
             return False
 
-    def insert_jobs(self, db_cur, job_data):
+    def insert_jobs(self, job_data):
         """
         passes job data to add_recording_job method of Scheduler class.
 
         Parameters
         ----------
-        db_cur
-            type: sqlite database cursor
-            cursor to the database of channels
         job_data
             type: dict
             dict containing channel with data as in the add_job function
@@ -105,33 +101,32 @@ class JobHandler:
         -------
 
         """
-        sql_command = "SELECT ip FROM channels WHERE name=?"
+        # recordings are launched this many seconds early, to be running by their start
+        preroll = int(get(get_recorder_config(), 'preroll_secs') or 0)
         for job_key in job_data.keys():
-            try:
-                job_data[job_key]["channel_name"] = "_".join(
-                    job_data[job_key]["channel_name"].lower().split()
-                )
-                db_cur.execute(sql_command, (job_data[job_key]["channel_name"], ))
-                try:
-                    ip_addr = db_cur.fetchall()[0][0]
-                except IndexError as err:
-                    LOG.info("No channel %s found!", job_data[job_key]["channel_name"])
-                    LOG.debug(err)
-                    return
-                out_path = os.path.join(__recording_dir__, job_data[job_key]["channel_name"],
-                                        job_data[job_key]["name"])
-                duration = job_data[job_key]["duration"]
-                job_time = str(job_data[job_key]["start_time"])
-                week_str = self.to_weekday(job_data[job_key]["repetition"])
-                job_name = "_".join(job_data[job_key]["name"].lower().split())
-
-                self._scheduler.add_recording_job(ip_addr=ip_addr, out_path=out_path,
-                                                  duration=duration,
-                                                  job_time=job_time, week_days=week_str,
-                                                  job_name=job_name)
-            except InterfaceError as error:
-                LOG.warning('No channel %s in database!', job_data[job_key]["channel_name"])
-                LOG.debug(error)
+            job_data[job_key]["channel_name"] = "_".join(
+                job_data[job_key]["channel_name"].lower().split()
+            )
+            channel = registry.get_by_name(job_data[job_key]["channel_name"])
+            if channel is None:
+                LOG.info("No channel %s found!", job_data[job_key]["channel_name"])
+                return
+            ip_addr = channel[CH_IP_INDEX]
+            out_path = os.path.join(__recording_dir__, job_data[job_key]["channel_name"],
+                                    job_data[job_key]["name"])
+            duration = job_data[job_key]["duration"]
+            job_time = str(job_data[job_key]["start_time"])
+            week_str = self.to_weekday(job_data[job_key]["repetition"])
+            job_name = "_".join(job_data[job_key]["name"].lower().split())
+            lookback = int(job_data[job_key].get("lookback") or 0)
+
+            self._scheduler.add_recording_job(ip_addr=ip_addr, out_path=out_path,
+                                              duration=duration,
+                                              job_time=job_time, week_days=week_str,
+                                              job_name=job_name,
+                                              live=bool(job_data[job_key].get("live", False)),
+                                              preroll=preroll,
+                                              lookback=lookback)
 
     def display_jobs(self):
         """
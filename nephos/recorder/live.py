@@ -0,0 +1,83 @@
+"""
+Live transcoding, feeding the stream to the encoder while it is recorded instead of writing
+the raw recording to disk and processing it afterwards
+"""
+import os
+import shutil
+from functools import partial
+from logging import getLogger
+
+from . import receiver
+from ..preprocessor import get_preprocessor_config, pipeline
+from ..preprocessor.methods import ApplyProcessMethods, RECORDING_TIME_PATTERN, MIN_BYTES
+from ..preprocessor.preprocess import PreprocessHandler
+from ..mail_notifier import add_to_report
+
+
+LOG = getLogger(__name__)
+
+
+def record_live(ip_addr, addr, duration_secs, ifaddr=""):
+    """
+    Records the stream straight into the encoder and subtitle extractor of the recording's
+    profile; the processed files are ready to be uploaded once the recording ends.
+
+    Parameters
+    ----------
+    ip_addr
+        type: str
+        IP address of the stream, format "host:port"
+    addr
+        type: str
+        absolute path the recording would have been saved at, with ".ts"
+    duration_secs
+        type: int
+        duration to record the show in seconds
+    ifaddr
+        type: str
+        address of the interface to join the multicast group on
+
+    Returns
+    -------
+    type: bool
+    True if successful, False if transcoding failed, None if the recording's profile
+    cannot encode while recording
+
+    """
+    config = get_preprocessor_config()
+    name = os.path.splitext(os.path.basename(addr))[0]
+    ch_name = os.path.basename(os.path.dirname(addr))
+    try:
+        profile = pipeline.select_profile(config, ch_name, RECORDING_TIME_PATTERN.sub("", name))
+    except ValueError as err:
+        LOG.warning("Invalid encode profile configuration")
+        LOG.debug(err)
+        return None
+    if not profile.streamable:
+        LOG.warning("Profile %s cannot encode while recording, recording %s instead",
+                    profile.name, addr)
+        return None
+
+    store_path = PreprocessHandler.get_store_path(ch_name)
+    os.makedirs(store_path, exist_ok=True)
+    stage = profile.stages(None, name, store_path, config, live=True)[0]
+    LOG.debug("Transcoding %s live with profile %s", ip_addr, profile.name)
+    results = pipeline.run_stage(stage, store_path,
+                                 partial(receiver.stream, ip_addr, duration_secs, ifaddr))
+
+    out_file = os.path.join(store_path, name + ".mp4")
+    failed_steps = [result for result in results
+                    if result.failed and result.name != "ccextractor"]
+    if failed_steps or not os.path.exists(out_file) or os.stat(out_file).st_size <= MIN_BYTES:
+        LOG.warning("Live transcoding of channel with ip %s failed!", ip_addr)
+        add_to_report("Live transcoding of IP:{ip_addr} failed, step(s): {steps}\n".format(
+            ip_addr=ip_addr,
+            steps=failed_steps
+        ))
+        shutil.rmtree(store_path, ignore_errors=True)
+        return False
+
+    if PreprocessHandler.insert_task(addr, ip_addr, store_path=store_path,
+                                     encoded=True) is not None:
+        ApplyProcessMethods(addr, store_path, encoded=True)
+    return True
@@ -0,0 +1,207 @@
+"""
+Probes multicast streams in process, reading the datagrams without recording them to disk
+"""
+import socket
+import struct
+import time
+from ipaddress import ip_address
+from logging import getLogger
+
+
+LOG = getLogger(__name__)
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+RTP_HEADER_SIZE = 12
+RTP_VERSION = 2
+RECV_BUFFER = 65536
+MIN_SYNC_RATIO = 0.9  # fraction of packets that must begin with the sync byte
+
+
+class ProbeResult:
+    """
+    Counts of what was received on a stream during a probe.
+    """
+
+    def __init__(self, ip_addr):
+        self.ip_addr = ip_addr
+        self.datagrams = 0
+        self.bytes = 0
+        self.packets = 0
+        self.sync_packets = 0
+
+    def add(self, datagram):
+        """
+        Accounts a received datagram, stripping the RTP header if present.
+
+        Parameters
+        ----------
+        datagram
+            type: bytes
+            payload of the UDP datagram
+
+        Returns
+        -------
+
+        """
+        self.datagrams += 1
+        self.bytes += len(datagram)
+        datagram = strip_rtp(datagram)
+        for offset in range(0, len(datagram), TS_PACKET_SIZE):
+            self.packets += 1
+            if (datagram[offset] == TS_SYNC_BYTE and
+                    offset + TS_PACKET_SIZE <= len(datagram)):
+                self.sync_packets += 1
+
+    @property
+    def is_receiving(self):
+        """
+        Returns
+        -------
+        type: bool
+        True if any packet was received, False otherwise
+
+        """
+        return self.datagrams > 0
+
+    @property
+    def is_valid(self):
+        """
+        Returns
+        -------
+        type: bool
+        True if the received packets are MPEG-TS, False otherwise
+
+        """
+        return self.packets > 0 and self.sync_packets / self.packets >= MIN_SYNC_RATIO
+
+    @property
+    def valid_bytes(self):
+        """
+        Returns
+        -------
+        type: int
+        bytes received in MPEG-TS packets with a valid sync byte
+
+        """
+        return self.sync_packets * TS_PACKET_SIZE
+
+    def __repr__(self):
+        return "<ProbeResult {ip}: {datagrams} datagrams, {bytes} bytes, {sync}/{packets} " \
+               "TS packets in sync>".format(ip=self.ip_addr, datagrams=self.datagrams,
+                                            bytes=self.bytes, sync=self.sync_packets,
+                                            packets=self.packets)
+
+
+def strip_rtp(datagram):
+    """
+    Removes the RTP header from a datagram carrying MPEG-TS packets.
+
+    Parameters
+    ----------
+    datagram
+        type: bytes
+        payload of the UDP datagram
+
+    Returns
+    -------
+    type: bytes
+    MPEG-TS packets of the datagram
+
+    """
+    if (len(datagram) % TS_PACKET_SIZE == RTP_HEADER_SIZE and
+            datagram[0] >> 6 == RTP_VERSION):
+        return datagram[RTP_HEADER_SIZE:]
+    return datagram
+
+
+def open_socket(ip_addr, ifaddr):
+    """
+    Opens a UDP socket receiving the stream, joining its multicast group on ifaddr.
+
+    Parameters
+    ----------
+    ip_addr
+        type: str
+        IP address of the stream, format "host:port"
+    ifaddr
+        type: str
+        address of the interface to join the group on, empty for the default interface
+
+    Returns
+    -------
+    type: socket.socket
+    bound socket
+
+    Raises
+    ------
+    OSError
+        when the socket cannot be bound or the group cannot be joined
+    ValueError
+        when the address is malformed
+
+    """
+    host, port = ip_addr.rsplit(":", 1)
+    port = int(port)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        if ip_address(host).is_multicast:
+            membership = struct.pack("4s4s", socket.inet_aton(host),
+                                     socket.inet_aton(ifaddr or "0.0.0.0"))
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+    except (OSError, ValueError):
+        sock.close()
+        raise
+    return sock
+
+
+def probe_stream(ip_addr, duration_secs, ifaddr="", enough_bytes=None):
+    """
+    Listens to the stream for at most duration_secs and counts what was received.
+
+    Parameters
+    ----------
+    ip_addr
+        type: str
+        IP address of the stream, format "host:port"
+    duration_secs
+        type: float
+        length of the listening window in seconds
+    ifaddr
+        type: str
+        address of the interface to join the multicast group on
+    enough_bytes
+        type: int
+        stop listening early once this many bytes of valid MPEG-TS are received
+
+    Returns
+    -------
+    type: ProbeResult
+    counts of the received datagrams and packets
+
+    Raises
+    ------
+    OSError
+        when the socket cannot be bound or the group cannot be joined
+    ValueError
+        when the address is malformed
+
+    """
+    result = ProbeResult(ip_addr)
+    deadline = time.monotonic() + duration_secs
+    with open_socket(ip_addr, ifaddr) as sock:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            sock.settimeout(remaining)
+            try:
+                datagram = sock.recv(RECV_BUFFER)
+            except socket.timeout:
+                break
+            result.add(datagram)
+            if enough_bytes is not None and result.valid_bytes >= enough_bytes:
+                break
+    LOG.debug(result)
+    return result
@@ -0,0 +1,547 @@
+"""
+Recorder daemon keeping a single receiver per multicast address; recordings and probes of the
+same stream attach to it as consumers instead of joining the group again
+"""
+import queue
+import socket
+import threading
+import time
+from abc import ABC, abstractmethod
+from logging import getLogger
+
+from .probe import ProbeResult, open_socket, strip_rtp, RECV_BUFFER
+
+
+LOG = getLogger(__name__)
+POLL_SECS = 0.5  # longest wait for a datagram before the consumers' boundaries are checked
+MAX_QUEUED = 50000  # datagrams, about 64 MB, buffered for processes fed by a PipeConsumer
+DETACH_GRACE_SECS = 10  # wait for a consumer to be detached beyond its stop boundary
+_RECEIVERS = {}
+_LOCK = threading.Lock()
+
+
+class Consumer(ABC):
+    """
+    Receives the datagrams of a stream between its start and stop boundaries.
+
+    Compulsory method for the derived classes:
+        _consume()
+    """
+
+    def __init__(self, duration_secs, start=None):
+        """
+        Parameters
+        ----------
+        duration_secs
+            type: float
+            seconds for which datagrams are to be consumed
+        start
+            type: float
+            time.monotonic() at which consumption begins, None for immediately
+        """
+        self.start = time.monotonic() if start is None else start
+        self.stop = self.start + duration_secs
+        self._done = threading.Event()
+
+    def feed(self, datagram):
+        """
+        Passes a datagram received within the boundaries to the consumer.
+
+        Parameters
+        ----------
+        datagram
+            type: bytes
+            payload of the UDP datagram
+
+        Returns
+        -------
+        type: bool
+        True if the consumer wants no more datagrams, False otherwise
+
+        """
+        return self._consume(datagram)
+
+    @abstractmethod
+    def _consume(self, datagram):
+        """
+        TO BE OVERRIDDEN IN DERIVED CLASS
+        handling of a received datagram goes here
+
+        Returns
+        -------
+        type: bool
+        True if the consumer wants no more datagrams, False otherwise
+
+        """
+        pass
+
+    def close(self):
+        """
+        Marks the consumer as finished, called by the receiver once detached.
+
+        Returns
+        -------
+
+        """
+        self._done.set()
+
+    @property
+    def done(self):
+        """
+        Returns
+        -------
+        type: bool
+        True if the consumer is detached from the receiver, False otherwise
+
+        """
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Blocks until the consumer is detached from the receiver.
+
+        Parameters
+        ----------
+        timeout
+            type: float
+            seconds to wait, None to wait till the stop boundary
+
+        Returns
+        -------
+        type: bool
+        True if the consumer finished, False on timeout
+
+        """
+        return self._done.wait(timeout)
+
+
+class FileConsumer(Consumer):
+    """
+    Writes the MPEG-TS packets of the stream to a file, as multicat does.
+    """
+
+    def __init__(self, path, duration_secs, start=None):
+        Consumer.__init__(self, duration_secs, start)
+        self.path = path
+        self.bytes_written = 0
+        self._file = open(path, "wb")
+
+    def _consume(self, datagram):
+        self.bytes_written += self._file.write(strip_rtp(datagram))
+        return False
+
+    def close(self):
+        self._file.close()
+        Consumer.close(self)
+
+
+class ProbeConsumer(Consumer):
+    """
+    Counts the received packets of the stream like probe.probe_stream does.
+    """
+
+    def __init__(self, ip_addr, duration_secs, enough_bytes=None, start=None):
+        Consumer.__init__(self, duration_secs, start)
+        self.result = ProbeResult(ip_addr)
+        self.enough_bytes = enough_bytes
+
+    def _consume(self, datagram):
+        self.result.add(datagram)
+        return self.enough_bytes is not None and self.result.valid_bytes >= self.enough_bytes
+
+
+class PipeConsumer(Consumer):
+    """
+    Writes the MPEG-TS packets of the stream into the stdin of processes, such as encoders
+    transcoding the stream while it is recorded. Writing happens in a thread of its own so
+    that a slow process does not hold up the receiver and its other consumers.
+    """
+
+    def __init__(self, pipes, duration_secs, start=None):
+        Consumer.__init__(self, duration_secs, start)
+        self.dropped = 0
+        self._pipes = list(pipes)
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write, name="pipe-writer", daemon=True)
+        self._writer.start()
+
+    def _consume(self, datagram):
+        if not self._pipes:
+            return True
+        if self._queue.qsize() >= MAX_QUEUED:
+            self.dropped += 1
+        else:
+            self._queue.put(strip_rtp(datagram))
+        return False
+
+    def _write(self):
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                break
+            for pipe in list(self._pipes):
+                try:
+                    pipe.write(chunk)
+                except (BrokenPipeError, ValueError):
+                    self._pipes.remove(pipe)
+        for pipe in self._pipes:
+            try:
+                pipe.close()
+            except BrokenPipeError:
+                pass
+        if self.dropped:
+            LOG.warning("%d datagram(s) dropped, the processes did not keep up", self.dropped)
+        Consumer.close(self)
+
+    def close(self):
+        # the writer marks the consumer finished once everything queued is written
+        self._queue.put(None)
+
+
+class Receiver(threading.Thread):
+    """
+    Owns the socket joined to a multicast group and dispatches every datagram to the
+    consumers attached to it; exits once the last consumer is detached.
+    """
+
+    def __init__(self, ip_addr, ifaddr=""):
+        """
+        Parameters
+        ----------
+        ip_addr
+            type: str
+            IP address of the stream, format "host:port"
+        ifaddr
+            type: str
+            address of the interface to join the multicast group on
+
+        Raises
+        ------
+        OSError
+            when the socket cannot be bound or the group cannot be joined
+        ValueError
+            when the address is malformed
+        """
+        threading.Thread.__init__(self, name="receiver-" + ip_addr, daemon=True)
+        self.ip_addr = ip_addr
+        self._sock = open_socket(ip_addr, ifaddr)
+        self._consumers = []
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def attach(self, consumer):
+        """
+        Adds a consumer to the receiver.
+
+        Parameters
+        ----------
+        consumer
+            type: Consumer
+            consumer to be fed with the datagrams of the stream
+
+        Returns
+        -------
+        type: bool
+        True if attached, False if the receiver is shutting down
+
+        """
+        with self._lock:
+            if self._closed:
+                return False
+            self._consumers.append(consumer)
+            return True
+
+    @property
+    def consumers(self):
+        """
+        Returns
+        -------
+        type: list
+        consumers currently attached
+
+        """
+        with self._lock:
+            return list(self._consumers)
+
+    def run(self):
+        LOG.debug("Receiver for %s started", self.ip_addr)
+        try:
+            while self._dispatch():
+                pass
+        finally:
+            self._sock.close()
+            _remove(self)
+            # consumers left behind by an unexpected error are released to their waiters
+            with self._lock:
+                self._closed = True
+                consumers = self._consumers
+                self._consumers = []
+            self._close(consumers)
+            LOG.debug("Receiver for %s stopped", self.ip_addr)
+
+    def _dispatch(self):
+        """
+        Receives a datagram and passes it to the consumers within their boundaries,
+        detaching those which are finished.
+
+        Returns
+        -------
+        type: bool
+        False once no consumer is left, True otherwise
+
+        """
+        with self._lock:
+            if not self._consumers:
+                self._closed = True
+                return False
+            consumers = list(self._consumers)
+
+        next_stop = min(consumer.stop for consumer in consumers) - time.monotonic()
+        self._sock.settimeout(min(max(next_stop, 0.01), POLL_SECS))
+        try:
+            datagram = self._sock.recv(RECV_BUFFER)
+        except socket.timeout:
+            datagram = None
+        except OSError as err:
+            LOG.warning("Receiving stream of IP:%s failed", self.ip_addr)
+            LOG.debug(err)
+            self._detach(consumers)
+            return True
+
+        now = time.monotonic()
+        finished = []
+        for consumer in consumers:
+            if now >= consumer.stop:
+                finished.append(consumer)
+            elif datagram is not None and now >= consumer.start:
+                try:
+                    if consumer.feed(datagram):
+                        finished.append(consumer)
+                except Exception as err:  # pylint: disable=broad-except
+                    # a failing consumer, eg. out of disk space, must not stop the others
+                    LOG.warning("A consumer of IP:%s failed, detaching it", self.ip_addr)
+                    LOG.debug(err)
+                    finished.append(consumer)
+        if finished:
+            self._detach(finished)
+        return True
+
+    def _detach(self, consumers):
+        with self._lock:
+            for consumer in consumers:
+                self._consumers.remove(consumer)
+        self._close(consumers)
+
+    def _close(self, consumers):
+        for consumer in consumers:
+            try:
+                consumer.close()
+            except Exception as err:  # pylint: disable=broad-except
+                LOG.warning("Closing a consumer of IP:%s failed", self.ip_addr)
+                LOG.debug(err)
+
+
+def _remove(receiver):
+    """
+    Forgets a stopped receiver, unless it has already been replaced.
+
+    Parameters
+    ----------
+    receiver
+        type: Receiver
+
+    Returns
+    -------
+
+    """
+    with _LOCK:
+        if _RECEIVERS.get(receiver.ip_addr) is receiver:
+            del _RECEIVERS[receiver.ip_addr]
+
+
+def attach(ip_addr, consumer, ifaddr=""):
+    """
+    Attaches the consumer to the receiver of the stream, starting one if none is running.
+
+    Parameters
+    ----------
+    ip_addr
+        type: str
+        IP address of the stream, format "host:port"
+    consumer
+        type: Consumer
+        consumer to be fed with the datagrams of the stream
+    ifaddr
+        type: str
+        address of the interface to join the multicast group on
+
+    Returns
+    -------
+    type: Receiver
+    receiver the consumer is attached to
+
+    Raises
+    ------
+    OSError
+        when the socket cannot be bound or the group cannot be joined
+    ValueError
+        when the address is malformed
+
+    """
+    with _LOCK:
+        receiver = _RECEIVERS.get(ip_addr)
+        if receiver is not None and receiver.attach(consumer):
+            LOG.debug("Sharing receiver for %s with %d consumer(s)", ip_addr,
+                      len(receiver.consumers) - 1)
+            return receiver
+
+        receiver = Receiver(ip_addr, ifaddr)
+        receiver.attach(consumer)
+        _RECEIVERS[ip_addr] = receiver
+        receiver.start()
+        return receiver
+
+
+def wait(consumer):
+    """
+    Waits for the consumer to be detached, at most till DETACH_GRACE_SECS after its stop
+    boundary; the consumer is closed if its receiver failed to detach it by then.
+
+    Parameters
+    ----------
+    consumer
+        type: Consumer
+        consumer attached to a receiver
+
+    Returns
+    -------
+    type: bool
+    True if the consumer was detached by the receiver, False otherwise
+
+    """
+    if consumer.wait(max(consumer.stop - time.monotonic(), 0) + DETACH_GRACE_SECS):
+        return True
+    LOG.warning("Consumer not detached from its receiver in time, closing it")
+    consumer.close()
+    # a PipeConsumer is finished by its writer once the queue is written
+    consumer.wait(DETACH_GRACE_SECS)
+    return False
+
+
+def is_receiving(ip_addr):
+    """
+    Parameters
+    ----------
+    ip_addr
+        type: str
+        IP address of the stream, format "host:port"
+
+    Returns
+    -------
+    type: bool
+    True if a receiver is running for the stream, False otherwise
+
+    """
+    with _LOCK:
+        return ip_addr in _RECEIVERS
+
+
+def record(ip_addr, path, duration_secs, ifaddr=""):
+    """
+    Records the stream to a file, sharing the receiver with other consumers of the stream.
+
+    Parameters
+    ----------
+    ip_addr
+        type: str
+        IP address of the stream, format "host:port"
+    path
+        type: str
+        absolute path of the file to be written
+    duration_secs
+        type: float
+        duration of the recording in seconds
+    ifaddr
+        type: str
+        address of the interface to join the multicast group on
+
+    Returns
+    -------
+    type: int
+    number of bytes recorded
+
+    """
+    consumer = FileConsumer(path, duration_secs)
+    try:
+        attach(ip_addr, consumer, ifaddr)
+    except (OSError, ValueError):
+        consumer.close()
+        raise
+    wait(consumer)
+    return consumer.bytes_written
+
+
+def probe(ip_addr, duration_secs, ifaddr="", enough_bytes=None):
+    """
+    Counts the packets of the stream, reusing the live traffic of a running receiver.
+
+    Parameters
+    ----------
+    ip_addr
+        type: str
+        IP address of the stream, format "host:port"
+    duration_secs
+        type: float
+        length of the listening window in seconds
+    ifaddr
+        type: str
+        address of the interface to join the multicast group on
+    enough_bytes
+        type: int
+        stop listening early once this many bytes of valid MPEG-TS are received
+
+    Returns
+    -------
+    type: ProbeResult
+    counts of the received datagrams and packets
+
+    """
+    consumer = ProbeConsumer(ip_addr, duration_secs, enough_bytes)
+    attach(ip_addr, consumer, ifaddr)
+    wait(consumer)
+    LOG.debug(consumer.result)
+    return consumer.result
+
+
+def stream(ip_addr, duration_secs, ifaddr, pipes):
+    """
+    Writes the stream into the pipes for duration_secs, closing them afterwards.
+
+    Parameters
+    ----------
+    ip_addr
+        type: str
+        IP address of the stream, format "host:port"
+    duration_secs
+        type: float
+        duration of the recording in seconds
+    ifaddr
+        type: str
+        address of the interface to join the multicast group on
+    pipes
+        type: list
+        stdin of the processes to be fed
+
+    Returns
+    -------
+
+    """
+    consumer = PipeConsumer(pipes, duration_secs)
+    try:
+        attach(ip_addr, consumer, ifaddr)
+    except (OSError, ValueError) as err:
+        LOG.warning("Failed to receive stream of IP:%s", ip_addr)
+        LOG.debug(err)
+        # closing the pipes lets the processes exit instead of waiting for input
+        consumer.close()
+    wait(consumer)
@@ -0,0 +1,108 @@
+"""
+Keeps the channels in memory, indexed by name and by ip, so that looking a channel up
+on the recording and preprocessing paths does not query the database
+"""
+import threading
+from logging import getLogger
+
+from ..manage_db import DBHandler, DBException, CH_NAME_INDEX, CH_IP_INDEX
+
+
+LOG = getLogger(__name__)
+CMD_GET_CHANNELS = "SELECT * FROM channels"
+# channels by name and by ip, loaded on first use and reloaded whenever the table is written
+_INDEX = None
+_LOCK = threading.Lock()
+
+
+def refresh():
+    """
+    Reloads the channels from the database, to be called after every write to the
+    channels table. The channels loaded before are kept if the table can't be read.
+
+    Returns
+    -------
+    type: bool
+    True if the channels were reloaded, False otherwise
+
+    """
+    global _INDEX
+    with _LOCK:
+        try:
+            _INDEX = _load()
+            return True
+        except DBException as err:
+            LOG.warning("Failed to reload the channels")
+            LOG.debug(err)
+            return False
+
+
+def get_by_name(name):
+    """
+    Parameters
+    ----------
+    name
+        type: str
+        name of the channel
+
+    Returns
+    -------
+    type: tuple
+    column values of the channel, None if there is no such channel
+
+    """
+    return _get_index()[0].get(name)
+
+
+def get_by_ip(ip_addr):
+    """
+    Parameters
+    ----------
+    ip_addr
+        type: str
+        ip address of the channel, format "host:port"
+
+    Returns
+    -------
+    type: tuple
+    column values of the channel, None if there is no such channel
+
+    """
+    return _get_index()[1].get(ip_addr)
+
+
+def _get_index():
+    """
+    Returns
+    -------
+    type: tuple
+    dict of the channels by name and dict of the channels by ip
+
+    Raises
+    ------
+    DBException
+        if the channels were never loaded and can't be read from the database
+
+    """
+    global _INDEX
+    with _LOCK:
+        if _INDEX is None:
+            _INDEX = _load()
+        return _INDEX
+
+
+def _load():
+    """
+    Returns
+    -------
+    type: tuple
+    dict of the channels by name and dict of the channels by ip, as in the database
+
+    """
+    with DBHandler.connect() as db_cur:
+        db_cur.execute(CMD_GET_CHANNELS)
+        channels = db_cur.fetchall()
+    by_name = {channel[CH_NAME_INDEX]: channel for channel in channels}
+    by_ip = {channel[CH_IP_INDEX]: channel for channel in channels}
+    LOG.debug("%d channel(s) loaded", len(channels))
+    return by_name, by_ip
@@ -0,0 +1,708 @@
+"""
+Time-shift buffers keeping the latest minutes of the streams of channels, attached to their
+receivers, so that a recording may begin in the past and clips may be cut from the buffer
+without capturing the stream again
+"""
+import os
+import shutil
+import threading
+import time
+from abc import abstractmethod
+from collections import deque
+from itertools import chain
+from datetime import datetime, timedelta
+from logging import getLogger
+from pydash import get
+
+from . import get_recorder_config, receiver, registry
+from .probe import strip_rtp
+from .. import __nephos_dir__, __recording_dir__
+from ..manage_db import CH_IP_INDEX
+from ..preprocessor.methods import MIN_BYTES
+from ..preprocessor.preprocess import PreprocessHandler
+
+
+LOG = getLogger(__name__)
+BYTES_PER_MB = 1024 * 1024
+DEFAULT_MAX_MB = 512
+DEFAULT_SEGMENT_SECS = 60
+MEMORY_STORAGE = "memory"
+DISK_STORAGE = "disk"
+MEMORY_BLOCK_BYTES = BYTES_PER_MB  # the memory of a buffer is dropped a block at a time
+MARK_SECS = 1  # resolution of the times a buffer can be read from
+READ_BYTES = BYTES_PER_MB
+CHECK_MINUTES = 1  # interval of the restart of buffers whose receiver stopped
+TIMESHIFT_DIR = os.path.join(__nephos_dir__, "timeshift")
+_BUFFERS = {}  # running buffers by ip address of the channel
+_LOCK = threading.Lock()
+
+
+class Block:
+    """
+    Consecutive bytes of the stream held by a buffer.
+    """
+
+    def __init__(self, offset, data=None, path=None):
+        """
+        Parameters
+        ----------
+        offset
+            type: int
+            position of the first byte of the block in the stream
+        data
+            type: bytearray
+            bytes of a block kept in memory
+        path
+            type: str
+            file of a block kept on disk
+        """
+        self.offset = offset
+        self.size = 0
+        self.started = time.monotonic()
+        self.data = data
+        self.path = path
+        self.file = open(path, "wb") if path is not None else None
+
+
+class TimeShiftBuffer(receiver.Consumer):
+    """
+    Keeps the latest bytes of a stream, up to a number of minutes and of bytes, dropping the
+    oldest first. Bytes are addressed by their offset from the start of the buffer.
+
+    Compulsory methods for the derived classes:
+        _new_block()
+        _is_full()
+        _append()
+        _source()
+    """
+
+    def __init__(self, ch_name, minutes, max_bytes):
+        """
+        Parameters
+        ----------
+        ch_name
+            type: str
+            name of the buffered channel
+        minutes
+            type: float
+            minutes of the stream kept
+        max_bytes
+            type: int
+            bytes of the stream kept at most
+        """
+        receiver.Consumer.__init__(self, float("inf"))
+        self.ch_name = ch_name
+        self.max_secs = 60 * minutes
+        self.max_bytes = max_bytes
+        self.total = 0  # bytes received since the buffer started
+        self._blocks = deque()
+        self._marks = deque()  # tuples of time.monotonic() and offset, every MARK_SECS
+        self._last = None, 0  # last datagram consumed and the length of its payload
+        self._discarded = False
+        self._lock = threading.Lock()
+
+    def _consume(self, datagram):
+        payload = strip_rtp(datagram)
+        now = time.monotonic()
+        with self._lock:
+            if self._discarded:
+                return True
+            if not self._marks or now - self._marks[-1][0] >= MARK_SECS:
+                self._marks.append((now, self.total))
+            if not self._blocks or self._is_full(self._blocks[-1], now):
+                if self._blocks:
+                    self._seal(self._blocks[-1])
+                self._blocks.append(self._new_block(self.total))
+            self._append(self._blocks[-1], payload)
+            self._blocks[-1].size += len(payload)
+            self.total += len(payload)
+            self._last = datagram, len(payload)
+            self._trim(now)
+        return False
+
+    def _trim(self, now):
+        """
+        Drops the oldest blocks beyond the bounds of the buffer, the latest block being kept.
+
+        Parameters
+        ----------
+        now
+            type: float
+            time.monotonic() of the latest datagram
+
+        Returns
+        -------
+
+        """
+        while len(self._blocks) > 1 and (self.total - self._blocks[0].offset > self.max_bytes or
+                                         self._blocks[1].started < now - self.max_secs):
+            self._drop(self._blocks.popleft())
+        while self._marks and self._marks[0][1] < self._blocks[0].offset:
+            self._marks.popleft()
+
+    def position(self, datagram):
+        """
+        Parameters
+        ----------
+        datagram
+            type: bytes
+            datagram being dispatched by the receiver of the buffer
+
+        Returns
+        -------
+        type: int
+        offset at which the datagram is, or is to be, appended to the buffer
+
+        """
+        with self._lock:
+            last, length = self._last
+            return self.total - length if last is datagram else self.total
+
+    def offset_at(self, secs):
+        """
+        Parameters
+        ----------
+        secs
+            type: float
+            seconds back from now
+
+        Returns
+        -------
+        type: tuple
+        offset of the stream received secs ago, or of the oldest byte kept if the buffer is
+        shorter, and the time.monotonic() it was received at
+
+        """
+        since = time.monotonic() - secs
+        with self._lock:
+            for mark in self._marks:
+                if mark[0] >= since:
+                    return mark[1], mark[0]
+            return self.total, time.monotonic()
+
+    def read(self, start, end):
+        """
+        Reads the bytes of the stream between two offsets, as far as they are still kept.
+        The blocks are taken right away, so that dropping them meanwhile does not cut the
+        read.
+
+        Parameters
+        ----------
+        start
+            type: int
+            offset of the first byte
+        end
+            type: int
+            offset after the last byte
+
+        Returns
+        -------
+        type: iterator
+        chunks of bytes
+
+        """
+        with self._lock:
+            sources = [self._source(block, max(start - block.offset, 0),
+                                    min(end - block.offset, block.size))
+                       for block in self._blocks
+                       if block.offset < end and block.offset + block.size > start]
+        return chain.from_iterable(sources)
+
+    @property
+    def start_offset(self):
+        """
+        Returns
+        -------
+        type: int
+        offset of the oldest byte kept
+
+        """
+        with self._lock:
+            return self._blocks[0].offset if self._blocks else self.total
+
+    @abstractmethod
+    def _new_block(self, offset):
+        """
+        TO BE OVERRIDDEN IN DERIVED CLASS
+
+        Returns
+        -------
+        type: Block
+        empty block starting at offset
+
+        """
+        pass
+
+    @abstractmethod
+    def _is_full(self, block, now):
+        """
+        TO BE OVERRIDDEN IN DERIVED CLASS
+
+        Returns
+        -------
+        type: bool
+        True if a new block is to be started, False otherwise
+
+        """
+        pass
+
+    @abstractmethod
+    def _append(self, block, payload):
+        """
+        TO BE OVERRIDDEN IN DERIVED CLASS
+        storing of the bytes received goes here
+
+        Returns
+        -------
+
+        """
+        pass
+
+    @abstractmethod
+    def _source(self, block, start, end):
+        """
+        TO BE OVERRIDDEN IN DERIVED CLASS
+
+        Returns
+        -------
+        type: iterable
+        chunks of the bytes of the block between the offsets start and end within it, taken
+        while the buffer is locked
+
+        """
+        pass
+
+    def _seal(self, block):
+        """
+        Called once a block is complete, no more bytes are appended to it.
+
+        Returns
+        -------
+
+        """
+        pass
+
+    def _drop(self, block):
+        """
+        Called once a block is dropped from the buffer.
+
+        Returns
+        -------
+
+        """
+        pass
+
+    def discard(self):
+        """
+        Releases what the buffer keeps, once it is no longer read.
+
+        Returns
+        -------
+
+        """
+        with self._lock:
+            self._discarded = True
+            while self._blocks:
+                self._drop(self._blocks.popleft())
+            self._marks.clear()
+
+
+class MemoryBuffer(TimeShiftBuffer):
+    """
+    Keeps the stream in memory, in blocks of MEMORY_BLOCK_BYTES.
+    """
+
+    def _new_block(self, offset):
+        return Block(offset, data=bytearray())
+
+    def _is_full(self, block, now):
+        return block.size >= MEMORY_BLOCK_BYTES
+
+    def _append(self, block, payload):
+        block.data += payload
+
+    def _seal(self, block):
+        # complete blocks are immutable, and read without being copied
+        block.data = bytes(block.data)
+
+    def _source(self, block, start, end):
+        if isinstance(block.data, bytearray):
+            return [bytes(block.data[start:end])]
+        return [memoryview(block.data)[start:end]]
+
+
+class DiskBuffer(TimeShiftBuffer):
+    """
+    Keeps the stream on disk, in a ring of TS files of segment_secs each.
+    """
+
+    def __init__(self, ch_name, minutes, max_bytes, segment_secs=DEFAULT_SEGMENT_SECS):
+        """
+        Parameters
+        ----------
+        ch_name
+            type: str
+            name of the buffered channel
+        minutes
+            type: float
+            minutes of the stream kept
+        max_bytes
+            type: int
+            bytes of the stream kept at most
+        segment_secs
+            type: int
+            seconds of the stream per file
+        """
+        TimeShiftBuffer.__init__(self, ch_name, minutes, max_bytes)
+        self.segment_secs = segment_secs
+        self.path = os.path.join(TIMESHIFT_DIR, ch_name)
+        # files left by an earlier run can't be addressed anymore
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.makedirs(self.path)
+
+    def _new_block(self, offset):
+        return Block(offset, path=os.path.join(self.path, "{:016d}.ts".format(offset)))
+
+    def _is_full(self, block, now):
+        return now - block.started >= self.segment_secs
+
+    def _append(self, block, payload):
+        block.file.write(payload)
+
+    def _seal(self, block):
+        block.file.close()
+
+    def _drop(self, block):
+        block.file.close()
+        try:
+            os.remove(block.path)
+        except FileNotFoundError:
+            pass
+
+    def _source(self, block, start, end):
+        if not block.file.closed:
+            block.file.flush()
+        # opened right away, a file removed meanwhile is still read to its end
+        source = open(block.path, "rb")
+        return _read_file(source, start, end)
+
+    def close(self):
+        with self._lock:
+            if self._blocks:
+                self._blocks[-1].file.close()
+        receiver.Consumer.close(self)
+
+    def discard(self):
+        TimeShiftBuffer.discard(self)
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def _read_file(source, start, end):
+    """
+    Parameters
+    ----------
+    source
+        type: file
+        file opened for reading, closed once read
+    start
+        type: int
+        offset of the first byte within the file
+    end
+        type: int
+        offset after the last byte within the file
+
+    Returns
+    -------
+    type: generator
+    chunks of the bytes of the file between the offsets
+
+    """
+    with source:
+        source.seek(start)
+        left = end - start
+        while left > 0:
+            chunk = source.read(min(left, READ_BYTES))
+            if not chunk:
+                break
+            left -= len(chunk)
+            yield chunk
+
+
+class BacklogFileConsumer(receiver.FileConsumer):
+    """
+    Writes the stream to a file like FileConsumer, preceded by what a time-shift buffer of
+    the stream received in the lookback seconds before. The backlog is written in a thread
+    of its own, at the head of the file, while the stream is written after it.
+    """
+
+    def __init__(self, path, duration_secs, buffer, lookback_secs):
+        receiver.FileConsumer.__init__(self, path, duration_secs)
+        self.buffer = buffer
+        self.lookback_secs = lookback_secs
+        self.backlog_bytes = 0
+        self._writer = None
+
+    def _consume(self, datagram):
+        if self._writer is None:
+            # the backlog ends exactly where the first datagram of the recording is
+            end = self.buffer.position(datagram)
+            start = min(max(self.buffer.offset_at(self.lookback_secs)[0],
+                            self.buffer.start_offset), end)
+            self.backlog_bytes = end - start
+            self._file.seek(self.backlog_bytes)
+            self._writer = threading.Thread(target=self._write_backlog,
+                                            args=(self.buffer.read(start, end), ),
+                                            name="backlog-writer", daemon=True)
+            self._writer.start()
+        return receiver.FileConsumer._consume(self, datagram)
+
+    def _write_backlog(self, chunks):
+        with open(self.path, "r+b") as backlog_file:
+            for chunk in chunks:
+                backlog_file.write(chunk)
+
+    def join(self):
+        """
+        Waits for the backlog to be written.
+
+        Returns
+        -------
+        type: int
+        bytes of the backlog
+
+        """
+        if self._writer is not None:
+            self._writer.join()
+        return self.backlog_bytes
+
+
+def get_timeshift_config():
+    """
+    Returns
+    -------
+    type: dict
+    "recording.timeshift" section of the configuration
+
+    """
+    return get(get_recorder_config(), 'timeshift') or {}
+
+
+def get_buffer(ip_addr):
+    """
+    Parameters
+    ----------
+    ip_addr
+        type: str
+        IP address of the stream, format "host:port"
+
+    Returns
+    -------
+    type: TimeShiftBuffer
+    running buffer of the stream, None if there is none
+
+    """
+    with _LOCK:
+        buffer = _BUFFERS.get(ip_addr)
+    if buffer is None or buffer.done:
+        return None
+    return buffer
+
+
+def start_buffers():
+    """
+    Starts the buffers of the channels in "recording.timeshift.channels" which are not
+    running, such as those whose receiver stopped on an error, and stops the buffers of
+    channels no longer listed.
+
+    Returns
+    -------
+    type: int
+    number of buffers started
+
+    """
+    config = get_timeshift_config()
+    channels = get(config, 'channels') or {}
+    max_bytes = int(float(get(config, 'max_mb') or DEFAULT_MAX_MB) * BYTES_PER_MB)
+    ifaddr = get(get_recorder_config(), 'ifaddr') or ""
+    started = 0
+
+    wanted = {}
+    for ch_name, minutes in channels.items():
+        channel = registry.get_by_name(ch_name)
+        if channel is None:
+            LOG.warning("No channel %s found for its time-shift buffer", ch_name)
+            continue
+        wanted[channel[CH_IP_INDEX]] = ch_name, float(minutes)
+
+    with _LOCK:
+        for ip_addr in list(_BUFFERS):
+            if ip_addr not in wanted:
+                LOG.info("Time-shift buffer of %s stopped", _BUFFERS[ip_addr].ch_name)
+                _stop(_BUFFERS.pop(ip_addr))
+
+        for ip_addr, (ch_name, minutes) in wanted.items():
+            previous = _BUFFERS.get(ip_addr)
+            if previous is not None and not previous.done:
+                continue
+            if get(config, 'storage') == DISK_STORAGE:
+                buffer = DiskBuffer(ch_name, minutes, max_bytes,
+                                    int(get(config, 'segment_secs') or DEFAULT_SEGMENT_SECS))
+            else:
+                buffer = MemoryBuffer(ch_name, minutes, max_bytes)
+            try:
+                receiver.attach(ip_addr, buffer, ifaddr)
+            except (OSError, ValueError) as err:
+                LOG.warning("Failed to start the time-shift buffer of %s", ch_name)
+                LOG.debug(err)
+                buffer.close()
+                buffer.discard()
+                continue
+            if previous is not None:
+                previous.discard()
+            _BUFFERS[ip_addr] = buffer
+            started += 1
+            LOG.info("Time-shift buffer of %s started, %d minutes at most", ch_name, minutes)
+    return started
+
+
+def _stop(buffer):
+    """
+    Detaches a buffer from its receiver and releases what it keeps.
+
+    Parameters
+    ----------
+    buffer
+        type: TimeShiftBuffer
+
+    Returns
+    -------
+
+    """
+    # the receiver detaches consumers past their stop boundary, or refusing datagrams
+    buffer.stop = time.monotonic()
+    buffer.discard()
+
+
+def add_to_scheduler(scheduler):
+    """
+    Starts the configured buffers and checks on them every CHECK_MINUTES.
+
+    Parameters
+    ----------
+    scheduler
+        type: Scheduler
+
+    Returns
+    -------
+
+    """
+    if not get(get_timeshift_config(), 'channels'):
+        return
+    start_buffers()
+    scheduler.add_necessary_job(start_buffers, "timeshift", CHECK_MINUTES)
+
+
+def record(ip_addr, path, duration_secs, lookback_secs, ifaddr=""):
+    """
+    Records the stream to a file beginning lookback_secs in the past, as far as the
+    time-shift buffer of the stream goes back; without a buffer it records from now.
+
+    Parameters
+    ----------
+    ip_addr
+        type: str
+        IP address of the stream, format "host:port"
+    path
+        type: str
+        absolute path of the file to be written
+    duration_secs
+        type: float
+        duration of the recording from now in seconds
+    lookback_secs
+        type: float
+        seconds of the buffered stream the recording begins with
+    ifaddr
+        type: str
+        address of the interface to join the multicast group on
+
+    Returns
+    -------
+    type: int
+    number of bytes recorded
+
+    """
+    buffer = get_buffer(ip_addr)
+    if buffer is None:
+        LOG.info("No time-shift buffer for IP:%s, recording from now on", ip_addr)
+        return receiver.record(ip_addr, path, duration_secs, ifaddr)
+
+    consumer = BacklogFileConsumer(path, duration_secs, buffer, lookback_secs)
+    try:
+        receiver.attach(ip_addr, consumer, ifaddr)
+    except (OSError, ValueError):
+        consumer.close()
+        raise
+    receiver.wait(consumer)
+    backlog = consumer.join()
+    LOG.debug("Recording %s begins with %d bytes of the time-shift buffer", path, backlog)
+    return backlog + consumer.bytes_written
+
+
+def clip(ch_name, minutes):
+    """
+    Cuts the latest minutes of a channel from its time-shift buffer into a recording,
+    which is then processed and uploaded like any other.
+
+    Parameters
+    ----------
+    ch_name
+        type: str
+        name of the channel
+    minutes
+        type: float
+        minutes of the stream, up to what the buffer keeps
+
+    Returns
+    -------
+    type: str
+    path of the clip, None if there is no buffer of the channel or nothing in it
+
+    """
+    channel = registry.get_by_name(ch_name)
+    buffer = get_buffer(channel[CH_IP_INDEX]) if channel is not None else None
+    if buffer is None:
+        LOG.warning("No time-shift buffer of channel %s", ch_name)
+        return None
+
+    end = buffer.total
+    start, received = buffer.offset_at(60 * minutes)
+    start = min(max(start, buffer.start_offset), end)
+    began = datetime.now() - timedelta(seconds=time.monotonic() - received)
+    path = os.path.join(__recording_dir__, ch_name,
+                        "clip_" + began.strftime("%Y-%m-%d_%H%M") + ".ts")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as clip_file:
+        for chunk in buffer.read(start, end):
+            clip_file.write(chunk)
+
+    if os.stat(path).st_size <= MIN_BYTES:
+        LOG.warning("Nothing buffered of channel %s", ch_name)
+        os.remove(path)
+        return None
+    LOG.info("Clip of the last %.1f minutes of %s saved to %s",
+             (time.monotonic() - received) / 60, ch_name, path)
+    PreprocessHandler.insert_task(path, channel[CH_IP_INDEX])
+    return path
+
+
+def cut_clip():
+    """
+    Provides CLI to cut a clip of the latest minutes of a channel
+
+    Returns
+    -------
+
+    """
+    ch_name = "_".join(input("Channel name: ").lower().split())
+    minutes = float(input("Minutes: "))
+    clip(ch_name, minutes)
@@ -0,0 +1,128 @@
+"""
+Supervises capture processes, sampling what they write so that a stream which stops in the
+middle of a recording is noticed while it is being recorded rather than once it ends
+"""
+import os
+import subprocess
+import time
+from logging import getLogger
+
+
+LOG = getLogger(__name__)
+SAMPLE_SECS = 5  # interval between two samples of a capture
+TS_PACKET_BYTES = 188
+# outcomes of a supervised capture
+FINISHED = "finished"
+STALLED = "stalled"
+TIMED_OUT = "timed out"
+
+
+class Watchdog:
+    """
+    Samples the bytes written to a capture file and the rate of TS packets they make up.
+    """
+
+    def __init__(self, path, stall_secs):
+        """
+        Parameters
+        ----------
+        path
+            type: str
+            path to the file being written by the capture
+        stall_secs
+            type: int
+            seconds without a byte written after which the capture is stalled, 0 for never
+        """
+        self.path = path
+        self.stall_secs = stall_secs
+        self.bytes = 0
+        self.packet_rate = 0.0
+        self.first_growth = None  # time.monotonic() of the first sample with bytes written
+        self.last_growth = time.monotonic()
+        self._last_sample = self.last_growth
+
+    def sample(self):
+        """
+        Reads the size of the capture file and updates the rates.
+
+        Returns
+        -------
+        type: int
+        bytes written so far
+
+        """
+        now = time.monotonic()
+        try:
+            size = os.stat(self.path).st_size
+        except FileNotFoundError:
+            size = 0
+        if now > self._last_sample:
+            self.packet_rate = (size - self.bytes) / TS_PACKET_BYTES / (now - self._last_sample)
+        if size > self.bytes:
+            self.last_growth = now
+            if self.first_growth is None:
+                self.first_growth = now
+        self.bytes = size
+        self._last_sample = now
+        return size
+
+    @property
+    def stalled(self):
+        """
+        Returns
+        -------
+        type: bool
+        True if nothing was written for stall_secs until the last sample, False otherwise
+
+        """
+        return 0 < self.stall_secs <= self._last_sample - self.last_growth
+
+
+def supervise(process, watchdog, timeout=None):
+    """
+    Waits for a capture process to exit, sampling its file every SAMPLE_SECS meanwhile.
+    The process is killed if it stalls or outlives the timeout.
+
+    Parameters
+    ----------
+    process
+        type: subprocess.Popen
+        capture process, with its output piped
+    watchdog
+        type: Watchdog
+        watchdog of the file written by the process
+    timeout
+        type: float
+        seconds after which the process is killed, None to wait for it
+
+    Returns
+    -------
+    type: str
+    FINISHED if the process exited, STALLED or TIMED_OUT if it was killed
+
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        wait = SAMPLE_SECS
+        if deadline is not None:
+            wait = min(wait, max(deadline - time.monotonic(), 0))
+        try:
+            # retrying communicate() after it times out loses none of the output
+            process_output, _ = process.communicate(timeout=wait)
+            LOG.debug(process_output)
+            return FINISHED
+        except subprocess.TimeoutExpired:
+            pass
+
+        if deadline is not None and time.monotonic() >= deadline:
+            outcome = TIMED_OUT
+        else:
+            watchdog.sample()
+            LOG.debug("%s: %d bytes, %.0f TS packets/s", watchdog.path, watchdog.bytes,
+                      watchdog.packet_rate)
+            if not watchdog.stalled:
+                continue
+            outcome = STALLED
+        process.kill()
+        process.communicate()
+        return outcome
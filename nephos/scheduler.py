@@ -4,7 +4,9 @@ All scheduler tasks go here.
 
 import os
 from logging import getLogger
+from datetime import datetime, timedelta
 
+from pydash import get
 from pytz.exceptions import UnknownTimeZoneError
 from tzlocal import get_localzone
 from apscheduler.schedulers.background import BackgroundScheduler
@@ -22,14 +24,26 @@ LOG = getLogger(__name__)
 # config for the scheduler, not to be set by the user
 TMZ = get_localzone()
 PATH_JOB_DB = os.path.join(__nephos_dir__, "databases/jobs.db")
-MAX_CONCURRENT_JOBS = 20
+
+# executors, each with a pool of threads of its own so that the jobs of one never wait on
+# those of another; the size of each is read from "scheduler.executors.<name>"
+RECORDING_EXECUTOR = "recording"
+PROCESS_EXECUTOR = "process"
+IO_EXECUTOR = "io"
+DEFAULT_POOL_SIZES = {
+    RECORDING_EXECUTOR: 50,
+    PROCESS_EXECUTOR: 2,
+    IO_EXECUTOR: 10
+}
+RECORDING_FUNC_REF = "nephos.recorder.channels:ChannelHandler.record_stream"
+WEEK_DAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
 
 
 class Scheduler:
     """
     A class to rule all the scheduling related tasks.
     """
-    def __init__(self, main):
+    def __init__(self, main, config=None):
         """
         initialize Scheduler with basic configuration
 
@@ -38,6 +52,9 @@ class Scheduler:
         main
             type: bool
             whether the initiated scheduler is the nephos' scheduler or not
+        config
+            type: dict
+            "scheduler" section of the modules configuration, None for the defaults
         """
         self.main = main
         job_stores = {
@@ -47,11 +64,16 @@ class Scheduler:
         if self.main:
             LOG.debug("Storing scheduler jobs in %s", job_stores["default"])
 
+        self.pool_sizes = {
+            name: int(get(config, 'executors.' + name) or size)
+            for name, size in DEFAULT_POOL_SIZES.items()
+        }
         executors = {
-            'default': ThreadPoolExecutor(MAX_CONCURRENT_JOBS)
+            name: ThreadPoolExecutor(size) for name, size in self.pool_sizes.items()
         }
 
         if self.main:
+            LOG.debug("Scheduler thread pools: %s", self.pool_sizes)
             LOG.info("Initialising scheduler with timezone %s", TMZ)
         try:
             self._scheduler = BackgroundScheduler(jobstores=job_stores, executors=executors,
@@ -71,12 +93,31 @@ class Scheduler:
         -------
 
         """
-        self._scheduler.start()
+        # paused until the stored recording jobs are moved to their executor
+        self._scheduler.start(paused=True)
+        self._move_recording_jobs()
+        self._scheduler.resume()
         if self.main:
             LOG.info("Scheduler running!")
 
+    def _move_recording_jobs(self):
+        """
+        Moves the recording jobs stored on another executor, eg. by an earlier version,
+        to the recording executor.
+
+        Returns
+        -------
+
+        """
+        for job in self._scheduler.get_jobs():
+            if job.func_ref == RECORDING_FUNC_REF and job.executor != RECORDING_EXECUTOR:
+                self._scheduler.modify_job(job.id, executor=RECORDING_EXECUTOR)
+                LOG.debug("Recording job %s moved to the %s executor", job.id,
+                          RECORDING_EXECUTOR)
+
     def add_recording_job(self, ip_addr, out_path,  # pylint: disable=too-many-arguments
-                          duration, job_time, week_days, job_name):
+                          duration, job_time, week_days, job_name, live=False, preroll=0,
+                          lookback=0):
         """
         Add recording jobs to the scheduler
 
@@ -100,23 +141,44 @@ class Scheduler:
         job_name
             type: str
             name of the job, unique
+        live
+            type: bool
+            True to transcode the stream while it is recorded
+        preroll
+            type: int
+            seconds before job_time at which the job is launched, the recording still being
+            named after job_time and ending duration minutes after it
+        lookback
+            type: int
+            minutes before job_time the recording begins at, from the time-shift buffer
+            of the channel
 
         Returns
         -------
 
         """
-        hour, minute = job_time.split(":")
+        week_days, hour, minute, second = _preroll_time(job_time, week_days, preroll)
         duration_secs = 60 * duration
+        kwargs = {}
+        if live:
+            kwargs['live'] = True
+        if preroll:
+            kwargs['preroll'] = preroll
+        if lookback:
+            kwargs['lookback'] = 60 * lookback
         try:
             job = self._scheduler.add_job(ChannelHandler.record_stream, trigger='cron', hour=hour,
-                                          minute=minute, day_of_week=week_days, id=job_name,
-                                          max_instances=1, args=[ip_addr, out_path, duration_secs])
+                                          minute=minute, second=second, day_of_week=week_days,
+                                          id=job_name, max_instances=1,
+                                          args=[ip_addr, out_path, duration_secs],
+                                          kwargs=kwargs or None, executor=RECORDING_EXECUTOR)
             LOG.info("Recording job added: %s", job)
         except ConflictingIdError as error:
             LOG.warning("Job insertion failed: name should be unique!")
             LOG.debug(error)
 
-    def add_necessary_job(self, func, main_id, interval, args=None):
+    def add_necessary_job(self, func, main_id,  # pylint: disable=too-many-arguments
+                          interval, args=None, executor=IO_EXECUTOR):
         """
         Add necessary jobs to the scheduler
 
@@ -134,6 +196,9 @@ class Scheduler:
         args
             type: list or tuple
             list of positional arguments to call func with
+        executor
+            type: str
+            executor the job is run by
 
         Returns
         -------
@@ -145,10 +210,13 @@ class Scheduler:
             pass
 
         job = self._scheduler.add_job(func=func, trigger='interval', args=args,
-                                      minutes=interval, id=main_id, max_instances=1, )
+                                      minutes=interval, id=main_id, max_instances=1,
+                                      executor=executor)
         LOG.debug("Default job added: %s", job)
 
-    def add_cron_necessary_job(self, func, main_id, job_time, repetition="1111111", args=None):
+    def add_cron_necessary_job(self, func, main_id,  # pylint: disable=too-many-arguments
+                               job_time, repetition="1111111", args=None,
+                               executor=IO_EXECUTOR):
         """
 
         Parameters
@@ -168,6 +236,9 @@ class Scheduler:
         args
             type: list
             list of arguments for the function
+        executor
+            type: str
+            executor the job is run by
 
         Returns
         -------
@@ -182,7 +253,7 @@ class Scheduler:
         week_days = JobHandler.to_weekday(repetition)
         job = self._scheduler.add_job(func, trigger='cron', hour=hour,
                                       minute=minute, day_of_week=week_days, id=main_id,
-                                      max_instances=1, args=args)
+                                      max_instances=1, args=args, executor=executor)
         LOG.debug("Default job added: %s", job)
 
     def get_jobs(self):
@@ -228,3 +299,35 @@ class Scheduler:
         self._scheduler.shutdown()
         if not self.main:
             LOG.debug("Side scheduler turned off!")
+
+
+def _preroll_time(job_time, week_days, preroll):
+    """
+    Moves the start of a weekly job earlier, to the previous days if it crosses midnight.
+
+    Parameters
+    ----------
+    job_time
+        type: str
+        time of the job, "HH:MM"
+    week_days
+        type: str
+        days of the job, eg. "mon,wed" as returned by JobHandler.to_weekday
+    preroll
+        type: int
+        seconds the job is to be launched earlier
+
+    Returns
+    -------
+    type: tuple
+    days, hour, minute and second of the cron trigger launching the job
+
+    """
+    hour, minute = (int(part) for part in job_time.split(":"))
+    monday = datetime(2001, 1, 1)
+    start = monday.replace(hour=hour, minute=minute) - timedelta(seconds=preroll)
+    days_back = (monday.date() - start.date()).days
+    if days_back and week_days:
+        week_days = ",".join(WEEK_DAYS[(WEEK_DAYS.index(day) - days_back) % len(WEEK_DAYS)]
+                             for day in week_days.split(","))
+    return week_days, start.hour, start.minute, start.second
@@ -4,16 +4,33 @@ Handles uploads to FTP server
 import os
 import ftplib
 import ntpath
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from logging import getLogger
 from pydash import get
 
 from . import get_uploader_config
-from ..exceptions import FTPFailure
-from ..manage_db import TSK_STORE_INDEX
+from .throttle import get_limiter
+from ..exceptions import FTPFailure, DBException
+from ..manage_db import TaskSinks, TSK_ID_INDEX, TSK_STORE_INDEX, SINK_UPLOADED, SINK_FAILED
 from ..mail_notifier import add_to_report
 
 
 LOG = getLogger(__name__)
+FTP_SINK = "ftp"
+NEPHOS_FOLDER = "/Nephos"
+SKIPPED_FILES = ('ffmpeg2pass-0.log.mbtree', )
+DEFAULT_WORKERS = 2
+DEFAULT_BLOCK_KB = 64
+DEFAULT_KEEPALIVE = 60  # seconds between NOOPs on idle sessions, servers drop silent ones
+TIMEOUT = 60  # seconds without a reply before a session is given up
+RETRIES = 2  # reconnections to resume a transfer after a broken session
+FTP_ERRORS = (FTPFailure, ) + ftplib.all_errors
+# errors of a broken session, after which the transfer is resumed on a new one
+RECONNECT_ERRORS = (OSError, EOFError, ftplib.error_temp, ftplib.error_reply)
+_POOLS = {}
+_LOCK = threading.Lock()
 
 
 class FTPUploader:
@@ -24,7 +41,9 @@ class FTPUploader:
 
     def __init__(self, tasks_list):
         """
-        initialises the uploading pipeline, called from within cloud storage uploader
+        initialises the uploading pipeline, called from within cloud storage uploader.
+        The files of all the folders are stored in parallel, over "upload.ftp.workers"
+        sessions of a pool kept across uploads.
 
         Parameters
         ----------
@@ -36,53 +55,238 @@ class FTPUploader:
         host, port, username, password = self._get_ftp_config()
         if not ((host is None) or (port is None) or
                 (username is None) or (password is None)):
+            workers, self.blocksize, keepalive = self._get_transfer_config()
+            self.pool = get_pool(host, port, username, password, keepalive)
             try:
-                self.ftp = ftplib.FTP()
-                self._auth(host, port, username, password)
-                self.nephos_ftp_path = self._create_folder("Nephos")
-                self.ftp.cwd(self.nephos_ftp_path)
-                for task in tasks_list:
-                    self._upload(task[TSK_STORE_INDEX])
-                    add_to_report("{folder} successfully uploaded to FTP server.".format(
-                        folder=task[TSK_STORE_INDEX]
-                    ))
-            except FTPFailure as _:
-                pass
+                with self.pool.session() as session:
+                    self.nephos_ftp_path = session.make_dir(NEPHOS_FOLDER)
+            except FTP_ERRORS as err:
+                LOG.debug(err)
+                return
+
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                # the files of every folder are queued before waiting on any of them
+                started = [(task, self._upload(executor, task[TSK_STORE_INDEX]))
+                           for task in tasks_list]
+                for task, uploads in started:
+                    self._finish(task, uploads)
         else:
             msg = "FTP upload aborted due to incomplete configuration!"
             add_to_report(msg)
             LOG.warning(msg)
 
-    def _upload(self, folder):
+    def _upload(self, executor, folder):
         """
-        Uploads the given folder to connected FTP server
+        Creates the folder on the FTP server and queues the upload of its files
 
         Parameters
         ----------
+        executor
+            type: concurrent.futures.ThreadPoolExecutor
+            pool of upload threads
         folder
             type: str
             absolute path to the folder to be uploaded
 
         Returns
         -------
-        type: bool
-        True if upload was successful, False otherwise
+        type: list
+        futures of the uploads of the files; a single failed future if the folder could
+        not be created
+
+        """
+        try:
+            with self.pool.session() as session:
+                to_path = session.make_dir(self.nephos_ftp_path + "/" + self._get_name(folder))
+        except FTP_ERRORS as err:
+            failed = Future()
+            failed.set_exception(err)
+            return [failed]
+
+        files = [os.path.join(folder, x) for x in os.listdir(folder) if x not in SKIPPED_FILES]
+        return [executor.submit(self._store, file, to_path + "/" + self._get_name(file))
+                for file in files]
+
+    def _store(self, file, to_path):
+        """
+        Stores a file on the FTP server, resuming on a new session if the one in use breaks.
+
+        Parameters
+        ----------
+        file
+            type: str
+            absolute path of the file to be uploaded
+        to_path
+            type: str
+            path of the file on the FTP server
+
+        Returns
+        -------
 
         """
-        upload_to_folder = self._create_folder(self._get_name(folder))
-        if upload_to_folder:
-            to_path = self.nephos_ftp_path + upload_to_folder
-            files = [os.path.join(folder, x) for x in os.listdir(folder)]
+        for attempt in range(RETRIES + 1):
             try:
-                files.remove(os.path.join(folder, 'ffmpeg2pass-0.log.mbtree'))
-            except ValueError:
-                pass
-
-            for file in files:
-                to_path = to_path + "/" + self._get_name(file)
-                with open(file, "rb") as open_file:
-                    self.ftp.storbinary("STOR {}".format(to_path), open_file)
+                with self.pool.session() as session:
+                    session.store(file, to_path, self.blocksize, get_limiter(FTP_SINK))
                 LOG.debug("%s uploaded to %s on FTP server", file, to_path)
+                return
+            except RECONNECT_ERRORS as err:
+                if attempt == RETRIES:
+                    raise
+                LOG.debug("FTP session broken while uploading %s, reconnecting", file)
+                LOG.debug(err)
+
+    @staticmethod
+    def _finish(task, uploads):
+        """
+        Waits for the files of a folder to be uploaded, and records and reports the outcome.
+
+        Parameters
+        ----------
+        task
+            type: tuple
+            details of the uploaded recording
+        uploads
+            type: list
+            futures of the uploads of the files of the folder
+
+        Returns
+        -------
+
+        """
+        folder = task[TSK_STORE_INDEX]
+        status, error = SINK_UPLOADED, None
+        try:
+            for upload in uploads:
+                upload.result()
+        except FTP_ERRORS as err:
+            LOG.warning("Uploading %s to FTP server failed!", folder)
+            LOG.debug(err)
+            status, error = SINK_FAILED, err
+
+        try:
+            TaskSinks.set_status(task[TSK_ID_INDEX], FTP_SINK, status)
+        except DBException as err:
+            LOG.debug(err)
+        if error is not None:
+            add_to_report("{folder} uploading to FTP server failed due to following "
+                          "error\n{error}\n".format(folder=folder, error=error))
+        else:
+            add_to_report("{folder} successfully uploaded to FTP server.".format(folder=folder))
+
+    @staticmethod
+    def is_configured():
+        """
+        Returns
+        -------
+        type: bool
+        True if the FTP server details are all present in the configuration
+
+        """
+        return None not in FTPUploader._get_ftp_config()
+
+    @staticmethod
+    def _get_ftp_config():
+        """
+        calls the get_uploader_config method and grabs all ftp config from modules.yaml
+
+        Returns
+        -------
+        host
+            type: str
+            ftp server hostname
+        port
+            type: int
+            ftp server port
+        username
+            type: str
+            ftp login username
+        password
+            type: str
+            ftp login password
+        """
+        config = get_uploader_config()
+
+        # the uploader's configuration is the "upload" section of modules.yaml
+        base_query = 'ftp.'
+
+        host = get(config, base_query+'host')
+        if host is None:
+            return host, None, None, None
+        port = int(get(config, base_query+'port'))
+        username = get(config, base_query+'username')
+        password = get(config, base_query+'password')
+
+        return host, port, username, password
+
+    @staticmethod
+    def _get_transfer_config():
+        """
+        Reads the concurrency, block size and keepalive of the sessions from "upload.ftp".
+
+        Returns
+        -------
+        type: tuple
+        number of parallel transfers, bytes sent per block, and seconds between NOOPs
+
+        """
+        config = get(get_uploader_config(), 'ftp') or {}
+        workers = max(1, int(config.get('workers') or DEFAULT_WORKERS))
+        blocksize = int(float(config.get('block_kb') or DEFAULT_BLOCK_KB) * 1024)
+        keepalive = float(config.get('keepalive') or DEFAULT_KEEPALIVE)
+        return workers, blocksize, keepalive
+
+    @staticmethod
+    def _get_name(path):
+        """
+        Parses name from the absolute path.
+
+        Parameters
+        ----------
+        path
+            type: str
+            absolute path to the file
+
+        Returns
+        ---------
+            type: str
+            name of the folder or file with extension
+        -------
+
+        """
+        head, tail = ntpath.split(path)
+        return tail or ntpath.basename(head)  # return tail when file, otherwise head for folder
+
+
+class FTPSession:
+    """
+    An authenticated connection to the FTP server.
+    """
+
+    def __init__(self, host, port, username, password):
+        """
+        Parameters
+        ----------
+        host
+            type: str
+            ftp server hostname
+        port
+            type: int
+            ftp server port
+        username
+            type: str
+            ftp login username
+        password
+            type: str
+            ftp login password
+
+        Raises
+        ------
+        FTPFailure
+            when the connection or the authentication fails
+        """
+        self.ftp = ftplib.FTP(timeout=TIMEOUT)
+        self._auth(host, port, username, password)
 
     def _auth(self, host, port, username, password):
         """
@@ -105,13 +309,11 @@ class FTPUploader:
 
         Returns
         -------
-        type: bool
-        True is authentication success, False otherwise
 
         """
         try:
             self.ftp.connect(host, port)
-        except ConnectionError as err:
+        except OSError as err:
             msg = "couldn't establish connection to ftp server"
             add_to_report("FTP Upload failed: {msg}".format(msg=msg))
             LOG.error(msg)
@@ -127,42 +329,129 @@ class FTPUploader:
             add_to_report("FTP Upload failed: {msg}".format(msg=msg))
             LOG.error(msg)
             LOG.debug(err)
+            self.ftp.close()
             raise FTPFailure
         LOG.debug("Authenticated to FTP server successfully")
 
-    def _create_folder(self, folder_name):
+    def alive(self):
+        """
+        Sends a NOOP, keeping the session from being dropped by the server for idling.
+
+        Returns
+        -------
+        type: bool
+        True if the server replied, False if the session is broken
+
+        """
+        try:
+            self.ftp.voidcmd("NOOP")
+            return True
+        except ftplib.all_errors as err:
+            LOG.debug(err)
+            return False
+
+    def make_dir(self, path):
         """
         creates a new folder if it doesn't exist
 
         Parameters
         -------
-        folder_name
+        path
             type: str
-            name of the folder to be created
+            absolute path of the folder on the FTP server
 
         Returns
         -------
         folder_path
             type: str
-            path to the create/existing folder
+            path to the created/existing folder
         """
         try:
-            self.ftp.mkd(folder_name)
-            LOG.debug("%s folder created on FTP server", folder_name)
+            self.ftp.mkd(path)
+            LOG.debug("%s folder created on FTP server", path)
         except ftplib.error_perm as _:
-            LOG.debug("%s folder exists", folder_name)
-            if folder_name != "Nephos":
-                return ""
+            LOG.debug("%s folder exists", path)
+        return path
 
-        return "/" + folder_name
+    def store(self, file, to_path, blocksize, limiter=None):
+        """
+        Stores a file, resuming with REST from the size already on the server.
+
+        Parameters
+        ----------
+        file
+            type: str
+            absolute path of the file to be uploaded
+        to_path
+            type: str
+            path of the file on the FTP server
+        blocksize
+            type: int
+            bytes sent per block
+        limiter
+            type: SinkLimiter
+            bandwidth limit the blocks are taken from, None for no limit
+
+        Returns
+        -------
 
-    @staticmethod
-    def _get_ftp_config():
         """
-        calls the get_uploader_config method and grabs all ftp config from modules.yaml
+        callback = None if limiter is None else (lambda block: limiter.consume(len(block)))
+        self.ftp.voidcmd("TYPE I")
+        try:
+            offset = self.ftp.size(to_path) or 0
+        except ftplib.error_perm:
+            offset = 0  # not uploaded yet
+        size = os.path.getsize(file)
+        if offset == size:
+            LOG.debug("%s already on FTP server", file)
+            return
+        if offset > size:
+            offset = 0
+        elif offset:
+            LOG.debug("Resuming upload of %s from byte %d", file, offset)
+
+        with open(file, "rb") as open_file:
+            open_file.seek(offset)
+            self.ftp.storbinary("STOR {}".format(to_path), open_file, blocksize,
+                                callback=callback, rest=offset or None)
 
+    @property
+    def connected(self):
+        """
         Returns
         -------
+        type: bool
+        True until the session is closed
+
+        """
+        return self.ftp.sock is not None
+
+    def close(self):
+        """
+        Ends the session.
+
+        Returns
+        -------
+
+        """
+        try:
+            self.ftp.quit()
+        except ftplib.all_errors:
+            self.ftp.close()
+
+
+class FTPPool:
+    """
+    Authenticated sessions to an FTP server, kept open across uploads. Idle sessions are
+    kept alive with NOOPs; a broken session is replaced by a new one.
+    """
+
+    def __init__(self, host, port, username, password,  # pylint: disable=too-many-arguments
+                 keepalive=DEFAULT_KEEPALIVE):
+        """
+        Parameters
+        ----------
         host
             type: str
             ftp server hostname
@@ -175,37 +464,144 @@ class FTPUploader:
         password
             type: str
             ftp login password
+        keepalive
+            type: float
+            seconds between NOOPs sent on idle sessions
         """
-        config = get_uploader_config()
+        self._login = (host, port, username, password)
+        self.keepalive = keepalive
+        self._idle = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._keeper = threading.Thread(target=self._keep_alive, name="ftp-keepalive",
+                                        daemon=True)
+        self._keeper.start()
 
-        base_query = 'upload.ftp.'
+    @contextmanager
+    def session(self):
+        """
+        Lends a session to the calling thread, connecting a new one if none is idle.
+        A session failing while lent is closed instead of being taken back.
 
-        host = get(config, base_query+'host')
-        if host is None:
-            return host, None, None, None
-        port = int(get(config, base_query+'port'))
-        username = get(config, base_query+'username')
-        password = get(config, base_query+'password')
+        Returns
+        -------
+        type: FTPSession
 
-        return host, port, username, password
+        Raises
+        ------
+        FTPFailure
+            when a new session cannot be connected or authenticated
 
-    @staticmethod
-    def _get_name(path):
         """
-        Parses name from the absolute path.
+        session = None
+        while session is None:
+            with self._lock:
+                if not self._idle:
+                    break
+                session = self._idle.pop()
+            if not session.alive():
+                session.close()
+                session = None
+        if session is None:
+            session = FTPSession(*self._login)
 
-        Parameters
-        ----------
-        path
-            type: str
-            absolute path to the file
+        try:
+            yield session
+        except ftplib.all_errors:
+            # the session may be left in the middle of a command
+            session.close()
+            raise
+        finally:
+            if session.connected:
+                with self._lock:
+                    self._idle.append(session)
 
+    @property
+    def idle(self):
+        """
         Returns
-        ---------
-            type: str
-            name of the folder or file with extension
         -------
+        type: int
+        number of idle sessions
 
         """
-        head, tail = ntpath.split(path)
-        return tail or ntpath.basename(head)  # return tail when file, otherwise head for folder
+        with self._lock:
+            return len(self._idle)
+
+    def _keep_alive(self):
+        """
+        Sends a NOOP on every idle session once per keepalive interval, dropping those
+        which are broken. The sessions are taken out of the pool while checked, so that
+        a slow server holds up no thread waiting on the lock.
+
+        Returns
+        -------
+
+        """
+        while not self._stop.wait(self.keepalive):
+            with self._lock:
+                idle, self._idle = self._idle, []
+            live = []
+            for session in idle:
+                if session.alive():
+                    live.append(session)
+                else:
+                    LOG.debug("Idle FTP session dropped")
+                    session.close()
+            with self._lock:
+                if not self._stop.is_set():
+                    self._idle.extend(live)
+                    live = []
+            for session in live:  # the pool was closed meanwhile
+                session.close()
+
+    def close(self):
+        """
+        Closes all the idle sessions and stops the keepalive.
+
+        Returns
+        -------
+
+        """
+        self._stop.set()
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for session in idle:
+            session.close()
+
+
+def get_pool(host, port, username, password, keepalive=DEFAULT_KEEPALIVE):
+    """
+    Returns the pool of sessions of the FTP account, creating it on first use.
+
+    Parameters
+    ----------
+    host
+        type: str
+        ftp server hostname
+    port
+        type: int
+        ftp server port
+    username
+        type: str
+        ftp login username
+    password
+        type: str
+        ftp login password
+    keepalive
+        type: float
+        seconds between NOOPs sent on idle sessions
+
+    Returns
+    -------
+    type: FTPPool
+
+    """
+    key = (host, port, username, password)
+    with _LOCK:
+        pool = _POOLS.get(key)
+        if pool is None or pool.keepalive != keepalive:
+            if pool is not None:
+                pool.close()
+            pool = _POOLS[key] = FTPPool(host, port, username, password, keepalive)
+        return pool
@@ -1,22 +1,32 @@
 """
 Derived class from uploader which manages uploading to Google Drive account.
 """
+import hashlib
 import os
+import queue
 import shutil
-from datetime import datetime
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from logging import getLogger
 
 from oauth2client import client, file
 from oauth2client.clientsecrets import InvalidClientSecretsError
 from googleapiclient.http import HttpError, MediaFileUpload, UnexpectedMethodError, \
-    ResumableUploadError, UnexpectedBodyError
+    ResumableUploadError, UnexpectedBodyError, build_http
 from googleapiclient import discovery
-from httplib2 import Http
+from googleapiclient.discovery_cache.base import Cache
+from httplib2 import HttpLib2Error
 
+from . import get_uploader_config
+from .throttle import get_bucket, get_limiter
 from .uploader import Uploader
 from .. import __nephos_dir__, __log_dir__
-from ..exceptions import OAuthFailure, UploadingFailed
-from ..manage_db import DBHandler, TSK_STORE_INDEX, TSK_SHR_INDEX
+from ..exceptions import OAuthFailure, DBException
+from ..manage_db import UploadSessions, TaskSinks, TSK_ID_INDEX, TSK_STORE_INDEX, \
+    TSK_SHR_INDEX, SINK_UPLOADED, SINK_FAILED
 from ..mail_notifier import send_mail, add_to_report
 
 
@@ -27,6 +37,211 @@ CRED_PATH = os.path.join(__nephos_dir__, ".up_cred")
 CLI_SECRET_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), ".client_secrets")
 LOG_DRIVE_FOLDER_ID = "1M8jl0tDPoN3K6TE6KipwJZYXsMxb75Do"
 LOG_FILE_PATH = os.path.join(__log_dir__, "nephos.log")
+DRIVE_SINK = "gdrive"
+DEFAULT_WORKERS = 4
+DEFAULT_CHUNK_MB = 8
+CHUNK_UNIT = 256 * 1024  # drive requires chunks to be multiples of 256 KB
+NUM_RETRIES = 3  # retries of a chunk on connection errors and 5xx responses
+SESSION_GONE = (404, 410)  # statuses of an expired resumable session
+UPLOAD_ERRORS = (UnexpectedBodyError, ResumableUploadError, UnexpectedMethodError, HttpError)
+TRANSPORT_ERRORS = (HttpLib2Error, OSError)  # connection failures, socket timeouts included
+REFRESH_MARGIN = timedelta(minutes=5)  # access tokens are refreshed this long before expiry
+DISCOVERY_CACHE_DIR = os.path.join(__nephos_dir__, "discovery_cache")
+DISCOVERY_CACHE_SECS = 24 * 60 * 60
+SHARE_BATCH_LIMIT = 100  # most requests drive accepts in a batch
+SHARE_RETRIES = 3
+SHARE_BACKOFF_SECS = 2  # doubled on every retry
+RETRY_STATUSES = (429, 500, 502, 503, 504)  # besides 403 rate limits, transient errors
+# services are kept across upload runs along with their connections; a service is not
+# thread-safe, hence each one is used by a single thread at a time
+_IDLE_SERVICES = queue.LifoQueue()  # tuples of the credentials and the idle service
+_AUTH_LOCK = threading.Lock()
+_CREDENTIALS = None
+
+
+class DiscoveryCache(Cache):
+    """
+    Keeps the discovery documents of the Google APIs on disk, sparing a request for them
+    whenever a service is built.
+    """
+
+    def __init__(self, cache_dir, max_age):
+        """
+        Parameters
+        ----------
+        cache_dir
+            type: str
+            directory in which the documents are stored
+        max_age
+            type: int
+            seconds after which a stored document is fetched again
+        """
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+
+    def _path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha1(url.encode()).hexdigest() + ".json")
+
+    def get(self, url):
+        path = self._path(url)
+        try:
+            if time.time() - os.stat(path).st_mtime > self.max_age:
+                return None
+            with open(path) as document:
+                return document.read()
+        except OSError:
+            return None
+
+    def set(self, url, content):
+        path = self._path(url)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # written aside and renamed, so other threads never read half a document
+            with open(path + ".tmp", "w") as document:
+                document.write(content)
+            os.replace(path + ".tmp", path)
+        except OSError as err:
+            LOG.debug(err)
+
+
+_DISCOVERY_CACHE = DiscoveryCache(DISCOVERY_CACHE_DIR, DISCOVERY_CACHE_SECS)
+
+
+class ShareBatcher:
+    """
+    Collects the permissions of the folders uploaded in a run, and creates them in batch
+    requests of up to SHARE_BATCH_LIMIT permissions. Permissions failing for a transient
+    error, eg. a rate limit, are retried with exponential backoff.
+    """
+
+    def __init__(self, service):
+        """
+        Parameters
+        ----------
+        service
+            drive service the permissions are created with
+        """
+        self._service = service
+        self._perm_service = service.permissions()
+        self._pending = []  # tuples of the folder id and the email to share it with
+
+    def add(self, folder_id, share_list):
+        """
+        Queues the permissions of a folder, to be created on flush.
+
+        Parameters
+        ----------
+        folder_id
+            type: str
+            unique folder id of the cloud folder
+        share_list
+            type: str
+            str of entities the folder is to be shared with,
+            multiple values separated by space
+
+        Returns
+        -------
+
+        """
+        self._pending.extend((folder_id, email) for email in share_list.split())
+
+    def flush(self):
+        """
+        Creates the queued permissions.
+
+        Returns
+        -------
+        type: list
+        tuples of the folder id and the email of the permissions which failed
+
+        """
+        pending, self._pending = self._pending, []
+        failed = []
+        for attempt in range(SHARE_RETRIES + 1):
+            if attempt:
+                LOG.debug("Retrying %d permission(s)", len(pending))
+                time.sleep(SHARE_BACKOFF_SECS * 2 ** (attempt - 1))
+            retry = []
+            for start in range(0, len(pending), SHARE_BATCH_LIMIT):
+                batch_retry, batch_failed = self._execute(
+                    pending[start:start + SHARE_BATCH_LIMIT])
+                retry.extend(batch_retry)
+                failed.extend(batch_failed)
+            pending = retry
+            if not pending:
+                break
+
+        failed.extend(pending)
+        for folder_id, email in failed:
+            LOG.warning("Sharing folder %s with %s failed!", folder_id, email)
+        return failed
+
+    def _execute(self, permissions):
+        """
+        Creates permissions in a single batch request.
+
+        Parameters
+        ----------
+        permissions
+            type: list
+            tuples of the folder id and the email, at most SHARE_BATCH_LIMIT
+
+        Returns
+        -------
+        type: tuple
+        permissions which failed for a transient error, and those which failed otherwise
+
+        """
+        retry, failed = [], []
+
+        def callback(request_id, response, exception):
+            permission = permissions[int(request_id)]
+            if exception is None:
+                LOG.debug("Permission Id: %s", response.get('id'))
+                return
+            LOG.debug(exception)
+            (retry if ShareBatcher._is_transient(exception) else failed).append(permission)
+
+        # a batch is executed once only, each one is a new object
+        batch = self._service.new_batch_http_request(callback=callback)
+        for index, (folder_id, email) in enumerate(permissions):
+            permission = {
+                "type": "user",
+                "role": "reader",
+                "emailAddress": email
+            }
+            batch.add(self._perm_service.create(
+                fileId=folder_id,
+                body=permission,
+                fields='id',
+            ), request_id=str(index))
+        try:
+            batch.execute()
+        except (HttpError, HttpLib2Error, OSError) as err:
+            LOG.debug(err)
+            return permissions, []
+        return retry, failed
+
+    @staticmethod
+    def _is_transient(error):
+        """
+        Parameters
+        ----------
+        error
+            type: Exception
+            error of a request of the batch
+
+        Returns
+        -------
+        type: bool
+        True if the request may succeed when retried
+
+        """
+        if not isinstance(error, HttpError):
+            return False
+        status = error.resp.status
+        return status in RETRY_STATUSES or (status == 403 and
+                                            "rate limit" in str(error.reason).lower())
 
 
 class GDrive(Uploader):
@@ -34,6 +249,8 @@ class GDrive(Uploader):
     Derived from uploader and handles uploading recordings
     to Google drive.
     """
+    sink = DRIVE_SINK
+
     def auth(self):
         """
         Runs authentication pipeline.
@@ -50,10 +267,11 @@ class GDrive(Uploader):
             credentials = self._init_auth_flow()
 
         store.put(credentials)
+        GDrive._set_credentials(credentials)
 
         try:
-            http = credentials.authorize(Http())
-            self.service = discovery.build("drive", "v3", http=http, cache_discovery=False)
+            http = credentials.authorize(build_http())
+            self.service = discovery.build("drive", "v3", http=http, cache=_DISCOVERY_CACHE)
         except HttpError as error:
             LOG.critical("Authentication request failed!")
             LOG.debug(error)
@@ -66,19 +284,104 @@ class GDrive(Uploader):
     @staticmethod
     def _get_upload_service():
         """
+        Builds a new service; use _service() to reuse the services of earlier uploads.
+
         Returns
         -------
         file_upload_service
             type: googleapiclient.discovery.build
             service to handle uploading and adding permissions for user
         """
-        http = GDrive._auth_from_file(file.Storage(CRED_PATH)).authorize(Http())
-        return discovery.build("drive", "v3", http=http, cache_discovery=False)
+        # build_http does not follow the 308 responses of resumable uploads as redirects
+        http = GDrive._get_credentials().authorize(build_http())
+        return discovery.build("drive", "v3", http=http, cache=_DISCOVERY_CACHE)
+
+    @staticmethod
+    @contextmanager
+    def _service():
+        """
+        Lends an idle service to the calling thread, building one if none is idle, and
+        takes it back afterwards. Reused services keep their connections alive.
+
+        Returns
+        -------
+        type: googleapiclient.discovery.Resource
+        service to handle uploading and adding permissions for user
+
+        """
+        credentials = GDrive._get_credentials()
+        service = None
+        while service is None:
+            try:
+                owner, service = _IDLE_SERVICES.get_nowait()
+            except queue.Empty:
+                service = GDrive._get_upload_service()
+                break
+            # services authorized by replaced credentials are dropped
+            if owner is not credentials:
+                service = None
+        try:
+            yield service
+        finally:
+            _IDLE_SERVICES.put((credentials, service))
+
+    @staticmethod
+    def _get_credentials():
+        """
+        Loads the stored credentials once, and refreshes the access token shortly before
+        it expires so that no upload request is turned down on expiry.
+
+        Returns
+        -------
+        credentials
+            type: OAuth2Credentials
+
+        Raises
+        ------
+        OAuthFailure
+            when there are no valid stored credentials
+
+        """
+        global _CREDENTIALS
+        with _AUTH_LOCK:
+            if _CREDENTIALS is None or _CREDENTIALS.invalid:
+                _CREDENTIALS = GDrive._auth_from_file(file.Storage(CRED_PATH))
+            expiry = _CREDENTIALS.token_expiry
+            if expiry is None or expiry - datetime.utcnow() < REFRESH_MARGIN:
+                try:
+                    # the credentials are stored again by their storage once refreshed
+                    _CREDENTIALS.refresh(build_http())
+                    LOG.debug("Drive access token refreshed, expires at %s",
+                              _CREDENTIALS.token_expiry)
+                except (client.AccessTokenRefreshError, HttpLib2Error, OSError) as err:
+                    # the token is still refreshed on demand by the first refused request
+                    LOG.warning("Failed to refresh drive access token!")
+                    LOG.debug(err)
+            return _CREDENTIALS
+
+    @staticmethod
+    def _set_credentials(credentials):
+        """
+        Replaces the credentials used by the uploads, e.g. after authenticating again.
+
+        Parameters
+        ----------
+        credentials
+            type: OAuth2Credentials
+
+        Returns
+        -------
+
+        """
+        global _CREDENTIALS
+        with _AUTH_LOCK:
+            _CREDENTIALS = credentials
 
     @staticmethod
     def _upload(tasks_list):
         """
-        Uploads the folder and appends share entities
+        Uploads the folders and appends share entities. The files of all the folders are
+        uploaded in parallel, by "upload.gdrive.workers" threads.
 
         Parameters
         -------
@@ -90,48 +393,164 @@ class GDrive(Uploader):
         -------
 
         """
-        service = GDrive._get_upload_service()
-        file_service = service.files()  # pylint: disable=no-member
-        permissions_service = service.permissions()  # pylint: disable=no-member
-        batch_service = service.new_batch_http_request(callback=GDrive._share_callback)  # pylint: disable=no-member
-        for task in tasks_list:
-            folder, share_list = task[TSK_STORE_INDEX], task[TSK_SHR_INDEX]
-            folder_id, error = None, None
+        workers, chunk_size = GDrive._get_transfer_config()
+        with GDrive._service() as service, \
+                ThreadPoolExecutor(max_workers=workers) as executor:
+            file_service = service.files()  # pylint: disable=no-member
+            sharer = ShareBatcher(service)
+            # the files of every folder are queued before waiting on any of them
+            started = [(task,) + GDrive._start_folder(file_service, executor, task, chunk_size)
+                       for task in tasks_list]
+            finished = []  # tuples of the task and the outcome of its upload
+            shared = False
             try:
-                try:
-                    GDrive._set_uploading(folder)
-                    folder_id = GDrive._create_folder(file_service, folder)
-                    GDrive._upload_files(file_service, folder, folder_id)
-                    GDrive._share(batch_service, permissions_service, folder_id, share_list)
-                    LOG.debug("%s uploaded successfully!", folder)
-                    GDrive._remove(folder)
-                    LOG.debug("%s removed from local storage successfully!", folder)
-                except (UnexpectedBodyError, ResumableUploadError, UnexpectedMethodError,
-                        HttpError) as err:
-                    LOG.warning("Uploading %s failed! Will retry later", folder)
-                    LOG.debug(err)
-                    with DBHandler.connect() as db_cur:
-                        folder_id, error = None, err
-                        raise UploadingFailed(folder, db_cur)
-            except UploadingFailed:
-                pass
-
-            if folder_id is not None:
-                add_to_report("{folder} successfully uploaded to drive (folderid = {folder_id}), "
-                              "and shared with {share_lists}.".format(
-                                  folder=task[TSK_STORE_INDEX],
-                                  folder_id=folder_id,
-                                  share_lists=task[TSK_SHR_INDEX]
-                                  ))
-            else:
-                add_to_report("{folder} uploading to drive failed due to "
-                              "following error\n{error}\n".format(
-                                  folder=task[TSK_STORE_INDEX],
-                                  error=error
-                                  ))
+                for task, folder_id, uploads in started:
+                    finished.append((task, GDrive._finish_folder(sharer, task, folder_id,
+                                                                 uploads)))
+                # the folders of the run are shared at once, in as few requests as possible
+                for folder_id, email in sharer.flush():
+                    add_to_report("Sharing drive folder (folderid = {folder_id}) with {email} "
+                                  "failed.".format(folder_id=folder_id, email=email))
+                shared = True
+            finally:
+                # a folder counts as uploaded once it was shared, else it is uploaded again
+                for task, status in finished:
+                    GDrive._set_status(task, status if shared else SINK_FAILED)
+
+            # uploading logs with every upload.
+            GDrive.upload_log(file_service)
+
+    @staticmethod
+    def _start_folder(file_service, executor, task, chunk_size):
+        """
+        Creates the folder of a task on drive and queues the upload of its files.
+
+        Parameters
+        ----------
+        file_service
+            file managing service for google drive
+        executor
+            type: concurrent.futures.ThreadPoolExecutor
+            pool of upload threads
+        task
+            type: tuple
+            details of the recording to be uploaded
+        chunk_size
+            type: int
+            bytes uploaded per request
+
+        Returns
+        -------
+        type: tuple
+        id of the created folder and the futures of the uploads of its files; a single
+        failed future if the folder could not be created
+
+        """
+        folder = task[TSK_STORE_INDEX]
+        try:
+            folder_id = GDrive._create_folder(file_service, folder)
+            return folder_id, GDrive._upload_files(executor, folder, folder_id, chunk_size)
+        except UPLOAD_ERRORS + TRANSPORT_ERRORS as err:
+            failed = Future()
+            failed.set_exception(err)
+            return None, [failed]
+
+    @staticmethod
+    def _finish_folder(sharer, task, folder_id, uploads):
+        """
+        Waits for the files of a folder to be uploaded, then queues the sharing of the
+        folder.
+
+        Parameters
+        ----------
+        sharer
+            type: ShareBatcher
+            permissions of the folders uploaded in the run
+        task
+            type: tuple
+            details of the recording being uploaded
+        folder_id
+            type: str
+            unique folder id of the cloud folder
+        uploads
+            type: list
+            futures of the uploads of the files of the folder
+
+        Returns
+        -------
+        type: str
+        outcome of the upload to drive, SINK_UPLOADED or SINK_FAILED
+
+        """
+        folder, share_list = task[TSK_STORE_INDEX], task[TSK_SHR_INDEX]
+        status, error = SINK_UPLOADED, None
+        try:
+            for upload in uploads:
+                upload.result()
+            sharer.add(folder_id, share_list)
+            LOG.debug("%s uploaded successfully!", folder)
+        except UPLOAD_ERRORS + TRANSPORT_ERRORS as err:
+            LOG.warning("Uploading %s failed! Will retry later", folder)
+            LOG.debug(err)
+            folder_id, status, error = None, SINK_FAILED, err
+
+        if folder_id is not None:
+            add_to_report("{folder} successfully uploaded to drive (folderid = {folder_id}), "
+                          "and shared with {share_lists}.".format(
+                              folder=folder,
+                              folder_id=folder_id,
+                              share_lists=share_list
+                              ))
+        else:
+            add_to_report("{folder} uploading to drive failed due to "
+                          "following error\n{error}\n".format(
+                              folder=folder,
+                              error=error
+                              ))
+        return status
+
+    @staticmethod
+    def _set_status(task, status):
+        """
+        Records the outcome of the upload of a task to drive.
+
+        Parameters
+        ----------
+        task
+            type: tuple
+            details of the uploaded recording
+        status
+            type: str
+            SINK_UPLOADED or SINK_FAILED
+
+        Returns
+        -------
+
+        """
+        try:
+            TaskSinks.set_status(task[TSK_ID_INDEX], DRIVE_SINK, status)
+        except DBException as err:
+            LOG.debug(err)
 
-        # uploading logs with every upload.
-        GDrive.upload_log(file_service)
+    @staticmethod
+    def _get_transfer_config():
+        """
+        Reads the concurrency and the chunk size of the uploads from "upload.gdrive". A
+        chunk is no larger than the burst of the bandwidth limit, so that it is sent at
+        the capped rate rather than in one burst followed by a wait.
+
+        Returns
+        -------
+        type: tuple
+        number of upload threads, and bytes uploaded per request
+
+        """
+        config = (get_uploader_config() or {}).get('gdrive') or {}
+        workers = max(1, int(config.get('workers') or DEFAULT_WORKERS))
+        chunk_mb = float(config.get('chunk_mb') or DEFAULT_CHUNK_MB)
+        chunk_size = min(int(chunk_mb * 1024 * 1024), int(get_bucket().capacity))
+        chunk_size = max(1, chunk_size // CHUNK_UNIT) * CHUNK_UNIT
+        return workers, chunk_size
 
     @staticmethod
     def upload_log(file_service):
@@ -267,24 +686,30 @@ class GDrive(Uploader):
         return folder_id
 
     @staticmethod
-    def _upload_files(file_service, folder, folder_id):
+    def _upload_files(executor, folder, folder_id, chunk_size):
         """
-        uploads files present in the folder to google drive under
+        queues the upload of the files present in the folder to google drive under
         the provided folder's id.
 
         Parameters
         ----------
-        file_service
-            file managing service for google drive
+        executor
+            type: concurrent.futures.ThreadPoolExecutor
+            pool of upload threads
         folder
             type: str
             absolute path of folder to be uploaded
         folder_id
             type: str
             unique folder id of the cloud parent folder
+        chunk_size
+            type: int
+            bytes uploaded per request
 
         Returns
         -------
+        type: list
+        futures of the uploads, resulting in the ids of the uploaded files
 
         """
         files = [os.path.join(folder, x) for x in os.listdir(folder)]
@@ -292,13 +717,42 @@ class GDrive(Uploader):
             files.remove(os.path.join(folder, 'ffmpeg2pass-0.log.mbtree'))
         except ValueError:
             pass
-        for file_path in files:
-            GDrive._upload_file(file_service, folder_id, file_path)
+        return [executor.submit(GDrive._upload_in_worker, folder_id, file_path, chunk_size)
+                for file_path in files]
+
+    @staticmethod
+    def _upload_in_worker(folder_id, file_path, chunk_size):
+        """
+        uploads a single file with a service lent to the calling upload thread
+
+        Parameters
+        -------
+        folder_id
+            type: str
+            unique folder id of the cloud parent folder
+        file_path
+            type: str
+            absolute path of the file to be uploaded
+        chunk_size
+            type: int
+            bytes uploaded per request
+
+        Returns
+        -------
+        type: str
+        id of the uploaded file
+
+        """
+        with GDrive._service() as service:
+            return GDrive._upload_file(service.files(), folder_id, file_path,  # pylint: disable=no-member
+                                       chunk_size)
 
     @staticmethod
-    def _upload_file(file_service, folder_id, file_path):
+    def _upload_file(file_service, folder_id, file_path, chunk_size=None):
         """
-        uploads a single file to the drive
+        uploads a single file to the drive, chunk by chunk. The resumable session is
+        stored in the database so that an interrupted upload resumes from the last
+        chunk received by drive, even after a restart of Nephos.
 
         Parameters
         -------
@@ -310,9 +764,14 @@ class GDrive(Uploader):
         file_path
             type: str
             absolute path of the file to be uploaded
+        chunk_size
+            type: int
+            bytes uploaded per request, None for the configured size
 
         Returns
         -------
+        type: str
+        id of the uploaded file
 
         """
         file_metadata = {
@@ -322,56 +781,94 @@ class GDrive(Uploader):
         media = MediaFileUpload(
             file_path,
             mimetype=GDrive._get_mimetype(GDrive._get_name(file_path)),
+            chunksize=chunk_size or GDrive._get_transfer_config()[1],
             resumable=True
         )
-        file_id = file_service.create(
+        request = file_service.create(
             body=file_metadata,
             media_body=media,
             fields='id'
-        ).execute().get('id')
+        )
+        session = GDrive._get_session(file_path)
+        if session is not None:
+            LOG.debug("Resuming upload of %s", file_path)
+            request.resumable_uri = session
+            # the next chunk then starts by asking drive how much it has received
+            request._in_error_state = True  # pylint: disable=protected-access
+
+        limiter = get_limiter(DRIVE_SINK)
+        response = None
+        while response is None:
+            # the bytes of the next chunk are taken from the bandwidth limit before it is sent
+            limiter.consume(min(media.chunksize(), media.size() - request.resumable_progress))
+            try:
+                status, response = request.next_chunk(num_retries=NUM_RETRIES)
+            except HttpError as err:
+                if session is None or err.resp.status not in SESSION_GONE:
+                    raise
+                LOG.debug("Upload session of %s expired, restarting the upload", file_path)
+                session = request.resumable_uri = None
+                request.resumable_progress = 0
+                request._in_error_state = False  # pylint: disable=protected-access
+                continue
+            if request.resumable_uri != session:
+                session = request.resumable_uri
+                GDrive._save_session(file_path, session)
+            if status is not None:
+                LOG.debug("%s: %d%% uploaded", file_path, status.progress() * 100)
+
+        GDrive._save_session(file_path, None)
+        file_id = response.get('id')
         LOG.debug("%s uploaded to file ID: %s", file_path, file_id)
         return file_id
 
     @staticmethod
-    def _share(batch_service, perm_service, folder_id, share_list):
+    def _get_session(file_path):
         """
-        Share a given folderid with some other entity.
-        Role defines the level of access the entity can have.
-        The supported values for role are: owner, reader, writer or commenter.
+        Parameters
+        ----------
+        file_path
+            type: str
+            absolute path of the file to be uploaded
 
-        Currently we add everyone as reader.
+        Returns
+        -------
+        type: str
+        resumable upload URI of the interrupted upload of the file, None if there is none
+
+        """
+        try:
+            return UploadSessions.get(file_path, DRIVE_SINK)
+        except DBException as err:
+            LOG.debug(err)
+            return None
+
+    @staticmethod
+    def _save_session(file_path, session):
+        """
+        Stores the resumable upload URI of the file; losing it only costs a restart of the
+        upload, hence database errors are ignored.
 
         Parameters
         ----------
-        batch_service
-            batch http requests managing service for google drive
-        perm_service
-            permissions managing service for google drive
-        folder_id
+        file_path
             type: str
-            unique folder id of the cloud folder
-        share_list
+            absolute path of the file being uploaded
+        session
             type: str
-            str of entities the file is to be shared with,
-            multiple values separated by space
+            resumable upload URI, None once the upload is complete
 
         Returns
         -------
 
         """
-        for email in share_list.split():
-            permission = {
-                "type": "user",
-                "role": "reader",
-                "emailAddress": email
-            }
-            batch_service.add(perm_service.create(
-                fileId=folder_id,
-                body=permission,
-                fields='id',
-            ))
-
-        batch_service.execute()
+        try:
+            if session is None:
+                UploadSessions.remove(file_path, DRIVE_SINK)
+            else:
+                UploadSessions.save(file_path, DRIVE_SINK, session)
+        except DBException as err:
+            LOG.debug(err)
 
     @staticmethod
     def _get_mimetype(filename):
@@ -388,7 +885,7 @@ class GDrive(Uploader):
         -------
         mimeType
             type: str
-            google drive mimetype
+            google drive mimetype, a generic one for unknown extensions
 
         """
         name_parts = filename.split('.')
@@ -401,12 +898,4 @@ class GDrive(Uploader):
             "log": 'text/plain'
         }
 
-        return mimetype[extension]
-
-    @staticmethod
-    def _share_callback(_, response, exception):
-        if exception:
-            # Handle error
-            LOG.debug(exception)
-        else:
-            LOG.debug("Permission Id: %s", response.get('id'))
+        return mimetype.get(extension, 'application/octet-stream')
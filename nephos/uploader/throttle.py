@@ -0,0 +1,314 @@
+"""
+Limits the bandwidth taken by the uploads, as a whole and per sink, and measures it
+"""
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from logging import getLogger
+from pydash import get
+
+from . import get_uploader_config
+
+
+LOG = getLogger(__name__)
+BYTES_PER_MBIT = 1000 * 1000 / 8
+BYTES_PER_MB = 1024 * 1024
+DEFAULT_BURST_MB = 16
+DEFAULT_BUSINESS_HOURS = "08:00-20:00"
+METER_WINDOW_SECS = 10  # throughput is averaged over this many past seconds
+TOTAL = "total"
+_BUCKET = None
+_LIMITERS = {}
+_LOCK = threading.Lock()
+
+
+class TokenBucket:
+    """
+    Token bucket shared by the upload threads. Tokens (bytes) are added at the rate of the
+    cap, up to the size of the bucket; a sender takes the tokens of what it sends and
+    waits while the bucket is in debt, which keeps the average rate at the cap.
+    """
+
+    def __init__(self, rate, capacity=None):
+        """
+        Parameters
+        ----------
+        rate
+            type: float
+            bytes per second, 0 for no limit
+        capacity
+            type: float
+            bytes which may be sent at once after an idle period, the rate by default
+        """
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def set_rate(self, rate):
+        """
+        Changes the cap, the tokens gathered until now being added at the previous rate.
+
+        Parameters
+        ----------
+        rate
+            type: float
+            bytes per second, 0 for no limit
+
+        Returns
+        -------
+
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self.rate:
+                self._tokens = min(self.capacity,
+                                   self._tokens + (now - self._stamp) * self.rate)
+            else:
+                self._tokens = self.capacity
+            self._stamp = now
+            self.rate = rate
+
+    def consume(self, amount):
+        """
+        Takes the tokens of the bytes to be sent, waiting until the bucket can afford them.
+
+        Parameters
+        ----------
+        amount
+            type: int
+            number of bytes
+
+        Returns
+        -------
+        type: float
+        seconds waited
+
+        """
+        if not self.rate:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            # the tokens are taken even if short, later senders queue up behind the debt
+            self._tokens -= amount
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+def get_bucket():
+    """
+    Returns the bucket shared by all the uploads, created from "upload.bandwidth_mbps"
+    and "upload.burst_mb" on first use and again whenever they change.
+
+    Returns
+    -------
+    type: TokenBucket
+
+    """
+    global _BUCKET
+    config = get_uploader_config()
+    rate = float(get(config, 'bandwidth_mbps') or 0) * BYTES_PER_MBIT
+    burst = float(get(config, 'burst_mb') or DEFAULT_BURST_MB) * BYTES_PER_MB
+    with _LOCK:
+        # the rate of the shared bucket is never changed, so it tells the limits it was made of
+        if _BUCKET is None or (_BUCKET.rate, _BUCKET.capacity) != (rate, burst):
+            if rate:
+                LOG.info("Uploads limited to %s Mbit/s", get(config, 'bandwidth_mbps'))
+            _BUCKET = TokenBucket(rate, burst)
+        return _BUCKET
+
+
+class ThroughputMeter:
+    """
+    Bytes sent over the last METER_WINDOW_SECS seconds.
+    """
+
+    def __init__(self, window=METER_WINDOW_SECS):
+        """
+        Parameters
+        ----------
+        window
+            type: float
+            seconds the rate is averaged over
+        """
+        self.window = window
+        self._sent = deque()  # tuples of the time and the bytes sent
+        self._lock = threading.Lock()
+
+    def add(self, amount):
+        """
+        Parameters
+        ----------
+        amount
+            type: int
+            bytes sent
+
+        Returns
+        -------
+
+        """
+        with self._lock:
+            self._sent.append((time.monotonic(), amount))
+
+    def rate(self):
+        """
+        Returns
+        -------
+        type: float
+        bytes per second
+
+        """
+        with self._lock:
+            since = time.monotonic() - self.window
+            while self._sent and self._sent[0][0] < since:
+                self._sent.popleft()
+            return sum(amount for _, amount in self._sent) / self.window
+
+
+class SinkLimiter:
+    """
+    Bandwidth limit of a sink, "upload.<sink>.business_mbps" within the business hours
+    and "upload.<sink>.offpeak_mbps" outside, within the limit of all the uploads.
+    """
+
+    def __init__(self, sink):
+        """
+        Parameters
+        ----------
+        sink
+            type: str
+            name of the sink, its section in the upload configuration
+        """
+        config = get_uploader_config()
+        self.sink = sink
+        self.business_hours = get(config, 'business_hours') or DEFAULT_BUSINESS_HOURS
+        self.business_rate = float(get(config, sink+'.business_mbps') or 0) * BYTES_PER_MBIT
+        self.offpeak_rate = float(get(config, sink+'.offpeak_mbps') or 0) * BYTES_PER_MBIT
+        burst = float(get(config, 'burst_mb') or DEFAULT_BURST_MB) * BYTES_PER_MB
+        self.bucket = TokenBucket(self._get_rate(), burst)
+        self.meter = ThroughputMeter()
+
+    def _get_rate(self):
+        """
+        Returns
+        -------
+        type: float
+        bytes per second allowed to the sink now, 0 for no limit
+
+        """
+        if in_time_window(self.business_hours, datetime.now().time()):
+            return self.business_rate
+        return self.offpeak_rate
+
+    def consume(self, amount):
+        """
+        Takes the bytes to be sent from the limits of the sink and of all the uploads,
+        waiting until both can afford them.
+
+        Parameters
+        ----------
+        amount
+            type: int
+            number of bytes
+
+        Returns
+        -------
+        type: float
+        seconds waited
+
+        """
+        rate = self._get_rate()
+        if rate != self.bucket.rate:
+            LOG.debug("Uploads to %s limited to %.1f Mbit/s", self.sink, rate / BYTES_PER_MBIT)
+            self.bucket.set_rate(rate)
+        waited = self.bucket.consume(amount) + get_bucket().consume(amount)
+        self.meter.add(amount)
+        return waited
+
+
+def get_limiter(sink):
+    """
+    Returns the limiter of a sink, created on first use.
+
+    Parameters
+    ----------
+    sink
+        type: str
+        name of the sink
+
+    Returns
+    -------
+    type: SinkLimiter
+
+    """
+    with _LOCK:
+        if sink not in _LIMITERS:
+            _LIMITERS[sink] = SinkLimiter(sink)
+        return _LIMITERS[sink]
+
+
+def get_throughput():
+    """
+    Returns
+    -------
+    type: dict
+    bytes per second sent lately by every sink, and by all of them under TOTAL
+
+    """
+    with _LOCK:
+        limiters = list(_LIMITERS.values())
+    throughput = {limiter.sink: limiter.meter.rate() for limiter in limiters}
+    throughput[TOTAL] = sum(throughput.values())
+    return throughput
+
+
+def display_throughput():
+    """
+    Prints the current upload rate of every sink
+
+    Returns
+    -------
+
+    """
+    LOG.info("\nSink\tMbit/s\tLimit (Mbit/s)")
+    with _LOCK:
+        limits = {sink: limiter.bucket.rate for sink, limiter in _LIMITERS.items()}
+    for sink, rate in sorted(get_throughput().items()):
+        limit = limits.get(sink, get_bucket().rate if sink == TOTAL else 0)
+        print("\t".join([sink, "{:.2f}".format(rate / BYTES_PER_MBIT),
+                         "{:.2f}".format(limit / BYTES_PER_MBIT) if limit else "none"]))
+
+
+def in_time_window(window, now):
+    """
+    Parameters
+    ----------
+    window
+        type: str
+        "HH:MM-HH:MM", may span midnight eg. "22:00-06:00"
+    now
+        type: datetime.time
+        time of the day to check
+
+    Returns
+    -------
+    type: bool
+    True if the time is within the window
+
+    """
+    try:
+        start, end = (datetime.strptime(bound.strip(), "%H:%M").time()
+                      for bound in window.split("-"))
+    except ValueError as error:
+        LOG.warning("Invalid time window %s, expected \"HH:MM-HH:MM\"", window)
+        LOG.debug(error)
+        return False
+    if start <= end:
+        return start <= now < end
+    return now >= start or now < end
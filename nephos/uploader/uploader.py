@@ -4,23 +4,33 @@ All uploading clients should be derived class Uploader and implement the necessa
 """
 from abc import ABC, abstractmethod
 import ntpath
+import os
 import shutil
 import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from logging import getLogger
+from pydash import get
 
 from . import get_uploader_config
-from .ftp import FTPUploader
-from ..manage_db import DBHandler, DBException
+from .ftp import FTPUploader, FTP_SINK
+from .throttle import in_time_window
+from ..manage_db import DBHandler, DBException, TaskQueue, TaskLease, TaskSinks, \
+    TSK_ID_INDEX, TSK_STORE_INDEX
 
 
 LOG = getLogger(__name__)
-CMD_GET_FOLDERS = 'SELECT * FROM tasks WHERE status = "processed"'
-CMD_SET_UPLOADING = """UPDATE tasks
-                    SET status = "uploading"
-                    WHERE store_path = ?"""
+CONTINUOUS_MODE = "continuous"
+DEFAULT_DISPATCH_MINUTES = 1
 CMD_RM_TASK = """DELETE
                 FROM tasks
                 WHERE store_path = ?"""
+CMD_RM_TASK_SINKS = """DELETE
+                FROM task_sinks
+                WHERE task_id IN (SELECT task_id FROM tasks WHERE store_path = ?)"""
+CMD_RM_SESSIONS = """DELETE
+                FROM upload_sessions
+                WHERE instr(path, ?) = 1"""
 
 
 class Uploader(ABC):
@@ -28,6 +38,7 @@ class Uploader(ABC):
     Handles basic and necessary functions of an uploader,
     all uploading modules need to derive from this class
     """
+    sink = None  # name of the destination of the uploader, eg. "gdrive"
 
     def __init__(self, scheduler):
         self._config = get_uploader_config()
@@ -60,73 +71,203 @@ class Uploader(ABC):
         pass
 
     @staticmethod
-    def begin_uploads(up_func):
+    def begin_uploads(up_func, sink):
         """
-        Parse folders to be uploaded from the database
+        Claims the processed folders from the database and uploads them to every sink.
+
+        Every claimed task is moved to "uploading" atomically and its lease is kept alive
+        during the upload. The sinks upload the tasks concurrently, each at its own pace,
+        and a folder is removed once every sink has it. Tasks which are still held once
+        the uploads are over, i.e. the ones some sink failed, are returned to the queue.
 
         Parameters
         -------
         up_func
             type: callable
-            upload function to be called
+            upload function of the cloud storage
+        sink
+            type: str
+            name of the cloud storage sink
 
         Returns
         -------
 
         """
+        worker_id = TaskQueue.worker_id()
+        tasks_list = []
         try:
-            with DBHandler.connect() as db_cur:
-                db_cur.execute(CMD_GET_FOLDERS)
-                tasks_list = db_cur.fetchall()
+            task = TaskQueue.claim_next("upload", worker_id)
+            while task is not None:
+                tasks_list.append(task)
+                task = TaskQueue.claim_next("upload", worker_id)
         except (DBException, sqlite3.OperationalError) as error:
             LOG.warning("Failed to connect to database")
             LOG.debug(error)
+            Uploader._release(tasks_list, worker_id)
             return
 
         if tasks_list:
-            LOG.info("Uploading to FTP server first...")
-            FTPUploader(tasks_list)
-            LOG.info("Beginning upload to cloud storage...")
-            up_func(tasks_list)
+            sinks = Uploader._get_sinks(up_func, sink)
+            with TaskLease("upload", [task[TSK_ID_INDEX] for task in tasks_list], worker_id):
+                with ThreadPoolExecutor(max_workers=len(sinks)) as executor:
+                    runs = [executor.submit(Uploader._run_sink, name, func, tasks_list)
+                            for name, func in sinks]
+                for (name, _), run in zip(sinks, runs):
+                    if run.exception() is not None:
+                        LOG.warning("Uploading to %s failed!", name)
+                        LOG.debug(run.exception())
+                Uploader._remove_uploaded(tasks_list, [name for name, _ in sinks])
+            Uploader._release(tasks_list, worker_id)
         else:
             LOG.debug("No uploads queued!")
 
     @staticmethod
-    @abstractmethod
-    def _upload(tasks_list):
+    def dispatch_uploads(up_func, sink):
         """
-        Uploads the folder and appends share entities
+        Uploads the processed folders, unless within the quiet hours of "continuous" mode.
 
         Parameters
         -------
+        up_func
+            type: callable
+            upload function of the cloud storage
+        sink
+            type: str
+            name of the cloud storage sink
+
+        Returns
+        -------
+
+        """
+        quiet_hours = get(get_uploader_config(), 'dispatch.quiet_hours')
+        if quiet_hours and in_time_window(quiet_hours, datetime.now().time()):
+            LOG.debug("Within quiet hours %s, uploads held", quiet_hours)
+            return
+        Uploader.begin_uploads(up_func, sink)
+
+    @staticmethod
+    def _get_sinks(up_func, sink):
+        """
+        Parameters
+        ----------
+        up_func
+            type: callable
+            upload function of the cloud storage
+        sink
+            type: str
+            name of the cloud storage sink
+
+        Returns
+        -------
+        type: list
+        tuples of the name and the upload function of every configured sink
+
+        """
+        sinks = [(sink, up_func)]
+        if FTPUploader.is_configured():
+            sinks.append((FTP_SINK, FTPUploader))
+        else:
+            LOG.debug("FTP server not configured, uploading to %s only", sink)
+        return sinks
+
+    @staticmethod
+    def _run_sink(name, up_func, tasks_list):
+        """
+        Uploads the tasks which the sink doesn't have yet.
+
+        Parameters
+        ----------
+        name
+            type: str
+            name of the sink
+        up_func
+            type: callable
+            upload function of the sink, records the status of every task it uploads
         tasks_list
-            type:  list
-            list containing details of recordings to be uploaded.
+            type: list
+            list of claimed tasks
 
         Returns
         -------
 
         """
-        # make sure to add a function to upload logs to a remote folder in cloud
-        pass
+        pending = [task for task in tasks_list
+                   if name not in TaskSinks.uploaded(task[TSK_ID_INDEX])]
+        if pending:
+            LOG.info("Beginning upload of %d folder(s) to %s...", len(pending), name)
+            up_func(pending)
 
     @staticmethod
-    def _set_uploading(folder):
+    def _remove_uploaded(tasks_list, sinks):
         """
-        Sets the status of the entry with corresponding folder to "uploading"
+        Removes the folders which every sink has, along with their tasks.
 
         Parameters
         ----------
-        folder
+        tasks_list
+            type: list
+            list of claimed tasks
+        sinks
+            type: list
+            names of the sinks
+
+        Returns
+        -------
+
+        """
+        for task in tasks_list:
+            folder = task[TSK_STORE_INDEX]
+            try:
+                if TaskSinks.uploaded(task[TSK_ID_INDEX]).issuperset(sinks):
+                    Uploader._remove(folder)
+                    LOG.debug("%s removed from local storage successfully!", folder)
+            except (DBException, OSError) as error:
+                LOG.warning("Failed to remove uploaded folder %s", folder)
+                LOG.debug(error)
+
+    @staticmethod
+    def _release(tasks_list, worker_id):
+        """
+        Returns the tasks still held by the worker to the upload queue.
+
+        Parameters
+        ----------
+        tasks_list
+            type: list
+            list of claimed tasks
+        worker_id
             type: str
-            path to the folder being uploaded
+            id of the worker which claimed the tasks
 
         Returns
         -------
 
         """
-        with DBHandler.connect() as db_cur:
-            db_cur.execute(CMD_SET_UPLOADING, (folder, ))
+        for task in tasks_list:
+            try:
+                if TaskQueue.release("upload", task[TSK_ID_INDEX], worker_id):
+                    LOG.debug("Task (id = %s) returned to upload queue", task[TSK_ID_INDEX])
+            except DBException as error:
+                LOG.debug(error)
+
+    @staticmethod
+    @abstractmethod
+    def _upload(tasks_list):
+        """
+        Uploads the folder and appends share entities
+
+        Parameters
+        -------
+        tasks_list
+            type:  list
+            list containing details of recordings to be uploaded.
+
+        Returns
+        -------
+
+        """
+        # make sure to add a function to upload logs to a remote folder in cloud
+        pass
 
     @staticmethod
     def _remove(folder):
@@ -144,13 +285,17 @@ class Uploader(ABC):
 
         """
         with DBHandler.connect() as db_cur:
+            db_cur.execute(CMD_RM_TASK_SINKS, (folder, ))
             db_cur.execute(CMD_RM_TASK, (folder, ))
+            db_cur.execute(CMD_RM_SESSIONS, (os.path.join(folder, ""), ))
 
         shutil.rmtree(folder)
 
     def add_to_scheduler(self):
         """
-        Adds uploading job to class' scheduler.
+        Adds uploading job to class' scheduler. In "continuous" mode the processed folders
+        are dispatched every "upload.dispatch.interval" minutes, otherwise they are
+        uploaded at the "upload.timings".
 
         Returns
         -------
@@ -163,7 +308,14 @@ class Uploader(ABC):
             "run_uploader": self.begin_uploads,
         }
 
-        args = [self._upload]
+        args = [self._upload, self.sink]
+
+        if get(self._config, 'mode') == CONTINUOUS_MODE:
+            LOG.debug("Adding dispatch_uploads default job to scheduler...")
+            interval = get(self._config, 'dispatch.interval') or DEFAULT_DISPATCH_MINUTES
+            self._scheduler.add_necessary_job(self.dispatch_uploads, "run_uploader",
+                                              interval, args)
+            return
 
         for job in jobs:
             LOG.debug("Adding %s default job to scheduler...", job)
@@ -184,7 +336,7 @@ class Uploader(ABC):
         """
         job_list = self._scheduler.get_jobs()
         for job in job_list:
-            if "run_uploader@" in job.id:
+            if job.id == "run_uploader" or "run_uploader@" in job.id:
                 self._scheduler.rm_recording_job(job.id)
 
     @staticmethod
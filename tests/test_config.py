@@ -8,7 +8,7 @@ from nephos.load_config import get_env_var, Config
 from nephos import __nephos_dir__
 
 
-def mock_load(to_load, _=True):
+def mock_load(to_load, _=True, __=False):
     """
     Mocks the load function from Config Class
 
@@ -19,6 +19,8 @@ def mock_load(to_load, _=True):
         configuration to load
     _
         type: bool
+    __
+        type: bool
 
     Returns
     -------
@@ -199,6 +201,52 @@ class TestConfig(TestCase):
                 expected_output = "Failed to open {file}".format(file=file_path)
                 self.assertIn(expected_output, output)
 
+    def test_load_data_cached(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            config, default = create_mock_yaml(temp_dir)
+            file_path = os.path.join(default, "test.yaml")
+            first = self.TestConfig.load_data(file_path, False)
+            with mock.patch('nephos.load_config.yaml.safe_load') as mock_safe_load:
+                second = self.TestConfig.load_data(file_path, False)
+
+                self.assertFalse(mock_safe_load.called)
+            self.assertEqual(first, second)
+            # callers get copies, modifying one must not alter the cache
+            second['version'] = 2
+            self.assertEqual(self.TestConfig.load_data(file_path, False), {'version': 1})
+
+    def test_load_data_cache_invalidated_on_change(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            config, default = create_mock_yaml(temp_dir)
+            file_path = os.path.join(default, "test.yaml")
+            self.TestConfig.load_data(file_path, False)
+            with open(file_path, "w") as file:
+                yaml.dump({'version': 2, 'changed': True}, file)
+
+            self.assertEqual(self.TestConfig.load_data(file_path, False),
+                             {'version': 2, 'changed': True})
+
+    def test_load_data_reload(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            config, default = create_mock_yaml(temp_dir)
+            file_path = os.path.join(default, "test.yaml")
+            self.TestConfig.load_data(file_path, False)
+            with mock.patch('nephos.load_config.yaml.safe_load', return_value={}) as mock_load:
+                self.assertEqual(self.TestConfig.load_data(file_path, False, reload=True), {})
+                self.assertTrue(mock_load.called)
+
+    def test_invalidate_cache(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            config, default = create_mock_yaml(temp_dir)
+            with mock.patch('nephos.load_config.__config_dir__', new=default), \
+                 mock.patch('nephos.load_config.__default_config_dir__', new=default):
+                self.TestConfig.load_data("test.yaml", True)
+                Config.invalidate_cache("test.yaml")
+                with mock.patch('nephos.load_config.yaml.safe_load', return_value={}) as mock_load:
+                    self.TestConfig.load_data("test.yaml", True)
+
+                    self.assertTrue(mock_load.called)
+
     @mock.patch('nephos.load_config.Config.logging_config')
     def test_correct_log_path(self, config_data):
         config_data.__getitem__.side_effect = MOCK_LOGGING_CONFIG_DATA.__getitem__
@@ -1,7 +1,10 @@
 from unittest import TestCase, mock
+from concurrent.futures import ThreadPoolExecutor
 import tempfile
+import time
 import os
-from nephos.manage_db import DBHandler, DBException
+from nephos.manage_db import DBHandler, DBException, TaskQueue, TaskLease, TaskSinks, \
+    TSK_ID_INDEX, TSK_PATH_INDEX, TSK_STAT_INDEX, TSK_WORKER_INDEX
 
 TEMP_DIR = tempfile.TemporaryDirectory()
 DB_PATH = os.path.join(TEMP_DIR.name, "storage.db")
@@ -45,3 +48,250 @@ class TestDBHandler(TestCase):
         with self.assertRaises(DBException):
             with self.db_handler.connect():
                 pass
+
+
+class TestConnectionPool(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.patcher = mock.patch('nephos.manage_db.DB_PATH',
+                                  new=os.path.join(self.temp_dir.name, "storage.db"))
+        self.patcher.start()
+        DBHandler().first_time()
+
+    def tearDown(self):
+        DBHandler.close()
+        self.patcher.stop()
+        self.temp_dir.cleanup()
+
+    def test_connection_reused_per_thread(self):
+        with DBHandler.connect() as db_cur:
+            first = db_cur.connection
+        with DBHandler.connect() as db_cur:
+            second = db_cur.connection
+
+        def other_thread():
+            with DBHandler.connect() as cur:
+                conn = cur.connection
+            DBHandler.close()
+            return conn
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            third = executor.submit(other_thread).result()
+
+        self.assertIs(first, second)
+        self.assertIsNot(first, third)
+
+    def test_pragmas(self):
+        with DBHandler.connect() as db_cur:
+            db_cur.execute("PRAGMA journal_mode")
+            self.assertEqual(db_cur.fetchone()[0], "wal")
+            db_cur.execute("PRAGMA synchronous")
+            self.assertEqual(db_cur.fetchone()[0], 1)  # NORMAL
+
+    @mock.patch('nephos.manage_db.get_db_config', return_value={"busy_timeout": 2})
+    def test_busy_timeout(self, _):
+        DBHandler.close()
+        with DBHandler.connect() as db_cur:
+            db_cur.execute("PRAGMA busy_timeout")
+            self.assertEqual(db_cur.fetchone()[0], 2000)
+
+    def test_rollback_on_error(self):
+        with self.assertRaises(ValueError):
+            with DBHandler.connect() as db_cur:
+                DBHandler.insert_data(db_cur, "share_list", {"email": "a@b.com"})
+                raise ValueError
+        with self.assertRaises(DBException):
+            with DBHandler.connect() as db_cur:
+                DBHandler.insert_data(db_cur, "share_list", {"email": "a@b.com"})
+                db_cur.execute("SELECT * FROM no_table")
+
+        with DBHandler.connect() as db_cur:
+            db_cur.execute("SELECT * FROM share_list")
+            self.assertEqual(db_cur.fetchall(), [])
+
+    def test_insert_data_quotes(self):
+        with DBHandler.connect() as db_cur:
+            DBHandler.insert_data(db_cur, "channels", {"name": "o'brien \"tv\"", "ip": "0:1",
+                                                       "timezone": "utc"})
+            db_cur.execute("SELECT name FROM channels")
+            self.assertEqual(db_cur.fetchall(), [("o'brien \"tv\"", )])
+
+    def test_insert_many(self):
+        rows = [{"email": "a@b.com", "tags": "x"}, {"email": "c'd@b.com", "tags": "y"},
+                {"email": "e@b.com"}]
+        with DBHandler.connect() as db_cur:
+            inserted = DBHandler.insert_many(db_cur, "share_list", rows)
+            db_cur.execute("SELECT email, tags FROM share_list ORDER BY share_id")
+            stored = db_cur.fetchall()
+
+        self.assertEqual(inserted, rows)
+        self.assertEqual(stored, [("a@b.com", "x"), ("c'd@b.com", "y"), ("e@b.com", None)])
+
+    @mock.patch('nephos.manage_db.LOG')
+    def test_insert_many_skips_duplicates(self, mock_log):
+        with DBHandler.connect() as db_cur:
+            DBHandler.insert_data(db_cur, "share_list", {"email": "b@b.com"})
+        rows = [{"email": "a@b.com"}, {"email": "b@b.com"}, {"email": "c@b.com"}]
+        with DBHandler.connect() as db_cur:
+            inserted = DBHandler.insert_many(db_cur, "share_list", rows)
+            db_cur.execute("SELECT email FROM share_list ORDER BY email")
+            stored = db_cur.fetchall()
+
+        self.assertEqual(inserted, [rows[0], rows[2]])
+        self.assertEqual(stored, [("a@b.com", ), ("b@b.com", ), ("c@b.com", )])
+        self.assertTrue(mock_log.warning.called)
+
+    @mock.patch('nephos.manage_db.LOG')
+    def test_insert_many_skips_duplicates_in_rows(self, _):
+        rows = [{"email": "a@b.com"}, {"email": "a@b.com"}, {"email": "c@b.com"},
+                {"email": "c@b.com"}, {"email": "e@b.com"}]
+        with DBHandler.connect() as db_cur:
+            inserted = DBHandler.insert_many(db_cur, "share_list", rows)
+            db_cur.execute("SELECT email FROM share_list ORDER BY email")
+            stored = db_cur.fetchall()
+
+        self.assertEqual(inserted, [rows[0], rows[2], rows[4]])
+        self.assertEqual(stored, [("a@b.com", ), ("c@b.com", ), ("e@b.com", )])
+
+    @mock.patch('nephos.manage_db.LOG')
+    def test_insert_many_invalid(self, mock_log):
+        with DBHandler.connect() as db_cur:
+            self.assertEqual(DBHandler.insert_many(db_cur, "share_list", [{"test": 1}]), [])
+        self.assertTrue(mock_log.warning.called)
+
+    def test_insert_many_joins_transaction(self):
+        with self.assertRaises(ValueError):
+            with DBHandler.connect() as db_cur:
+                DBHandler.insert_many(db_cur, "share_list", [{"email": "a@b.com"}])
+                raise ValueError
+
+        with DBHandler.connect() as db_cur:
+            db_cur.execute("SELECT * FROM share_list")
+            self.assertEqual(db_cur.fetchall(), [])
+
+    def test_nested_blocks_share_transaction(self):
+        with self.assertRaises(ValueError):
+            with DBHandler.connect() as db_cur:
+                with DBHandler.connect() as inner_cur:
+                    DBHandler.insert_data(inner_cur, "share_list", {"email": "a@b.com"})
+                raise ValueError
+
+        with DBHandler.connect() as db_cur:
+            db_cur.execute("SELECT * FROM share_list")
+            self.assertEqual(db_cur.fetchall(), [])
+
+
+class TestTaskQueue(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.patcher = mock.patch('nephos.manage_db.DB_PATH',
+                                  new=os.path.join(self.temp_dir.name, "storage.db"))
+        self.patcher.start()
+        DBHandler().first_time()
+        with DBHandler.connect() as db_cur:
+            for index in range(3):
+                DBHandler.insert_data(db_cur, "tasks", {"orig_path": str(index),
+                                                        "store_path": "s" + str(index)})
+
+    def tearDown(self):
+        DBHandler.close()
+        self.patcher.stop()
+        self.temp_dir.cleanup()
+
+    def test_upgrade_adds_columns(self):
+        with DBHandler.connect() as db_cur:
+            db_cur.execute("DROP TABLE tasks")
+            db_cur.execute("CREATE TABLE tasks (task_id integer PRIMARY KEY, orig_path text)")
+        DBHandler().upgrade()
+
+        with DBHandler.connect() as db_cur:
+            db_cur.execute("PRAGMA table_info(tasks)")
+            columns = [column[1] for column in db_cur.fetchall()]
+        self.assertIn("worker_id", columns)
+        self.assertIn("lease_expiry", columns)
+        self.assertEqual(columns[-3:], ["parent_id", "seg_index", "gaps"])
+
+    def test_claim_next_never_repeats(self):
+        claimed = [TaskQueue.claim_next("preprocess", "worker") for _ in range(4)]
+
+        self.assertIsNone(claimed[-1])
+        self.assertEqual(sorted(task[TSK_PATH_INDEX] for task in claimed[:-1]), ['0', '1', '2'])
+        self.assertTrue(all(task[TSK_STAT_INDEX] == "processing" for task in claimed[:-1]))
+        self.assertTrue(all(task[TSK_WORKER_INDEX] == "worker" for task in claimed[:-1]))
+
+    def test_claim_next_after(self):
+        first = TaskQueue.claim_next("preprocess", "worker")
+        TaskQueue.release("preprocess", first[TSK_ID_INDEX], "worker")
+        claimed = [TaskQueue.claim_next("preprocess", "worker", after=first[TSK_ID_INDEX])
+                   for _ in range(3)]
+
+        self.assertIsNone(claimed[-1])
+        self.assertNotIn(first[TSK_ID_INDEX], [task[TSK_ID_INDEX] for task in claimed[:-1]])
+
+    def test_claim_next_concurrent(self):
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            claimed = list(executor.map(
+                lambda worker: TaskQueue.claim_next("preprocess", worker), ["a", "b", "c"]))
+
+        self.assertEqual(sorted(task[TSK_PATH_INDEX] for task in claimed), ['0', '1', '2'])
+
+    def test_claim_next_expired_lease(self):
+        task = TaskQueue.claim_next("preprocess", "dead", lease_secs=-1)
+        reclaimed = [TaskQueue.claim_next("preprocess", "alive") for _ in range(3)]
+
+        self.assertIn(task[TSK_ID_INDEX], [row[TSK_ID_INDEX] for row in reclaimed])
+        self.assertFalse(TaskQueue.heartbeat("preprocess", task[TSK_ID_INDEX], "dead"))
+
+    def test_heartbeat_and_release(self):
+        task = TaskQueue.claim_next("preprocess", "worker", lease_secs=1)
+
+        self.assertTrue(TaskQueue.heartbeat("preprocess", task[TSK_ID_INDEX], "worker", 100))
+        self.assertFalse(TaskQueue.release("preprocess", task[TSK_ID_INDEX], "other"))
+        self.assertTrue(TaskQueue.release("preprocess", task[TSK_ID_INDEX], "worker"))
+        self.assertEqual(TaskQueue.claim_next("preprocess", "worker")[TSK_ID_INDEX],
+                         task[TSK_ID_INDEX])
+
+    def test_recover_stale_tasks(self):
+        TaskQueue.claim_next("preprocess", "worker")
+        TaskQueue.claim_next("preprocess", "worker", lease_secs=-1)
+
+        self.assertEqual(TaskQueue.recover_stale_tasks(), 1)
+        self.assertEqual(TaskQueue.recover_stale_tasks(expired_only=False), 1)
+        with DBHandler.connect() as db_cur:
+            db_cur.execute('SELECT * FROM tasks WHERE status = "not processed"')
+            self.assertEqual(len(db_cur.fetchall()), 3)
+
+    def test_encoded_task_not_recovered(self):
+        with DBHandler.connect() as db_cur:
+            db_cur.execute('INSERT INTO tasks (orig_path, store_path, status) '
+                           'VALUES ("live", "live_store", "encoded")')
+        TaskQueue.recover_stale_tasks(expired_only=False)
+        claimed = [TaskQueue.claim_next("preprocess", "worker") for _ in range(4)]
+
+        self.assertNotIn("live", [task[TSK_PATH_INDEX] for task in claimed[:-1]])
+        with DBHandler.connect() as db_cur:
+            db_cur.execute('SELECT status FROM tasks WHERE orig_path = "live"')
+            self.assertEqual(db_cur.fetchone()[0], "encoded")
+
+    def test_task_lease(self):
+        self.assertIsNone(TaskQueue.claim_next("upload", "worker"))
+
+        task = TaskQueue.claim_next("preprocess", "worker", lease_secs=0.3)
+        with TaskLease("preprocess", [task[TSK_ID_INDEX]], "worker", lease_secs=0.3):
+            time.sleep(0.5)
+            others = [TaskQueue.claim_next("preprocess", "other") for _ in range(3)]
+
+        self.assertIsNone(others[-1])
+        self.assertNotIn(task[TSK_ID_INDEX], [row[TSK_ID_INDEX] for row in others[:-1]])
+
+    def test_task_sinks(self):
+        TaskSinks.set_status(1, "ftp", "failed")
+        TaskSinks.set_status(1, "gdrive", "uploaded")
+        TaskSinks.set_status(2, "ftp", "uploaded")
+
+        self.assertEqual(TaskSinks.uploaded(1), {"gdrive"})
+        TaskSinks.set_status(1, "ftp", "uploaded")
+        self.assertEqual(TaskSinks.uploaded(1), {"ftp", "gdrive"})
+        self.assertEqual(TaskSinks.uploaded(3), set())
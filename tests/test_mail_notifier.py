@@ -1,4 +1,3 @@
-import subprocess
 from unittest import TestCase, mock
 from nephos.mail_notifier import send_mail, send_report, add_to_report
 
@@ -6,11 +5,13 @@ MOCK_REPORT_FILE = 'report.txt'
 
 
 class MockPopen:
-    def __init__(self, cmd, shell, stdout, stderr):
+    returncode = 0
+
+    def __init__(self, cmd, stdin, stdout, stderr):
         pass
 
     @staticmethod
-    def communicate():
+    def communicate(input=None):
         return "some text", "some other text"
 
 
@@ -18,7 +19,7 @@ class MockPopen:
 class TestMailNotifier(TestCase):
 
     @mock.patch('nephos.mail_notifier.subprocess')
-    @mock.patch('nephos.mail_notifier.load_mail_list', return_value='test')
+    @mock.patch('nephos.mail_notifier.load_mail_list', return_value=['test'])
     def test_send_mail(self, mock_mails, mock_subprocess, mock_log):
         mock_subprocess.Popen.side_effect = MockPopen
         return_value = send_mail("test", "critical")
@@ -31,8 +32,7 @@ class TestMailNotifier(TestCase):
     @mock.patch('nephos.mail_notifier.subprocess')
     @mock.patch('nephos.mail_notifier.load_mail_list', return_value='test')
     def test_send_mail_error(self, mock_mails, mock_subprocess, mock_log):
-        mock_subprocess.Popen.side_effect = subprocess.CalledProcessError(1, cmd="test")
-        mock_subprocess.CalledProcessError = subprocess.CalledProcessError
+        mock_subprocess.Popen.side_effect = FileNotFoundError("mail")
         return_value = send_mail("test", "critical")
 
         self.assertTrue(mock_mails.called)
@@ -40,6 +40,16 @@ class TestMailNotifier(TestCase):
         self.assertTrue(mock_log.warning.called)
         self.assertEqual(return_value, False)
 
+    @mock.patch('nephos.mail_notifier.subprocess')
+    @mock.patch('nephos.mail_notifier.load_mail_list', return_value='test')
+    def test_send_mail_exit_status(self, _, mock_subprocess, mock_log):
+        mock_subprocess.Popen.return_value.communicate.return_value = "some text", None
+        mock_subprocess.Popen.return_value.returncode = 1
+        return_value = send_mail("test", "critical")
+
+        self.assertTrue(mock_log.warning.called)
+        self.assertEqual(return_value, False)
+
     @mock.patch('builtins.open')
     def test_add_to_report(self, mock_open, mock_log):
         add_to_report("test")
@@ -1,7 +1,9 @@
 from unittest import TestCase, mock
 from multiprocessing import pool
 from functools import partial
+import time
 from nephos.maintenance.channel_online_check import ChannelOnlineCheck
+from nephos.exceptions import DBException
 
 
 MOCK_POOL = pool.ThreadPool(2)
@@ -42,39 +44,71 @@ class TestChannelOnlineCheck(TestCase):
 
     @mock.patch('nephos.maintenance.channel_online_check.ChannelHandler')
     def test__execute(self, mock_ch, mock_channel_checker):
-        mock_channel_checker._extract_ips.return_value = ['0.0.0.0']
+        mock_channel_checker._extract_ips.return_value = ['0.0.0.0', '127.0.0.1']
+        mock_channel_checker._get_data.return_value = 2
+        mock_channel_checker._check_ip.side_effect = lambda ip, path, timeout: (ip, False)
         ChannelOnlineCheck._execute(mock_channel_checker)
 
         self.assertTrue(mock_ch.grab_ch_list.called)
         self.assertTrue(mock_channel_checker._channel_stats.called)
         self.assertTrue(mock_channel_checker._extract_ips.called)
+        self.assertEqual(mock_channel_checker._check_ip.call_count, 2)
+        mock_channel_checker._update_status.assert_called_with([('0.0.0.0', False),
+                                                                ('127.0.0.1', False)])
+
+    @mock.patch('nephos.maintenance.channel_online_check.ChannelHandler')
+    def test__execute_concurrent(self, _, mock_channel_checker):
+        ips = [str(index) for index in range(8)]
+        mock_channel_checker._extract_ips.return_value = ips
+        mock_channel_checker._get_data.return_value = 8
+
+        def slow_probe(ip_addr, path, timeout):
+            time.sleep(0.2)
+            return ip_addr, True
+        mock_channel_checker._check_ip.side_effect = slow_probe
+
+        start = time.monotonic()
+        ChannelOnlineCheck._execute(mock_channel_checker)
+
+        self.assertLess(time.monotonic() - start, 1)
+        mock_channel_checker._update_status.assert_called_with([(ip, True) for ip in ips])
 
-    @mock.patch('nephos.manage_db.DBHandler.connect')
     @mock.patch('nephos.maintenance.channel_online_check.ChannelHandler')
     @mock.patch('os.stat')
     @mock.patch('nephos.maintenance.channel_online_check.LOG')
-    def test__check_ip(self, mock_log, mock_stat, mock_ch, mock_db, _):
+    def test__check_ip(self, mock_log, mock_stat, mock_ch, _):
         mock_stat.return_value = MockOSReturn(0)
         ip_addr = '0.0.0.0:8080'
-        ChannelOnlineCheck._check_ip(ip_addr, 'test')
+        result = ChannelOnlineCheck._check_ip(ip_addr, 'test', timeout=10)
 
-        mock_ch.record_stream.assert_called_with(mock.ANY, mock.ANY, mock.ANY, test=True)
+        mock_ch.record_stream.assert_called_with(mock.ANY, mock.ANY, mock.ANY, test=True,
+                                                 timeout=10)
         self.assertTrue(mock_stat.called)
-        self.assertTrue(mock_db.called)
+        self.assertEqual(result, (ip_addr, True))
         mock_log.debug.assert_called_with(mock.ANY, ip_addr)
 
-    @mock.patch('nephos.manage_db.DBHandler.connect')
     @mock.patch('nephos.maintenance.channel_online_check.ChannelHandler')
     @mock.patch('os.stat')
     @mock.patch('nephos.maintenance.channel_online_check.LOG')
-    def test__check_ip_record_error(self, mock_log, mock_stat, mock_ch, mock_db, _):
+    def test__check_ip_up(self, mock_log, mock_stat, mock_ch, _):
+        mock_stat.return_value = MockOSReturn(4096)
+        ip_addr = '0.0.0.0:8080'
+        result = ChannelOnlineCheck._check_ip(ip_addr, 'test')
+
+        self.assertEqual(result, (ip_addr, False))
+        self.assertFalse(mock_log.debug.called)
+
+    @mock.patch('nephos.maintenance.channel_online_check.ChannelHandler')
+    @mock.patch('os.stat')
+    @mock.patch('nephos.maintenance.channel_online_check.LOG')
+    def test__check_ip_record_error(self, mock_log, mock_stat, mock_ch, _):
         mock_stat.return_value = MockOSReturn(0)
         ip_addr = '0.0.0.0:8080'
         mock_ch.record_stream.return_value = False
-        ChannelOnlineCheck._check_ip(ip_addr, 'test')
+        result = ChannelOnlineCheck._check_ip(ip_addr, 'test')
 
         self.assertFalse(mock_stat.called)
-        self.assertTrue(mock_db.called)
+        self.assertEqual(result, (ip_addr, True))
         mock_log.debug.assert_called_with(mock.ANY, ip_addr)
 
     @mock.patch('nephos.maintenance.channel_online_check.ChannelHandler')
@@ -87,10 +121,78 @@ class TestChannelOnlineCheck(TestCase):
         mock_stat.side_effect = FileNotFoundError
         ChannelOnlineCheck._check_ip(ip_addr, 'test')
 
-        mock_ch.record_stream.assert_called_with(mock.ANY, mock.ANY, mock.ANY, test=True)
+        mock_ch.record_stream.assert_called_with(mock.ANY, mock.ANY, mock.ANY, test=True,
+                                                 timeout=None)
         self.assertTrue(mock_stat.called)
         self.assertTrue(mock_log.debug.called)
 
+    @mock.patch('nephos.maintenance.channel_online_check.get_recorder_config')
+    @mock.patch('nephos.maintenance.channel_online_check.ChannelHandler')
+    def test__execute_native(self, _, mock_config, mock_channel_checker):
+        mock_config.return_value = {'ifaddr': '10.0.0.1'}
+        mock_channel_checker._extract_ips.return_value = ['0.0.0.0']
+        mock_channel_checker._get_data.side_effect = lambda kind, key: {'probe': 'native'}.get(key)
+        mock_channel_checker._probe_ip.return_value = ('0.0.0.0', False)
+        ChannelOnlineCheck._execute(mock_channel_checker)
+
+        mock_channel_checker._probe_ip.assert_called_with('0.0.0.0', ifaddr='10.0.0.1')
+        self.assertFalse(mock_channel_checker._check_ip.called)
+        mock_channel_checker._update_status.assert_called_with([('0.0.0.0', False)])
+
+    @mock.patch('nephos.maintenance.channel_online_check.receiver.probe')
+    def test__probe_ip(self, mock_probe, _):
+        mock_probe.return_value.is_receiving = True
+        mock_probe.return_value.is_valid = True
+        mock_probe.return_value.valid_bytes = 4096
+
+        self.assertEqual(ChannelOnlineCheck._probe_ip('0.0.0.0:1234', ''), ('0.0.0.0:1234', False))
+
+    @mock.patch('nephos.maintenance.channel_online_check.receiver.probe')
+    @mock.patch('nephos.maintenance.channel_online_check.LOG')
+    def test__probe_ip_down(self, mock_log, mock_probe, _):
+        mock_probe.return_value.is_receiving = False
+        mock_probe.return_value.is_valid = False
+        mock_probe.return_value.valid_bytes = 0
+
+        self.assertEqual(ChannelOnlineCheck._probe_ip('0.0.0.0:1234', ''), ('0.0.0.0:1234', True))
+        mock_log.debug.assert_called_with(mock.ANY, '0.0.0.0:1234')
+
+    @mock.patch('nephos.maintenance.channel_online_check.receiver.probe')
+    def test__probe_ip_garbage(self, mock_probe, _):
+        mock_probe.return_value.is_receiving = True
+        mock_probe.return_value.is_valid = False
+
+        self.assertEqual(ChannelOnlineCheck._probe_ip('0.0.0.0:1234', ''), ('0.0.0.0:1234', True))
+
+    @mock.patch('nephos.maintenance.channel_online_check.receiver.probe')
+    def test__probe_ip_bind_error(self, mock_probe, _):
+        mock_probe.side_effect = OSError
+
+        self.assertEqual(ChannelOnlineCheck._probe_ip('0.0.0.0:1234', ''), ('0.0.0.0:1234', True))
+
+    @mock.patch('nephos.maintenance.channel_online_check.DBHandler')
+    @mock.patch('nephos.maintenance.channel_online_check.LOG')
+    @mock.patch('nephos.maintenance.channel_online_check.registry')
+    def test__update_status(self, mock_registry, mock_log, mock_db, _):
+        ChannelOnlineCheck._update_status([('0.0.0.0', True), ('127.0.0.1', False)])
+
+        self.assertEqual(mock_db.connect.call_count, 1)
+        with mock_db.connect() as db_cur:
+            db_cur.executemany.assert_any_call(mock.ANY, [('0.0.0.0', )])
+            db_cur.executemany.assert_any_call(mock.ANY, [('127.0.0.1', )])
+        self.assertFalse(mock_log.warning.called)
+        self.assertTrue(mock_registry.refresh.called)
+
+    @mock.patch('nephos.maintenance.channel_online_check.DBHandler')
+    @mock.patch('nephos.maintenance.channel_online_check.LOG')
+    @mock.patch('nephos.maintenance.channel_online_check.registry')
+    def test__update_status_fail(self, mock_registry, mock_log, mock_db, _):
+        mock_db.connect.side_effect = DBException()
+        ChannelOnlineCheck._update_status([('0.0.0.0', True)])
+
+        self.assertTrue(mock_log.warning.called)
+        self.assertTrue(mock_registry.refresh.called)
+
     def test__channel_stats(self, mock_channel_checker):
         with mock.patch('nephos.maintenance.channel_online_check.ChannelOnlineCheck.channel_list',
                         new=MOCK_CH_LIST), \
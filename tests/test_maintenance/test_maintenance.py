@@ -51,3 +51,4 @@ class TestMaintenance(TestCase):
         _refresh_config()
 
         self.assertTrue(mock_config.called)
+        mock_config.return_value.load_config.assert_called_with(reload=True)
@@ -28,9 +28,13 @@ class TestNephos(TestCase):
             self.assertTrue(mock_maintenance.called)
             mock_log.info.assert_called_with("Nephos is all set to launch")
 
-    def test_start(self, _, mock_nephos):
+    @mock.patch('nephos.nephos.PreprocessHandler')
+    @mock.patch('nephos.nephos.TaskQueue')
+    def test_start(self, mock_queue, mock_preprocess, _, mock_nephos):
         Nephos.start(mock_nephos)
 
+        mock_queue.recover_stale_tasks.assert_called_with(expired_only=False)
+        self.assertTrue(mock_preprocess.recover_encoded.called)
         self.assertTrue(mock_nephos.scheduler.start.called)
 
     @mock.patch('builtins.input')
@@ -1,15 +1,7 @@
 from unittest import mock, TestCase
 
-from nephos.preprocessor.methods import ApplyProcessMethods
-
-
-class MockPopen:
-    def __init__(self, cmd, shell, stdout, stderr):
-        pass
-
-    @staticmethod
-    def communicate():
-        return "some text", "some other text"
+from nephos.preprocessor.methods import ApplyProcessMethods, DBException
+from nephos.preprocessor.pipeline import StepResult
 
 
 class MockSize:
@@ -41,11 +33,6 @@ mock_lang_data = {
     ]
 }
 
-mock_share_list = {
-    'entry': "test"
-}
-
-
 @mock.patch('nephos.preprocessor.methods.ApplyProcessMethods')
 @mock.patch('nephos.preprocessor.methods.LOG')
 class TestApplyProcessMethods(TestCase):
@@ -55,7 +42,7 @@ class TestApplyProcessMethods(TestCase):
         ApplyProcessMethods.__init__(mock_methods, 'test', 'test')
 
         self.assertTrue(mock_methods._get_name.called)
-        self.assertTrue(mock_db.connect.called)
+        self.assertFalse(mock_db.connect.called)
         self.assertTrue(mock_methods._apply_methods.called)
         self.assertFalse(mock_log.warning.called)
 
@@ -63,6 +50,8 @@ class TestApplyProcessMethods(TestCase):
     @mock.patch('os.makedirs')
     @mock.patch('nephos.preprocessor.methods.DBHandler')
     def test__apply_methods(self, mock_db, mock_mkdir, mock_rm, mock_log, mock_methods):
+        mock_methods.encoded = False
+        mock_methods.segment = False
         ApplyProcessMethods._apply_methods(mock_methods)
 
         self.assertTrue(mock_mkdir.called)
@@ -72,53 +61,143 @@ class TestApplyProcessMethods(TestCase):
         self.assertTrue(mock_db.connect.called)
         self.assertFalse(mock_log.debug.called)
 
-    @mock.patch('nephos.preprocessor.methods.subprocess')
-    @mock.patch('os.path')
+    @mock.patch('os.remove')
+    @mock.patch('os.makedirs')
+    @mock.patch('nephos.preprocessor.methods.DBHandler')
+    def test__apply_methods_encoded(self, mock_db, mock_mkdir, mock_rm, mock_log, mock_methods):
+        mock_methods.encoded = True
+        mock_methods.segment = False
+        mock_rm.side_effect = FileNotFoundError
+        ApplyProcessMethods._apply_methods(mock_methods)
+
+        self.assertFalse(mock_methods._execute_processing.called)
+        self.assertTrue(mock_methods._add_share_entities.called)
+        self.assertTrue(mock_db.connect.called)
+
+    @mock.patch('os.remove')
+    @mock.patch('os.makedirs')
+    @mock.patch('nephos.preprocessor.methods.DBHandler')
+    def test__apply_methods_segment(self, mock_db, _, __, mock_log, mock_methods):
+        mock_methods.encoded = False
+        mock_methods.segment = True
+        ApplyProcessMethods._apply_methods(mock_methods)
+
+        self.assertTrue(mock_methods._execute_processing.called)
+        self.assertFalse(mock_methods._add_share_entities.called)
+        cursor = mock_db.connect.return_value.__enter__.return_value
+        self.assertIn("segment processed", cursor.execute.call_args[0][0])
+
+    @mock.patch('nephos.preprocessor.methods.get_preprocessor_config')
+    @mock.patch('nephos.preprocessor.methods.pipeline')
+    @mock.patch('nephos.preprocessor.methods.DBHandler')
     @mock.patch('os.stat')
-    def test__execute_processing(self, mock_stat, mock_path, mock_subprocess, mock_log, mock_methods):
-        mock_subprocess.Popen.side_effect = MockPopen
+    def test__execute_processing(self, mock_stat, mock_db, mock_pipeline, mock_config, mock_log,
+                                 mock_methods):
         mock_stat.side_effect = MockSize
+        mock_methods.store_dir = '/store'
+        mock_methods.name = 'news2018-01-01_2000'
+        mock_pipeline.run_profile.return_value = [StepResult("ccextractor", 1, 1, 1),
+                                                  StepResult("encode", 0, 1, 1)]
         ApplyProcessMethods._execute_processing(mock_methods)
 
-        self.assertTrue(mock_path.join.called)
-        self.assertTrue(mock_log.debug.called)
-        self.assertTrue(mock_subprocess.Popen.called)
-        self.assertTrue(mock_stat.called)
+        mock_pipeline.select_profile.assert_called_with(mock_config.return_value,
+                                                        mock_methods._get_channel_name(),
+                                                        mock_methods._get_job_name())
+        mock_pipeline.run_profile.assert_called_with(mock_pipeline.select_profile.return_value,
+                                                     mock_methods.addr, mock_methods.name,
+                                                     '/store', mock_config.return_value)
+        mock_stat.assert_called_with('/store/news2018-01-01_2000.mp4')
+        self.assertFalse(mock_db.connect.called)
+
+    @mock.patch('nephos.preprocessor.methods.ProcessFailedException')
+    @mock.patch('nephos.preprocessor.methods.get_preprocessor_config')
+    @mock.patch('nephos.preprocessor.methods.pipeline')
+    @mock.patch('nephos.preprocessor.methods.DBHandler')
+    @mock.patch('os.stat')
+    def test__execute_processing_step_failed(self, mock_stat, mock_db, mock_pipeline, _,
+                                             mock_failure, mock_log, mock_methods):
+        mock_methods.store_dir = '/store'
+        mock_methods.name = 'test'
+        mock_failure.return_value = ValueError()
+        mock_pipeline.run_profile.return_value = [StepResult("pass 1", 1, 1, 1)]
+        with self.assertRaises(ValueError):
+            ApplyProcessMethods._execute_processing(mock_methods)
+
+        self.assertFalse(mock_stat.called)
+        self.assertTrue(mock_db.connect.called)
+        self.assertIn("pass 1", str(mock_failure.call_args[0][3]))
+
+    @mock.patch('nephos.preprocessor.methods.ProcessFailedException')
+    @mock.patch('nephos.preprocessor.methods.get_preprocessor_config')
+    @mock.patch('nephos.preprocessor.methods.pipeline')
+    @mock.patch('nephos.preprocessor.methods.DBHandler')
+    @mock.patch('os.stat')
+    def test__execute_processing_small_output(self, mock_stat, mock_db, mock_pipeline, _,
+                                              mock_failure, mock_log, mock_methods):
+        mock_methods.store_dir = '/store'
+        mock_methods.name = 'test'
+        mock_stat.return_value.st_size = 10
+        mock_failure.return_value = ValueError()
+        mock_pipeline.run_profile.return_value = [StepResult("encode", 0, 1, 1)]
+        with self.assertRaises(ValueError):
+            ApplyProcessMethods._execute_processing(mock_methods)
+
+        self.assertTrue(mock_db.connect.called)
+
+    @mock.patch('nephos.preprocessor.methods.ProcessFailedException')
+    @mock.patch('nephos.preprocessor.methods.get_preprocessor_config')
+    @mock.patch('nephos.preprocessor.methods.pipeline')
+    @mock.patch('nephos.preprocessor.methods.DBHandler')
+    def test__execute_processing_invalid_profile(self, mock_db, mock_pipeline, _,
+                                                 mock_failure, mock_log, mock_methods):
+        mock_methods.store_dir = '/store'
+        mock_methods.name = 'test'
+        mock_pipeline.select_profile.side_effect = ValueError("Profile x is not defined")
+        mock_failure.return_value = KeyError()
+        with self.assertRaises(KeyError):
+            ApplyProcessMethods._execute_processing(mock_methods)
+
+        self.assertFalse(mock_pipeline.run_profile.called)
+        self.assertTrue(mock_log.warning.called)
 
     @mock.patch('nephos.preprocessor.methods.ShareHandler')
     @mock.patch('nephos.preprocessor.methods.DBHandler')
     def test__add_share_entities(self, mock_db, mock_share, mock_log, mock_methods):
-        mock_share.grab_shr_list.return_value = mock_share_list
-        mock_methods._tag_match.return_value = False
+        mock_methods._assemble_tags.return_value = "ch spa"
+        mock_methods.addr = "test"
+        mock_share.match_emails.return_value = ["a@b.c", "d@e.f"]
         ApplyProcessMethods._add_share_entities(mock_methods)
 
-        self.assertTrue(mock_share.grab_shr_list.called)
-        self.assertTrue(mock_methods._assemble_tags.called)
-        self.assertTrue(mock_methods._tag_match.called)
-        self.assertTrue(mock_db.connect.called)
+        mock_share.match_emails.assert_called_with(["ch", "spa"])
+        mock_db.connect.return_value.__enter__.return_value.execute.assert_called_with(
+            mock.ANY, ("a@b.c d@e.f", "test"))
         self.assertFalse(mock_log.debug.called)
 
     @mock.patch('nephos.preprocessor.methods.DBHandler')
     def test__assemble_tags(self, mock_db, mock_log, mock_methods):
-        with self.failUnlessRaises(TypeError):
-            ApplyProcessMethods._assemble_tags(mock_methods)
+        db_cur = mock_db.connect.return_value.__enter__.return_value
+        db_cur.fetchone.return_value = ("ch", "spa", "", "ESP", "CET", None)
 
-        self.assertTrue(mock_db.connect.called)
+        self.assertEqual(ApplyProcessMethods._assemble_tags(mock_methods), "ch spa ESP CET")
+        self.assertEqual(db_cur.execute.call_count, 1)
         self.assertFalse(mock_log.debug.called)
 
-    def test__tag_match_true(self, _, __):
-        ls_a = ["text1", "text2"]
-        ls_b = ["text2", "text3"]
-        return_value = ApplyProcessMethods._tag_match(ls_a, ls_b)
+    @mock.patch('nephos.preprocessor.methods.DBHandler')
+    def test__assemble_tags_fail(self, mock_db, mock_log, mock_methods):
+        mock_db.connect.side_effect = DBException()
+
+        self.assertEqual(ApplyProcessMethods._assemble_tags(mock_methods), "")
+        self.assertTrue(mock_log.debug.called)
+
+    def test__get_channel_name(self, _, mock_methods):
+        mock_methods.addr = '/home/user/recorded/ch_name/news2018-01-01_2000.ts'
 
-        self.assertTrue(return_value)
+        self.assertEqual(ApplyProcessMethods._get_channel_name(mock_methods), 'ch_name')
 
-    def test__tag_match_false(self, _, __):
-        ls_a = ["text1", "text2"]
-        ls_b = ["text4", "text3"]
-        return_value = ApplyProcessMethods._tag_match(ls_a, ls_b)
+    def test__get_job_name(self, _, mock_methods):
+        mock_methods.name = 'Evening News2018-01-01_2000'
 
-        self.assertFalse(return_value)
+        self.assertEqual(ApplyProcessMethods._get_job_name(mock_methods), 'Evening News')
 
     def test__get_name(self, _, mock_methods):
         mock_methods.addr = '/home/user/return.txt'
@@ -140,3 +219,23 @@ class TestApplyProcessMethods(TestCase):
         self.assertTrue(mock_json.loads.called)
         self.assertEqual(aud_lang, 'eng')
         self.assertEqual(sub_lang, 'spa')
+
+    @mock.patch('nephos.preprocessor.methods.subprocess.check_output')
+    def test__get_lang_untagged(self, mock_check_output, mock_log, _):
+        mock_check_output.return_value = b'{"streams": [{"codec_type": "audio"}, ' \
+            b'{"codec_type": "subtitle", "tags": {"language": "SPA"}}]}'
+        aud_lang, sub_lang = ApplyProcessMethods.get_lang("test")
+
+        self.assertFalse(mock_log.warning.called)
+        self.assertEqual(aud_lang, '')
+        self.assertEqual(sub_lang, 'spa')
+
+    @mock.patch('nephos.preprocessor.methods.subprocess.check_output')
+    def test__get_lang_fails(self, mock_check_output, mock_log, _):
+        for error in (FileNotFoundError("ffprobe"), None):
+            mock_log.reset_mock()
+            mock_check_output.side_effect = error
+            mock_check_output.return_value = b'not json'
+
+            self.assertEqual(ApplyProcessMethods.get_lang("test"), ('', ''))
+            self.assertTrue(mock_log.warning.called)
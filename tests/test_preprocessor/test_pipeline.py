@@ -0,0 +1,211 @@
+import os
+import sys
+import time
+from functools import partial
+from tempfile import TemporaryDirectory
+from unittest import TestCase, mock
+from nephos.preprocessor.pipeline import Profile, StepResult, select_profile, run_step, \
+    run_stage, run_profile, fan_out_file
+
+
+MOCK_CONFIG = {
+    'path_to_ffmpeg': 'ffmpeg',
+    'path_to_ccextractor': 'ccextractor',
+    'profile': 'crf',
+    'channel_profiles': {'ch_remux': 'remux'},
+    'job_profiles': {'job_two_pass': 'two_pass'},
+    'profiles': {
+        'crf': {'type': 'single_pass', 'args': '-c:v libx264 -crf 28'},
+        'remux': {'type': 'single_pass', 'args': '-c copy', 'subtitles': False},
+        'two_pass': {'type': 'two_pass', 'input_args': '-probesize 2G', 'args': '-b:v 500k'},
+    }
+}
+COPY_STDIN = "import shutil, sys\nwith open(sys.argv[1], 'wb') as out:\n" \
+             "    shutil.copyfileobj(sys.stdin.buffer, out)"
+BUSY_LOOP = "import time\nend = time.process_time() + 0.2\nwhile time.process_time() < end: pass"
+
+
+class TestProfile(TestCase):
+
+    def test_select_profile(self):
+        self.assertEqual(select_profile(MOCK_CONFIG, 'ch', 'job').name, 'crf')
+        self.assertEqual(select_profile(MOCK_CONFIG, 'ch_remux', 'job').name, 'remux')
+        self.assertEqual(select_profile(MOCK_CONFIG, 'ch_remux', 'job_two_pass').name, 'two_pass')
+
+    def test_select_profile_legacy(self):
+        profile = select_profile({'path_to_ffprobe': 'ffprobe'})
+
+        self.assertEqual(profile.kind, 'script')
+        self.assertFalse(profile.subtitles)
+
+    def test_select_profile_undefined(self):
+        with self.assertRaises(ValueError):
+            select_profile(dict(MOCK_CONFIG, profile='missing'))
+
+    def test_unknown_type(self):
+        with self.assertRaises(ValueError):
+            Profile('test', {'type': 'three_pass'})
+
+    def test_stages_single_pass(self):
+        stages = Profile('crf', MOCK_CONFIG['profiles']['crf']).stages('in.ts', 'out', '/out',
+                                                                       MOCK_CONFIG)
+
+        self.assertEqual([[name for name, _ in stage] for stage in stages],
+                         [['ccextractor', 'encode']])
+        self.assertEqual(stages[0][1][1], ['ffmpeg', '-y', '-i', 'in.ts', '-c:v', 'libx264',
+                                           '-crf', '28', '/out/out.mp4'])
+
+    def test_stages_remux(self):
+        stages = Profile('remux', MOCK_CONFIG['profiles']['remux']).stages('in.ts', 'out', '/out',
+                                                                           MOCK_CONFIG)
+
+        self.assertEqual(stages, [[('encode', ['ffmpeg', '-y', '-i', 'in.ts', '-c', 'copy',
+                                               '/out/out.mp4'])]])
+
+    def test_stages_two_pass(self):
+        stages = Profile('two_pass', MOCK_CONFIG['profiles']['two_pass']).stages(
+            'in.ts', 'out', '/out', MOCK_CONFIG)
+
+        self.assertEqual([[name for name, _ in stage] for stage in stages],
+                         [['ccextractor', 'pass 1'], ['pass 2']])
+        self.assertIn(os.devnull, stages[0][1][1])
+        self.assertEqual(stages[1][0][1][:5], ['ffmpeg', '-y', '-probesize', '2G', '-i'])
+        self.assertEqual(stages[1][0][1][-1], '/out/out.mp4')
+
+    def test_stages_two_pass_log(self):
+        stages = Profile('two_pass', MOCK_CONFIG['profiles']['two_pass']).stages(
+            'in.ts', 'out', '/out', MOCK_CONFIG, pass_dir='/tmp/pass')
+
+        # kept out of the uploaded folder
+        for args in (stages[0][1][1], stages[1][0][1]):
+            self.assertEqual(args[args.index('-passlogfile') + 1], '/tmp/pass/out')
+
+    def test_stages_shared_read(self):
+        profile = Profile('two_pass', dict(MOCK_CONFIG['profiles']['two_pass'], shared_read=True))
+        stages = profile.stages('in.ts', 'out', '/out', MOCK_CONFIG)
+
+        self.assertTrue(profile.shares_read)
+        self.assertEqual(stages[0][0][1][1], '-')
+        self.assertIn('pipe:0', stages[0][1][1])
+        self.assertIn('in.ts', stages[1][0][1])
+
+    def test_stages_live(self):
+        profile = Profile('crf', MOCK_CONFIG['profiles']['crf'])
+        stages = profile.stages(None, 'out', '/out', MOCK_CONFIG, live=True)
+
+        self.assertTrue(profile.streamable)
+        self.assertFalse(Profile('two_pass', MOCK_CONFIG['profiles']['two_pass']).streamable)
+        self.assertEqual(stages[0][0][1][1], '-')
+        self.assertIn('pipe:0', stages[0][1][1])
+
+    @mock.patch('nephos.preprocessor.pipeline.__config_dir__', new='/config')
+    def test_stages_script(self):
+        profile = Profile('script', {'type': 'script', 'path': 'custom.sh', 'shared_read': True})
+        stages = profile.stages('in.ts', 'out', '/out', MOCK_CONFIG)
+
+        self.assertFalse(profile.shares_read)
+        self.assertEqual(stages, [[('script', ['/config/custom.sh', 'in.ts', 'out', '/out'])]])
+
+
+class TestRunner(TestCase):
+
+    def test_run_step(self):
+        with TemporaryDirectory() as tmpdir:
+            log_path = os.path.join(tmpdir, "step.log")
+            result = run_step("busy", [sys.executable, "-c", BUSY_LOOP + "\nprint('done')"],
+                              tmpdir, log_path)
+
+            self.assertFalse(result.failed)
+            self.assertGreaterEqual(result.cpu_secs, 0.15)
+            self.assertGreaterEqual(result.wall_secs, result.cpu_secs * 0.5)
+            with open(log_path) as log_file:
+                self.assertIn("done", log_file.read())
+
+    def test_run_step_failed(self):
+        with TemporaryDirectory() as tmpdir:
+            result = run_step("fail", [sys.executable, "-c", "raise SystemExit(3)"], tmpdir,
+                              os.path.join(tmpdir, "step.log"))
+
+            self.assertTrue(result.failed)
+            self.assertEqual(result.returncode, 3)
+
+    def test_run_step_killed(self):
+        with TemporaryDirectory() as tmpdir:
+            result = run_step("killed", [sys.executable, "-c",
+                                         "import os, signal; os.kill(os.getpid(), signal.SIGKILL)"],
+                              tmpdir, os.path.join(tmpdir, "step.log"))
+
+            self.assertTrue(result.failed)
+            self.assertEqual(result.returncode, -9)
+
+    def test_run_stage_concurrent(self):
+        sleep = [sys.executable, "-c", "import time; time.sleep(0.5)"]
+        with TemporaryDirectory() as tmpdir:
+            start = time.monotonic()
+            results = run_stage([("ccextractor", sleep), ("pass 1", sleep)], tmpdir)
+
+            self.assertLess(time.monotonic() - start, 0.9)
+            self.assertEqual([result.name for result in results], ["ccextractor", "pass 1"])
+            self.assertFalse(any(result.failed for result in results))
+
+    def test_run_stage_shared_read(self):
+        with TemporaryDirectory() as tmpdir:
+            input_file = os.path.join(tmpdir, "in.ts")
+            with open(input_file, "wb") as recording:
+                recording.write(os.urandom(3 * 1024 * 1024 + 5))
+            copy = [sys.executable, "-c", COPY_STDIN]
+            results = run_stage([("ccextractor", copy + ["first"]), ("pass 1", copy + ["second"])],
+                                tmpdir, partial(fan_out_file, input_file))
+
+            self.assertFalse(any(result.failed for result in results))
+            with open(input_file, "rb") as recording:
+                expected = recording.read()
+            for name in ("first", "second"):
+                with open(os.path.join(tmpdir, name), "rb") as copied:
+                    self.assertEqual(copied.read(), expected)
+
+    def test_run_stage_shared_read_early_exit(self):
+        with TemporaryDirectory() as tmpdir:
+            input_file = os.path.join(tmpdir, "in.ts")
+            with open(input_file, "wb") as recording:
+                recording.write(bytes(3 * 1024 * 1024))
+            results = run_stage([("ccextractor", [sys.executable, "-c", "exit(0)"]),
+                                 ("pass 1", [sys.executable, "-c", COPY_STDIN, "copy"])],
+                                tmpdir, partial(fan_out_file, input_file))
+
+            self.assertFalse(any(result.failed for result in results))
+            self.assertEqual(os.stat(os.path.join(tmpdir, "copy")).st_size, 3 * 1024 * 1024)
+
+    @mock.patch('nephos.preprocessor.pipeline.LOG')
+    def test_run_profile(self, mock_log):
+        profile = mock.MagicMock()
+        profile.shares_read = False
+        profile.stages.return_value = [[("ccextractor", [sys.executable, "-c", "exit(1)"]),
+                                        ("pass 1", [sys.executable, "-c", "exit(0)"])],
+                                       [("pass 2", [sys.executable, "-c", "exit(0)"])]]
+        with TemporaryDirectory() as tmpdir:
+            results = run_profile(profile, "in.ts", "out", tmpdir, MOCK_CONFIG)
+
+            self.assertEqual([result.returncode for result in results], [1, 0, 0])
+            self.assertTrue(os.path.exists(os.path.join(tmpdir, "ccex.log")))
+            self.assertTrue(os.path.exists(os.path.join(tmpdir, "ffmpeg.log")))
+        self.assertTrue(mock_log.info.called)
+        pass_dir = profile.stages.call_args[1]['pass_dir']
+        self.assertFalse(pass_dir.startswith(tmpdir))
+        self.assertFalse(os.path.exists(pass_dir))
+
+    @mock.patch('nephos.preprocessor.pipeline.LOG')
+    def test_run_profile_stops_on_failure(self, mock_log):
+        profile = mock.MagicMock()
+        profile.shares_read = False
+        profile.stages.return_value = [[("pass 1", ["/nonexistent/ffmpeg"])],
+                                       [("pass 2", [sys.executable, "-c", "exit(0)"])]]
+        with TemporaryDirectory() as tmpdir:
+            results = run_profile(profile, "in.ts", "out", tmpdir, MOCK_CONFIG)
+
+        self.assertEqual(len(results), 1)
+        self.assertTrue(results[0].failed)
+        self.assertTrue(mock_log.warning.called)
+
+    def test_step_result(self):
+        self.assertIn("encode", repr(StepResult("encode", 0, 1.5, 1.0)))
@@ -1,6 +1,10 @@
 from unittest import TestCase, mock
 
-from nephos.preprocessor.preprocess import PreprocessHandler, DBException
+from nephos.preprocessor.preprocess import PreprocessHandler, ClaimCursor, DBException
+
+
+MOCK_TASK = (0, 'path', 'store', 'ch', 'spa', '', 'processing', 0, None, 'worker', 0.0, None, None)
+MOCK_SEGMENT_TASK = MOCK_TASK[:11] + (5, 2)
 
 
 @mock.patch('nephos.preprocessor.preprocess.PreprocessHandler')
@@ -11,15 +15,71 @@ class TestPreprocessHandler(TestCase):
         PreprocessHandler.__init__(mock_preprocess, mock.ANY)
         self.assertFalse(mock_log.warning.called)
 
-    @mock.patch('nephos.preprocessor.preprocess.ApplyProcessMethods')
-    def test_init_preprocess_pipe(self, mock_methods, mock_log, mock_preprocess):
-        mock_preprocess._query_tasks.return_value = ['mocktask']
+    @mock.patch('nephos.preprocessor.preprocess._POOL', new=None)
+    @mock.patch('nephos.preprocessor.preprocess.get_preprocessor_config',
+                return_value={'workers': 3})
+    @mock.patch('nephos.preprocessor.preprocess.segments')
+    def test_init_preprocess_pipe(self, mock_segments, _, mock_log, mock_preprocess):
         PreprocessHandler.init_preprocess_pipe()
 
-        self.assertTrue(mock_preprocess._query_tasks.called)
-        self.assertTrue(mock_methods.called)
+        self.assertEqual(mock_preprocess._run_worker.call_count, 3)
+        self.assertTrue(mock_segments.stitch_segments.called)
+        self.assertFalse(mock_log.warning.called)
+
+    @mock.patch('nephos.preprocessor.preprocess.TaskLease')
+    @mock.patch('nephos.preprocessor.preprocess.TaskQueue')
+    @mock.patch('nephos.preprocessor.preprocess.ApplyProcessMethods')
+    def test__run_worker(self, mock_methods, mock_queue, mock_lease, mock_log, _):
+        mock_queue.claim_next.side_effect = [MOCK_TASK, None]
+        PreprocessHandler._run_worker()
+
+        self.assertEqual(mock_queue.claim_next.call_count, 2)
+        mock_methods.assert_called_once_with('path', 'store', segment=False)
+        self.assertTrue(mock_lease.called)
+        self.assertTrue(mock_queue.release.called)
         self.assertFalse(mock_log.warning.called)
 
+    @mock.patch('nephos.preprocessor.preprocess.TaskLease')
+    @mock.patch('nephos.preprocessor.preprocess.TaskQueue')
+    @mock.patch('nephos.preprocessor.preprocess.ApplyProcessMethods')
+    def test__run_worker_segment(self, mock_methods, mock_queue, _, mock_log, __):
+        mock_queue.claim_next.side_effect = [MOCK_SEGMENT_TASK, None]
+        PreprocessHandler._run_worker()
+
+        mock_methods.assert_called_once_with('path', 'store', segment=True)
+
+    @mock.patch('nephos.preprocessor.preprocess.TaskLease')
+    @mock.patch('nephos.preprocessor.preprocess.TaskQueue')
+    @mock.patch('nephos.preprocessor.preprocess.ApplyProcessMethods')
+    def test__run_worker_error(self, mock_methods, mock_queue, _, mock_log, __):
+        mock_queue.claim_next.side_effect = [MOCK_TASK, None]
+        mock_methods.side_effect = IndexError
+        PreprocessHandler._run_worker()
+
+        self.assertEqual(mock_queue.claim_next.call_count, 2)
+        self.assertTrue(mock_queue.release.called)
+        self.assertTrue(mock_log.warning.called)
+
+    @mock.patch('nephos.preprocessor.preprocess.TaskLease')
+    @mock.patch('nephos.preprocessor.preprocess.TaskQueue')
+    @mock.patch('nephos.preprocessor.preprocess.ApplyProcessMethods')
+    def test__run_worker_cursor(self, mock_methods, mock_queue, _, mock_log, __):
+        mock_queue.claim_next.side_effect = [MOCK_TASK, None]
+        cursor = ClaimCursor()
+        PreprocessHandler._run_worker(cursor)
+
+        # a failed task is not claimed again in the same run
+        self.assertEqual(cursor.last_id, MOCK_TASK[0])
+        self.assertIsNone(mock_queue.claim_next.call_args_list[0][1]['after'])
+        self.assertEqual(mock_queue.claim_next.call_args[1]['after'], MOCK_TASK[0])
+
+    @mock.patch('nephos.preprocessor.preprocess.TaskQueue')
+    def test__run_worker_db_fail(self, mock_queue, mock_log, _):
+        mock_queue.claim_next.side_effect = DBException()
+        PreprocessHandler._run_worker()
+
+        self.assertTrue(mock_log.warning.called)
+
     @mock.patch('nephos.preprocessor.preprocess.DBHandler')
     @mock.patch('nephos.preprocessor.preprocess.ApplyProcessMethods')
     @mock.patch('nephos.preprocessor.preprocess.os')
@@ -31,10 +91,108 @@ class TestPreprocessHandler(TestCase):
         self.assertTrue(mock_db.connect.called)
         self.assertTrue(mock_db.insert_data.called)
         self.assertTrue(mock_preprocess._get_channel_name.called)
-        self.assertTrue(mock_os.path.join.called)
-        self.assertTrue(mock_methods.get_lang.called)
+        self.assertTrue(mock_preprocess.get_store_path.called)
+        mock_methods.get_lang.assert_called_with("test")
         self.assertTrue(mock_log.debug.called)
 
+    @mock.patch('nephos.preprocessor.preprocess.DBHandler')
+    @mock.patch('nephos.preprocessor.preprocess.ApplyProcessMethods')
+    def test_insert_task_encoded(self, mock_methods, mock_db, mock_log, mock_preprocess):
+        mock_methods.get_lang.return_value = "spa", ""
+        mock_db.insert_data.return_value = 1
+        task_id = PreprocessHandler.insert_task("/rec/ch/news.ts", "test2", store_path="/up/ch",
+                                                encoded=True)
+
+        self.assertEqual(task_id, 1)
+        self.assertFalse(mock_preprocess.get_store_path.called)
+        mock_methods.get_lang.assert_called_with("/up/ch/news.mp4")
+        data = mock_db.insert_data.call_args[0][2]
+        self.assertEqual(data["status"], "encoded")
+        self.assertEqual(data["store_path"], "/up/ch")
+
+    @mock.patch('nephos.preprocessor.preprocess.os.remove')
+    @mock.patch('nephos.preprocessor.preprocess.DBHandler')
+    @mock.patch('nephos.preprocessor.preprocess.ApplyProcessMethods')
+    def test_insert_task_encoded_fail(self, mock_methods, mock_db, mock_remove, mock_log, _):
+        mock_methods.get_lang.return_value = "spa", ""
+        mock_db.insert_data.return_value = None
+        task_id = PreprocessHandler.insert_task("/rec/ch/news.ts", "test2", store_path="/up/ch",
+                                                encoded=True)
+
+        self.assertIsNone(task_id)
+        self.assertFalse(mock_remove.called)
+        self.assertTrue(mock_log.warning.called)
+
+    @mock.patch('nephos.preprocessor.preprocess.DBHandler')
+    @mock.patch('nephos.preprocessor.preprocess.ApplyProcessMethods')
+    def test_insert_task_segment(self, mock_methods, mock_db, mock_log, _):
+        mock_methods.get_lang.return_value = "spa", ""
+        mock_db.insert_data.return_value = 2
+        PreprocessHandler.insert_task("/rec/ch/news_part001.ts", "test2",
+                                      store_path="/up/ch.segments/001", parent_id=1, seg_index=1)
+
+        data = mock_db.insert_data.call_args[0][2]
+        self.assertEqual(data["parent_id"], 1)
+        self.assertEqual(data["seg_index"], 1)
+        self.assertNotIn("status", data)
+        self.assertNotIn("gaps", data)
+
+    @mock.patch('nephos.preprocessor.preprocess.DBHandler')
+    @mock.patch('nephos.preprocessor.preprocess.ApplyProcessMethods')
+    def test_insert_task_gaps(self, mock_methods, mock_db, mock_log, _):
+        mock_methods.get_lang.return_value = "spa", ""
+        mock_db.insert_data.return_value = 2
+        PreprocessHandler.insert_task("/rec/ch/news.ts", "test2", gaps=[[600, 45]])
+
+        data = mock_db.insert_data.call_args[0][2]
+        self.assertEqual(data["gaps"], "[[600, 45]]")
+
+    @mock.patch('nephos.preprocessor.preprocess.ApplyProcessMethods')
+    def test_recover_encoded(self, mock_methods, mock_log, mock_preprocess):
+        mock_preprocess._query_tasks.return_value = [MOCK_TASK]
+
+        self.assertEqual(PreprocessHandler.recover_encoded(), 1)
+        mock_methods.assert_called_with('path', 'store', encoded=True)
+        self.assertTrue(mock_log.info.called)
+
+    @mock.patch('nephos.preprocessor.preprocess.DBHandler')
+    def test_insert_parent_task(self, mock_db, mock_log, mock_preprocess):
+        mock_db.insert_data.return_value = 1
+        mock_preprocess.get_store_path.return_value = "/up/ch"
+        result = PreprocessHandler.insert_parent_task("/rec/ch/news.ts", "test2")
+
+        self.assertEqual(result, (1, "/up/ch"))
+        data = mock_db.insert_data.call_args[0][2]
+        self.assertEqual(data["status"], "recording")
+        self.assertFalse(mock_log.warning.called)
+
+    @mock.patch('nephos.preprocessor.preprocess.DBHandler')
+    def test_insert_parent_task_fail(self, mock_db, mock_log, _):
+        mock_db.insert_data.return_value = None
+        self.assertIsNone(PreprocessHandler.insert_parent_task("/rec/ch/news.ts", "test2"))
+        self.assertTrue(mock_log.warning.called)
+
+    @mock.patch('nephos.preprocessor.preprocess._POOL', new=None)
+    @mock.patch('nephos.preprocessor.preprocess.ThreadPoolExecutor')
+    @mock.patch('nephos.preprocessor.preprocess.get_preprocessor_config',
+                return_value={'workers': 2})
+    def test_start_worker(self, _, mock_executor, __, mock_preprocess):
+        for _ in range(5):
+            PreprocessHandler.start_worker()
+
+        # every worker goes to the one pool, bounded by the configured workers
+        mock_executor.assert_called_once_with(max_workers=2)
+        mock_executor.return_value.submit.assert_called_with(
+            mock_preprocess._run_standalone_worker)
+        self.assertEqual(mock_executor.return_value.submit.call_count, 5)
+
+    @mock.patch('nephos.preprocessor.preprocess.segments')
+    def test__run_standalone_worker(self, mock_segments, _, mock_preprocess):
+        PreprocessHandler._run_standalone_worker()
+
+        mock_preprocess._run_worker.assert_called_once_with()
+        self.assertTrue(mock_segments.stitch_segments.called)
+
     def test_display_tasks(self, mock_log, mock_preprocess):
         mock_preprocess._query_tasks.return_value = ['test task']
         PreprocessHandler.display_tasks()
@@ -48,6 +206,8 @@ class TestPreprocessHandler(TestCase):
         self.assertFalse(mock_preprocess.init_preprocess_pipe.called)
         self.assertTrue(mock_log.debug.called)
         self.assertTrue(mock_preprocess.scheduler.add_necessary_job.called)
+        self.assertEqual(mock_preprocess.scheduler.add_necessary_job.call_args[1]['executor'],
+                         "process")
 
     @mock.patch('nephos.preprocessor.preprocess.DBHandler')
     def test__query_tasks(self, mock_db, mock_log, _):
@@ -64,9 +224,24 @@ class TestPreprocessHandler(TestCase):
         self.assertTrue(mock_db.connect.called)
         self.assertTrue(mock_log.warning.called)
 
-    @mock.patch('nephos.preprocessor.preprocess.DBHandler')
-    def test__get_channel_name(self, mock_db, _, __):
-        PreprocessHandler._get_channel_name("test", mock_db)
+    @mock.patch('nephos.preprocessor.preprocess.registry')
+    def test__get_channel_name(self, mock_registry, _, __):
+        mock_registry.get_by_ip.return_value = (0, "ch_test", "0.0.0.0:80")
+        self.assertEqual(PreprocessHandler._get_channel_name("0.0.0.0:80"), "ch_test")
+
+        mock_registry.get_by_ip.return_value = None
+        with self.assertRaises(KeyError):
+            PreprocessHandler._get_channel_name("0.0.0.0:80")
+
+
+
+class TestClaimCursor(TestCase):
+
+    def test_advance(self):
+        cursor = ClaimCursor()
+        self.assertIsNone(cursor.last_id)
 
-        self.assertTrue(mock_db.execute.called)
-        self.assertTrue(mock_db.fetchall.called)
+        # workers finishing their claims out of order never move the cursor back
+        for task_id in (2, 5, 3):
+            cursor.advance(task_id)
+        self.assertEqual(cursor.last_id, 5)
@@ -0,0 +1,122 @@
+from unittest import TestCase, mock
+import tempfile
+import os
+
+from nephos.manage_db import DBHandler
+from nephos.preprocessor import segments
+from nephos.preprocessor.pipeline import StepResult
+
+
+SRT_PART = "1\n00:00:01,500 --> 00:00:03,000\nhola\n\n2\n00:59:59,000 --> 01:00:00,250\nadios\n"
+
+
+class TestSegments(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.patcher = mock.patch('nephos.manage_db.DB_PATH',
+                                  new=os.path.join(self.temp_dir.name, "storage.db"))
+        self.patcher.start()
+        DBHandler().first_time()
+        self.store_path = os.path.join(self.temp_dir.name, "ch_2019")
+        with DBHandler.connect() as db_cur:
+            self.parent_id = DBHandler.insert_data(db_cur, "tasks", {
+                "orig_path": "/rec/ch/news.ts", "store_path": self.store_path,
+                "ch_name": "ch", "status": "segmented", "seg_index": 2})
+            for index in range(2):
+                seg_store = os.path.join(self.store_path + segments.SEGMENTS_SUFFIX,
+                                         "{:03d}".format(index))
+                os.makedirs(seg_store)
+                with open(os.path.join(seg_store, "news_part{:03d}.srt".format(index)),
+                          "w") as srt_file:
+                    srt_file.write(SRT_PART)
+                DBHandler.insert_data(db_cur, "tasks", {
+                    "orig_path": "/rec/ch/news_part{:03d}.ts".format(index),
+                    "store_path": seg_store, "ch_name": "ch", "lang": "spa", "sub_lang": "",
+                    "status": "segment processed", "parent_id": self.parent_id,
+                    "seg_index": index})
+
+    def tearDown(self):
+        DBHandler.close()
+        self.patcher.stop()
+        self.temp_dir.cleanup()
+
+    def _statuses(self):
+        with DBHandler.connect() as db_cur:
+            db_cur.execute("SELECT status FROM tasks ORDER BY task_id")
+            return [row[0] for row in db_cur.fetchall()]
+
+    def _concat(self, name, args, cwd, log_path):
+        with open(args[-1], "wb") as out_file:
+            out_file.write(b"\0" * 2048)
+        return StepResult(name, 0, 0.0, 0.0)
+
+    @mock.patch('nephos.preprocessor.segments.get_preprocessor_config',
+                return_value={'path_to_ffprobe': 'ffprobe'})
+    @mock.patch('nephos.preprocessor.segments._get_duration', return_value=3600.0)
+    @mock.patch('nephos.preprocessor.segments.ApplyProcessMethods')
+    @mock.patch('nephos.preprocessor.segments.pipeline.run_step')
+    def test_stitch_segments(self, mock_step, mock_methods, _, __):
+        mock_step.side_effect = self._concat
+        self.assertEqual(segments.stitch_segments(), 1)
+
+        args = mock_step.call_args[0][1]
+        self.assertEqual(args[args.index("-f") + 1], "concat")
+        mock_methods.assert_called_with("/rec/ch/news.ts", self.store_path, encoded=True)
+        # segment rows and directories are gone once stitched
+        self.assertEqual(self._statuses(), ["stitching"])
+        self.assertFalse(os.path.exists(self.store_path + segments.SEGMENTS_SUFFIX))
+        self.assertFalse(os.path.exists(os.path.join(self.store_path, segments.CONCAT_LIST)))
+        with open(os.path.join(self.store_path, "news.srt")) as srt_file:
+            merged = srt_file.read()
+        self.assertIn("4\n01:59:59,000 --> 02:00:00,250\nadios", merged)
+        self.assertIn("3\n01:00:01,500 --> 01:00:03,000\nhola", merged)
+
+    @mock.patch('nephos.preprocessor.segments.pipeline.run_step')
+    def test_stitch_segments_pending(self, mock_step):
+        with DBHandler.connect() as db_cur:
+            db_cur.execute('UPDATE tasks SET status = "processing" WHERE seg_index = 1 '
+                           'AND parent_id IS NOT NULL')
+        self.assertEqual(segments.stitch_segments(), 0)
+        self.assertFalse(mock_step.called)
+
+    @mock.patch('nephos.preprocessor.segments.get_preprocessor_config', return_value={})
+    @mock.patch('nephos.preprocessor.segments.LOG')
+    @mock.patch('nephos.preprocessor.segments.ApplyProcessMethods')
+    @mock.patch('nephos.preprocessor.segments.pipeline.run_step')
+    def test_stitch_segments_fail(self, mock_step, mock_methods, mock_log, _):
+        mock_step.return_value = StepResult("concat", 1, 0.0, 0.0)
+        self.assertEqual(segments.stitch_segments(), 0)
+
+        self.assertTrue(mock_log.warning.called)
+        self.assertFalse(mock_methods.called)
+        self.assertEqual(self._statuses()[0], "segmented")
+
+    @mock.patch('nephos.preprocessor.segments.get_preprocessor_config', return_value={})
+    @mock.patch('nephos.preprocessor.segments.LOG')
+    @mock.patch('nephos.preprocessor.segments.ApplyProcessMethods')
+    @mock.patch('nephos.preprocessor.segments.pipeline.run_step')
+    def test_stitch_segments_not_started(self, mock_step, mock_methods, mock_log, _):
+        mock_step.side_effect = FileNotFoundError
+        self.assertEqual(segments.stitch_segments(), 0)
+
+        self.assertFalse(mock_methods.called)
+        self.assertEqual(self._statuses()[0], "segmented")
+        self.assertFalse(os.path.exists(os.path.join(self.store_path, segments.CONCAT_LIST)))
+
+    @mock.patch('nephos.preprocessor.segments.add_to_report')
+    @mock.patch('nephos.preprocessor.segments.pipeline.run_step')
+    def test_stitch_segments_none_processed(self, mock_step, mock_report):
+        with DBHandler.connect() as db_cur:
+            db_cur.execute("DELETE FROM tasks WHERE parent_id IS NOT NULL")
+        self.assertEqual(segments.stitch_segments(), 0)
+
+        self.assertFalse(mock_step.called)
+        self.assertTrue(mock_report.called)
+        self.assertEqual(self._statuses(), [])
+
+    def test_recover(self):
+        with DBHandler.connect() as db_cur:
+            db_cur.execute('UPDATE tasks SET status = "recording" WHERE parent_id IS NULL')
+        self.assertEqual(segments.recover(), 1)
+        self.assertEqual(self._statuses()[0], "segmented")
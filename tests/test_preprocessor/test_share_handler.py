@@ -1,5 +1,8 @@
 from unittest import TestCase, mock
+import os
+import tempfile
 
+from nephos.manage_db import DBHandler
 from nephos.preprocessor.share_handler import ShareHandler, DBException
 
 
@@ -19,11 +22,12 @@ class TestShareHandler(TestCase):
     @mock.patch('nephos.preprocessor.share_handler.validate_entries')
     def test_insert_share_entities(self, mock_validate, mock_db, mock_log, _):
         mock_validate.return_value = {"test": "text"}
+        mock_db.insert_many.return_value = ["text"]
         ShareHandler.insert_share_entities("test")
 
         self.assertTrue(mock_validate.called)
         self.assertTrue(mock_db.connect.called)
-        self.assertTrue(mock_db.insert_data.called)
+        mock_db.insert_many.assert_called_with(mock.ANY, "share_list", ["text"])
         self.assertTrue(mock_log.info.called)
         self.assertFalse(mock_log.debug.called)
 
@@ -31,12 +35,12 @@ class TestShareHandler(TestCase):
     @mock.patch('nephos.preprocessor.share_handler.validate_entries')
     def test_insert_share_entities_fails(self, mock_validate, mock_db, mock_log, _):
         mock_validate.return_value = {"test": "text"}
-        mock_db.insert_data.side_effect = DBException()
+        mock_db.connect.side_effect = DBException()
         ShareHandler.insert_share_entities({"test": "text"})
 
         self.assertTrue(mock_validate.called)
         self.assertTrue(mock_db.connect.called)
-        self.assertTrue(mock_db.insert_data.called)
+        self.assertFalse(mock_db.insert_many.called)
         self.assertTrue(mock_log.info.called)
         self.assertTrue(mock_log.debug.called)
 
@@ -80,3 +84,51 @@ class TestShareHandler(TestCase):
         self.assertTrue(mock_db.connect.called)
         self.assertTrue(mock_log.warning.called)
         self.assertTrue(mock_log.debug.called)
+
+    def test_match_emails(self, mock_log, mock_share):
+        mock_share._get_index.return_value = ({"ch": {3, 1}, "spa": {2}, "eng": {4}},
+                                              {1: "a", 2: "b", 3: "c", 4: "d"})
+
+        self.assertEqual(ShareHandler.match_emails(["spa", "ch", "fra"]), ["a", "b", "c"])
+        self.assertEqual(ShareHandler.match_emails([]), [])
+
+
+@mock.patch('nephos.preprocessor.share_handler._INDEX', new=None)
+class TestShareIndex(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.patcher = mock.patch('nephos.manage_db.DB_PATH',
+                                  new=os.path.join(self.temp_dir.name, "storage.db"))
+        self.patcher.start()
+        DBHandler().first_time()
+        ShareHandler.insert_share_entities({
+            0: {"email": "ana@b.c", "tags": "ch1 spa"},
+            1: {"email": "dan@e.f", "tags": "ch2 ESP"},
+        })
+
+    def tearDown(self):
+        DBHandler.close()
+        self.patcher.stop()
+        self.temp_dir.cleanup()
+
+    def test_match_emails(self):
+        self.assertEqual(ShareHandler.match_emails(["ch1", "ESP"]), ["ana@b.c", "dan@e.f"])
+        self.assertEqual(ShareHandler.match_emails(["ch2"]), ["dan@e.f"])
+        self.assertEqual(ShareHandler.match_emails(["eng"]), [])
+
+    @mock.patch('nephos.preprocessor.share_handler.DBHandler.connect')
+    def test_match_emails_cached(self, mock_connect):
+        ShareHandler.invalidate_index()
+        ShareHandler.match_emails(["ch1"])
+        ShareHandler.match_emails(["ch2"])
+
+        self.assertEqual(mock_connect.call_count, 1)
+
+    def test_invalidated_on_write(self):
+        self.assertEqual(ShareHandler.match_emails(["eng"]), [])
+        ShareHandler.insert_share_entities({0: {"email": "gil@h.i", "tags": "eng"}})
+        self.assertEqual(ShareHandler.match_emails(["eng"]), ["gil@h.i"])
+
+        ShareHandler.delete_entity()
+        self.assertEqual(ShareHandler.match_emails(["eng", "ch1"]), [])
@@ -1,7 +1,12 @@
 from unittest import TestCase, mock
 from sqlite3 import Error
+from datetime import datetime
+import os
 import subprocess
-from nephos.recorder.channels import ChannelHandler, _is_up
+import tempfile
+import time
+from nephos.recorder.channels import ChannelHandler, _is_up, _scheduled_start, _record_multicat
+from nephos.recorder.watchdog import STALLED, FINISHED
 from nephos.exceptions import DBException
 
 MOCK_CH_TUPLE = (
@@ -20,6 +25,15 @@ MOCK_RECORDER_CONFIG = {
 }
 
 
+class FakeClock:
+
+    def __init__(self):
+        self.now = 100.0
+
+    def monotonic(self):
+        return self.now
+
+
 @mock.patch('nephos.recorder.channels.ChannelHandler')
 class TestChannelHandler(TestCase):
 
@@ -42,40 +56,60 @@ class TestChannelHandler(TestCase):
     @mock.patch('nephos.recorder.channels.LOG')
     @mock.patch('nephos.recorder.channels.os')
     @mock.patch('nephos.recorder.channels.DBHandler')
-    def test_insert_channels_correct(self, mock_db_handler, mock_os, mock_log, _):
-        mock_db_handler.insert_data.return_value = 0
+    @mock.patch('nephos.recorder.channels.registry')
+    def test_insert_channels_correct(self, mock_registry, mock_db_handler, mock_os, mock_log, _):
+        mock_db_handler.insert_many.return_value = [MOCK_CH_DATA['0']]
         ChannelHandler.insert_channels(MOCK_CH_DATA)
 
-        self.assertTrue(mock_db_handler.insert_data.called)
+        self.assertEqual(mock_db_handler.connect.call_count, 1)
+        mock_db_handler.insert_many.assert_called_with(mock.ANY, "channels", mock.ANY)
         self.assertTrue(mock_log.info.called)
         self.assertTrue(mock_os.makedirs.called)
         self.assertFalse(mock_log.warning.called)
+        self.assertTrue(mock_registry.refresh.called)
 
     @mock.patch('nephos.recorder.channels.LOG')
     @mock.patch('nephos.recorder.channels.os')
     @mock.patch('nephos.recorder.channels.DBHandler')
-    def test_insert_channels_invalid(self, mock_db_handler, mock_os, mock_log, _):
-        mock_db_handler.insert_data.return_value = None
+    @mock.patch('nephos.recorder.channels.registry')
+    def test_insert_channels_invalid(self, mock_registry, mock_db_handler, mock_os, mock_log, _):
+        mock_db_handler.insert_many.return_value = []
 
         ChannelHandler.insert_channels(MOCK_CH_DATA)
 
-        self.assertTrue(mock_db_handler.insert_data.called)
+        self.assertTrue(mock_db_handler.insert_many.called)
         self.assertFalse(mock_log.info.called)
         self.assertFalse(mock_os.makedirs.called)
 
+    @mock.patch('nephos.recorder.channels.LOG')
+    @mock.patch('nephos.recorder.channels.os')
+    @mock.patch('nephos.recorder.channels.DBHandler')
+    @mock.patch('nephos.recorder.channels.registry')
+    def test_insert_channels_db_error(self, mock_registry, mock_db_handler, mock_os, mock_log, _):
+        mock_db_handler.connect.side_effect = DBException
+
+        ChannelHandler.insert_channels(MOCK_CH_DATA)
+
+        self.assertTrue(mock_log.warning.called)
+        self.assertFalse(mock_os.makedirs.called)
+        self.assertTrue(mock_registry.refresh.called)
+
     @mock.patch('nephos.recorder.channels.LOG')
     @mock.patch('nephos.recorder.channels.DBHandler')
-    def test_delete_channel(self, mock_db_handler, mock_log, _):
+    @mock.patch('nephos.recorder.channels.registry')
+    def test_delete_channel(self, mock_registry, mock_db_handler, mock_log, _):
         ChannelHandler.delete_channel()
 
         self.assertTrue(mock_db_handler.connect.called)
+        self.assertTrue(mock_registry.refresh.called)
         self.assertTrue(mock_log.info.called)
         self.assertFalse(mock_log.warning.called)
         self.assertFalse(mock_log.debug.called)
 
     @mock.patch('nephos.recorder.channels.LOG')
     @mock.patch('nephos.recorder.channels.DBHandler')
-    def test_delete_channel_error(self, mock_db_handler, mock_log, _):
+    @mock.patch('nephos.recorder.channels.registry')
+    def test_delete_channel_error(self, mock_registry, mock_db_handler, mock_log, _):
         mock_db_handler.connect.side_effect = Error
         with self.assertRaises(IOError):
             ChannelHandler.delete_channel()
@@ -119,9 +153,251 @@ class TestChannelHandler(TestCase):
             self.assertTrue(mock_log.debug.called)
             self.assertTrue(mock_add_report.called)
 
+    @mock.patch('nephos.recorder.channels.LOG')
+    def test_record_stream_timeout(self, mock_log, _):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            multicat = os.path.join(temp_dir, "multicat")
+            with open(multicat, "w") as script:
+                script.write("#!/bin/sh\nexec sleep 5\n")
+            os.chmod(multicat, 0o755)
+            with mock.patch('nephos.recorder.channels.get_recorder_config',
+                            return_value={'path_to_multicat': multicat, 'ifaddr': ''}):
+                start = time.monotonic()
+                return_value = ChannelHandler.record_stream('0.0.0.0', 'test', 0, test=True,
+                                                            timeout=0.2)
+
+            self.assertFalse(return_value)
+            self.assertLess(time.monotonic() - start, 3)
+            self.assertTrue(mock_log.debug.called)
+
+    @mock.patch('nephos.recorder.channels.add_to_report')
+    @mock.patch('nephos.recorder.channels.LOG')
+    @mock.patch('nephos.recorder.channels.subprocess')
+    def test__record_multicat_stalled(self, mock_subprocess, mock_log, mock_report, _):
+        clock = FakeClock()
+        outcomes = iter([(10, 40, STALLED), (20, 0, FINISHED)])
+
+        def supervise(process, watchdog, timeout):
+            written_after, stalled_for, outcome = next(outcomes)
+            clock.now += written_after
+            with open(watchdog.path, "ab") as capture:
+                capture.write(b"\x47" * 188)
+            watchdog.sample()
+            clock.now += stalled_for
+            return outcome
+
+        config = dict(MOCK_RECORDER_CONFIG, stall_secs=30)
+        with tempfile.TemporaryDirectory() as temp_dir, \
+                mock.patch('nephos.recorder.channels.supervise', side_effect=supervise), \
+                mock.patch('nephos.recorder.channels.time', new=clock), \
+                mock.patch('nephos.recorder.watchdog.time', new=clock):
+            addr = os.path.join(temp_dir, "news.ts")
+            gaps = []
+            self.assertTrue(_record_multicat('0.0.0.0:1234', addr, 600, config, None, gaps))
+
+            self.assertEqual(os.listdir(temp_dir), ["news.ts"])
+            self.assertEqual(os.stat(addr).st_size, 2 * 188)
+        # stopped 10 seconds in, restarted 40 seconds later and written to 20 seconds after
+        self.assertEqual(gaps, [[10, 60]])
+        first, second = (call[0][0] for call in mock_subprocess.Popen.call_args_list)
+        self.assertEqual(first, ['path', '-d', str(600 * 27000000), '-u', '@0.0.0.0:1234', addr])
+        self.assertEqual(second[-1], os.path.join(temp_dir, "news_piece01.ts"))
+        self.assertNotIn('shell', mock_subprocess.Popen.call_args[1])
+        self.assertTrue(mock_log.warning.called)
+        self.assertTrue(mock_report.called)
+
+    @mock.patch('nephos.recorder.channels.add_to_report')
+    @mock.patch('nephos.recorder.channels.LOG')
+    @mock.patch('nephos.recorder.channels.subprocess')
+    def test__record_multicat_not_resumed(self, mock_subprocess, mock_log, mock_report, _):
+        clock = FakeClock()
+
+        def supervise(process, watchdog, timeout):
+            clock.now += 30
+            return STALLED
+
+        config = dict(MOCK_RECORDER_CONFIG, stall_secs=30)
+        with mock.patch('nephos.recorder.channels.supervise', side_effect=supervise), \
+                mock.patch('nephos.recorder.channels.time', new=clock), \
+                mock.patch('nephos.recorder.watchdog.time', new=clock):
+            gaps = []
+            self.assertTrue(_record_multicat('0.0.0.0:1234', '/rec/news.ts', 100, config, None,
+                                             gaps))
+
+        # restarted until the end, the stream missing from the start
+        self.assertEqual(mock_subprocess.Popen.call_count, 4)
+        self.assertEqual(gaps, [[0, 100]])
+        self.assertEqual(mock_report.call_count, 1)
+
+    @mock.patch('nephos.recorder.channels.subprocess')
+    @mock.patch('nephos.recorder.channels.receiver')
+    @mock.patch('nephos.recorder.channels.PreprocessHandler')
+    @mock.patch('os.stat')
+    @mock.patch('os.remove')
+    def test_record_stream_receiver(self, mock_remove, mock_stat, mock_preprocess, mock_receiver,
+                                    mock_subprocess, _):
+        mock_stat.return_value.st_size = 4096
+        config = dict(MOCK_RECORDER_CONFIG, capture='receiver')
+        with mock.patch('nephos.recorder.channels._is_up', return_value=True), \
+                mock.patch('nephos.recorder.channels.get_recorder_config', return_value=config):
+            self.assertTrue(ChannelHandler.record_stream('0.0.0.0:1234', 'test', 10))
+
+            mock_receiver.record.assert_called_with('0.0.0.0:1234', mock.ANY, 10, '')
+            self.assertFalse(mock_subprocess.Popen.called)
+            self.assertFalse(mock_remove.called)
+            self.assertTrue(mock_preprocess.insert_task.called)
+
+    @mock.patch('nephos.recorder.channels.subprocess')
+    @mock.patch('nephos.recorder.channels.record_live')
+    def test_record_stream_live(self, mock_live, mock_subprocess, _):
+        mock_live.return_value = True
+        with mock.patch('nephos.recorder.channels._is_up', return_value=True), \
+                mock.patch('nephos.recorder.channels.get_recorder_config',
+                           return_value=MOCK_RECORDER_CONFIG):
+            self.assertTrue(ChannelHandler.record_stream('0.0.0.0:1234', 'test', 10, live=True))
+
+            mock_live.assert_called_with('0.0.0.0:1234', mock.ANY, 10, '')
+            self.assertFalse(mock_subprocess.Popen.called)
+
+    @mock.patch('nephos.recorder.channels.receiver')
+    @mock.patch('nephos.recorder.channels.PreprocessHandler')
+    @mock.patch('nephos.recorder.channels.datetime')
+    @mock.patch('os.stat')
+    def test_record_stream_preroll(self, mock_stat, mock_datetime, mock_preprocess, mock_receiver,
+                                   _):
+        mock_stat.return_value.st_size = 4096
+        # launched 28.5 seconds before a start at 20:00, scheduled 30 seconds before it
+        mock_datetime.now.return_value = datetime(2019, 1, 1, 19, 59, 31, 500000)
+        config = dict(MOCK_RECORDER_CONFIG, capture='receiver')
+        with mock.patch('nephos.recorder.channels._is_up', return_value=True), \
+                mock.patch('nephos.recorder.channels.get_recorder_config', return_value=config):
+            self.assertTrue(ChannelHandler.record_stream('0.0.0.0:1234', '/rec/ch/news_', 600,
+                                                         preroll=30))
+
+        # recorded from now on, named after the start and ending 600 seconds after it
+        mock_receiver.record.assert_called_with('0.0.0.0:1234',
+                                                '/rec/ch/news_2019-01-01_2000.ts', 628, '')
+        mock_preprocess.insert_task.assert_called_with('/rec/ch/news_2019-01-01_2000.ts',
+                                                       '0.0.0.0:1234', gaps=[])
+
+    @mock.patch('nephos.recorder.channels.timeshift')
+    @mock.patch('nephos.recorder.channels.receiver')
+    @mock.patch('nephos.recorder.channels._record_multicat')
+    @mock.patch('nephos.recorder.channels.PreprocessHandler')
+    @mock.patch('os.stat')
+    @mock.patch('os.remove')
+    def test_record_stream_lookback(self, mock_remove, mock_stat, mock_preprocess,
+                                    mock_multicat, mock_receiver, mock_timeshift, _):
+        mock_stat.return_value.st_size = 4096
+        with mock.patch('nephos.recorder.channels._is_up', return_value=True), \
+                mock.patch('nephos.recorder.channels.get_recorder_config',
+                           return_value=MOCK_RECORDER_CONFIG):
+            self.assertTrue(ChannelHandler.record_stream('0.0.0.0:1234', 'test', 10,
+                                                         lookback=60))
+
+            mock_timeshift.record.assert_called_with('0.0.0.0:1234', mock.ANY, 10, 60, '')
+            self.assertFalse(mock_receiver.record.called)
+            self.assertFalse(mock_multicat.called)
+            self.assertFalse(mock_remove.called)
+
+            # without a buffer of the channel, recorded from now as configured
+            mock_timeshift.get_buffer.return_value = None
+            self.assertTrue(ChannelHandler.record_stream('0.0.0.0:1234', 'test', 10,
+                                                         lookback=60))
+            self.assertTrue(mock_multicat.called)
+
+    @mock.patch('nephos.recorder.channels.datetime')
+    def test__scheduled_start(self, mock_datetime, _):
+        mock_datetime.now.return_value = datetime(2019, 1, 1, 23, 59, 45, 200)
+        self.assertEqual(_scheduled_start(20), datetime(2019, 1, 2, 0, 0))
+        self.assertEqual(_scheduled_start(0), datetime(2019, 1, 1, 23, 59, 45, 200))
+        mock_datetime.now.return_value = datetime(2019, 1, 2, 0, 0, 8)
+        self.assertEqual(_scheduled_start(20), datetime(2019, 1, 2, 0, 0))
+
     @mock.patch('nephos.recorder.channels.DBHandler')
-    def test__is_up(self, mock_db_handler, _):
-        return_bool = _is_up('0.0.0.0')
+    @mock.patch('nephos.recorder.channels.receiver')
+    @mock.patch('nephos.recorder.channels.PreprocessHandler')
+    @mock.patch('os.stat')
+    def test_record_stream_segments(self, mock_stat, mock_preprocess, mock_receiver, mock_db, _):
+        mock_stat.return_value.st_size = 4096
+        mock_preprocess.insert_parent_task.return_value = 7, '/up/ch'
+        config = dict(MOCK_RECORDER_CONFIG, capture='receiver', segment_minutes=30)
+        with mock.patch('nephos.recorder.channels._is_up', return_value=True), \
+                mock.patch('nephos.recorder.channels.get_recorder_config', return_value=config):
+            self.assertTrue(ChannelHandler.record_stream('0.0.0.0:1234', '/rec/ch/news', 4500))
 
-        self.assertTrue(mock_db_handler.connect.called)
-        self.assertFalse(return_bool)
+        durations = [call[0][1] for call in mock_receiver.FileConsumer.call_args_list]
+        self.assertEqual(durations, [1800, 1800, 900])
+        starts = [call[0][2] for call in mock_receiver.FileConsumer.call_args_list]
+        for start, offset in zip(starts, [0, 1800, 3600]):
+            self.assertAlmostEqual(start - starts[0], offset, places=3)
+        self.assertEqual(mock_receiver.attach.call_count, 3)
+        segment_calls = mock_preprocess.insert_task.call_args_list
+        self.assertEqual([call[1]['seg_index'] for call in segment_calls], [0, 1, 2])
+        self.assertTrue(all(call[1]['parent_id'] == 7 for call in segment_calls))
+        self.assertTrue(segment_calls[2][1]['store_path'].endswith('ch.segments/002'))
+        self.assertTrue(segment_calls[2][0][0].endswith('_part002.ts'))
+        self.assertEqual(mock_preprocess.start_worker.call_count, 3)
+        cursor = mock_db.connect.return_value.__enter__.return_value
+        self.assertEqual(cursor.execute.call_args[0][1], (3, None, 7))
+
+    @mock.patch('nephos.recorder.channels.DBHandler')
+    @mock.patch('nephos.recorder.channels._record_multicat')
+    @mock.patch('nephos.recorder.channels.PreprocessHandler')
+    @mock.patch('os.stat')
+    @mock.patch('os.remove')
+    def test_record_stream_segments_multicat(self, mock_remove, mock_stat, mock_preprocess,
+                                             mock_multicat, mock_db, _):
+        mock_stat.return_value.st_size = 4096
+        mock_preprocess.insert_parent_task.return_value = 7, '/up/ch'
+        mock_multicat.side_effect = [True, False]
+        config = dict(MOCK_RECORDER_CONFIG, segment_minutes=30)
+        with mock.patch('nephos.recorder.channels._is_up', return_value=True), \
+                mock.patch('nephos.recorder.channels.get_recorder_config', return_value=config):
+            self.assertTrue(ChannelHandler.record_stream('0.0.0.0:1234', '/rec/ch/news', 4500))
+
+        self.assertEqual(mock_multicat.call_count, 2)
+        self.assertEqual(mock_preprocess.insert_task.call_count, 1)
+        cursor = mock_db.connect.return_value.__enter__.return_value
+        # the segments recorded before the failure are still stitched
+        self.assertEqual(cursor.execute.call_args[0][1], (1, None, 7))
+
+    @mock.patch('nephos.recorder.channels._record_multicat')
+    @mock.patch('nephos.recorder.channels.PreprocessHandler')
+    def test_record_stream_segments_short(self, mock_preprocess, mock_multicat, _):
+        mock_multicat.return_value = False
+        config = dict(MOCK_RECORDER_CONFIG, segment_minutes=30)
+        with mock.patch('nephos.recorder.channels._is_up', return_value=True), \
+                mock.patch('nephos.recorder.channels.get_recorder_config', return_value=config):
+            ChannelHandler.record_stream('0.0.0.0:1234', '/rec/ch/news', 1800)
+
+        self.assertFalse(mock_preprocess.insert_parent_task.called)
+
+    @mock.patch('nephos.recorder.channels._record_multicat')
+    @mock.patch('nephos.recorder.channels.record_live')
+    @mock.patch('nephos.recorder.channels.PreprocessHandler')
+    @mock.patch('os.stat')
+    @mock.patch('os.remove')
+    def test_record_stream_live_fallback(self, mock_remove, mock_stat, _, mock_live,
+                                         mock_multicat, __):
+        mock_live.return_value = None
+        mock_stat.return_value.st_size = 4096
+        with mock.patch('nephos.recorder.channels._is_up', return_value=True), \
+                mock.patch('nephos.recorder.channels.get_recorder_config',
+                           return_value=MOCK_RECORDER_CONFIG):
+            self.assertTrue(ChannelHandler.record_stream('0.0.0.0:1234', 'test', 10, live=True))
+
+            self.assertTrue(mock_multicat.called)
+
+    @mock.patch('nephos.recorder.channels.DBHandler')
+    @mock.patch('nephos.recorder.channels.registry')
+    def test__is_up(self, mock_registry, mock_db_handler, _):
+        mock_registry.get_by_ip.return_value = (0, "ch_test", "0.0.0.0", "", "", "", "down")
+        self.assertFalse(_is_up('0.0.0.0'))
+        mock_registry.get_by_ip.return_value = (0, "ch_test", "0.0.0.0", "", "", "", "up")
+        self.assertTrue(_is_up('0.0.0.0'))
+        mock_registry.get_by_ip.return_value = None
+        self.assertFalse(_is_up('0.0.0.0'))
+
+        mock_registry.get_by_ip.assert_called_with('0.0.0.0')
+        self.assertFalse(mock_db_handler.connect.called)
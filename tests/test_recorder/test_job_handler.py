@@ -19,61 +19,72 @@ class TestJobHandler(TestCase):
 
     @mock.patch('nephos.recorder.jobs.LOG')
     @mock.patch('builtins.input')
-    @mock.patch('nephos.recorder.jobs.DBHandler')
-    def test_add_job(self, mock_db, mock_input, mock_log, mock_job_handler):
+    def test_add_job(self, mock_input, mock_log, mock_job_handler):
         with mock.patch('nephos.recorder.jobs.validate_entries'):
             JobHandler.add_job(mock_job_handler)
 
         self.assertTrue(mock_input.called)
-        self.assertTrue(mock_db.connect.called)
-        mock_job_handler.insert_jobs.assert_called_with(mock.ANY, mock.ANY)
+        mock_job_handler.insert_jobs.assert_called_with(mock.ANY)
         self.assertFalse(mock_log.warning.called)
         self.assertFalse(mock_log.debug.called)
 
     @mock.patch('nephos.recorder.jobs.LOG')
     @mock.patch('builtins.input')
-    @mock.patch('nephos.recorder.jobs.DBHandler')
-    def test_add_job_error(self, mock_db, mock_input, mock_log, mock_job_handler):
+    def test_add_job_error(self, mock_input, mock_log, mock_job_handler):
         with mock.patch('nephos.recorder.jobs.validate_entries'):
-            mock_db.connect.side_effect = DBException
+            mock_job_handler.insert_jobs.side_effect = DBException
             JobHandler.add_job(mock_job_handler)
 
         self.assertTrue(mock_input.called)
-        self.assertTrue(mock_db.connect.called)
-        self.assertFalse(mock_job_handler.insert_jobs.called)
         self.assertTrue(mock_log.warning.called)
         self.assertTrue(mock_log.debug.called)
 
     @mock.patch('nephos.recorder.jobs.LOG')
-    @mock.patch('nephos.recorder.jobs.DBHandler')
-    def test_load_jobs(self, mock_db, mock_log, mock_job_handler):
-        JobHandler.load_jobs(mock_job_handler, MOCK_JOB_DATA)
+    def test_load_jobs(self, mock_log, mock_job_handler):
+        self.assertTrue(JobHandler.load_jobs(mock_job_handler, MOCK_JOB_DATA))
 
-        self.assertTrue(mock_db.connect.called)
-        mock_job_handler.insert_jobs.assert_called_with(mock.ANY, mock.ANY)
+        mock_job_handler.insert_jobs.assert_called_with(MOCK_JOB_DATA)
         self.assertFalse(mock_log.warning.called)
         self.assertFalse(mock_log.debug.called)
 
     @mock.patch('nephos.recorder.jobs.LOG')
-    @mock.patch('nephos.recorder.jobs.DBHandler')
-    def test_load_jobs_error(self, mock_db, mock_log, mock_job_handler):
-        mock_db.connect.side_effect = DBException
-        JobHandler.load_jobs(mock_job_handler, MOCK_JOB_DATA)
+    def test_load_jobs_error(self, mock_log, mock_job_handler):
+        mock_job_handler.insert_jobs.side_effect = DBException
+        self.assertFalse(JobHandler.load_jobs(mock_job_handler, MOCK_JOB_DATA))
 
-        self.assertTrue(mock_db.connect.called)
-        self.assertFalse(mock_job_handler.insert_jobs.called)
         self.assertTrue(mock_log.warning.called)
         self.assertTrue(mock_log.debug.called)
 
-    @mock.patch('nephos.recorder.jobs.DBHandler')
-    def test_insert_jobs(self, mock_db, mock_job_handler):
-        with mock_db.connect() as db_cur, \
-             mock.patch('os.path'):
-            JobHandler.insert_jobs(mock_job_handler, db_cur, MOCK_JOB_DATA)
+    @mock.patch('nephos.recorder.jobs.registry')
+    def test_insert_jobs(self, mock_registry, mock_job_handler):
+        mock_registry.get_by_name.return_value = (0, "ch_test", "0.0.0.0:80")
+        with mock.patch('os.path'):
+            JobHandler.insert_jobs(mock_job_handler, MOCK_JOB_DATA)
 
-            db_cur.execute.assert_called_with(mock.ANY, mock.ANY)
-            mock_job_handler.to_weekday.assert_called_with('0000000')
-            self.assertTrue(mock_job_handler._scheduler.add_recording_job.called)
+        mock_registry.get_by_name.assert_called_with("ch_test")
+        mock_job_handler.to_weekday.assert_called_with('0000000')
+        mock_job_handler._scheduler.add_recording_job.assert_called_with(
+            ip_addr="0.0.0.0:80", out_path=mock.ANY, duration=0, job_time="00:00",
+            week_days=mock.ANY, job_name="job_test", live=False, preroll=0, lookback=0)
+
+    @mock.patch('nephos.recorder.jobs.get_recorder_config', return_value={'preroll_secs': 30})
+    @mock.patch('nephos.recorder.jobs.registry')
+    def test_insert_jobs_preroll(self, mock_registry, _, mock_job_handler):
+        mock_registry.get_by_name.return_value = (0, "ch_test", "0.0.0.0:80")
+        with mock.patch('os.path'):
+            JobHandler.insert_jobs(mock_job_handler, MOCK_JOB_DATA)
+
+        self.assertEqual(mock_job_handler._scheduler.add_recording_job.call_args[1]['preroll'],
+                         30)
+
+    @mock.patch('nephos.recorder.jobs.LOG')
+    @mock.patch('nephos.recorder.jobs.registry')
+    def test_insert_jobs_no_channel(self, mock_registry, mock_log, mock_job_handler):
+        mock_registry.get_by_name.return_value = None
+        JobHandler.insert_jobs(mock_job_handler, MOCK_JOB_DATA)
+
+        self.assertTrue(mock_log.info.called)
+        self.assertFalse(mock_job_handler._scheduler.add_recording_job.called)
 
     def test_display_jobs(self, mock_job_handler):
         JobHandler.display_jobs(mock_job_handler)
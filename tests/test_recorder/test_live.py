@@ -0,0 +1,65 @@
+from unittest import TestCase, mock
+from nephos.recorder.live import record_live
+from nephos.preprocessor.pipeline import StepResult
+
+
+MOCK_CONFIG = {
+    'profile': 'crf',
+    'job_profiles': {'two pass job': 'two_pass'},
+    'profiles': {
+        'crf': {'type': 'single_pass', 'args': '-crf 28'},
+        'two_pass': {'type': 'two_pass'},
+    }
+}
+
+
+@mock.patch('nephos.recorder.live.get_preprocessor_config', return_value=MOCK_CONFIG)
+@mock.patch('nephos.recorder.live.PreprocessHandler')
+@mock.patch('nephos.recorder.live.ApplyProcessMethods')
+@mock.patch('nephos.recorder.live.LOG')
+class TestRecordLive(TestCase):
+
+    @mock.patch('os.makedirs')
+    @mock.patch('os.path.exists', return_value=True)
+    @mock.patch('os.stat')
+    @mock.patch('nephos.recorder.live.pipeline.run_stage')
+    def test_record_live(self, mock_run, mock_stat, _, __, mock_log, mock_methods,
+                         mock_preprocess, ___):
+        mock_stat.return_value.st_size = 4096
+        mock_preprocess.get_store_path.return_value = '/up/ch'
+        mock_run.return_value = [StepResult("ccextractor", 0, 1, 1), StepResult("encode", 0, 1, 1)]
+        return_value = record_live('0.0.0.0:1234', '/rec/ch/news2018-01-01_2000.ts', 10)
+
+        self.assertTrue(return_value)
+        stage = mock_run.call_args[0][0]
+        self.assertEqual([name for name, _ in stage], ["ccextractor", "encode"])
+        self.assertIn("pipe:0", stage[1][1])
+        feed = mock_run.call_args[0][2]
+        self.assertEqual(feed.args, ('0.0.0.0:1234', 10, ''))
+        mock_preprocess.insert_task.assert_called_with('/rec/ch/news2018-01-01_2000.ts',
+                                                       '0.0.0.0:1234', store_path='/up/ch',
+                                                       encoded=True)
+        mock_methods.assert_called_with('/rec/ch/news2018-01-01_2000.ts', '/up/ch', encoded=True)
+
+    @mock.patch('nephos.recorder.live.pipeline.run_stage')
+    def test_record_live_not_streamable(self, mock_run, mock_log, mock_methods, mock_preprocess,
+                                        _):
+        return_value = record_live('0.0.0.0:1234', '/rec/ch/two pass job2018-01-01_2000.ts', 10)
+
+        self.assertIsNone(return_value)
+        self.assertFalse(mock_run.called)
+        self.assertTrue(mock_log.warning.called)
+
+    @mock.patch('os.makedirs')
+    @mock.patch('shutil.rmtree')
+    @mock.patch('nephos.recorder.live.add_to_report')
+    @mock.patch('nephos.recorder.live.pipeline.run_stage')
+    def test_record_live_failed(self, mock_run, mock_report, mock_rmtree, _, mock_log,
+                                mock_methods, mock_preprocess, __):
+        mock_run.return_value = [StepResult("encode", 1, 1, 1)]
+        return_value = record_live('0.0.0.0:1234', '/rec/ch/news2018-01-01_2000.ts', 10)
+
+        self.assertFalse(return_value)
+        self.assertTrue(mock_rmtree.called)
+        self.assertTrue(mock_report.called)
+        self.assertFalse(mock_preprocess.insert_task.called)
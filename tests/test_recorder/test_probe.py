@@ -0,0 +1,116 @@
+import socket
+import threading
+import time
+from unittest import TestCase, mock
+from nephos.recorder.probe import probe_stream, ProbeResult, TS_PACKET_SIZE, TS_SYNC_BYTE
+
+
+TS_PACKET = bytes([TS_SYNC_BYTE]) + bytes(TS_PACKET_SIZE - 1)
+TS_DATAGRAM = TS_PACKET * 7
+RTP_DATAGRAM = bytes([0x80, 33]) + bytes(10) + TS_DATAGRAM
+GARBAGE_DATAGRAM = bytes(range(256)) * 5
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class LocalSender(threading.Thread):
+    """
+    Sends the datagram to the port on localhost until stopped.
+    """
+
+    def __init__(self, port, datagram):
+        threading.Thread.__init__(self, daemon=True)
+        self.port = port
+        self.datagram = datagram
+        self.stopped = threading.Event()
+
+    def run(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            while not self.stopped.wait(0.01):
+                sock.sendto(self.datagram, ("127.0.0.1", self.port))
+
+
+class TestProbeResult(TestCase):
+
+    def test_add(self):
+        result = ProbeResult("0.0.0.0:1234")
+        result.add(TS_DATAGRAM)
+
+        self.assertEqual(result.datagrams, 1)
+        self.assertEqual(result.packets, 7)
+        self.assertEqual(result.sync_packets, 7)
+        self.assertTrue(result.is_valid)
+
+    def test_add_rtp(self):
+        result = ProbeResult("0.0.0.0:1234")
+        result.add(RTP_DATAGRAM)
+
+        self.assertEqual(result.bytes, len(RTP_DATAGRAM))
+        self.assertEqual(result.sync_packets, 7)
+        self.assertTrue(result.is_valid)
+
+    def test_add_garbage(self):
+        result = ProbeResult("0.0.0.0:1234")
+        result.add(GARBAGE_DATAGRAM)
+
+        self.assertTrue(result.is_receiving)
+        self.assertFalse(result.is_valid)
+
+    def test_empty(self):
+        result = ProbeResult("0.0.0.0:1234")
+
+        self.assertFalse(result.is_receiving)
+        self.assertFalse(result.is_valid)
+
+
+class TestProbeStream(TestCase):
+
+    def _probe_sender(self, datagram, **kwargs):
+        port = _free_port()
+        sender = LocalSender(port, datagram)
+        sender.start()
+        try:
+            return probe_stream("127.0.0.1:{}".format(port), 0.5, **kwargs)
+        finally:
+            sender.stopped.set()
+            sender.join()
+
+    def test_probe_stream(self):
+        result = self._probe_sender(TS_DATAGRAM)
+
+        self.assertTrue(result.is_receiving)
+        self.assertTrue(result.is_valid)
+
+    def test_probe_stream_garbage(self):
+        result = self._probe_sender(GARBAGE_DATAGRAM)
+
+        self.assertTrue(result.is_receiving)
+        self.assertFalse(result.is_valid)
+
+    def test_probe_stream_enough_bytes(self):
+        start = time.monotonic()
+        result = self._probe_sender(TS_DATAGRAM, enough_bytes=len(TS_DATAGRAM))
+
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual(result.datagrams, 1)
+
+    def test_probe_stream_silent(self):
+        result = probe_stream("127.0.0.1:{}".format(_free_port()), 0.2)
+
+        self.assertFalse(result.is_receiving)
+
+    def test_probe_stream_invalid_address(self):
+        with self.assertRaises(ValueError):
+            probe_stream("127.0.0.1", 0.2)
+
+    @mock.patch('nephos.recorder.probe.socket.socket')
+    def test_probe_stream_multicast(self, mock_socket):
+        mock_socket.return_value.__enter__.return_value.recv.side_effect = socket.timeout
+        probe_stream("239.1.1.1:1234", 0.1, "10.0.0.1")
+
+        mock_socket.return_value.setsockopt.assert_called_with(
+            mock.ANY, mock.ANY, socket.inet_aton("239.1.1.1") + socket.inet_aton("10.0.0.1"))
@@ -0,0 +1,157 @@
+import os
+import time
+from tempfile import TemporaryDirectory
+from unittest import TestCase, mock
+from nephos.recorder import receiver
+from nephos.recorder.receiver import FileConsumer, ProbeConsumer
+from tests.test_recorder.test_probe import LocalSender, TS_DATAGRAM, RTP_DATAGRAM, _free_port
+
+
+class TestReceiver(TestCase):
+
+    def setUp(self):
+        self.ip_addr = "127.0.0.1:{}".format(_free_port())
+        self.sender = LocalSender(int(self.ip_addr.split(":")[1]), TS_DATAGRAM)
+        self.sender.start()
+
+    def tearDown(self):
+        self.sender.stopped.set()
+        self.sender.join()
+
+    def test_record(self):
+        with TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "test.ts")
+            bytes_written = receiver.record(self.ip_addr, path, 0.3)
+
+            self.assertGreater(bytes_written, 0)
+            self.assertEqual(os.stat(path).st_size, bytes_written)
+        self.assertFalse(receiver.is_receiving(self.ip_addr))
+
+    def test_record_rtp(self):
+        self.sender.datagram = RTP_DATAGRAM
+        with TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "test.ts")
+            bytes_written = receiver.record(self.ip_addr, path, 0.3)
+
+            self.assertEqual(bytes_written % len(TS_DATAGRAM), 0)
+
+    def test_shared_receiver(self):
+        with TemporaryDirectory() as tmpdir:
+            first = FileConsumer(os.path.join(tmpdir, "first.ts"), 0.5)
+            second = FileConsumer(os.path.join(tmpdir, "second.ts"), 0.5)
+            first_receiver = receiver.attach(self.ip_addr, first)
+            second_receiver = receiver.attach(self.ip_addr, second)
+
+            self.assertIs(first_receiver, second_receiver)
+            self.assertEqual(len(first_receiver.consumers), 2)
+            self.assertTrue(first.wait(2))
+            self.assertTrue(second.wait(2))
+            self.assertGreater(first.bytes_written, 0)
+            self.assertGreater(second.bytes_written, 0)
+            first_receiver.join(2)
+        self.assertFalse(first_receiver.is_alive())
+
+    def test_probe_reuses_recording(self):
+        with TemporaryDirectory() as tmpdir:
+            recording = FileConsumer(os.path.join(tmpdir, "test.ts"), 1)
+            recording_receiver = receiver.attach(self.ip_addr, recording)
+            with mock.patch('nephos.recorder.receiver.Receiver') as mock_receiver:
+                result = receiver.probe(self.ip_addr, 0.5, enough_bytes=len(TS_DATAGRAM))
+
+            self.assertFalse(mock_receiver.called)
+            self.assertTrue(result.is_valid)
+            self.assertFalse(recording.done)
+            self.assertTrue(recording.wait(2))
+            recording_receiver.join(2)
+
+    def test_stream(self):
+        read_fd, write_fd = os.pipe()
+        with open(read_fd, "rb") as reader, open(write_fd, "wb") as writer:
+            receiver.stream(self.ip_addr, 0.3, "", [writer])
+            data = reader.read()
+
+        self.assertTrue(writer.closed)
+        self.assertGreater(len(data), 0)
+        self.assertEqual(len(data) % len(TS_DATAGRAM), 0)
+
+    def test_stream_broken_pipe(self):
+        read_fd, write_fd = os.pipe()
+        os.close(read_fd)
+        with open(write_fd, "wb", buffering=0) as writer:
+            start = time.monotonic()
+            receiver.stream(self.ip_addr, 2, "", [writer])
+
+            self.assertLess(time.monotonic() - start, 1.5)
+
+    @mock.patch('nephos.recorder.receiver.LOG')
+    def test_stream_attach_error(self, mock_log):
+        read_fd, write_fd = os.pipe()
+        with open(read_fd, "rb") as reader, open(write_fd, "wb") as writer:
+            receiver.stream("127.0.0.1", 0.3, "", [writer])
+
+            self.assertEqual(reader.read(), b"")
+        self.assertTrue(mock_log.warning.called)
+
+    @mock.patch('nephos.recorder.receiver.MAX_QUEUED', new=0)
+    @mock.patch('nephos.recorder.receiver.LOG')
+    def test_pipe_consumer_dropped(self, mock_log):
+        read_fd, write_fd = os.pipe()
+        with open(read_fd, "rb"), open(write_fd, "wb") as writer:
+            consumer = receiver.PipeConsumer([writer], 0.2)
+            receiver.attach(self.ip_addr, consumer)
+            consumer.wait()
+
+        self.assertGreater(consumer.dropped, 0)
+        self.assertTrue(mock_log.warning.called)
+
+    def test_start_boundary(self):
+        consumer = ProbeConsumer(self.ip_addr, 0.2, start=time.monotonic() + 0.2)
+        receiver.attach(self.ip_addr, consumer)
+
+        self.assertTrue(consumer.wait(2))
+        self.assertTrue(consumer.result.is_receiving)
+        self.assertGreaterEqual(time.monotonic(), consumer.stop)
+
+    def test_probe_silent(self):
+        result = receiver.probe("127.0.0.1:{}".format(_free_port()), 0.2)
+
+        self.assertFalse(result.is_receiving)
+
+    def test_attach_error(self):
+        with self.assertRaises(ValueError):
+            receiver.probe("127.0.0.1", 0.2)
+        self.assertFalse(receiver.is_receiving("127.0.0.1"))
+
+    @mock.patch('nephos.recorder.receiver.LOG')
+    def test_failing_consumer(self, mock_log):
+        with TemporaryDirectory() as tmpdir:
+            failing = FileConsumer(os.path.join(tmpdir, "full.ts"), 0.5)
+            failing._consume = mock.Mock(side_effect=OSError(28, "No space left on device"))
+            recording = FileConsumer(os.path.join(tmpdir, "test.ts"), 0.5)
+            shared = receiver.attach(self.ip_addr, failing)
+            receiver.attach(self.ip_addr, recording)
+
+            self.assertTrue(failing.wait(2))
+            self.assertTrue(recording.wait(2))
+            self.assertGreater(recording.bytes_written, 0)
+            shared.join(2)
+        self.assertTrue(mock_log.warning.called)
+
+    @mock.patch('nephos.recorder.receiver.LOG')
+    def test_receiver_error_closes_consumers(self, _):
+        consumer = ProbeConsumer(self.ip_addr, 5)
+        with mock.patch.object(receiver.Receiver, '_dispatch', side_effect=RuntimeError):
+            crashed = receiver.attach(self.ip_addr, consumer)
+            crashed.join(2)
+
+        self.assertTrue(consumer.done)
+        self.assertFalse(receiver.is_receiving(self.ip_addr))
+
+    @mock.patch('nephos.recorder.receiver.DETACH_GRACE_SECS', new=0.1)
+    @mock.patch('nephos.recorder.receiver.LOG')
+    def test_wait_not_detached(self, mock_log):
+        consumer = ProbeConsumer(self.ip_addr, 0.1)
+
+        self.assertFalse(receiver.wait(consumer))
+        self.assertTrue(consumer.done)
+        self.assertTrue(mock_log.warning.called)
@@ -0,0 +1,66 @@
+from unittest import TestCase, mock
+import tempfile
+import os
+
+from nephos.manage_db import DBHandler
+from nephos.recorder import registry
+from nephos.recorder.channels import ChannelHandler
+
+
+class TestRegistry(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.patchers = [
+            mock.patch('nephos.manage_db.DB_PATH',
+                       new=os.path.join(self.temp_dir.name, "storage.db")),
+            mock.patch('nephos.recorder.registry._INDEX', new=None),
+            mock.patch('nephos.recorder.channels.__recording_dir__', new=self.temp_dir.name)
+        ]
+        for patcher in self.patchers:
+            patcher.start()
+        DBHandler().first_time()
+        with DBHandler.connect() as db_cur:
+            db_cur.execute('INSERT INTO channels (name, ip, timezone) VALUES '
+                           '("ch_one", "0.0.0.1:1234", "utc")')
+
+    def tearDown(self):
+        DBHandler.close()
+        for patcher in self.patchers:
+            patcher.stop()
+        self.temp_dir.cleanup()
+
+    def test_lookups(self):
+        channel = registry.get_by_name("ch_one")
+        self.assertEqual(channel, registry.get_by_ip("0.0.0.1:1234"))
+        self.assertEqual(channel[2], "0.0.0.1:1234")
+        self.assertIsNone(registry.get_by_name("ch_two"))
+        self.assertIsNone(registry.get_by_ip("0.0.0.2:1234"))
+
+    def test_lookups_no_io(self):
+        registry.get_by_name("ch_one")
+        with mock.patch('nephos.recorder.registry.DBHandler') as mock_db:
+            self.assertIsNotNone(registry.get_by_ip("0.0.0.1:1234"))
+            self.assertFalse(mock_db.connect.called)
+
+    @mock.patch('nephos.recorder.channels.LOG')
+    def test_refreshed_on_write(self, _):
+        self.assertIsNone(registry.get_by_name("ch_two"))
+        ChannelHandler.insert_channels({0: {"name": "ch two", "ip": "0.0.0.2:1234",
+                                            "country_code": "in", "lang": "hin",
+                                            "timezone": "utc"}})
+        self.assertEqual(registry.get_by_name("ch_two")[2], "0.0.0.2:1234")
+
+        ChannelHandler.delete_channel()
+        self.assertIsNone(registry.get_by_name("ch_one"))
+        self.assertIsNone(registry.get_by_ip("0.0.0.2:1234"))
+
+    @mock.patch('nephos.recorder.registry.LOG')
+    def test_refresh_fail(self, mock_log):
+        channel = registry.get_by_name("ch_one")
+        with mock.patch('nephos.recorder.registry.DBHandler') as mock_db:
+            mock_db.connect.side_effect = registry.DBException()
+            self.assertFalse(registry.refresh())
+
+        self.assertTrue(mock_log.warning.called)
+        self.assertEqual(registry.get_by_name("ch_one"), channel)
@@ -0,0 +1,195 @@
+from unittest import TestCase, mock
+import os
+import tempfile
+
+from nephos.recorder import timeshift
+from nephos.recorder.timeshift import MemoryBuffer, DiskBuffer, BacklogFileConsumer
+
+
+DATAGRAM = b"\x47" * 1316
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 100.0
+
+    def monotonic(self):
+        return self.now
+
+
+def fill(buffer, clock, secs, per_sec=10):
+    """feeds the buffer secs seconds of datagrams, numbered by their second"""
+    for _ in range(secs):
+        for _ in range(per_sec):
+            buffer.feed(bytes([int(clock.now) % 256]) * 1316)
+        clock.now += 1
+
+
+@mock.patch('nephos.recorder.timeshift.LOG')
+class TestMemoryBuffer(TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.patcher = mock.patch('nephos.recorder.timeshift.time', new=self.clock)
+        self.patcher.start()
+        self.block_patcher = mock.patch('nephos.recorder.timeshift.MEMORY_BLOCK_BYTES',
+                                        new=1316 * 10)
+        self.block_patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.block_patcher.stop()
+
+    def test_bounded_by_minutes(self, _):
+        buffer = MemoryBuffer("ch", 1, 10 ** 9)
+        fill(buffer, self.clock, 90)
+
+        self.assertEqual(buffer.total, 90 * 13160)
+        # blocks entirely older than a minute are dropped
+        self.assertEqual(buffer.start_offset, 28 * 13160)
+        offset, received = buffer.offset_at(10)
+        self.assertEqual((offset, received), (80 * 13160, 180.0))
+        data = b"".join(buffer.read(offset, buffer.total))
+        self.assertEqual(len(data), 10 * 13160)
+        self.assertEqual(data[0], 180 % 256)
+
+    def test_bounded_by_bytes(self, _):
+        buffer = MemoryBuffer("ch", 60, 13160 * 5)
+        fill(buffer, self.clock, 20)
+
+        self.assertLessEqual(buffer.total - buffer.start_offset, 13160 * 6)
+        # older than the buffer goes back to, the oldest byte kept is read from
+        offset = max(buffer.offset_at(60)[0], buffer.start_offset)
+        self.assertEqual(b"".join(buffer.read(offset, buffer.total))[0], 115)
+
+    def test_position(self, _):
+        buffer = MemoryBuffer("ch", 1, 10 ** 9)
+        buffer.feed(DATAGRAM)
+        self.assertEqual(buffer.position(DATAGRAM), 0)
+        self.assertEqual(buffer.position(b"other"), 1316)
+
+    def test_discard(self, _):
+        buffer = MemoryBuffer("ch", 1, 10 ** 9)
+        fill(buffer, self.clock, 2)
+        buffer.discard()
+
+        self.assertTrue(buffer.feed(DATAGRAM))
+        self.assertEqual(list(buffer.read(0, buffer.total)), [])
+
+    def test_backlog(self, _):
+        buffer = MemoryBuffer("ch", 1, 10 ** 9)
+        fill(buffer, self.clock, 30)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "news.ts")
+            consumer = BacklogFileConsumer(path, 60, buffer, 5)
+            # as dispatched by the receiver, the buffer being fed first
+            for index in range(3):
+                datagram = bytes([200 + index]) * 1316
+                buffer.feed(datagram)
+                consumer.feed(datagram)
+            consumer.close()
+
+            self.assertEqual(consumer.join(), 5 * 13160)
+            with open(path, "rb") as recording:
+                data = recording.read()
+        self.assertEqual(len(data), 5 * 13160 + 3 * 1316)
+        self.assertEqual(data[0], 125)
+        self.assertEqual(data[5 * 13160 - 1], 129)
+        self.assertEqual(data[5 * 13160:], bytes([200]) * 1316 + bytes([201]) * 1316 +
+                         bytes([202]) * 1316)
+
+
+@mock.patch('nephos.recorder.timeshift.LOG')
+class TestDiskBuffer(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.clock = FakeClock()
+        self.patchers = [
+            mock.patch('nephos.recorder.timeshift.time', new=self.clock),
+            mock.patch('nephos.recorder.timeshift.TIMESHIFT_DIR', new=self.temp_dir.name)
+        ]
+        for patcher in self.patchers:
+            patcher.start()
+
+    def tearDown(self):
+        for patcher in self.patchers:
+            patcher.stop()
+        self.temp_dir.cleanup()
+
+    def test_ring(self, _):
+        buffer = DiskBuffer("ch", 1, 10 ** 9, segment_secs=10)
+        fill(buffer, self.clock, 95)
+
+        files = sorted(os.listdir(os.path.join(self.temp_dir.name, "ch")))
+        self.assertEqual(len(files), 7)
+        self.assertEqual(int(files[0][:-3]), buffer.start_offset)
+        offset = buffer.offset_at(25)[0]
+        data = b"".join(buffer.read(offset, buffer.total))
+        self.assertEqual(len(data), 25 * 13160)
+        self.assertEqual(data[0], 170)
+
+        buffer.close()
+        buffer.discard()
+        self.assertFalse(os.path.exists(os.path.join(self.temp_dir.name, "ch")))
+
+
+@mock.patch('nephos.recorder.timeshift.LOG')
+@mock.patch('nephos.recorder.timeshift.registry')
+class TestTimeShift(TestCase):
+
+    def setUp(self):
+        self.patcher = mock.patch.dict('nephos.recorder.timeshift._BUFFERS', clear=True)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    @mock.patch('nephos.recorder.timeshift.receiver.attach')
+    def test_start_buffers(self, mock_attach, mock_registry, _):
+        mock_registry.get_by_name.return_value = (0, "ch", "0.0.0.0:1234")
+        config = {'ifaddr': '', 'timeshift': {'channels': {'ch': 30}, 'max_mb': 1}}
+        with mock.patch('nephos.recorder.timeshift.get_recorder_config', return_value=config):
+            self.assertEqual(timeshift.start_buffers(), 1)
+            buffer = timeshift.get_buffer("0.0.0.0:1234")
+            self.assertIsInstance(buffer, MemoryBuffer)
+            self.assertEqual((buffer.max_secs, buffer.max_bytes), (1800, 1024 * 1024))
+            mock_attach.assert_called_with("0.0.0.0:1234", buffer, '')
+
+            # running buffers are left alone, stopped ones are started again
+            self.assertEqual(timeshift.start_buffers(), 0)
+            buffer.close()
+            self.assertIsNone(timeshift.get_buffer("0.0.0.0:1234"))
+            self.assertEqual(timeshift.start_buffers(), 1)
+
+            config['timeshift']['channels'] = {}
+            timeshift.start_buffers()
+        self.assertIsNone(timeshift.get_buffer("0.0.0.0:1234"))
+
+    @mock.patch('nephos.recorder.timeshift.receiver')
+    def test_record_no_buffer(self, mock_receiver, _, __):
+        timeshift.record("0.0.0.0:1234", "/rec/news.ts", 60, 120)
+
+        mock_receiver.record.assert_called_with("0.0.0.0:1234", "/rec/news.ts", 60, "")
+
+    @mock.patch('nephos.recorder.timeshift.PreprocessHandler')
+    def test_clip(self, mock_preprocess, mock_registry, _):
+        mock_registry.get_by_name.return_value = (0, "ch", "0.0.0.0:1234")
+        buffer = MemoryBuffer("ch", 10, 10 ** 9)
+        for _ in range(10):
+            buffer.feed(DATAGRAM)
+        timeshift._BUFFERS["0.0.0.0:1234"] = buffer
+        with tempfile.TemporaryDirectory() as temp_dir, \
+                mock.patch('nephos.recorder.timeshift.__recording_dir__', new=temp_dir):
+            path = timeshift.clip("ch", 5)
+
+            self.assertTrue(os.path.basename(path).startswith("clip_"))
+            self.assertEqual(os.stat(path).st_size, 13160)
+        mock_preprocess.insert_task.assert_called_with(path, "0.0.0.0:1234")
+
+    def test_clip_no_buffer(self, mock_registry, mock_log):
+        mock_registry.get_by_name.return_value = (0, "ch", "0.0.0.0:1234")
+
+        self.assertIsNone(timeshift.clip("ch", 5))
+        self.assertTrue(mock_log.warning.called)
@@ -0,0 +1,104 @@
+from unittest import TestCase, mock
+import os
+import subprocess
+import tempfile
+import time
+
+from nephos.recorder.watchdog import Watchdog, supervise, FINISHED, STALLED, TIMED_OUT
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 100.0
+
+    def monotonic(self):
+        return self.now
+
+
+@mock.patch('nephos.recorder.watchdog.LOG')
+class TestWatchdog(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.temp_dir.name, "news.ts")
+        self.clock = FakeClock()
+        self.patcher = mock.patch('nephos.recorder.watchdog.time', new=self.clock)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.temp_dir.cleanup()
+
+    def write(self, packets):
+        with open(self.path, "ab") as capture:
+            capture.write(b"\x47" * 188 * packets)
+
+    def test_sample(self, _):
+        watchdog = Watchdog(self.path, 30)
+        self.clock.now += 5
+        self.assertEqual(watchdog.sample(), 0)
+        self.assertIsNone(watchdog.first_growth)
+
+        self.write(1000)
+        self.clock.now += 5
+        self.assertEqual(watchdog.sample(), 188000)
+        self.assertEqual(watchdog.packet_rate, 200)
+        self.assertEqual(watchdog.first_growth, 110)
+        self.assertFalse(watchdog.stalled)
+
+    def test_stalled(self, _):
+        watchdog = Watchdog(self.path, 30)
+        self.write(10)
+        self.clock.now += 5
+        watchdog.sample()
+        self.clock.now += 25
+        watchdog.sample()
+        self.assertFalse(watchdog.stalled)
+
+        self.clock.now += 5
+        watchdog.sample()
+        self.assertEqual(watchdog.packet_rate, 0)
+        self.assertTrue(watchdog.stalled)
+
+    def test_never_stalled(self, _):
+        watchdog = Watchdog(self.path, 0)
+        self.clock.now += 3600
+        watchdog.sample()
+        self.assertFalse(watchdog.stalled)
+
+
+@mock.patch('nephos.recorder.watchdog.LOG')
+@mock.patch('nephos.recorder.watchdog.SAMPLE_SECS', new=0.05)
+class TestSupervise(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.temp_dir.name, "news.ts")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_finished(self, mock_log):
+        process = subprocess.Popen(["true"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+        self.assertEqual(supervise(process, Watchdog(self.path, 30)), FINISHED)
+        self.assertTrue(mock_log.debug.called)
+
+    def test_stalled(self, _):
+        process = subprocess.Popen(["sleep", "5"], stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        start = time.monotonic()
+
+        self.assertEqual(supervise(process, Watchdog(self.path, 0.2)), STALLED)
+        self.assertLess(time.monotonic() - start, 3)
+        self.assertIsNotNone(process.returncode)
+
+    def test_timed_out(self, _):
+        process = subprocess.Popen(["sleep", "5"], stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        start = time.monotonic()
+
+        self.assertEqual(supervise(process, Watchdog(self.path, 0), timeout=0.2), TIMED_OUT)
+        self.assertLess(time.monotonic() - start, 3)
+        self.assertIsNotNone(process.returncode)
@@ -2,7 +2,9 @@ from unittest import TestCase, mock
 import os
 import tempfile
 from apscheduler.jobstores.base import ConflictingIdError
-from nephos.scheduler import Scheduler
+from nephos.scheduler import Scheduler, RECORDING_EXECUTOR, PROCESS_EXECUTOR, IO_EXECUTOR, \
+    _preroll_time
+from nephos.recorder.channels import ChannelHandler
 
 TEMP_DIR = tempfile.TemporaryDirectory()
 DB_JOBS_PATH = os.path.join(TEMP_DIR.name, "jobs.db")
@@ -31,6 +33,27 @@ class TestScheduler(TestCase):
         mock_log.warning.assert_called_with("Unknown timezone %s, resetting timezone to 'utc'",
                                             'IST')
 
+    def test_init_executors(self, _):
+        scheduler = Scheduler(True, {'executors': {RECORDING_EXECUTOR: 3}})
+
+        self.assertEqual(scheduler.pool_sizes, {RECORDING_EXECUTOR: 3, PROCESS_EXECUTOR: 2,
+                                                IO_EXECUTOR: 10})
+        for name in scheduler.pool_sizes:
+            self.assertIn(name, scheduler._scheduler._executors)
+
+    def test_start_moves_recording_jobs(self, _):
+        scheduler = Scheduler(True)
+        # as stored by a version with a single executor
+        scheduler._scheduler.add_job(ChannelHandler.record_stream, trigger='cron', hour=0,
+                                     minute=0, id=MOCK_JOB_ID, args=['0.0.0.0:80', 'out', 60])
+        scheduler.start()
+        try:
+            self.assertEqual(scheduler._scheduler.get_job(MOCK_JOB_ID).executor,
+                             RECORDING_EXECUTOR)
+        finally:
+            scheduler.rm_recording_job(MOCK_JOB_ID)
+            scheduler.shutdown()
+
     def test_start_and_shutdown(self, mock_log):
         scheduler = Scheduler(True)
         scheduler.start()
@@ -46,11 +69,41 @@ class TestScheduler(TestCase):
                                     mock.ANY, mock.ANY)
 
         expected = 'Recording job added: %s'
-        self.assertTrue(mock_scheduler._scheduler.add_job.called)
+        self.assertEqual(mock_scheduler._scheduler.add_job.call_args[1]['executor'],
+                         RECORDING_EXECUTOR)
         self.assertIn(expected, mock_log.info.call_args[0])
         self.assertFalse(mock_log.warning.called)
         self.assertFalse(mock_log.debug.called)
 
+    @mock.patch('nephos.scheduler.Scheduler')
+    def test_add_recording_job_live(self, mock_scheduler, mock_log):
+        Scheduler.add_recording_job(mock_scheduler, mock.ANY, mock.ANY, 0, '00:00',
+                                    mock.ANY, mock.ANY, live=True)
+
+        self.assertEqual(mock_scheduler._scheduler.add_job.call_args[1]['kwargs'], {'live': True})
+
+    @mock.patch('nephos.scheduler.Scheduler')
+    def test_add_recording_job_preroll(self, mock_scheduler, _):
+        Scheduler.add_recording_job(mock_scheduler, mock.ANY, mock.ANY, 0, '00:00',
+                                    'mon,sun', mock.ANY, preroll=10)
+
+        kwargs = mock_scheduler._scheduler.add_job.call_args[1]
+        self.assertEqual((kwargs['day_of_week'], kwargs['hour'], kwargs['minute'],
+                          kwargs['second']), ('sun,sat', 23, 59, 50))
+        self.assertEqual(kwargs['kwargs'], {'preroll': 10})
+
+    @mock.patch('nephos.scheduler.Scheduler')
+    def test_add_recording_job_lookback(self, mock_scheduler, _):
+        Scheduler.add_recording_job(mock_scheduler, mock.ANY, mock.ANY, 0, '00:00',
+                                    'mon', mock.ANY, lookback=2)
+
+        self.assertEqual(mock_scheduler._scheduler.add_job.call_args[1]['kwargs'],
+                         {'lookback': 120})
+
+    def test__preroll_time(self, _):
+        self.assertEqual(_preroll_time('20:30', 'fri', 90), ('fri', 20, 28, 30))
+        self.assertEqual(_preroll_time('20:30', 'fri', 0), ('fri', 20, 30, 0))
+
     @mock.patch('nephos.scheduler.Scheduler')
     def test_add_recording_job_error(self, mock_scheduler, mock_log):
         mock_scheduler._scheduler.add_job.side_effect = mock_unique_id_error
@@ -67,7 +120,8 @@ class TestScheduler(TestCase):
         Scheduler.add_necessary_job(mock_scheduler, mock.ANY, mock.ANY, 0)
 
         expected = 'Default job added: %s'
-        self.assertTrue(mock_scheduler._scheduler.add_job.called)
+        self.assertEqual(mock_scheduler._scheduler.add_job.call_args[1]['executor'],
+                         IO_EXECUTOR)
         self.assertIn(expected, mock_log.debug.call_args[0])
 
     def test_get_jobs(self, _):
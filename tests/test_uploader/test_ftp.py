@@ -1,105 +1,129 @@
 from unittest import TestCase, mock
+from concurrent.futures import Future
 import ftplib
+import os
+import socket
+import tempfile
+import threading
+import time
 
-from nephos.uploader.ftp import FTPUploader, FTPFailure
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import FTPHandler
+from pyftpdlib.servers import ThreadedFTPServer
+
+from nephos.manage_db import DBHandler, TaskSinks
+from nephos.uploader import ftp
+from nephos.uploader.ftp import FTPUploader, FTPSession, FTPPool, FTPFailure
 
 
 @mock.patch('nephos.uploader.ftp.FTPUploader')
 @mock.patch('nephos.uploader.ftp.LOG')
 class TestFTPUploader(TestCase):
 
-    @mock.patch('nephos.uploader.ftp.ftplib')
+    @mock.patch('nephos.uploader.ftp.ThreadPoolExecutor')
+    @mock.patch('nephos.uploader.ftp.get_pool')
     @mock.patch('nephos.uploader.ftp.add_to_report')
-    def test___init__(self, mock_report, mock_ftp_lib, mock_log, mock_ftp):
+    def test___init__(self, mock_report, mock_get_pool, _, mock_log, mock_ftp):
         mock_ftp._get_ftp_config.return_value = "test", "test", "test", "test"
+        mock_ftp._get_transfer_config.return_value = 2, 1024, 60
         tasks_list = ["test task"]
         FTPUploader.__init__(mock_ftp, tasks_list)
 
         self.assertTrue(mock_ftp._get_ftp_config.called)
-        self.assertTrue(mock_ftp_lib.FTP.called)
-        self.assertTrue(mock_ftp._auth.called)
-        self.assertTrue(mock_ftp._create_folder.called)
-        self.assertTrue(mock_ftp.ftp.cwd.called)
+        mock_get_pool.assert_called_with("test", "test", "test", "test", 60)
+        self.assertTrue(mock_get_pool.return_value.session.called)
         self.assertTrue(mock_ftp._upload.called)
-        self.assertTrue(mock_report.called)
+        self.assertTrue(mock_ftp._finish.called)
+        self.assertFalse(mock_report.called)
         self.assertFalse(mock_log.warning.called)
 
-    @mock.patch('nephos.uploader.ftp.ftplib')
+    @mock.patch('nephos.uploader.ftp.get_pool')
     @mock.patch('nephos.uploader.ftp.add_to_report')
-    def test___init___empty_config(self, mock_report, mock_ftp_lib, mock_log, mock_ftp):
+    def test___init___empty_config(self, mock_report, mock_get_pool, mock_log, mock_ftp):
         mock_ftp._get_ftp_config.return_value = None, "test", "test", "test"
         tasks_list = ["test task"]
         FTPUploader.__init__(mock_ftp, tasks_list)
 
         self.assertTrue(mock_ftp._get_ftp_config.called)
-        self.assertFalse(mock_ftp_lib.FTP.called)
-        self.assertFalse(mock_ftp._auth.called)
-        self.assertFalse(mock_ftp._create_folder.called)
-        self.assertFalse(mock_ftp.ftp.cwd.called)
+        self.assertFalse(mock_get_pool.called)
         self.assertFalse(mock_ftp._upload.called)
         self.assertTrue(mock_report.called)
         self.assertTrue(mock_log.warning.called)
 
-    @mock.patch('nephos.uploader.ftp.os')
-    def test__upload(self, mock_os, _, mock_ftp):
-        mock_os.path.join.return_value = "test"
-        FTPUploader._upload(mock_ftp, "test_dir")
+    @mock.patch('nephos.uploader.ftp.get_pool')
+    @mock.patch('nephos.uploader.ftp.add_to_report')
+    def test___init___auth_fails(self, mock_report, mock_get_pool, mock_log, mock_ftp):
+        mock_ftp._get_ftp_config.return_value = "test", "test", "test", "test"
+        mock_ftp._get_transfer_config.return_value = 2, 1024, 60
+        mock_get_pool.return_value.session.side_effect = FTPFailure()
+        FTPUploader.__init__(mock_ftp, ["test task"])
 
-        self.assertTrue(mock_ftp._get_name.called)
-        self.assertTrue(mock_os.listdir.called)
-        self.assertTrue(mock_os.path.join.called)
-        self.assertTrue(mock_ftp._get_name.called)
+        self.assertFalse(mock_ftp._upload.called)
 
-    @mock.patch('nephos.uploader.ftp.add_to_report')
-    def test__auth(self, mock_report, mock_log, mock_ftp):
-        FTPUploader._auth(mock_ftp, "test", "test", "test", "test")
+    @mock.patch('nephos.uploader.ftp.os.listdir')
+    def test__upload(self, mock_listdir, _, mock_ftp):
+        mock_listdir.return_value = ["a.mp4", "ffmpeg2pass-0.log.mbtree"]
+        mock_ftp.nephos_ftp_path = "/Nephos"
+        mock_ftp._get_name.side_effect = os.path.basename
+        mock_ftp.pool.session.return_value.__enter__.return_value.make_dir.side_effect = \
+            lambda path: path
+        executor = mock.Mock()
+        uploads = FTPUploader._upload(mock_ftp, executor, "/up/test_dir")
 
-        self.assertTrue(mock_ftp.ftp.connect.called)
-        self.assertFalse(mock_report.called)
-        self.assertFalse(mock_log.error.called)
-        self.assertTrue(mock_ftp.ftp.login.called)
-        self.assertTrue(mock_log.debug.called)
+        self.assertEqual(len(uploads), 1)
+        executor.submit.assert_called_with(mock_ftp._store, "/up/test_dir/a.mp4",
+                                           "/Nephos/test_dir/a.mp4")
 
-    @mock.patch('nephos.uploader.ftp.add_to_report')
-    def test__auth_fail_connection(self, mock_report, mock_log, mock_ftp):
-        mock_ftp.ftp.connect.side_effect = ConnectionError()
-        with self.failUnlessRaises(FTPFailure):
-            FTPUploader._auth(mock_ftp, "test", "test", "test", "test")
+    def test__upload_fails(self, _, mock_ftp):
+        mock_ftp.pool.session.side_effect = FTPFailure()
+        uploads = FTPUploader._upload(mock_ftp, mock.Mock(), "/up/test_dir")
 
-        self.assertTrue(mock_ftp.ftp.connect.called)
-        self.assertTrue(mock_report.called)
-        self.assertTrue(mock_log.error.called)
-        self.assertFalse(mock_ftp.ftp.login.called)
-        self.assertTrue(mock_log.debug.called)
+        with self.assertRaises(FTPFailure):
+            uploads[0].result()
+
+    def test__store_reconnects(self, _, mock_ftp):
+        session = mock_ftp.pool.session.return_value.__enter__.return_value
+        session.store.side_effect = [EOFError(), None]
+        FTPUploader._store(mock_ftp, "file", "/Nephos/file")
+
+        self.assertEqual(session.store.call_count, 2)
 
+    def test__store_fails(self, _, mock_ftp):
+        session = mock_ftp.pool.session.return_value.__enter__.return_value
+        session.store.side_effect = EOFError()
+        with self.assertRaises(EOFError):
+            FTPUploader._store(mock_ftp, "file", "/Nephos/file")
+
+        self.assertEqual(session.store.call_count, ftp.RETRIES + 1)
+
+    @mock.patch('nephos.uploader.ftp.TaskSinks')
     @mock.patch('nephos.uploader.ftp.add_to_report')
-    def test__auth_fail_login(self, mock_report, mock_log, mock_ftp):
-        mock_ftp.ftp.login.side_effect = ftplib.error_perm()
-        with self.failUnlessRaises(FTPFailure):
-            FTPUploader._auth(mock_ftp, "test", "test", "test", "test")
+    def test__finish(self, mock_report, mock_sinks, mock_log, _):
+        upload = Future()
+        upload.set_result(None)
+        FTPUploader._finish((1, "path", "folder"), [upload])
 
-        self.assertTrue(mock_ftp.ftp.connect.called)
-        self.assertTrue(mock_report.called)
-        self.assertTrue(mock_log.error.called)
-        self.assertTrue(mock_ftp.ftp.login.called)
-        self.assertTrue(mock_log.debug.called)
+        mock_sinks.set_status.assert_called_with(1, "ftp", "uploaded")
+        self.assertIn("successfully", mock_report.call_args[0][0])
+        self.assertFalse(mock_log.warning.called)
 
-    def test__create_folder(self, mock_log, mock_ftp):
-        expected = "/test"
-        output = FTPUploader._create_folder(mock_ftp, "test")
+    @mock.patch('nephos.uploader.ftp.TaskSinks')
+    @mock.patch('nephos.uploader.ftp.add_to_report')
+    def test__finish_fails(self, mock_report, mock_sinks, mock_log, _):
+        upload = Future()
+        upload.set_exception(ftplib.error_perm())
+        FTPUploader._finish((1, "path", "folder"), [upload])
 
-        self.assertEqual(expected, output)
-        self.assertTrue(mock_ftp.ftp.mkd.called)
-        self.assertTrue(mock_log.debug.called)
+        mock_sinks.set_status.assert_called_with(1, "ftp", "failed")
+        self.assertIn("failed", mock_report.call_args[0][0])
+        self.assertTrue(mock_log.warning.called)
 
-    def test__create_folder_perm_err(self, mock_log, mock_ftp):
-        mock_ftp.ftp.mkd.side_effect = ftplib.error_perm()
-        expected = ""
-        output = FTPUploader._create_folder(mock_ftp, "test")
+    def test_is_configured(self, _, mock_ftp):
+        mock_ftp._get_ftp_config.return_value = None, None, None, None
+        self.assertFalse(FTPUploader.is_configured())
 
-        self.assertEqual(expected, output)
-        self.assertTrue(mock_ftp.ftp.mkd.called)
-        self.assertTrue(mock_log.debug.called)
+        mock_ftp._get_ftp_config.return_value = "h", 21, "u", "p"
+        self.assertTrue(FTPUploader.is_configured())
 
     @mock.patch('nephos.uploader.ftp.get')
     def test__get_ftp_config_none(self, mock_get, _, __):
@@ -107,7 +131,7 @@ class TestFTPUploader(TestCase):
         FTPUploader._get_ftp_config()
 
         self.assertTrue(mock_get.called)
-        mock_get.assert_called_with(mock.ANY, 'upload.ftp.host')
+        mock_get.assert_called_with(mock.ANY, 'ftp.host')
 
     @mock.patch('nephos.uploader.ftp.get')
     def test__get_ftp_config_not_none(self, mock_get, _, __):
@@ -115,7 +139,22 @@ class TestFTPUploader(TestCase):
         FTPUploader._get_ftp_config()
 
         self.assertTrue(mock_get.called)
-        mock_get.assert_called_with(mock.ANY, 'upload.ftp.password')
+        mock_get.assert_called_with(mock.ANY, 'ftp.password')
+
+    @mock.patch('nephos.uploader.ftp.get_uploader_config')
+    def test__get_ftp_config_upload_section(self, mock_config, _, __):
+        mock_config.return_value = {'ftp': {'host': 'h', 'port': '21', 'username': 'u',
+                                            'password': 'p'}}
+
+        self.assertEqual(FTPUploader._get_ftp_config(), ('h', 21, 'u', 'p'))
+
+    @mock.patch('nephos.uploader.ftp.get_uploader_config')
+    def test__get_transfer_config(self, mock_config, _, __):
+        mock_config.return_value = {'ftp': {'workers': 3, 'block_kb': 8, 'keepalive': 30}}
+        self.assertEqual(FTPUploader._get_transfer_config(), (3, 8192, 30))
+
+        mock_config.return_value = {'ftp': {'host': None}}
+        self.assertEqual(FTPUploader._get_transfer_config(), (2, 65536, 60))
 
     def test__get_name_file(self, _, __):
         expected = "test.tst"
@@ -128,3 +167,226 @@ class TestFTPUploader(TestCase):
         output = FTPUploader._get_name('/home/test')
 
         self.assertEqual(expected, output)
+
+
+@mock.patch('nephos.uploader.ftp.LOG')
+class TestFTPSession(TestCase):
+
+    @mock.patch('nephos.uploader.ftp.ftplib.FTP')
+    @mock.patch('nephos.uploader.ftp.add_to_report')
+    def test__auth(self, mock_report, mock_ftp, mock_log):
+        FTPSession("test", "test", "test", "test")
+
+        self.assertTrue(mock_ftp.return_value.connect.called)
+        self.assertFalse(mock_report.called)
+        self.assertFalse(mock_log.error.called)
+        self.assertTrue(mock_ftp.return_value.login.called)
+        self.assertTrue(mock_log.debug.called)
+
+    @mock.patch('nephos.uploader.ftp.ftplib.FTP')
+    @mock.patch('nephos.uploader.ftp.add_to_report')
+    def test__auth_fail_connection(self, mock_report, mock_ftp, mock_log):
+        mock_ftp.return_value.connect.side_effect = ConnectionError()
+        with self.assertRaises(FTPFailure):
+            FTPSession("test", "test", "test", "test")
+
+        self.assertTrue(mock_report.called)
+        self.assertTrue(mock_log.error.called)
+        self.assertFalse(mock_ftp.return_value.login.called)
+
+    @mock.patch('nephos.uploader.ftp.ftplib.FTP')
+    @mock.patch('nephos.uploader.ftp.add_to_report')
+    def test__auth_fail_login(self, mock_report, mock_ftp, mock_log):
+        mock_ftp.return_value.login.side_effect = ftplib.error_perm()
+        with self.assertRaises(FTPFailure):
+            FTPSession("test", "test", "test", "test")
+
+        self.assertTrue(mock_report.called)
+        self.assertTrue(mock_log.error.called)
+        self.assertTrue(mock_ftp.return_value.close.called)
+
+
+class FTPServerTestCase(TestCase):
+    """
+    Runs a local FTP server, with a single account whose home is a temporary directory.
+    """
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.home = os.path.join(self.temp_dir.name, "home")
+        self.local = os.path.join(self.temp_dir.name, "up")
+        os.makedirs(self.home)
+        os.makedirs(self.local)
+        self.patcher = mock.patch('nephos.manage_db.DB_PATH',
+                                  new=os.path.join(self.temp_dir.name, "storage.db"))
+        self.patcher.start()
+        DBHandler().first_time()
+        authorizer = DummyAuthorizer()
+        authorizer.add_user("nephos", "secret", self.home, perm="elradfmwMT")
+        handler = type("Handler", (FTPHandler, ), {"authorizer": authorizer})
+        self.server = ThreadedFTPServer(("127.0.0.1", 0), handler)
+        self.port = self.server.address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={"timeout": 0.05, "handle_exit": False},
+                                       daemon=True)
+        self.thread.start()
+        self.pools = mock.patch.dict('nephos.uploader.ftp._POOLS', clear=True)
+        self.pools.start()
+        self.config = mock.patch('nephos.uploader.ftp.get_uploader_config', return_value={
+            'ftp': {'host': '127.0.0.1', 'port': self.port, 'username': 'nephos',
+                    'password': 'secret', 'workers': 3, 'block_kb': 1}})
+        self.config.start()
+        self.content = os.urandom(10000)
+
+    def tearDown(self):
+        for pool in ftp._POOLS.values():
+            pool.close()
+        self.config.stop()
+        self.pools.stop()
+        self.server.close_all()
+        self.thread.join()
+        DBHandler.close()
+        self.patcher.stop()
+        self.temp_dir.cleanup()
+
+    def _make_folders(self, count):
+        tasks_list = []
+        for index in range(count):
+            folder = os.path.join(self.local, "ch_{}".format(index))
+            os.makedirs(folder)
+            for name in ("news.mp4", "news.srt", "ffmpeg2pass-0.log.mbtree"):
+                with open(os.path.join(folder, name), "wb") as out_file:
+                    out_file.write(self.content)
+            tasks_list.append((index, "path", folder))
+        return tasks_list
+
+    def _remote(self, *parts):
+        with open(os.path.join(self.home, "Nephos", *parts), "rb") as remote_file:
+            return remote_file.read()
+
+
+@mock.patch('nephos.uploader.ftp.add_to_report')
+class TestFTPUploads(FTPServerTestCase):
+
+    def test_upload(self, mock_report):
+        FTPUploader(self._make_folders(3))
+
+        for index in range(3):
+            self.assertEqual(self._remote("ch_{}".format(index), "news.mp4"), self.content)
+            self.assertEqual(self._remote("ch_{}".format(index), "news.srt"), self.content)
+        self.assertFalse(os.path.exists(os.path.join(self.home, "Nephos", "ch_0",
+                                                     "ffmpeg2pass-0.log.mbtree")))
+        self.assertEqual(mock_report.call_count, 3)
+        self.assertTrue(all("successfully" in call[0][0] for call in mock_report.call_args_list))
+        self.assertTrue(all(TaskSinks.uploaded(index) == {"ftp"} for index in range(3)))
+
+    def test_upload_limited(self, _):
+        with mock.patch('nephos.uploader.ftp.get_limiter') as mock_bucket:
+            FTPUploader(self._make_folders(1))
+
+        consumed = [call[0][0] for call in mock_bucket.return_value.consume.call_args_list]
+        self.assertEqual(sum(consumed), 2 * len(self.content))
+        self.assertTrue(all(amount <= 1024 for amount in consumed))
+
+    def test_upload_reuses_sessions(self, _):
+        with mock.patch('nephos.uploader.ftp.FTPSession', wraps=FTPSession) as mock_session:
+            FTPUploader(self._make_folders(2))
+            created = mock_session.call_count
+            FTPUploader(self._make_folders(0))
+
+        self.assertLessEqual(created, 3)
+        self.assertEqual(mock_session.call_count, created)
+
+    def test_upload_resumes(self, _):
+        tasks_list = self._make_folders(1)
+        os.makedirs(os.path.join(self.home, "Nephos", "ch_0"))
+        with open(os.path.join(self.home, "Nephos", "ch_0", "news.mp4"), "wb") as partial:
+            partial.write(self.content[:4000])
+
+        with mock.patch.object(ftplib.FTP, 'storbinary', autospec=True,
+                               side_effect=ftplib.FTP.storbinary) as mock_store:
+            FTPUploader(tasks_list)
+
+        self.assertEqual(self._remote("ch_0", "news.mp4"), self.content)
+        rests = sorted(str(call[1]['rest']) for call in mock_store.call_args_list)
+        self.assertEqual(rests, ["4000", "None"])
+
+    def test_upload_broken_session(self, _):
+        FTPUploader(self._make_folders(1))
+        # idle sessions dropped by the server are replaced
+        for pool in ftp._POOLS.values():
+            for session in pool._idle:
+                session.ftp.sock.shutdown(socket.SHUT_RDWR)
+        tasks_list = [(1, "path", os.path.join(self.local, "other"))]
+        os.makedirs(tasks_list[0][2])
+        with open(os.path.join(tasks_list[0][2], "news.mp4"), "wb") as out_file:
+            out_file.write(self.content)
+        FTPUploader(tasks_list)
+
+        self.assertEqual(self._remote("other", "news.mp4"), self.content)
+
+
+class TestFTPPool(FTPServerTestCase):
+
+    def test_keepalive(self):
+        pool = ftp.get_pool('127.0.0.1', self.port, 'nephos', 'secret', keepalive=0.05)
+        with pool.session():
+            pass
+        with mock.patch.object(FTPSession, 'alive', autospec=True, return_value=True) as mock_alive:
+            time.sleep(0.3)
+        # the session may be in the middle of a check
+        deadline = time.monotonic() + 2
+        while not pool.idle and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        self.assertGreater(mock_alive.call_count, 1)
+        self.assertEqual(pool.idle, 1)
+
+    def test_keepalive_outside_lock(self):
+        pool = ftp.get_pool('127.0.0.1', self.port, 'nephos', 'secret', keepalive=0.05)
+        with pool.session():
+            pass
+        checking = threading.Event()
+        release = threading.Event()
+
+        def slow_alive(_):
+            checking.set()
+            return release.wait(2)
+
+        with mock.patch.object(FTPSession, 'alive', autospec=True, side_effect=slow_alive):
+            self.assertTrue(checking.wait(2))
+            # the pool stays usable while a session is checked
+            self.assertEqual(pool.idle, 0)
+            release.set()
+        deadline = time.monotonic() + 2
+        while not pool.idle and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual(pool.idle, 1)
+
+    def test_keepalive_drops_broken(self):
+        pool = ftp.get_pool('127.0.0.1', self.port, 'nephos', 'secret', keepalive=0.05)
+        with pool.session() as session:
+            pass
+        session.ftp.sock.shutdown(socket.SHUT_RDWR)
+        deadline = time.monotonic() + 2
+        while pool.idle and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+        self.assertEqual(pool.idle, 0)
+
+    def test_session_error_not_reused(self):
+        pool = ftp.get_pool('127.0.0.1', self.port, 'nephos', 'secret')
+        with self.assertRaises(ftplib.error_perm):
+            with pool.session() as session:
+                session.ftp.voidcmd("BOGUS")
+
+        self.assertEqual(pool.idle, 0)
+        self.assertFalse(session.connected)
+
+    def test_get_pool(self):
+        pool = ftp.get_pool('127.0.0.1', self.port, 'nephos', 'secret')
+
+        self.assertIs(ftp.get_pool('127.0.0.1', self.port, 'nephos', 'secret'), pool)
+        self.assertIsNot(ftp.get_pool('127.0.0.1', self.port, 'nephos', 'secret', 5), pool)
+        self.assertIsInstance(pool, FTPPool)
@@ -1,8 +1,20 @@
 from unittest import TestCase, mock
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import queue
+import tempfile
+import threading
+import time
 
-from googleapiclient.http import UnexpectedBodyError
+from googleapiclient import discovery, discovery_cache
+from googleapiclient.http import UnexpectedBodyError, HttpError, build_http
+from oauth2client.client import AccessTokenRefreshError
 
-from nephos.uploader.gdrive import GDrive, OAuthFailure
+from nephos.manage_db import DBHandler, UploadSessions, TaskSinks
+from nephos.uploader import gdrive
+from nephos.uploader.gdrive import GDrive, OAuthFailure, DiscoveryCache, ShareBatcher
 
 
 class Credentials:
@@ -10,6 +22,9 @@ class Credentials:
         self.invalid = False
 
 
+MOCK_TASK = (0, "path", "store", "ch", "", "", "uploading", 0, "a@b.c")
+
+
 class Response:
     @staticmethod
     def get(_):
@@ -53,43 +68,162 @@ class TestGDrive(TestCase):
     def test__get_upload_service(self, mock_discovery, _, mock_drive):
         GDrive._get_upload_service()
 
-        self.assertTrue(mock_drive._auth_from_file.called)
-        self.assertTrue(mock_discovery.build.called)
+        self.assertTrue(mock_drive._get_credentials.called)
+        self.assertEqual(mock_discovery.build.call_args[1]['cache'], gdrive._DISCOVERY_CACHE)
+
+    @mock.patch('nephos.uploader.gdrive._IDLE_SERVICES', new_callable=queue.LifoQueue)
+    def test__service(self, _, __, mock_drive):
+        mock_drive._get_upload_service.side_effect = lambda: object()
+        with GDrive._service() as first:
+            # a service in use is not lent to another thread
+            with GDrive._service() as second:
+                self.assertIsNot(first, second)
+        with GDrive._service() as reused:
+            self.assertIn(reused, (first, second))
+        self.assertEqual(mock_drive._get_upload_service.call_count, 2)
+
+        mock_drive._get_credentials.return_value = mock.Mock()
+        with GDrive._service() as service:
+            # services authorized by the replaced credentials are dropped
+            self.assertNotIn(service, (first, second))
+
+    @mock.patch('nephos.uploader.gdrive._CREDENTIALS', new=None)
+    @mock.patch('nephos.uploader.gdrive.file')
+    def test__get_credentials(self, _, mock_log, mock_drive):
+        credentials = mock_drive._auth_from_file.return_value
+        credentials.invalid = False
+        credentials.token_expiry = datetime.utcnow() + timedelta(hours=1)
+        GDrive._get_credentials()
+        GDrive._get_credentials()
+
+        self.assertEqual(mock_drive._auth_from_file.call_count, 1)
+        self.assertFalse(credentials.refresh.called)
+
+        credentials.token_expiry = datetime.utcnow() + timedelta(minutes=1)
+        self.assertIs(GDrive._get_credentials(), credentials)
+        self.assertTrue(credentials.refresh.called)
+        self.assertFalse(mock_log.warning.called)
+
+    @mock.patch('nephos.uploader.gdrive._CREDENTIALS', new=None)
+    @mock.patch('nephos.uploader.gdrive.file')
+    def test__get_credentials_refresh_fails(self, _, mock_log, mock_drive):
+        credentials = mock_drive._auth_from_file.return_value
+        credentials.invalid = False
+        credentials.token_expiry = None
+        credentials.refresh.side_effect = AccessTokenRefreshError()
+
+        self.assertIs(GDrive._get_credentials(), credentials)
+        self.assertTrue(mock_log.warning.called)
 
-    @mock.patch('nephos.uploader.gdrive.DBHandler')
     @mock.patch('nephos.uploader.gdrive.add_to_report')
-    def test__upload(self, mock_report, mock_db, mock_log, mock_drive):
-        tasks_list = ["test task"]
-        mock_drive._create_folder.return_value = "test"
+    @mock.patch('nephos.uploader.gdrive.ShareBatcher')
+    @mock.patch('nephos.uploader.gdrive.ThreadPoolExecutor')
+    def test__upload(self, mock_executor, mock_sharer, mock_report, mock_log, mock_drive):
+        tasks_list = ["test task", "test task 2"]
+        mock_drive._get_transfer_config.return_value = 2, 1024
+        mock_drive._start_folder.return_value = "test", []
+        mock_drive._finish_folder.return_value = "uploaded"
+        mock_sharer.return_value.flush.return_value = [("test", "a@b.c")]
         GDrive._upload(tasks_list)
 
-        self.assertTrue(mock_drive._get_upload_service.called)
-        self.assertTrue(mock_drive._set_uploading.called)
-        self.assertTrue(mock_drive._create_folder.called)
-        self.assertTrue(mock_drive._upload_files.called)
-        self.assertTrue(mock_drive._share.called)
+        self.assertTrue(mock_drive._service.called)
+        mock_executor.assert_called_with(max_workers=2)
+        self.assertEqual(mock_drive._start_folder.call_count, 2)
+        self.assertEqual(mock_drive._finish_folder.call_count, 2)
+        self.assertEqual(mock_sharer.return_value.flush.call_count, 1)
+        mock_drive._set_status.assert_has_calls([mock.call("test task", "uploaded"),
+                                                 mock.call("test task 2", "uploaded")])
+        self.assertTrue(mock_report.called)
+        self.assertTrue(mock_drive.upload_log.called)
+
+    @mock.patch('nephos.uploader.gdrive.add_to_report')
+    @mock.patch('nephos.uploader.gdrive.ShareBatcher')
+    @mock.patch('nephos.uploader.gdrive.ThreadPoolExecutor')
+    def test__upload_share_fails(self, _, mock_sharer, __, ___, mock_drive):
+        mock_drive._get_transfer_config.return_value = 2, 1024
+        mock_drive._start_folder.return_value = "test", []
+        mock_drive._finish_folder.return_value = "uploaded"
+        mock_sharer.return_value.flush.side_effect = OSError("test")
+        with self.assertRaises(OSError):
+            GDrive._upload(["test task"])
+
+        mock_drive._set_status.assert_called_with("test task", "failed")
+
+    def test__start_folder(self, _, mock_drive):
+        mock_drive._create_folder.return_value = "test"
+        folder_id, uploads = GDrive._start_folder(mock_drive, mock_drive, MOCK_TASK, 1024)
+
+        self.assertEqual(folder_id, "test")
+        mock_drive._upload_files.assert_called_with(mock_drive, "store", "test", 1024)
+        self.assertEqual(uploads, mock_drive._upload_files.return_value)
+
+    def test__start_folder_fails(self, _, mock_drive):
+        mock_drive._create_folder.side_effect = UnexpectedBodyError("test", "text")
+        folder_id, uploads = GDrive._start_folder(mock_drive, mock_drive, MOCK_TASK, 1024)
+
+        self.assertIsNone(folder_id)
+        self.assertFalse(mock_drive._upload_files.called)
+        with self.assertRaises(UnexpectedBodyError):
+            uploads[0].result()
+
+    @mock.patch('nephos.uploader.gdrive.TaskSinks')
+    @mock.patch('nephos.uploader.gdrive.add_to_report')
+    def test__finish_folder(self, mock_report, mock_sinks, mock_log, mock_drive):
+        upload = mock.Mock()
+        sharer = mock.Mock()
+        status = GDrive._finish_folder(sharer, MOCK_TASK, "test", [upload])
+
+        self.assertTrue(upload.result.called)
+        sharer.add.assert_called_with("test", "a@b.c")
         self.assertTrue(mock_log.debug.called)
-        self.assertTrue(mock_drive._remove.called)
+        self.assertEqual(status, "uploaded")
+        self.assertFalse(mock_sinks.set_status.called)
+        self.assertFalse(mock_drive._remove.called)
         self.assertTrue(mock_report.called)
-        self.assertFalse(mock_db.connect.called)
 
-    @mock.patch('nephos.uploader.gdrive.DBHandler')
+    @mock.patch('nephos.uploader.gdrive.TaskSinks')
     @mock.patch('nephos.uploader.gdrive.add_to_report')
-    def test__upload_folder_fails(self, mock_report, mock_db, mock_log, mock_drive):
-        tasks_list = ["test task"]
-        mock_drive._create_folder.return_value = None
-        mock_drive._upload_files.side_effect = UnexpectedBodyError("test", "text")
-        GDrive._upload(tasks_list)
+    def test__finish_folder_fails(self, mock_report, mock_sinks, mock_log, mock_drive):
+        upload = mock.Mock()
+        upload.result.side_effect = UnexpectedBodyError("test", "text")
+        sharer = mock.Mock()
+        status = GDrive._finish_folder(sharer, MOCK_TASK, "test", [upload])
 
-        self.assertTrue(mock_drive._get_upload_service.called)
-        self.assertTrue(mock_drive._set_uploading.called)
-        self.assertTrue(mock_drive._create_folder.called)
-        self.assertTrue(mock_drive._upload_files.called)
-        self.assertFalse(mock_drive._share.called)
+        self.assertFalse(sharer.add.called)
         self.assertTrue(mock_log.debug.called)
+        self.assertEqual(status, "failed")
+        self.assertFalse(mock_sinks.set_status.called)
         self.assertFalse(mock_drive._remove.called)
         self.assertTrue(mock_report.called)
-        self.assertTrue(mock_db.connect.called)
+
+    @mock.patch('nephos.uploader.gdrive.add_to_report')
+    def test__finish_folder_connection_fails(self, _, __, ___):
+        upload = mock.Mock()
+        upload.result.side_effect = OSError("test")
+        sharer = mock.Mock()
+
+        self.assertEqual(GDrive._finish_folder(sharer, MOCK_TASK, "test", [upload]), "failed")
+        self.assertFalse(sharer.add.called)
+
+    @mock.patch('nephos.uploader.gdrive.TaskSinks')
+    def test__set_status(self, mock_sinks, _, __):
+        GDrive._set_status(MOCK_TASK, "uploaded")
+
+        mock_sinks.set_status.assert_called_with(MOCK_TASK[0], "gdrive", "uploaded")
+
+    @mock.patch('nephos.uploader.gdrive.get_bucket')
+    @mock.patch('nephos.uploader.gdrive.get_uploader_config')
+    def test__get_transfer_config(self, mock_config, mock_bucket, _, __):
+        mock_bucket.return_value.capacity = 16 * 1024 * 1024
+        mock_config.return_value = {'gdrive': {'workers': 6, 'chunk_mb': 1.1}}
+        self.assertEqual(GDrive._get_transfer_config(), (6, 1024 * 1024))
+
+        mock_config.return_value = {}
+        self.assertEqual(GDrive._get_transfer_config(), (4, 8 * 1024 * 1024))
+
+        # a chunk never outgrows the burst of the bandwidth limit
+        mock_bucket.return_value.capacity = 2.4 * 1024 * 1024
+        self.assertEqual(GDrive._get_transfer_config(), (4, 9 * 256 * 1024))
 
     @mock.patch('nephos.uploader.gdrive.os')
     @mock.patch('nephos.uploader.gdrive.shutil')
@@ -148,42 +282,328 @@ class TestGDrive(TestCase):
         self.assertTrue(mock_drive.create.called)
         self.assertTrue(mock_log.debug.called)
 
-    @mock.patch('nephos.uploader.gdrive.os')
-    def test__upload_files(self, mock_os, _, mock_drive):
-        GDrive._upload_files(mock_drive, "test", "test")
+    @mock.patch('nephos.uploader.gdrive.os.listdir')
+    def test__upload_files(self, mock_listdir, _, mock_drive):
+        mock_listdir.return_value = ["a.mp4", "ffmpeg2pass-0.log.mbtree", "b.srt"]
+        uploads = GDrive._upload_files(mock_drive, "test", "test", 1024)
 
-        self.assertTrue(mock_os.path.join.called)
-        self.assertTrue(mock_os.listdir.called)
+        self.assertTrue(mock_listdir.called)
+        mock_drive.submit.assert_called_with(mock_drive._upload_in_worker, "test", "test/b.srt",
+                                             1024)
+        self.assertEqual(mock_drive.submit.call_count, 2)
+        self.assertEqual(len(uploads), 2)
 
+    @mock.patch('nephos.uploader.gdrive.get_limiter')
     @mock.patch('nephos.uploader.gdrive.MediaFileUpload')
-    def test_upload_file(self, mock_media, mock_log, mock_drive):
-        GDrive._upload_file(mock_drive, "test", "test")
+    def test_upload_file(self, mock_media, mock_bucket, mock_log, mock_drive):
+        mock_drive._get_session.return_value = None
+        request = mock_drive.create.return_value
+        request.resumable_uri = None
+        request.resumable_progress = 0
+        request.next_chunk.return_value = None, Response()
+        mock_media.return_value.chunksize.return_value = 1024
+        mock_media.return_value.size.return_value = 100
+        GDrive._upload_file(mock_drive, "test", "test", 1024)
 
         self.assertTrue(mock_drive._get_name.called)
-        self.assertTrue(mock_media.called)
+        self.assertEqual(mock_media.call_args[1]['chunksize'], 1024)
+        mock_bucket.return_value.consume.assert_called_with(100)
         self.assertTrue(mock_drive.create.called)
+        mock_drive._save_session.assert_called_with("test", None)
         self.assertTrue(mock_log.debug.called)
 
-    def test__share(self, _, mock_drive):
-        GDrive._share(mock_drive, mock_drive, "test", "test")
-
-        self.assertTrue(mock_drive.add.called)
-        self.assertTrue(mock_drive.execute.called)
-
     def test__get_mimetype_video(self, _, __):
         expected = "video/mp4"
         output = GDrive._get_mimetype('/home/user/test.mp4')
 
         self.assertEqual(expected, output)
 
-    def test__share_callback(self, mock_log, _):
-        GDrive._share_callback(None, Response(), None)
+    def test__get_mimetype_unknown(self, _, __):
+        output = GDrive._get_mimetype('/home/user/test.xyz')
 
-        self.assertTrue(mock_log.debug.called)
+        self.assertEqual("application/octet-stream", output)
 
-    def test__share_callback_error(self, mock_log, _):
-        GDrive._share_callback(None, None, "test")
 
-        self.assertTrue(mock_log.debug.called)
+class FakeBatch:
+    """
+    Batch request calling back with the error set for an email, if any.
+    """
+
+    def __init__(self, errors, callback):
+        self.errors = errors
+        self.callback = callback
+        self.requests = []
+        self.executed = False
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        assert not self.executed, "a batch is executed once only"
+        self.executed = True
+        for request_id, request in self.requests:
+            email = request["body"]["emailAddress"]
+            errors = self.errors.get(email)
+            if errors:
+                self.callback(request_id, None, errors.pop(0))
+            else:
+                self.callback(request_id, {"id": email}, None)
+
+
+def http_error(status, reason=""):
+    resp = mock.Mock(status=status, reason=reason)
+    content = json.dumps({"error": {"message": reason}}).encode()
+    return HttpError(resp, content)
 
 
+@mock.patch('nephos.uploader.gdrive.time')
+@mock.patch('nephos.uploader.gdrive.LOG')
+class TestShareBatcher(TestCase):
+
+    def setUp(self):
+        self.errors = {}
+        self.batches = []
+        self.service = mock.Mock()
+        self.service.permissions.return_value.create.side_effect = \
+            lambda **request: request
+        self.service.new_batch_http_request.side_effect = self._new_batch
+
+    def _new_batch(self, callback):
+        self.batches.append(FakeBatch(self.errors, callback))
+        return self.batches[-1]
+
+    def test_flush(self, mock_log, mock_time):
+        sharer = ShareBatcher(self.service)
+        for index in range(3):
+            sharer.add("folder{}".format(index),
+                       " ".join("{}_{}@b.c".format(index, mail) for mail in range(50)))
+
+        self.assertEqual(self.batches, [])
+        self.assertEqual(sharer.flush(), [])
+        self.assertEqual([len(batch.requests) for batch in self.batches], [100, 50])
+        self.assertFalse(mock_time.sleep.called)
+        self.assertFalse(mock_log.warning.called)
+        self.assertEqual(sharer.flush(), [])
+        self.assertEqual(len(self.batches), 2)
+
+    def test_flush_retries(self, mock_log, mock_time):
+        self.errors["a@b.c"] = [http_error(403, "User Rate Limit Exceeded"), http_error(503)]
+        self.errors["b@b.c"] = [http_error(404, "File not found")]
+        sharer = ShareBatcher(self.service)
+        sharer.add("folder", "a@b.c b@b.c c@b.c")
+
+        self.assertEqual(sharer.flush(), [("folder", "b@b.c")])
+        # only the transient failure is retried, in a new batch each time
+        self.assertEqual([len(batch.requests) for batch in self.batches], [3, 1, 1])
+        self.assertEqual([call[0][0] for call in mock_time.sleep.call_args_list], [2, 4])
+        self.assertEqual(mock_log.warning.call_count, 1)
+
+    def test_flush_gives_up(self, mock_log, mock_time):
+        self.errors["a@b.c"] = [http_error(500)] * (gdrive.SHARE_RETRIES + 1)
+        sharer = ShareBatcher(self.service)
+        sharer.add("folder", "a@b.c")
+
+        self.assertEqual(sharer.flush(), [("folder", "a@b.c")])
+        self.assertEqual(len(self.batches), gdrive.SHARE_RETRIES + 1)
+
+    def test_flush_batch_fails(self, mock_log, mock_time):
+        sharer = ShareBatcher(self.service)
+        sharer.add("folder", "a@b.c")
+        with mock.patch.object(FakeBatch, 'execute', side_effect=[OSError(), None]):
+            self.assertEqual(sharer.flush(), [])
+
+        self.assertEqual(len(self.batches), 2)
+
+
+class FakeDriveHandler(BaseHTTPRequestHandler):
+    """
+    Serves the parts of the Drive API used by the uploader: folder creation and
+    resumable uploads, failing a chosen chunk with a 503.
+    """
+
+    def log_message(self, *_):
+        pass
+
+    def _reply(self, status, body=None, headers=None):
+        payload = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with self.server.lock:
+            if self.path.startswith("/upload/"):
+                session = str(len(self.server.sessions))
+                self.server.sessions[session] = bytearray()
+                self.server.names[session] = json.loads(body.decode())["name"]
+                location = "http://127.0.0.1:{port}/session/{session}".format(
+                    port=self.server.server_port, session=session)
+                self._reply(200, headers={"Location": location})
+            else:
+                self.server.folders += 1
+                self._reply(200, {"id": "folder" + str(self.server.folders)})
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        session = self.path.rsplit("/", 1)[-1]
+        span, total = self.headers["Content-Range"].split()[1].split("/")
+        with self.server.lock:
+            received = self.server.sessions.get(session)
+            if received is None:
+                self._reply(404)
+                return
+            if span != "*":
+                self.server.chunks += 1
+                if self.server.chunks == self.server.fail_chunk:
+                    self._reply(503)
+                    return
+                received.extend(body)
+                self.server.bytes_received += len(body)
+            if len(received) == int(total):
+                self.server.files[self.server.names[session]] = bytes(received)
+                self._reply(200, {"id": "file" + session})
+            else:
+                headers = {"Range": "bytes=0-{}".format(len(received) - 1)} if received else {}
+                self._reply(308, headers=headers)
+
+
+class FakeDrive(ThreadingHTTPServer):
+    """
+    Local endpoint standing in for the Drive API.
+    """
+
+    def __init__(self):
+        ThreadingHTTPServer.__init__(self, ("127.0.0.1", 0), FakeDriveHandler)
+        self.lock = threading.Lock()
+        self.sessions, self.names, self.files = {}, {}, {}
+        self.folders = self.chunks = self.bytes_received = 0
+        self.fail_chunk = None
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def service(self):
+        document = json.loads(discovery_cache.get_static_doc("drive", "v3"))
+        document['rootUrl'] = "http://127.0.0.1:{port}/".format(port=self.server_port)
+        return discovery.build_from_document(document, http=build_http())
+
+
+@mock.patch('nephos.uploader.gdrive.NUM_RETRIES', new=0)
+class TestGDriveUploads(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.patcher = mock.patch('nephos.manage_db.DB_PATH',
+                                  new=os.path.join(self.temp_dir.name, "storage.db"))
+        self.patcher.start()
+        DBHandler().first_time()
+        self.drive = FakeDrive()
+        self.file_path = os.path.join(self.temp_dir.name, "news.mp4")
+        self.content = os.urandom(5000)
+        with open(self.file_path, "wb") as video:
+            video.write(self.content)
+
+    def tearDown(self):
+        self.drive.shutdown()
+        self.drive.server_close()
+        DBHandler.close()
+        self.patcher.stop()
+        self.temp_dir.cleanup()
+
+    def test_upload_file_chunks(self):
+        file_id = GDrive._upload_file(self.drive.service().files(), "folder", self.file_path,
+                                      1024)
+
+        self.assertEqual(file_id, "file0")
+        self.assertEqual(self.drive.files["news.mp4"], self.content)
+        self.assertEqual(self.drive.chunks, 5)
+        self.assertIsNone(UploadSessions.get(self.file_path, "gdrive"))
+
+    @mock.patch('nephos.uploader.gdrive.get_limiter')
+    def test_upload_file_limited(self, mock_bucket):
+        GDrive._upload_file(self.drive.service().files(), "folder", self.file_path, 1024)
+
+        consumed = [call[0][0] for call in mock_bucket.return_value.consume.call_args_list]
+        self.assertEqual(consumed, [1024, 1024, 1024, 1024, 904])
+
+    def test_upload_file_resume(self):
+        self.drive.fail_chunk = 3
+        with self.assertRaises(HttpError):
+            GDrive._upload_file(self.drive.service().files(), "folder", self.file_path, 1024)
+        self.assertIsNotNone(UploadSessions.get(self.file_path, "gdrive"))
+
+        # a new service, as after a restart, continues the session from the third chunk
+        GDrive._upload_file(self.drive.service().files(), "folder", self.file_path, 1024)
+
+        self.assertEqual(self.drive.files["news.mp4"], self.content)
+        self.assertEqual(len(self.drive.sessions), 1)
+        self.assertEqual(self.drive.bytes_received, len(self.content))
+        self.assertIsNone(UploadSessions.get(self.file_path, "gdrive"))
+
+    def test_upload_file_expired_session(self):
+        UploadSessions.save(self.file_path, "gdrive", "http://127.0.0.1:{port}/session/gone".format(
+            port=self.drive.server_port))
+        GDrive._upload_file(self.drive.service().files(), "folder", self.file_path, 1024)
+
+        self.assertEqual(self.drive.files["news.mp4"], self.content)
+        self.assertEqual(len(self.drive.sessions), 1)
+
+    @mock.patch('nephos.uploader.gdrive._IDLE_SERVICES', new_callable=queue.LifoQueue)
+    @mock.patch('nephos.uploader.gdrive.GDrive._get_credentials')
+    @mock.patch('nephos.uploader.gdrive.add_to_report')
+    @mock.patch('nephos.uploader.gdrive.GDrive.upload_log')
+    @mock.patch('nephos.uploader.gdrive.ShareBatcher.add')
+    @mock.patch('nephos.uploader.gdrive.GDrive._get_transfer_config', return_value=(3, 1024))
+    def test__upload_parallel(self, _, mock_share, __, ___, ____, mock_idle):
+        tasks_list = []
+        for index in range(3):
+            folder = os.path.join(self.temp_dir.name, "ch_{}".format(index))
+            os.makedirs(folder)
+            for name in ("news{}.mp4".format(index), "news{}.srt".format(index)):
+                with open(os.path.join(folder, name), "wb") as out_file:
+                    out_file.write(self.content)
+            tasks_list.append((index, "path", folder, "ch", "", "", "uploading", 0, ""))
+
+        with mock.patch('nephos.uploader.gdrive.GDrive._get_upload_service',
+                        side_effect=self.drive.service) as mock_service:
+            GDrive._upload(tasks_list)
+
+        self.assertEqual(len(self.drive.files), 6)
+        self.assertTrue(all(data == self.content for data in self.drive.files.values()))
+        self.assertEqual(self.drive.folders, 3)
+        self.assertEqual(mock_share.call_count, 3)
+        # the main thread and every upload thread build a service of their own
+        self.assertLessEqual(mock_service.call_count, 4)
+        self.assertEqual(mock_idle.qsize(), mock_service.call_count)
+        # the folders are left to be removed once every sink has them
+        self.assertTrue(all(TaskSinks.uploaded(task[0]) == {"gdrive"} for task in tasks_list))
+
+        # the next run reuses the idle services
+        with mock.patch('nephos.uploader.gdrive.GDrive._get_upload_service') as mock_service:
+            GDrive._upload([])
+        self.assertFalse(mock_service.called)
+
+
+class TestDiscoveryCache(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache = DiscoveryCache(os.path.join(self.temp_dir.name, "cache"), 60)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_get_set(self):
+        self.assertIsNone(self.cache.get("https://discovery/drive"))
+        self.cache.set("https://discovery/drive", "{}")
+
+        self.assertEqual(self.cache.get("https://discovery/drive"), "{}")
+        self.assertIsNone(self.cache.get("https://discovery/sheets"))
+
+    def test_get_expired(self):
+        self.cache.set("https://discovery/drive", "{}")
+        with mock.patch('nephos.uploader.gdrive.time.time', return_value=time.time() + 61):
+            self.assertIsNone(self.cache.get("https://discovery/drive"))
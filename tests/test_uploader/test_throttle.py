@@ -0,0 +1,157 @@
+from unittest import TestCase, mock
+from datetime import datetime, time
+
+from nephos.uploader import throttle
+from nephos.uploader.throttle import TokenBucket, ThroughputMeter, SinkLimiter, get_bucket, \
+    get_limiter, get_throughput, in_time_window
+
+
+@mock.patch('nephos.uploader.throttle.time')
+class TestTokenBucket(TestCase):
+
+    def test_consume(self, mock_time):
+        mock_time.monotonic.return_value = 100.0
+        bucket = TokenBucket(1000, 500)
+
+        self.assertEqual(bucket.consume(500), 0.0)
+        self.assertEqual(bucket.consume(250), 0.25)
+        # the debt of the first sender is paid by the next one too
+        self.assertEqual(bucket.consume(250), 0.5)
+        self.assertEqual(mock_time.sleep.call_count, 2)
+
+    def test_consume_refills(self, mock_time):
+        mock_time.monotonic.return_value = 100.0
+        bucket = TokenBucket(1000, 500)
+        bucket.consume(500)
+        mock_time.monotonic.return_value = 100.25
+
+        self.assertEqual(bucket.consume(250), 0.0)
+        # never more than the capacity, however long idle
+        mock_time.monotonic.return_value = 200.0
+        self.assertEqual(bucket.consume(600), 0.1)
+
+    def test_set_rate(self, mock_time):
+        mock_time.monotonic.return_value = 100.0
+        bucket = TokenBucket(1000, 500)
+        bucket.consume(500)
+        mock_time.monotonic.return_value = 100.25
+        bucket.set_rate(2000)
+
+        # 250 tokens gathered at the previous rate
+        self.assertEqual(bucket.consume(750), 0.25)
+
+    def test_consume_unlimited(self, mock_time):
+        bucket = TokenBucket(0)
+
+        self.assertEqual(bucket.consume(10 ** 9), 0.0)
+        self.assertFalse(mock_time.sleep.called)
+
+
+@mock.patch('nephos.uploader.throttle.time')
+class TestThroughputMeter(TestCase):
+
+    def test_rate(self, mock_time):
+        mock_time.monotonic.return_value = 100.0
+        meter = ThroughputMeter(window=10)
+        meter.add(5000)
+        mock_time.monotonic.return_value = 105.0
+        meter.add(5000)
+
+        self.assertEqual(meter.rate(), 1000)
+        mock_time.monotonic.return_value = 112.0
+        self.assertEqual(meter.rate(), 500)
+        mock_time.monotonic.return_value = 116.0
+        self.assertEqual(meter.rate(), 0)
+
+
+@mock.patch('nephos.uploader.throttle._BUCKET', new=None)
+@mock.patch('nephos.uploader.throttle.get_uploader_config')
+class TestGetBucket(TestCase):
+
+    def test_get_bucket(self, mock_config):
+        mock_config.return_value = {'bandwidth_mbps': 8, 'burst_mb': 2}
+        bucket = get_bucket()
+
+        self.assertEqual(bucket.rate, 1000 * 1000)
+        self.assertEqual(bucket.capacity, 2 * 1024 * 1024)
+        self.assertIs(get_bucket(), bucket)
+
+    def test_get_bucket_reloaded(self, mock_config):
+        mock_config.return_value = {'bandwidth_mbps': 8, 'burst_mb': 2}
+        bucket = get_bucket()
+        mock_config.return_value = {'bandwidth_mbps': 16, 'burst_mb': 2}
+
+        self.assertIsNot(get_bucket(), bucket)
+        self.assertEqual(get_bucket().rate, 2 * 1000 * 1000)
+
+    def test_get_bucket_unlimited(self, mock_config):
+        mock_config.return_value = {'bandwidth_mbps': 0}
+
+        self.assertEqual(get_bucket().rate, 0)
+        self.assertEqual(get_bucket().capacity, throttle.DEFAULT_BURST_MB * 1024 * 1024)
+
+
+@mock.patch('nephos.uploader.throttle._BUCKET', new=TokenBucket(0, 1024 * 1024))
+@mock.patch('nephos.uploader.throttle.datetime')
+@mock.patch('nephos.uploader.throttle.get_uploader_config')
+class TestSinkLimiter(TestCase):
+
+    CONFIG = {'business_hours': '08:00-20:00', 'burst_mb': 1,
+              'ftp': {'business_mbps': 8, 'offpeak_mbps': 80}}
+
+    def test_business_and_offpeak(self, mock_config, mock_datetime):
+        mock_config.return_value = self.CONFIG
+        mock_datetime.strptime.side_effect = datetime.strptime
+        mock_datetime.now.return_value.time.return_value = time(12, 0)
+        limiter = SinkLimiter("ftp")
+
+        self.assertEqual(limiter.bucket.rate, 1000 * 1000)
+        mock_datetime.now.return_value.time.return_value = time(22, 0)
+        with mock.patch.object(limiter.bucket, 'consume', return_value=0.0) as mock_consume:
+            limiter.consume(100)
+
+        self.assertEqual(limiter.bucket.rate, 10 * 1000 * 1000)
+        mock_consume.assert_called_with(100)
+
+    def test_consume_shares_total_limit(self, mock_config, mock_datetime):
+        mock_config.return_value = self.CONFIG
+        mock_datetime.now.return_value.time.return_value = time(12, 0)
+        mock_datetime.strptime.side_effect = datetime.strptime
+        limiter = SinkLimiter("gdrive")
+
+        self.assertEqual(limiter.bucket.rate, 0)
+        with mock.patch.object(throttle._BUCKET, 'consume', return_value=0.5) as mock_total:
+            self.assertEqual(limiter.consume(100), 0.5)
+        mock_total.assert_called_with(100)
+
+    @mock.patch.dict('nephos.uploader.throttle._LIMITERS', clear=True)
+    def test_get_throughput(self, mock_config, mock_datetime):
+        mock_config.return_value = self.CONFIG
+        mock_datetime.now.return_value.time.return_value = time(12, 0)
+        mock_datetime.strptime.side_effect = datetime.strptime
+        limiter = get_limiter("ftp")
+
+        self.assertIs(get_limiter("ftp"), limiter)
+        with mock.patch.object(limiter.bucket, 'consume', return_value=0.0):
+            limiter.consume(10 * 1000 * 1000)
+            get_limiter("gdrive").consume(5 * 1000 * 1000)
+        throughput = get_throughput()
+
+        self.assertEqual(throughput["ftp"], 1000 * 1000)
+        self.assertEqual(throughput["total"], 1500 * 1000)
+
+
+@mock.patch('nephos.uploader.throttle.LOG')
+class TestTimeWindow(TestCase):
+
+    def test_in_time_window(self, mock_log):
+        self.assertTrue(in_time_window("08:00-18:00", time(8, 0)))
+        self.assertFalse(in_time_window("08:00-18:00", time(18, 0)))
+        self.assertTrue(in_time_window("22:00 - 06:00", time(23, 30)))
+        self.assertTrue(in_time_window("22:00 - 06:00", time(5, 59)))
+        self.assertFalse(in_time_window("22:00 - 06:00", time(12, 0)))
+        self.assertFalse(mock_log.warning.called)
+
+    def test_in_time_window_invalid(self, mock_log):
+        self.assertFalse(in_time_window("8-18", time(12, 0)))
+        self.assertTrue(mock_log.warning.called)
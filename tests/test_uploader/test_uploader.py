@@ -1,5 +1,9 @@
 from unittest import TestCase, mock
+import os
+import tempfile
+import threading
 
+from nephos.manage_db import DBHandler, TaskSinks, TSK_ID_INDEX
 from nephos.uploader.uploader import Uploader, DBException
 
 
@@ -18,32 +22,81 @@ class TestUploader(TestCase):
         self.assertTrue(mock_uploader.auth.called)
         self.assertTrue(mock_uploader.service is None)
 
-    @mock.patch('nephos.uploader.uploader.DBHandler')
-    @mock.patch('nephos.uploader.uploader.FTPUploader')
-    def test_begin_uploads(self, mock_ftp, mock_db, mock_log, __):
-        Uploader.begin_uploads(mock_log)
+    @mock.patch('nephos.uploader.uploader.TaskLease')
+    @mock.patch('nephos.uploader.uploader.TaskQueue')
+    def test_begin_uploads(self, mock_queue, mock_lease, mock_log, mock_uploader):
+        mock_queue.claim_next.side_effect = [(0, "test"), None]
+        mock_uploader._get_sinks.return_value = [("gdrive", mock_log), ("ftp", mock_log)]
+        Uploader.begin_uploads(mock_log, "gdrive")
 
-        self.assertTrue(mock_db.connect.called)
+        self.assertEqual(mock_queue.claim_next.call_count, 2)
+        self.assertTrue(mock_lease.called)
         self.assertFalse(mock_log.warning.called)
-        self.assertTrue(mock_ftp.called)
-        self.assertTrue(mock_log.called)
-        self.assertFalse(mock_log.debug.called)
+        self.assertEqual(mock_uploader._run_sink.call_count, 2)
+        mock_uploader._remove_uploaded.assert_called_with([(0, "test")], ["gdrive", "ftp"])
+        self.assertTrue(mock_uploader._release.called)
+
+    @mock.patch('nephos.uploader.uploader.TaskLease')
+    @mock.patch('nephos.uploader.uploader.TaskQueue')
+    def test_begin_uploads_sink_fails(self, mock_queue, _, mock_log, mock_uploader):
+        mock_queue.claim_next.side_effect = [(0, "test"), None]
+        mock_uploader._get_sinks.return_value = [("gdrive", mock_log), ("ftp", mock_log)]
+        mock_uploader._run_sink.side_effect = [IndexError(), None]
+        Uploader.begin_uploads(mock_log, "gdrive")
+
+        self.assertEqual(mock_log.warning.call_count, 1)
+        self.assertTrue(mock_uploader._remove_uploaded.called)
+        self.assertTrue(mock_uploader._release.called)
+
+    @mock.patch('nephos.uploader.uploader.TaskQueue')
+    def test_begin_uploads_empty(self, mock_queue, mock_log, mock_uploader):
+        mock_queue.claim_next.return_value = None
+        Uploader.begin_uploads(mock_log, "gdrive")
+
+        self.assertFalse(mock_uploader._run_sink.called)
+        self.assertTrue(mock_log.debug.called)
 
-    @mock.patch('nephos.uploader.uploader.DBHandler')
-    def test_begin_uploads_fail(self, mock_db, mock_log, _):
-        mock_db.connect.side_effect = DBException()
-        Uploader.begin_uploads(mock_log)
+    @mock.patch('nephos.uploader.uploader.TaskQueue')
+    def test_begin_uploads_fail(self, mock_queue, mock_log, _):
+        mock_queue.claim_next.side_effect = DBException()
+        Uploader.begin_uploads(mock_log, "gdrive")
 
-        self.assertTrue(mock_db.connect.called)
+        self.assertTrue(mock_queue.claim_next.called)
         self.assertTrue(mock_log.warning.called)
         self.assertTrue(mock_log.debug.called)
 
-    @mock.patch('nephos.uploader.uploader.DBHandler')
-    def test_set_uploading(self, mock_db, mock_log, _):
-        Uploader._set_uploading("test")
+    @mock.patch('nephos.uploader.uploader.FTPUploader')
+    def test__get_sinks(self, mock_ftp, mock_log, _):
+        mock_ftp.is_configured.return_value = True
+        self.assertEqual(Uploader._get_sinks(mock_log, "gdrive"),
+                         [("gdrive", mock_log), ("ftp", mock_ftp)])
 
-        self.assertTrue(mock_db.connect.called)
-        self.assertFalse(mock_log.warning.called)
+        mock_ftp.is_configured.return_value = False
+        self.assertEqual(Uploader._get_sinks(mock_log, "gdrive"), [("gdrive", mock_log)])
+
+    @mock.patch('nephos.uploader.uploader.TaskSinks')
+    def test__run_sink(self, mock_sinks, mock_log, _):
+        mock_sinks.uploaded.side_effect = [{"ftp"}, set()]
+        up_func = mock.Mock()
+        Uploader._run_sink("ftp", up_func, [(0, "test"), (1, "test")])
+
+        up_func.assert_called_with([(1, "test")])
+
+    @mock.patch('nephos.uploader.uploader.TaskSinks')
+    def test__run_sink_nothing_pending(self, mock_sinks, mock_log, _):
+        mock_sinks.uploaded.return_value = {"ftp"}
+        up_func = mock.Mock()
+        Uploader._run_sink("ftp", up_func, [(0, "test")])
+
+        self.assertFalse(up_func.called)
+
+    @mock.patch('nephos.uploader.uploader.TaskQueue')
+    def test__release(self, mock_queue, mock_log, _):
+        mock_queue.release.return_value = True
+        Uploader._release([(0, "test"), (1, "test")], "worker")
+
+        mock_queue.release.assert_called_with("upload", 1, "worker")
+        self.assertTrue(mock_log.debug.called)
 
     @mock.patch('nephos.uploader.uploader.DBHandler')
     @mock.patch('nephos.uploader.uploader.shutil')
@@ -62,12 +115,41 @@ class TestUploader(TestCase):
         self.assertTrue(mock_log.debug.called)
         self.assertTrue(mock_uploader._scheduler.add_cron_necessary_job.called)
 
+    def test_add_to_scheduler_continuous(self, mock_log, mock_uploader):
+        mock_uploader._config = {"mode": "continuous", "dispatch": {"interval": 5},
+                                 "timings": {"0": "01:00"}, "repetition": "1111111"}
+        Uploader.add_to_scheduler(mock_uploader)
+
+        mock_uploader._scheduler.add_necessary_job.assert_called_with(
+            mock_uploader.dispatch_uploads, "run_uploader", 5,
+            [mock_uploader._upload, mock_uploader.sink])
+        self.assertFalse(mock_uploader._scheduler.add_cron_necessary_job.called)
+
+    @mock.patch('nephos.uploader.uploader.in_time_window', return_value=False)
+    @mock.patch('nephos.uploader.uploader.get_uploader_config')
+    def test_dispatch_uploads(self, mock_config, mock_window, mock_log, mock_uploader):
+        mock_config.return_value = {"dispatch": {"quiet_hours": "08:00-18:00"}}
+        Uploader.dispatch_uploads(mock_log, "gdrive")
+
+        self.assertEqual(mock_window.call_args[0][0], "08:00-18:00")
+        mock_uploader.begin_uploads.assert_called_with(mock_log, "gdrive")
+
+    @mock.patch('nephos.uploader.uploader.in_time_window', return_value=True)
+    @mock.patch('nephos.uploader.uploader.get_uploader_config')
+    def test_dispatch_uploads_quiet(self, mock_config, _, mock_log, mock_uploader):
+        mock_config.return_value = {"dispatch": {"quiet_hours": "08:00-18:00"}}
+        Uploader.dispatch_uploads(mock_log, "gdrive")
+
+        self.assertFalse(mock_uploader.begin_uploads.called)
+
     def test__rm_old_jobs(self, mock_log, mock_uploader):
-        mock_uploader._scheduler.get_jobs.return_value = [Job("run_uploader@01:00")]
+        mock_uploader._scheduler.get_jobs.return_value = [Job("run_uploader@01:00"),
+                                                          Job("run_uploader"),
+                                                          Job("run_preprocessor")]
         Uploader._rm_old_jobs(mock_uploader)
 
         self.assertTrue(mock_uploader._scheduler.get_jobs.called)
-        self.assertTrue(mock_uploader._scheduler.rm_recording_job.called)
+        self.assertEqual(mock_uploader._scheduler.rm_recording_job.call_count, 2)
         self.assertFalse(mock_log.warning.called)
 
     def test__get_name_file(self, _, __):
@@ -80,4 +162,74 @@ class TestUploader(TestCase):
         expected = "test"
         output = Uploader._get_name('/home/test')
 
-        self.assertEqual(expected, output)
\ No newline at end of file
+        self.assertEqual(expected, output)
+
+
+class TestSinks(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.patcher = mock.patch('nephos.manage_db.DB_PATH',
+                                  new=os.path.join(self.temp_dir.name, "storage.db"))
+        self.patcher.start()
+        DBHandler().first_time()
+        self.folder = os.path.join(self.temp_dir.name, "ch_2019")
+        os.makedirs(self.folder)
+        with DBHandler.connect() as db_cur:
+            DBHandler.insert_data(db_cur, "tasks", {"orig_path": "/rec/ch/news.ts",
+                                                    "store_path": self.folder,
+                                                    "status": "processed"})
+        self.drive = mock.Mock(side_effect=self._sink("gdrive"))
+        self.ftp = mock.Mock(side_effect=self._sink("ftp"))
+        self.failing = set()
+        self.ftp_patcher = mock.patch('nephos.uploader.uploader.FTPUploader', new=self.ftp)
+        self.ftp.is_configured.return_value = True
+        self.ftp_patcher.start()
+
+    def tearDown(self):
+        self.ftp_patcher.stop()
+        DBHandler.close()
+        self.patcher.stop()
+        self.temp_dir.cleanup()
+
+    def _sink(self, name):
+        def upload(tasks_list):
+            status = "failed" if name in self.failing else "uploaded"
+            for task in tasks_list:
+                TaskSinks.set_status(task[TSK_ID_INDEX], name, status)
+        return upload
+
+    def _tasks(self):
+        with DBHandler.connect() as db_cur:
+            db_cur.execute("SELECT status FROM tasks")
+            return [row[0] for row in db_cur.fetchall()]
+
+    def test_removed_once_every_sink_has_it(self):
+        self.failing.add("ftp")
+        Uploader.begin_uploads(self.drive, "gdrive")
+
+        self.assertTrue(os.path.exists(self.folder))
+        self.assertEqual(self._tasks(), ["processed"])
+
+        # only the failed sink uploads the folder again
+        self.failing.clear()
+        Uploader.begin_uploads(self.drive, "gdrive")
+
+        self.assertEqual(self.drive.call_count, 1)
+        self.assertEqual(self.ftp.call_count, 2)
+        self.assertFalse(os.path.exists(self.folder))
+        self.assertEqual(self._tasks(), [])
+        with DBHandler.connect() as db_cur:
+            db_cur.execute("SELECT * FROM task_sinks")
+            self.assertEqual(db_cur.fetchall(), [])
+
+    def test_sinks_run_concurrently(self):
+        barrier = threading.Barrier(2, timeout=5)
+        self.drive.side_effect = lambda tasks_list: (barrier.wait(),
+                                                     self._sink("gdrive")(tasks_list))
+        self.ftp.side_effect = lambda tasks_list: (barrier.wait(),
+                                                   self._sink("ftp")(tasks_list))
+        Uploader.begin_uploads(self.drive, "gdrive")
+
+        self.assertFalse(barrier.broken)
+        self.assertFalse(os.path.exists(self.folder))